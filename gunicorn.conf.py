@@ -26,3 +26,34 @@ timeout = int(os.environ.get("GUNICORN_TIMEOUT", 30))
 
 if settings.DEBUG:
     loglevel = 'debug'
+
+# Load the app in the master process, so that the datasets preloaded there
+# are shared by the forked workers (see msgvis/preload.py)
+preload_app = bool(int(os.environ.get("GUNICORN_PRELOAD", 1)))
+
+# Log the memory of each worker after this many requests
+memory_report_interval = int(os.environ.get("GUNICORN_MEMORY_REPORT_INTERVAL", 1000))
+
+
+def when_ready(server):
+    if preload_app:
+        from msgvis import preload
+        preload.preload_datasets()
+        server.log.info("Preloaded datasets: %s" % preload.format_memory_usage(preload.memory_usage()))
+
+
+def post_fork(server, worker):
+    worker.requests_handled = 0
+
+
+def post_request(worker, req, environ, resp):
+    worker.requests_handled += 1
+    if memory_report_interval and worker.requests_handled % memory_report_interval == 0:
+        from msgvis import preload
+        worker.log.info("Worker %d after %d requests: %s" % (
+            worker.pid, worker.requests_handled, preload.format_memory_usage(preload.memory_usage())))
+
+
+def worker_exit(server, worker):
+    from msgvis import preload
+    server.log.info("Worker %d exiting: %s" % (worker.pid, preload.format_memory_usage(preload.memory_usage())))
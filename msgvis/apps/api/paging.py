@@ -0,0 +1,166 @@
+"""
+Paging of message lists by cursor, for the example message, search and group endpoints.
+
+Messages are listed in order of (time, id). Instead of counting all the matching
+messages and skipping to a page with ``LIMIT/OFFSET``, the ``next`` and ``previous``
+links of a page carry a cursor: the time and id of the last (or first) message on
+it. The next page is then the first few messages after that position, which the
+``(dataset, time)`` index finds as quickly as the first page.
+
+.. code-block:: python
+
+    from msgvis.apps.api import paging
+    page = paging.paginate_messages(messages, page_size=10, cursor=request.query_params.get('cursor'))
+    page.results, page.next_cursor, page.previous_cursor
+
+Page numbers (``?page=3``) still work, for jumping to a page. Totals are counted
+once per query and cached in the data table cache (see :mod:`msgvis.apps.datatable.cache`)
+until the dataset is invalidated. Messages with no time are listed first, as
+MySQL and SQLite sort them.
+"""
+import base64
+import hashlib
+
+from django.db.models import Q
+from django.db.models.query import QuerySet
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.utils import dateparse
+
+from msgvis.apps.datatable.cache import table_cache
+
+# The fields messages are listed in order of
+ORDERING = ('time', 'id')
+
+DEFAULT_PAGE_SIZE = 10
+
+# No page is longer than this
+MAX_PAGE_SIZE = 500
+
+
+def encode_cursor(message, reverse=False):
+    """A cursor for the position of a message, for the messages after it (or before it, if reverse)."""
+    time = message.time.isoformat() if message.time is not None else ""
+    position = "%s|%s|%d" % ('p' if reverse else 'n', time, message.id)
+    return base64.urlsafe_b64encode(position)
+
+
+def decode_cursor(cursor):
+    """Get the (time, id, reverse) of a cursor. Raises ValueError if it is invalid."""
+    try:
+        direction, time, message_id = base64.urlsafe_b64decode(str(cursor)).split('|')
+        message_id = int(message_id)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid cursor %s" % cursor)
+
+    if direction not in ('n', 'p'):
+        raise ValueError("Invalid cursor %s" % cursor)
+    if time:
+        time = dateparse.parse_datetime(time)
+        if time is None:
+            raise ValueError("Invalid cursor %s" % cursor)
+    else:
+        time = None
+    return time, message_id, direction == 'p'
+
+
+def after(messages, time, message_id):
+    """The messages after a position in (time, id) order."""
+    if time is None:
+        return messages.filter(Q(time__isnull=True, id__gt=message_id) | Q(time__isnull=False))
+    return messages.filter(Q(time__gt=time) | Q(time=time, id__gt=message_id))
+
+
+def before(messages, time, message_id):
+    """The messages before a position in (time, id) order."""
+    if time is None:
+        return messages.filter(time__isnull=True, id__lt=message_id)
+    return messages.filter(Q(time__lt=time) | Q(time=time, id__lt=message_id) | Q(time__isnull=True))
+
+
+def count_messages(messages, dataset=None):
+    """
+    Count a queryset of messages, caching the count for the dataset's current version.
+    Lists are just measured.
+    """
+    if not isinstance(messages, QuerySet):
+        return len(messages)
+
+    messages = messages.order_by()
+    if dataset is None or not table_cache.enabled:
+        return messages.count()
+
+    try:
+        sql, params = messages.values('id').query.sql_with_params()
+    except EmptyResultSet:
+        return 0
+
+    dataset_id = getattr(dataset, 'id', dataset)
+    digest = hashlib.md5(repr((sql, params))).hexdigest()
+    key = 'messages:count:%d:%s:%s' % (dataset_id, table_cache.get_version(dataset_id), digest)
+    count = table_cache.cache.get(key)
+    if count is None:
+        count = messages.count()
+        table_cache.cache.set(key, count, table_cache.timeout)
+    return count
+
+
+class MessagePage(object):
+    """One page of messages, with the cursors of the pages before and after it (None at either end)."""
+
+    def __init__(self, results, next_cursor=None, previous_cursor=None):
+        self.results = results
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+
+def _page_by_cursor(messages, page_size, cursor):
+    time, message_id, reverse = decode_cursor(cursor)
+    if reverse:
+        ordering = tuple('-' + field for field in ORDERING)
+        results = list(before(messages, time, message_id).order_by(*ordering)[:page_size + 1])
+        has_more = len(results) > page_size
+        results = results[:page_size]
+        results.reverse()
+        if not results:
+            return MessagePage(results)
+        return MessagePage(results,
+                           next_cursor=encode_cursor(results[-1]),
+                           previous_cursor=encode_cursor(results[0], reverse=True) if has_more else None)
+
+    results = list(after(messages, time, message_id).order_by(*ORDERING)[:page_size + 1])
+    has_more = len(results) > page_size
+    results = results[:page_size]
+    if not results:
+        return MessagePage(results)
+    return MessagePage(results,
+                       next_cursor=encode_cursor(results[-1]) if has_more else None,
+                       previous_cursor=encode_cursor(results[0], reverse=True))
+
+
+def paginate_messages(messages, page_size=DEFAULT_PAGE_SIZE, page=None, cursor=None):
+    """
+    Get a :class:`MessagePage` of a queryset of messages, after (or before) a cursor,
+    or by page number, starting at 1. A cursor takes precedence over a page number.
+    Lists of messages, already in memory, are paged by number, without cursors.
+    Raises ValueError if the cursor or page number is invalid.
+    """
+    page_size = min(max(int(page_size), 1), MAX_PAGE_SIZE)
+    page = int(page or 1)
+    if page < 1:
+        raise ValueError("Invalid page %d" % page)
+    offset = (page - 1) * page_size
+
+    if not isinstance(messages, QuerySet):
+        return MessagePage(list(messages[offset:offset + page_size]))
+
+    if cursor:
+        return _page_by_cursor(messages, page_size, cursor)
+
+    results = list(messages.order_by(*ORDERING)[offset:offset + page_size + 1])
+    has_more = len(results) > page_size
+    results = results[:page_size]
+    if not results:
+        return MessagePage(results)
+    return MessagePage(results,
+                       next_cursor=encode_cursor(results[-1]) if has_more else None,
+                       previous_cursor=encode_cursor(results[0], reverse=True) if page > 1 else None)
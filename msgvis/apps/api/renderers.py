@@ -0,0 +1,34 @@
+"""
+Streaming JSON responses, for large API results.
+
+DRF's :class:`~rest_framework.renderers.JSONRenderer` builds the whole
+response body in memory before sending it. :class:`StreamingJSONResponse`
+encodes the data in chunks as it is sent, with DRF's encoder (so datetimes
+and querysets are encoded the same way) and without spaces between items.
+"""
+from django.http import StreamingHttpResponse
+from rest_framework.utils.encoders import JSONEncoder
+
+# How many encoded pieces to send at once
+CHUNK_SIZE = 4096
+
+
+def iter_json(data, chunk_size=CHUNK_SIZE):
+    """Encode data as compact JSON, yielding byte strings."""
+    encoder = JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+    pieces = []
+    for piece in encoder.iterencode(data):
+        pieces.append(piece)
+        if len(pieces) >= chunk_size:
+            yield u''.join(pieces).encode('utf-8')
+            pieces = []
+    if pieces:
+        yield u''.join(pieces).encode('utf-8')
+
+
+class StreamingJSONResponse(StreamingHttpResponse):
+    """A response that encodes its data as JSON while it is sent."""
+
+    def __init__(self, data, status=None):
+        super(StreamingJSONResponse, self).__init__(iter_json(data), status=status,
+                                                    content_type='application/json; charset=utf-8')
@@ -10,14 +10,16 @@ This module defines serializers for the main API data objects:
     QuestionSerializer
 
 """
-from django.core.paginator import Paginator
-
-from rest_framework import serializers, pagination
+from django.db.models.query import QuerySet
+from rest_framework import serializers
+from rest_framework.templatetags.rest_framework import replace_query_param
 
 import msgvis.apps.corpus.models as corpus_models
 import msgvis.apps.questions.models as questions_models
 import msgvis.apps.enhance.models as enhance_models
 import msgvis.apps.groups.models as groups_models
+from msgvis.apps.datatable.layouts import LAYOUTS
+from msgvis.apps.api import paging
 from msgvis.apps.dimensions import registry
 from django.contrib.auth.models import User
 
@@ -217,20 +219,7 @@ class ExampleMessageSerializer(serializers.Serializer):
     groups = serializers.ListField(child=serializers.IntegerField(), required=False)
     messages = serializers.SerializerMethodField('paginated_messages')
     def paginated_messages(self, obj):
-        request = self.context.get('request')
-        messages_per_page = 10
-        page = 1
-
-        if request and request.query_params.get('page'):
-            page = request.query_params.get('page')
-        if request and request.query_params.get('messages_per_page'):
-            messages_per_page = request.query_params.get('messages_per_page')
-
-        paginator = Paginator(obj["messages"][:], messages_per_page)
-        messages = paginator.page(page)
-
-        serializer = PaginatedMessageSerializer(messages)
-        return serializer.data
+        return paginate_messages(obj["messages"], self.context.get('request'), dataset=obj["dataset"])
 
 
 class KeywordMessageSerializer(serializers.Serializer):
@@ -240,20 +229,7 @@ class KeywordMessageSerializer(serializers.Serializer):
     types_list = serializers.ListField(child=serializers.CharField(), required=False)
 
     def paginated_messages(self, obj):
-        request = self.context.get('request')
-        messages_per_page = 10
-        page = 1
-
-        if request and request.query_params.get('page'):
-            page = request.query_params.get('page')
-        if request and request.query_params.get('messages_per_page'):
-            messages_per_page = request.query_params.get('messages_per_page')
-
-        paginator = Paginator(obj["messages"].all(), messages_per_page)
-        messages = paginator.page(page)
-
-        serializer = PaginatedMessageSerializer(messages)
-        return serializer.data
+        return paginate_messages(obj["messages"], self.context.get('request'), dataset=obj["dataset"])
 
 
 class KeywordListSerializer(serializers.Serializer):
@@ -262,9 +238,41 @@ class KeywordListSerializer(serializers.Serializer):
     keywords = serializers.ListField(child=serializers.CharField(), required=False)
 
 
-class PaginatedMessageSerializer(pagination.PaginationSerializer):
-    class Meta:
-        object_serializer_class = MessageSerializer
+def paginate_messages(messages, request=None, page_size=paging.DEFAULT_PAGE_SIZE, dataset=None, count=None):
+    """
+    Serialize a page of messages like a paginated list, with ``count``, ``next``, ``previous`` and ``results``.
+    The page is chosen by the ``cursor``, ``page`` and ``messages_per_page`` query params
+    (see :mod:`msgvis.apps.api.paging`), and the links to the next and previous pages carry cursors.
+    """
+    page = cursor = None
+    if request:
+        page = request.query_params.get('page')
+        cursor = request.query_params.get('cursor')
+        page_size = request.query_params.get('messages_per_page') or page_size
+
+    if isinstance(messages, QuerySet):
+        # Only the page is serialized, so only its details are loaded
+        messages = corpus_models.select_message_details(messages)
+
+    try:
+        messages_page = paging.paginate_messages(messages, page_size, page=page, cursor=cursor)
+    except ValueError as e:
+        raise serializers.ValidationError(str(e))
+
+    if count is None:
+        count = paging.count_messages(messages, dataset)
+
+    def link(cursor):
+        if request is None or cursor is None:
+            return None
+        return replace_query_param(request.build_absolute_uri(), 'cursor', cursor)
+
+    return {
+        'count': count,
+        'next': link(messages_page.next_cursor),
+        'previous': link(messages_page.previous_cursor),
+        'results': MessageSerializer(messages_page.results, many=True).data,
+    }
 
 
 class GroupSerializer(serializers.ModelSerializer):
@@ -282,16 +290,8 @@ class GroupSerializer(serializers.ModelSerializer):
 
     def paginated_messages(self, obj):
         if self.context and self.context.get('show_message'):
-            paginator = Paginator(obj.messages.all(), 10)
-            page = 1
-            request = self.context.get('request')
-
-            if request and request.query_params.get('page'):
-                page = request.query_params.get('page')
-            messages = paginator.page(page)
-
-            serializer = PaginatedMessageSerializer(messages)
-            return serializer.data
+            # The group stores how many members it has
+            return paginate_messages(obj.messages, self.context.get('request'), count=obj.message_count)
         else:
             return None
 
@@ -336,6 +336,7 @@ class DataTableSerializer(serializers.Serializer):
     search_key = serializers.CharField(allow_null=True, allow_blank=True, required=False)
     mode = serializers.CharField(allow_null=True, allow_blank=True, required=False)
     groups = serializers.ListField(child=serializers.IntegerField(), required=False)
+    layout = serializers.ChoiceField(choices=LAYOUTS, required=False)
 
 class ActionHistorySerializer(serializers.ModelSerializer):
     created_at = serializers.DateTimeField(required=False)
@@ -2,14 +2,23 @@ from rest_framework.test import APITestCase
 from django.core.urlresolvers import reverse
 from rest_framework import status
 
+from datetime import timedelta
 from django.utils import timezone as tz
 from django.db.models import query
+from django.core.cache import cache
+from django.test.utils import override_settings, CaptureQueriesContext
+from django.db import connection
 
 from msgvis.apps.corpus import models as corpus_models
 from msgvis.apps.corpus import utils as corpus_utils
 from msgvis.apps.questions import models as questions_models
 from msgvis.apps.dimensions import models as dimensions_models
+from msgvis.apps.datatable import models as datatable_models
+from msgvis.apps.datatable.cache import table_cache, invalidate_dataset
+from msgvis.apps.groups import models as groups_models
+from msgvis.apps.enhance import models as enhance_models
 import mock
+import json
 
 from msgvis.apps.api.tests import api_time_format, django_time_format
 
@@ -194,6 +203,8 @@ class DataTableViewTest(APITestCase):
             )
         ]
 
+    # The fake filters cannot be part of a cache key
+    @override_settings(DATATABLE_CACHE_ENABLED=False)
     @mock.patch('msgvis.apps.api.serializers.DataTableSerializer')
     @mock.patch('msgvis.apps.datatable.models.DataTable')
     def test_get_datatable_api(self, DataTable, DataTableSerializer):
@@ -250,3 +261,186 @@ class DataTableViewTest(APITestCase):
         #datatable.generate.assert_called_once_with(self.dataset.id, filters, [], 30, None, None, None )
 
         # TODO: write tests for paging and searching
+
+
+@override_settings(DATATABLE_CACHE_ENABLED=True)
+class DataTableCacheTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.dataset = corpus_models.Dataset.objects.create(name="Api test dataset")
+        sender = self.dataset.person_set.create(username='a person')
+        for text in ["i am a message", "another message"]:
+            self.dataset.message_set.create(text=text, sender=sender, time=tz.now())
+        self.group = groups_models.Group.objects.create(dataset=self.dataset, name="a group", keywords="message")
+
+    def test_cached_results(self):
+        """Repeated requests should be answered from the cache until the dataset changes"""
+        url = reverse('data-table')
+        request_data = {
+            'dataset': self.dataset.id,
+            'dimensions': ['sender', 'contains_url'],
+        }
+
+        generate = datatable_models.DataTable.generate
+        with mock.patch.object(datatable_models.DataTable, 'generate',
+                               autospec=True, side_effect=generate) as generate_mock:
+            first = self.client.post(url, request_data, format='json')
+            second = self.client.post(url, request_data, format='json')
+            self.assertEquals(generate_mock.call_count, 1)
+            self.assertEquals(first.data['result'], second.data['result'])
+            self.assertEquals(first.data['result']['table'], [
+                {'sender': 'a person', 'contains_url': False, 'value': 2},
+            ])
+
+            # Editing a group changes the dataset
+            response = self.client.delete(reverse('group') + '?id=%d' % self.group.id)
+            self.assertEquals(response.status_code, status.HTTP_204_NO_CONTENT)
+            self.client.post(url, request_data, format='json')
+            self.assertEquals(generate_mock.call_count, 2)
+
+        stats = table_cache.stats()
+        self.assertEquals((stats['hits'], stats['misses']), (1, 2))
+
+
+class DataTableLayoutTest(APITestCase):
+    def setUp(self):
+        self.dataset = corpus_models.Dataset.objects.create(name="Api test dataset")
+        alice = self.dataset.person_set.create(username='alice')
+        bob = self.dataset.person_set.create(username='bob')
+        for sender, contains_url in [(alice, False), (alice, False), (alice, True), (bob, True)]:
+            self.dataset.message_set.create(text="a message", sender=sender, contains_url=contains_url,
+                                            time=tz.now())
+
+    def post(self, layout):
+        url = reverse('data-table')
+        response = self.client.post(url, {
+            'dataset': self.dataset.id,
+            'dimensions': ['sender', 'contains_url'],
+            'layout': layout,
+        }, format='json')
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        return json.loads(''.join(response.streaming_content))['result']
+
+    def test_columns(self):
+        """Tables should be sent as the positions of the levels of each cell"""
+        result = self.post('columns')
+        table = result['table']
+        self.assertEquals(table['layout'], 'columns')
+        self.assertEquals(table['levels']['sender'], result['domains']['sender'])
+        cells = sorted((table['levels']['sender'][i], table['levels']['contains_url'][j], value)
+                       for i, j, value in zip(table['columns']['sender'], table['columns']['contains_url'],
+                                              table['values']))
+        self.assertEquals(cells, [('alice', False, 2), ('alice', True, 1), ('bob', True, 1)])
+
+    def test_matrix(self):
+        """Tables should be sent as the values of every pair of levels"""
+        table = self.post('matrix')['table']
+        self.assertEquals(table['dimensions'], ['sender', 'contains_url'])
+        senders = table['levels']['sender']
+        urls = table['levels']['contains_url']
+        self.assertEquals(table['values'][senders.index('bob')][urls.index(False)], 0)
+        self.assertEquals(table['values'][senders.index('alice')][urls.index(False)], 2)
+
+    def test_unknown_layout(self):
+        url = reverse('data-table')
+        response = self.client.post(url, {
+            'dataset': self.dataset.id,
+            'dimensions': ['sender'],
+            'layout': 'sideways',
+        }, format='json')
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class MessagePageQueriesTest(APITestCase):
+    def setUp(self):
+        self.dataset = corpus_models.Dataset.objects.create(name="Api test dataset")
+        word = enhance_models.TweetWord.objects.create(dataset=self.dataset, original_text="message",
+                                                       pos="N", text="message")
+        for i in range(12):
+            sender = self.dataset.person_set.create(username="person%d" % i, original_id=i)
+            message = self.dataset.message_set.create(text="message %d" % i, sender=sender,
+                                                      contains_media=True, time=tz.now())
+            message.media.create(type="photo", media_url="http://example.com/photo%d.jpg" % i)
+            message.tweet_words.add(word)
+
+    def count_queries(self, url, messages_per_page, data):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(url + '?messages_per_page=%d' % messages_per_page, data, format='json')
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(len(response.data['messages']['results']), messages_per_page)
+        return len(queries)
+
+    def test_example_messages(self):
+        """A page of example messages should take the same number of queries however long it is"""
+        url = reverse('example-messages')
+        data = {'dataset': self.dataset.id}
+        # The first request caches the count
+        self.count_queries(url, 2, data)
+        self.assertEquals(self.count_queries(url, 2, data), self.count_queries(url, 10, data))
+
+    def test_keyword_messages(self):
+        """A page of search results should take the same number of queries however long it is"""
+        url = reverse('keyword-messages')
+        data = {'dataset': self.dataset.id, 'keywords': "message"}
+        # The first request caches the count
+        self.count_queries(url, 2, data)
+        self.assertEquals(self.count_queries(url, 2, data), self.count_queries(url, 10, data))
+
+
+class MessagePagingTest(APITestCase):
+    def setUp(self):
+        self.dataset = corpus_models.Dataset.objects.create(name="Api test dataset")
+        start = tz.now()
+        # Pairs of messages at the same time, and a couple with no time
+        for i in range(23):
+            self.dataset.message_set.create(text="message %d" % i, time=start + timedelta(minutes=i // 2))
+        for i in range(2):
+            self.dataset.message_set.create(text="no time %d" % i)
+
+        self.expected = list(self.dataset.message_set.order_by('time', 'id').values_list('id', flat=True))
+        self.url = reverse('example-messages')
+
+    def get_page(self, url):
+        response = self.client.post(url, {'dataset': self.dataset.id}, format='json')
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        return response.data['messages']
+
+    def test_cursors(self):
+        """Following the next and previous links should visit every message once, in order"""
+        page = self.get_page(self.url + '?messages_per_page=10')
+        self.assertEquals(page['count'], 25)
+        self.assertIsNone(page['previous'])
+        pages = [[m['id'] for m in page['results']]]
+        while page['next']:
+            self.assertIn('cursor=', page['next'])
+            page = self.get_page(page['next'])
+            pages.append([m['id'] for m in page['results']])
+
+        self.assertEquals([len(ids) for ids in pages], [10, 10, 5])
+        self.assertEquals(sum(pages, []), self.expected)
+
+        page = self.get_page(page['previous'])
+        self.assertEquals([m['id'] for m in page['results']], pages[1])
+
+    def test_page_numbers(self):
+        """Pages should still be found by number"""
+        page = self.get_page(self.url + '?messages_per_page=10&page=3')
+        self.assertEquals([m['id'] for m in page['results']], self.expected[20:])
+        self.assertIsNone(page['next'])
+        self.assertIsNotNone(page['previous'])
+
+    def test_invalid_cursor(self):
+        response = self.client.post(self.url + '?cursor=nonsense', {'dataset': self.dataset.id}, format='json')
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(DATATABLE_CACHE_ENABLED=True)
+    def test_cached_count(self):
+        """The total should be counted once until the dataset is invalidated"""
+        cache.clear()
+        self.assertEquals(self.get_page(self.url)['count'], 25)
+        self.dataset.message_set.create(text="new message", time=tz.now())
+        self.assertEquals(self.get_page(self.url)['count'], 25)
+
+        invalidate_dataset(self.dataset)
+        self.assertEquals(self.get_page(self.url)['count'], 26)
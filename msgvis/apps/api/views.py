@@ -29,10 +29,14 @@ from django.db.models import Count
 from django.contrib.auth.models import User
 
 from msgvis.apps.api import serializers
+from msgvis.apps.api.renderers import StreamingJSONResponse
 from msgvis.apps.corpus import models as corpus_models
 from msgvis.apps.questions import models as questions_models
 from msgvis.apps.datatable import models as datatable_models
+from msgvis.apps.datatable import layouts
+from msgvis.apps.datatable.cache import table_cache, invalidate_dataset
 from msgvis.apps.enhance import models as enhance_models
+from msgvis.apps.enhance import completion
 import msgvis.apps.groups.models as groups_models
 import json
 import logging
@@ -69,8 +73,12 @@ class DataTableView(APIView):
     defines the list of possible values within the selected data
     for each of the dimensions in the request.
 
-    This is the most general output format for results, but later we may
-    switch to a more compact format.
+    This is the most general output format for results. For large tables,
+    the request may ask for a more compact ``layout`` of the table:
+    ``"columns"`` gives the position of each cell's level in each dimension
+    and an array of values, and ``"matrix"`` gives the values of every pair
+    of levels (see :mod:`msgvis.apps.datatable.layouts`). These responses
+    are streamed as compact JSON.
 
     **Request:** ``POST /api/table``
 
@@ -143,17 +151,31 @@ class DataTableView(APIView):
             if data.get('page'):
                 page = max(1, int(data.get('page')))
 
-            if type(filters) == types.ListType and len(filters) == 0 and \
-               type(exclude) == types.ListType and len(exclude) == 0 and len(dimensions) == 1 and dimensions[0].is_categorical():
-                result = dataset.get_precalc_distribution(dimension=dimensions[0], search_key=search_key, page=page, page_size=page_size, mode=mode)
+            cache_key = table_cache.make_key(dataset, dimensions, filters, exclude, mode,
+                                             page, page_size, search_key, groups)
+            found, result = table_cache.get(cache_key)
 
-            else:
+            if not found:
+                if type(filters) == types.ListType and len(filters) == 0 and \
+                   type(exclude) == types.ListType and len(exclude) == 0 and len(dimensions) == 1 and dimensions[0].is_categorical():
+                    result = dataset.get_precalc_distribution(dimension=dimensions[0], search_key=search_key, page=page, page_size=page_size, mode=mode)
+
+                else:
 
-                datatable = datatable_models.DataTable(*dimensions)
-                if mode is not None:
-                    datatable.set_mode(mode)
+                    datatable = datatable_models.DataTable(*dimensions)
+                    if mode is not None:
+                        datatable.set_mode(mode)
 
-                result = datatable.generate(dataset, filters, exclude, page_size, page, search_key, groups)
+                    result = datatable.generate(dataset, filters, exclude, page_size, page, search_key, groups)
+
+                table_cache.set(cache_key, result)
+
+            layout = data.get('layout')
+            if layout is not None and layout != 'rows':
+                # Send the compact layout without serializing every row
+                response_data = serializers.DataTableSerializer(data).data
+                response_data['result'] = layouts.apply_layout(result, [d.key for d in dimensions], layout)
+                return StreamingJSONResponse(response_data, status=status.HTTP_200_OK)
 
             # Just add the result key
             response_data = data
@@ -391,6 +413,9 @@ class GroupView(APIView):
 
             # Just add the messages key to the response
 
+            group.update_members()
+            invalidate_dataset(group.dataset_id)
+
             output = serializers.GroupSerializer(group, context={'request': request, 'show_message': False})
             return Response(output.data, status=status.HTTP_200_OK)
 
@@ -438,6 +463,9 @@ class GroupView(APIView):
                 group.include_types.clear()
                 group.include_types = include_types
 
+            if data.get('keywords') is not None or data.get('types_list') is not None:
+                group.update_members()
+            invalidate_dataset(group.dataset_id)
 
             output = serializers.GroupSerializer(group, context={'request': request, 'show_message': False})
             return Response(output.data, status=status.HTTP_200_OK)
@@ -451,6 +479,7 @@ class GroupView(APIView):
             if group:
                 group.deleted = True
                 group.save()
+                invalidate_dataset(group.dataset_id)
             return Response(status=status.HTTP_204_NO_CONTENT)
 
 
@@ -479,9 +508,8 @@ class KeywordView(APIView):
             }
 
             if request.query_params.get('q') is None:
-                keywords = enhance_models.TweetWord.objects.filter(dataset_id=dataset_id).values('text').distinct()[:20]
-                response_data["keywords"] = keywords
-                output = serializers.KeywordListSerializer(response_data)
+                # The most frequent words
+                response_data["keywords"] = completion.complete(int(dataset_id), "")
             else:
                 q = request.query_params.get('q')
                 response_data["q"] = q
@@ -489,15 +517,13 @@ class KeywordView(APIView):
                 strings = q.split(' ')
                 prefix = " ".join(strings[:-1]) + " "
                 keyword = strings[-1]
-                keywords = enhance_models.PrecalcCategoricalDistribution.objects.filter(dataset_id=dataset_id,
-                                                                                        dimension_key="words",
-                                                                                        level__istartswith=keyword).order_by('-count')
+                keywords = completion.complete(int(dataset_id), keyword)
 
-                response_data["keywords"] = map(lambda x: prefix + x.level, keywords[:20])
-                output = serializers.KeywordListSerializer(response_data)
+                response_data["keywords"] = map(lambda x: prefix + x, keywords)
 
-                for idx, keyword in enumerate(output.data['keywords']):
-                    output.data['keywords'][idx] = {"text": output.data['keywords'][idx]}
+            output = serializers.KeywordListSerializer(response_data)
+            for idx, keyword in enumerate(output.data['keywords']):
+                output.data['keywords'][idx] = {"text": output.data['keywords'][idx]}
 
             #output = serializers.GroupListItemSerializer(group, context={'request': request})
             return Response(output.data, status=status.HTTP_200_OK)
@@ -0,0 +1,248 @@
+"""
+Compressed bitmaps of message ids, for set algebra in the server process.
+
+A :class:`Bitmap` is a set of integers from 0 to 2**32 - 1, split
+roaring-style into chunks of 2**16 values by their upper 16 bits.
+Each chunk is stored either as a sorted array of the lower 16 bits
+(when it has up to 4096 values) or as a packed 65536-bit bitset,
+so that sparse and dense sets of ids both stay small.
+
+.. code-block:: python
+
+    a = Bitmap([1, 2, 3, 100000])
+    b = Bitmap(queryset.values_list('id', flat=True))
+    print len(a & b), len(a | b), len(a - b)
+
+    data = a.serialize()
+    assert Bitmap.deserialize(data) == a
+"""
+import struct
+
+import numpy as np
+
+# The most values stored in an array chunk
+ARRAY_MAX = 4096
+
+CHUNK_BITS = 16
+CHUNK_SIZE = 1 << CHUNK_BITS
+BITSET_BYTES = CHUNK_SIZE / 8
+MAX_VALUE = (1 << 32) - 1
+
+# The number of set bits in each byte
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.int64)
+
+_HEADER = struct.Struct('<I')
+_CHUNK_HEADER = struct.Struct('<HBI')
+_ARRAY = 0
+_BITSET = 1
+
+
+def _is_bitset(chunk):
+    return chunk.dtype == np.uint8
+
+
+def _to_bitset(values):
+    bits = np.zeros(CHUNK_SIZE, dtype=np.bool_)
+    bits[values] = True
+    return np.packbits(bits)
+
+
+def _bit_test(bitset, values):
+    """Which of the values are in the bitset."""
+    return np.unpackbits(bitset)[values].astype(np.bool_)
+
+
+def _cardinality(chunk):
+    if _is_bitset(chunk):
+        return int(_POPCOUNT[chunk].sum())
+    return len(chunk)
+
+
+def _normalize(chunk):
+    """Store a chunk in the smaller form, or return None if it is empty."""
+    if _is_bitset(chunk):
+        count = _cardinality(chunk)
+        if count == 0:
+            return None
+        if count <= ARRAY_MAX:
+            return np.flatnonzero(np.unpackbits(chunk)).astype(np.uint16)
+        return chunk
+
+    if len(chunk) == 0:
+        return None
+    if len(chunk) > ARRAY_MAX:
+        return _to_bitset(chunk)
+    return chunk
+
+
+def _and(a, b):
+    if not _is_bitset(a) and not _is_bitset(b):
+        return _normalize(np.intersect1d(a, b, assume_unique=True))
+    if not _is_bitset(a):
+        return _normalize(a[_bit_test(b, a)])
+    if not _is_bitset(b):
+        return _normalize(b[_bit_test(a, b)])
+    return _normalize(a & b)
+
+
+def _or(a, b):
+    if not _is_bitset(a) and not _is_bitset(b):
+        return _normalize(np.union1d(a, b))
+    if not _is_bitset(a):
+        a = _to_bitset(a)
+    if not _is_bitset(b):
+        b = _to_bitset(b)
+    return a | b
+
+
+def _andnot(a, b):
+    if not _is_bitset(a):
+        if not _is_bitset(b):
+            return _normalize(np.setdiff1d(a, b, assume_unique=True))
+        return _normalize(a[~_bit_test(b, a)])
+    if not _is_bitset(b):
+        b = _to_bitset(b)
+    return _normalize(a & ~b)
+
+
+class Bitmap(object):
+    """A compressed set of integers from 0 to 2**32 - 1."""
+
+    def __init__(self, values=()):
+        """Create a bitmap from any iterable of integers, such as a list of ids."""
+        self._chunks = {}
+
+        if not isinstance(values, np.ndarray):
+            values = np.fromiter(values, dtype=np.int64)
+        values = np.unique(values.astype(np.int64))
+        if len(values) == 0:
+            return
+        if values[0] < 0 or values[-1] > MAX_VALUE:
+            raise ValueError("Bitmaps can only contain integers from 0 to %d" % MAX_VALUE)
+
+        high = values >> CHUNK_BITS
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(high)) + 1))
+        ends = np.concatenate((starts[1:], [len(values)]))
+        for start, end in zip(starts, ends):
+            low = (values[start:end] & (CHUNK_SIZE - 1)).astype(np.uint16)
+            self._chunks[int(high[start])] = _normalize(low)
+
+    @classmethod
+    def _from_chunks(cls, chunks):
+        bitmap = cls()
+        bitmap._chunks = dict((key, chunk) for key, chunk in chunks if chunk is not None)
+        return bitmap
+
+    @classmethod
+    def union_all(cls, bitmaps):
+        """The union of any number of bitmaps."""
+        result = cls()
+        for bitmap in bitmaps:
+            result |= bitmap
+        return result
+
+    def __len__(self):
+        return sum(_cardinality(chunk) for chunk in self._chunks.itervalues())
+
+    def __nonzero__(self):
+        return len(self._chunks) > 0
+
+    def __contains__(self, value):
+        if value < 0 or value > MAX_VALUE:
+            return False
+        chunk = self._chunks.get(value >> CHUNK_BITS)
+        if chunk is None:
+            return False
+        low = value & (CHUNK_SIZE - 1)
+        if _is_bitset(chunk):
+            return bool(chunk[low >> 3] & (0x80 >> (low & 7)))
+        index = np.searchsorted(chunk, low)
+        return index < len(chunk) and chunk[index] == low
+
+    def __iter__(self):
+        return iter(self.to_array().tolist())
+
+    def __eq__(self, other):
+        if not isinstance(other, Bitmap) or sorted(self._chunks) != sorted(other._chunks):
+            return False
+        for key, chunk in self._chunks.iteritems():
+            if not np.array_equal(chunk, other._chunks[key]):
+                return False
+        return True
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __and__(self, other):
+        return Bitmap._from_chunks((key, _and(chunk, other._chunks[key]))
+                                   for key, chunk in self._chunks.iteritems()
+                                   if key in other._chunks)
+
+    def __or__(self, other):
+        chunks = dict(self._chunks)
+        for key, chunk in other._chunks.iteritems():
+            chunks[key] = _or(chunks[key], chunk) if key in chunks else chunk
+        return Bitmap._from_chunks(chunks.iteritems())
+
+    def __sub__(self, other):
+        return Bitmap._from_chunks((key, _andnot(chunk, other._chunks[key]) if key in other._chunks else chunk)
+                                   for key, chunk in self._chunks.iteritems())
+
+    def intersection_count(self, other):
+        """The number of values in both bitmaps, without storing the intersection."""
+        count = 0
+        for key, chunk in self._chunks.iteritems():
+            if key in other._chunks:
+                both = _and(chunk, other._chunks[key])
+                if both is not None:
+                    count += _cardinality(both)
+        return count
+
+    def to_array(self):
+        """The values, in order, as a NumPy array."""
+        parts = []
+        for key in sorted(self._chunks):
+            chunk = self._chunks[key]
+            if _is_bitset(chunk):
+                low = np.flatnonzero(np.unpackbits(chunk))
+            else:
+                low = chunk
+            parts.append((key << CHUNK_BITS) + low.astype(np.int64))
+        if len(parts) == 0:
+            return np.array([], dtype=np.int64)
+        return np.concatenate(parts)
+
+    def tolist(self):
+        return self.to_array().tolist()
+
+    def serialize(self):
+        """Pack the bitmap into a string of bytes, for storage."""
+        parts = [_HEADER.pack(len(self._chunks))]
+        for key in sorted(self._chunks):
+            chunk = self._chunks[key]
+            kind = _BITSET if _is_bitset(chunk) else _ARRAY
+            parts.append(_CHUNK_HEADER.pack(key, kind, len(chunk)))
+            parts.append(chunk.astype(chunk.dtype.newbyteorder('<')).tostring())
+        return b''.join(parts)
+
+    @classmethod
+    def deserialize(cls, data):
+        """Get a bitmap back from :meth:`serialize`."""
+        data = bytes(data)
+        num_chunks, = _HEADER.unpack_from(data, 0)
+        offset = _HEADER.size
+        chunks = []
+        for i in range(num_chunks):
+            key, kind, length = _CHUNK_HEADER.unpack_from(data, offset)
+            offset += _CHUNK_HEADER.size
+            if kind == _BITSET:
+                chunk = np.frombuffer(data, dtype=np.uint8, count=length, offset=offset).copy()
+                offset += length
+            else:
+                chunk = np.frombuffer(data, dtype='<u2', count=length, offset=offset).astype(np.uint16)
+                offset += 2 * length
+            chunks.append((key, chunk))
+        return cls._from_chunks(chunks)
+
+    def __repr__(self):
+        return '<Bitmap of %d values>' % len(self)
@@ -16,20 +16,24 @@ class MappedValuesQuerySet(query.ValuesQuerySet):
         mapped[0]
         # { 'nice_expression': 5 }
 
+    Values may also be converted, by giving a dictionary from
+    field names (before re-mapping) to functions.
     """
 
     def __init__(self, *args, **kwargs):
         super(MappedValuesQuerySet, self).__init__(*args, **kwargs)
         self.field_map = kwargs.get('field_map', {})
+        self.value_map = kwargs.get('value_map', {})
 
     @classmethod
-    def create_from(cls, values_query_set, field_map):
+    def create_from(cls, values_query_set, field_map, value_map=None):
         """Create a MappedValueQuerySet with a field name mapping dictionary."""
-        return values_query_set._clone(cls, field_map=field_map)
+        return values_query_set._clone(cls, field_map=field_map, value_map=value_map or {})
 
     def _clone(self, klass=None, setup=False, **kwargs):
         c = super(MappedValuesQuerySet, self)._clone(klass, setup, **kwargs)
         c.field_map = self.field_map
+        c.value_map = self.value_map
         return c
 
     def iterator(self):
@@ -39,11 +43,16 @@ class MappedValuesQuerySet(query.ValuesQuerySet):
         aggregate_names = list(self.query.aggregate_select)
 
         names = extra_names + field_names + aggregate_names
+        converters = [(i, self.value_map[name]) for i, name in enumerate(names) if name in self.value_map]
 
         # Remap the fields, but fall back on regular name
         names = [self.field_map.get(name, name) for name in names]
 
         for row in self.query.get_compiler(self.db).results_iter():
+            if converters:
+                row = list(row)
+                for i, convert in converters:
+                    row[i] = convert(row[i])
             yield dict(zip(names, row))
 
 
@@ -2,6 +2,7 @@ from django.test import TestCase
 
 import mock
 from templatetags import active
+from msgvis.apps.base.bitmaps import Bitmap
 
 from msgvis.apps.corpus import models as corpus_models
 from django.utils import timezone as tz
@@ -25,6 +26,28 @@ class TemplateTagActiveTest(TestCase):
         self.assertEquals(result, '')
 
 
+class BitmapTest(TestCase):
+    def test_set_algebra(self):
+        """Bitmaps should agree with sets, for both sparse and dense chunks"""
+        a_values = set(range(0, 200000, 3)) | set([70000, 4000000])
+        b_values = set(range(1000, 140000, 2))
+        a = Bitmap(a_values)
+        b = Bitmap(b_values)
+
+        self.assertEquals(len(a), len(a_values))
+        self.assertEquals((a & b).tolist(), sorted(a_values & b_values))
+        self.assertEquals((a | b).tolist(), sorted(a_values | b_values))
+        self.assertEquals((a - b).tolist(), sorted(a_values - b_values))
+        self.assertEquals(a.intersection_count(b), len(a_values & b_values))
+        self.assertIn(4000000, a)
+        self.assertNotIn(4000001, a)
+
+    def test_serialize(self):
+        bitmap = Bitmap([5, 1, 100000] + range(200000, 210000))
+        self.assertEquals(Bitmap.deserialize(bitmap.serialize()), bitmap)
+        self.assertEquals(Bitmap.deserialize(Bitmap().serialize()), Bitmap())
+
+
 class DistributionTestCaseMixins(object):
     """Some utilities for working with distributions"""
 
@@ -41,6 +64,40 @@ class DistributionTestCaseMixins(object):
             description="Created by create_empty_dataset",
         )
 
+    def create_leveled_dataset(self, senders=False, empty_language=False, minutes_apart=1):
+        """
+        Create a dataset of messages in 12 languages with up to 4 hashtags, with a distinct count
+        at each language so that the levels are always sorted the same way, plus a message without
+        a time. Optionally, the messages have one of 3 senders, some have no language, and they
+        are further apart in time. Returns the dataset and the time of its first message.
+        """
+        dataset = self.create_empty_dataset()
+        start = tz.now()
+
+        languages = [corpus_models.Language.objects.create(code="l%d" % i, name="Language %d" % i)
+                     for i in range(12)]
+        hashtags = [corpus_models.Hashtag.objects.create(text="#ht%d" % i) for i in range(4)]
+        people = [corpus_models.Person.objects.create(dataset=dataset, username="person%d" % i)
+                  for i in range(3)]
+
+        idx = 0
+        for lang_idx, language in enumerate(languages + ([None] if empty_language else [])):
+            for i in range(lang_idx + 1):
+                message = corpus_models.Message.objects.create(
+                    dataset=dataset, language=language, sender=people[(idx * idx) % 3] if senders else None,
+                    contains_url=idx % 3 == 0, sentiment=idx % 3 - 1, replied_to_count=idx % 7,
+                    time=start + timedelta(minutes=minutes_apart * idx),
+                )
+                message.hashtags.add(*hashtags[:idx % 5])
+                idx += 1
+
+        corpus_models.Message.objects.create(dataset=dataset, language=languages[0])
+
+        dataset.start_time = start
+        dataset.end_time = start + timedelta(minutes=minutes_apart * idx)
+        dataset.save()
+        return dataset, start
+
     def generate_messages_for_distribution(self, field_name, distribution, many=False, dataset=None):
         """
         Generates a bunch of messages for testing.
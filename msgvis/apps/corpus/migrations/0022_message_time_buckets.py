@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def fill_time_buckets(apps, schema_editor):
+    from msgvis.apps.corpus.models import fill_time_buckets
+    fill_time_buckets()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('corpus', '0021_dataset_has_prefetched_images'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='timestamp',
+            field=models.BigIntegerField(default=None, null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='time_bucket_60',
+            field=models.BigIntegerField(default=None, null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='time_bucket_300',
+            field=models.BigIntegerField(default=None, null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='time_bucket_900',
+            field=models.BigIntegerField(default=None, null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='time_bucket_1800',
+            field=models.BigIntegerField(default=None, null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='time_bucket_3600',
+            field=models.BigIntegerField(default=None, null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='time_bucket_10800',
+            field=models.BigIntegerField(default=None, null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='time_bucket_21600',
+            field=models.BigIntegerField(default=None, null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='time_bucket_43200',
+            field=models.BigIntegerField(default=None, null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='time_bucket_86400',
+            field=models.BigIntegerField(default=None, null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='time_bucket_172800',
+            field=models.BigIntegerField(default=None, null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='time_bucket_604800',
+            field=models.BigIntegerField(default=None, null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='time_bucket_2592000',
+            field=models.BigIntegerField(default=None, null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='time_bucket_7776000',
+            field=models.BigIntegerField(default=None, null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='time_bucket_31536000',
+            field=models.BigIntegerField(default=None, null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AlterIndexTogether(
+            name='message',
+            index_together=set([('dataset', 'original_id'), ('dataset', 'time'),
+                                ('dataset', 'time_bucket_60'),
+                                ('dataset', 'time_bucket_300'),
+                                ('dataset', 'time_bucket_900'),
+                                ('dataset', 'time_bucket_1800'),
+                                ('dataset', 'time_bucket_3600'),
+                                ('dataset', 'time_bucket_10800'),
+                                ('dataset', 'time_bucket_21600'),
+                                ('dataset', 'time_bucket_43200'),
+                                ('dataset', 'time_bucket_86400'),
+                                ('dataset', 'time_bucket_172800'),
+                                ('dataset', 'time_bucket_604800'),
+                                ('dataset', 'time_bucket_2592000'),
+                                ('dataset', 'time_bucket_7776000'),
+                                ('dataset', 'time_bucket_31536000')]),
+        ),
+        migrations.RunPython(fill_time_buckets),
+    ]
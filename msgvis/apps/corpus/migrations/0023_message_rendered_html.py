@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import msgvis.apps.base.models
+
+
+def fill_rendered_html(apps, schema_editor):
+    from msgvis.apps.corpus.models import fill_rendered_html
+    fill_rendered_html()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('corpus', '0022_message_time_buckets'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='rendered_html',
+            field=msgvis.apps.base.models.Utf8TextField(default=None, null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='rendered_html_version',
+            field=models.PositiveSmallIntegerField(default=None, null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.RunPython(fill_rendered_html),
+    ]
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import msgvis.apps.corpus.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('corpus', '0023_message_rendered_html'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dataset',
+            name='table_version',
+            field=models.CharField(default=msgvis.apps.corpus.models.new_table_version, max_length=32),
+            preserve_default=True,
+        ),
+    ]
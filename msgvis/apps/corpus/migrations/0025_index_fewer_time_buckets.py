@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('corpus', '0024_dataset_table_version'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='message',
+            index_together=set([('dataset', 'original_id'), ('dataset', 'time'),
+                                ('dataset', 'time_bucket_3600'),
+                                ('dataset', 'time_bucket_86400'),
+                                ('dataset', 'time_bucket_604800')]),
+        ),
+    ]
@@ -1,6 +1,9 @@
 import operator
-from django.db import models
+import calendar
+import uuid
+from django.db import models, connection, transaction
 from django.db.models import Q
+from django.utils import dateparse, timezone
 from caching.base import CachingManager, CachingMixin
 
 from msgvis.apps.base import models as base_models
@@ -12,6 +15,11 @@ import os
 from msgvis.settings.common import DEBUG
 
 
+def new_table_version():
+    """A version for the data of a dataset that has never been used before."""
+    return uuid.uuid4().hex
+
+
 class Dataset(models.Model):
     """A top-level dataset object containing messages."""
 
@@ -32,6 +40,9 @@ class Dataset(models.Model):
 
     has_prefetched_images = models.BooleanField(default=False)
 
+    table_version = models.CharField(max_length=32, default=new_table_version)
+    """Changed whenever the data of the dataset changes (see :func:`.invalidate_dataset`)"""
+
     @property
     def message_count(self):
         return self.message_set.count()
@@ -56,50 +67,32 @@ class Dataset(models.Model):
             dimension = exclude["dimension"]
 
             # Remove the dimension key
-            params = {key: value for key, value in excludes.iteritems() if key != "dimension"}
+            params = {key: value for key, value in exclude.iteritems() if key != "dimension"}
 
             messages = dimension.exclude(messages, **params)
 
         return messages
 
     def get_example_messages_by_groups(self, groups, filters=[], excludes=[]):
+        """Get example messages in any of the groups, given some filters (like :meth:`get_example_messages`)"""
         include_groups = map(lambda x: int(x['value']), filter(lambda x: x['dimension'].key=='groups', filters))
         if len(include_groups)> 0:
             groups = include_groups
         exclude_groups = map(lambda x: int(x['value']), filter(lambda x: x['dimension'].key=='groups', excludes))
         groups = filter(lambda x: x not in exclude_groups, groups)
 
-        per_group = int(10 / len(groups))
-        combined_messages = []
-        group_querysets = []
-        for group in groups:
-            group_obj = self.groups.get(id=group)
-            messages = group_obj.messages
-            for filterA in filters:
-                dimension = filterA["dimension"]
-
-                # Remove the dimension key
-                params = {key: value for key, value in filterA.iteritems() if key != "dimension"}
-                messages = dimension.filter(messages, **params)
-
-            for exclude in excludes:
-                dimension = exclude["dimension"]
-
-                # Remove the dimension key
-                params = {key: value for key, value in excludes.iteritems() if key != "dimension"}
-
-                messages = dimension.exclude(messages, **params)
-
-            group_querysets.append(messages)
-            #combined_messages.extend(messages[:per_group])
-        query = ""
-        for idx, queryset in enumerate(group_querysets):
-            if idx > 0:
-                query += " UNION "
-            query += "(%s)" %(utils.quote(str(queryset.query)))
-        query = utils.convert_boolean(query)
-        queryset = Message.objects.raw(query)
-        return queryset
+        filters = filter(lambda x: x['dimension'].key != 'groups', filters)
+        excludes = filter(lambda x: x['dimension'].key != 'groups', excludes)
+
+        for group in self.groups.filter(id__in=groups):
+            group.ensure_members()
+
+        # A semi-join on the memberships, rather than a join that needs DISTINCT,
+        # so pages of the messages can be read without collecting all of them
+        Membership = self.groups.model.members.through
+        members = Membership.objects.filter(group_id__in=groups).values('message_id')
+        messages = self.get_example_messages(filters, excludes)
+        return messages.filter(id__in=members)
 
     def get_dictionary(self):
         dictionary = self.dictionary.all()
@@ -109,48 +102,46 @@ class Dataset(models.Model):
         return None
 
     def get_advanced_search_results(self, keywords_text, include_types):
-
-        clauses = keywords_text.split(',')
-        inclusive_keywords = []
-        exclusive_keywords = []
-        queryset = self.tweet_words.all()
+        """
+        Find the messages matching keywords like "soup food,NOT ladies".
+        Messages must contain all the words of one of the comma separated clauses,
+        and not all the words of any clause starting with "NOT ". Words are matched
+        by their lemma, and words that do not occur in the dataset are ignored.
+
+        Uses the word index of the dataset if it has been built
+        (see :mod:`msgvis.apps.enhance.word_index`).
+        """
+        from msgvis.apps.enhance import word_index
+
+        clauses = utils.parse_keyword_clauses(keywords_text)
         message_queryset = self.message_set.all()
         if (len(include_types) > 0):
             message_queryset = message_queryset.filter(utils.levels_or('type__name', map(lambda x: x.name, include_types)))
-        final_queryset = self.message_set.none()
-        for clause in clauses:
-            if clause.startswith("NOT "):
-                words = clause[4:].split(' ')
-                word_list = utils.get_word_objs(queryset=queryset, text_field_name='original_text', related_field_name="tweet_words__id", words=words)
-                if len(word_list) > 0:
-                    # TODO: makes this real AND
-                    #and_word_list = reduce(operator.or_, word_list)
-                    exclusive_keywords.extend(word_list)
-
-            else:
-                words = clause.split(' ')
-                word_list = utils.get_word_objs(queryset=queryset, text_field_name='original_text', related_field_name="tweet_words__id", words=words)
-                if len(word_list) > 0:
-                    #and_word_list = reduce(operator.and_, word_list)
-                    #inclusive_keywords.append(and_word_list)
-                    clause_queryset = message_queryset
-                    for or_word_list in word_list:
-                        clause_queryset = clause_queryset.filter(or_word_list)
 
+        message_ids = word_index.search_messages(self, clauses)
+        if message_ids is not None:
+            return message_queryset.filter(id__in=message_ids)
 
+        queryset = self.tweet_words.all()
+        final_queryset = self.message_set.none()
+        exclusive_querysets = []
+        for exclude, words in clauses:
+            word_list = utils.get_word_objs(queryset=queryset, text_field_name='original_text', related_field_name="tweet_words__id", words=words)
+            if len(word_list) > 0:
+                clause_queryset = self.message_set.all() if exclude else message_queryset
+                for or_word_list in word_list:
+                    clause_queryset = clause_queryset.filter(or_word_list)
+
+                if exclude:
+                    exclusive_querysets.append(clause_queryset)
+                else:
                     final_queryset |= clause_queryset
 
-
         queryset = final_queryset
 
-
-        #if len(inclusive_keywords) > 0:
-        #    inclusive_keywords = reduce(operator.or_, inclusive_keywords)
-        #    queryset = queryset.filter(inclusive_keywords)
-
-        if len(exclusive_keywords) > 0:
-            for word in exclusive_keywords:
-                queryset = queryset.exclude(word)
+        # Leave out the messages with all the words of an exclusive clause
+        for clause_queryset in exclusive_querysets:
+            queryset = queryset.exclude(id__in=clause_queryset.values('id'))
 
         return queryset.distinct()
 
@@ -334,6 +325,133 @@ class Person(models.Model):
         return url
         
 
+# The sizes of the time bins (in seconds) each message stores the start of its bin at:
+# the steps of :attr:`.TimeDimension.d3_time_scaleSteps` from one minute to a year.
+TIME_BUCKET_SIZES = (60, 300, 900, 1800, 3600, 10800, 21600, 43200,
+                     86400, 172800, 604800, 2592000, 7776000, 31536000)
+
+# The time bins with a (dataset, bin) index, for grouping messages by time with an index-only scan:
+# hours, days and weeks, which histograms of datasets from a few days to a few years use.
+# Each index slows down imports, so the other bins are only grouped on as plain columns.
+INDEXED_TIME_BUCKET_SIZES = (3600, 86400, 604800)
+
+# Epoch seconds of the message time, for filling in the time bins in SQL
+TIMESTAMP_EXPRESSIONS = {
+    'mysql': "TIMESTAMPDIFF(SECOND, '1970-01-01', `time`)",
+    'sqlite': "CAST(STRFTIME('%%s', `time`) AS INTEGER)",
+}
+
+# The start of the time bin for epoch seconds
+TIME_BUCKET_EXPRESSIONS = {
+    'mysql': "{bin_size} * FLOOR({timestamp} / {bin_size})",
+    'sqlite': "{bin_size} * ({timestamp} / {bin_size})",
+}
+
+# How many messages to fill in the time bins of at once
+TIME_BUCKET_BATCH_SIZE = 50000
+
+
+def get_time_bucket_field(bin_size):
+    """The name of the :class:`Message` field storing the start of its time bin of a size, or None."""
+    if bin_size in TIME_BUCKET_SIZES:
+        return 'time_bucket_%d' % bin_size
+    return None
+
+
+def get_time_buckets(time):
+    """The epoch seconds of a time and the starts of its time bins, as a dict of :class:`Message` field values."""
+    if isinstance(time, basestring):
+        time = dateparse.parse_datetime(time)
+    if time is None:
+        timestamp = None
+    else:
+        if timezone.is_naive(time):
+            time = timezone.make_aware(time, timezone.get_default_timezone())
+        timestamp = calendar.timegm(time.utctimetuple())
+
+    values = {'timestamp': timestamp}
+    for bin_size in TIME_BUCKET_SIZES:
+        values[get_time_bucket_field(bin_size)] = None if timestamp is None else bin_size * (timestamp // bin_size)
+    return values
+
+
+def fill_time_buckets(dataset=None, batch_size=TIME_BUCKET_BATCH_SIZE):
+    """
+    Set the epoch seconds and time bins of all the messages (in a dataset) from their times,
+    for messages stored before they were added. Returns the number of messages updated.
+    """
+    vendor = connection.vendor
+    timestamp = TIMESTAMP_EXPRESSIONS[vendor]
+    assignments = ["`timestamp` = %s" % timestamp]
+    for bin_size in TIME_BUCKET_SIZES:
+        expression = TIME_BUCKET_EXPRESSIONS[vendor].format(bin_size=bin_size, timestamp=timestamp)
+        assignments.append("`%s` = %s" % (get_time_bucket_field(bin_size), expression))
+
+    sql = "UPDATE `%s` SET %s WHERE `id` >= %%s AND `id` < %%s" % (Message._meta.db_table, ", ".join(assignments))
+    if dataset is not None:
+        sql += " AND `dataset_id` = %d" % getattr(dataset, 'id', dataset)
+
+    messages = Message.objects.all()
+    if dataset is not None:
+        messages = messages.filter(dataset=dataset)
+    id_range = messages.aggregate(min=models.Min('id'), max=models.Max('id'))
+    if id_range['min'] is None:
+        return 0
+
+    updated = 0
+    cursor = connection.cursor()
+    for start in xrange(id_range['min'], id_range['max'] + 1, batch_size):
+        with transaction.atomic():
+            cursor.execute(sql, [start, start + batch_size])
+            updated += cursor.rowcount
+    return updated
+
+
+# How many messages to render the html of at once
+RENDERED_HTML_BATCH_SIZE = 5000
+
+
+def get_rendered_html(text):
+    """The html of a message's text and the version of the renderer, as a dict of :class:`Message` field values."""
+    return {
+        'rendered_html': utils.render_html_tag(text or ""),
+        'rendered_html_version': utils.RENDER_HTML_VERSION,
+    }
+
+
+def fill_rendered_html(dataset=None, force=False, batch_size=RENDERED_HTML_BATCH_SIZE):
+    """
+    Store the html of all the messages (in a dataset) that have none, or that were rendered
+    by another version of :func:`.utils.render_html_tag`, or all of them if forced.
+    Returns the number of messages rendered.
+    """
+    messages = Message.objects.all()
+    if dataset is not None:
+        messages = messages.filter(dataset=dataset)
+    if not force:
+        messages = messages.exclude(rendered_html_version=utils.RENDER_HTML_VERSION)
+
+    sql = "UPDATE `%s` SET `rendered_html` = %%s, `rendered_html_version` = %%s WHERE `id` = %%s" % \
+          Message._meta.db_table
+
+    rendered = 0
+    last_id = 0
+    cursor = connection.cursor()
+    while True:
+        rows = list(messages.filter(id__gt=last_id).order_by('id').values_list('id', 'text')[:batch_size])
+        if not rows:
+            return rendered
+
+        params = []
+        for message_id, text in rows:
+            values = get_rendered_html(text)
+            params.append((values['rendered_html'], values['rendered_html_version'], message_id))
+        with transaction.atomic():
+            cursor.executemany(sql, params)
+
+        rendered += len(rows)
+        last_id = rows[-1][0]
+
 
 class Message(models.Model):
     """
@@ -343,7 +461,7 @@ class Message(models.Model):
         index_together = (
             ('dataset', 'original_id'),  # used by importer
             ('dataset', 'time'),
-        )
+        ) + tuple(('dataset', get_time_bucket_field(bin_size)) for bin_size in INDEXED_TIME_BUCKET_SIZES)
             
     dataset = models.ForeignKey(Dataset)
     """Which :class:`Dataset` the message belongs to"""
@@ -360,6 +478,26 @@ class Message(models.Model):
     time = models.DateTimeField(null=True, blank=True, default=None)
     """The :py:class:`datetime.datetime` (in UTC) when the message was sent"""
 
+    timestamp = models.BigIntegerField(null=True, blank=True, default=None)
+    """The time of the message in seconds since the epoch"""
+
+    # The start of the message's time bin of each size, in seconds since the epoch
+    # (see :data:`TIME_BUCKET_SIZES`), for grouping messages by time on plain integer columns
+    time_bucket_60 = models.BigIntegerField(null=True, blank=True, default=None)
+    time_bucket_300 = models.BigIntegerField(null=True, blank=True, default=None)
+    time_bucket_900 = models.BigIntegerField(null=True, blank=True, default=None)
+    time_bucket_1800 = models.BigIntegerField(null=True, blank=True, default=None)
+    time_bucket_3600 = models.BigIntegerField(null=True, blank=True, default=None)
+    time_bucket_10800 = models.BigIntegerField(null=True, blank=True, default=None)
+    time_bucket_21600 = models.BigIntegerField(null=True, blank=True, default=None)
+    time_bucket_43200 = models.BigIntegerField(null=True, blank=True, default=None)
+    time_bucket_86400 = models.BigIntegerField(null=True, blank=True, default=None)
+    time_bucket_172800 = models.BigIntegerField(null=True, blank=True, default=None)
+    time_bucket_604800 = models.BigIntegerField(null=True, blank=True, default=None)
+    time_bucket_2592000 = models.BigIntegerField(null=True, blank=True, default=None)
+    time_bucket_7776000 = models.BigIntegerField(null=True, blank=True, default=None)
+    time_bucket_31536000 = models.BigIntegerField(null=True, blank=True, default=None)
+
     language = models.ForeignKey(Language, null=True, blank=True, default=None)
     """The :class:`Language` of the message."""
 
@@ -411,10 +549,47 @@ class Message(models.Model):
     text = base_models.Utf8TextField(null=True, blank=True, default="")
     """The actual text of the message."""
 
+    rendered_html = base_models.Utf8TextField(null=True, blank=True, default=None)
+    """The text of the message as html, with its hashtags, mentions and links marked up."""
+
+    rendered_html_version = models.PositiveSmallIntegerField(null=True, blank=True, default=None)
+    """The :data:`.utils.RENDER_HTML_VERSION` the html was rendered with."""
+
+    def set_time_buckets(self):
+        """Set the epoch seconds and time bins of the message from its time."""
+        for name, value in get_time_buckets(self.time).iteritems():
+            setattr(self, name, value)
+
+    def set_rendered_html(self):
+        """Render the html of the message from its text."""
+        for name, value in get_rendered_html(self.text).iteritems():
+            setattr(self, name, value)
+
+    def __init__(self, *args, **kwargs):
+        super(Message, self).__init__(*args, **kwargs)
+        self._saved_time_and_text = self._time_and_text()
+
+    def _time_and_text(self):
+        # Deferred fields are not loaded just to compare them
+        return self.__dict__.get('time'), self.__dict__.get('text')
+
+    def save(self, *args, **kwargs):
+        # The time bins and html are only found again when the time or text changed
+        saved_time, saved_text = self._saved_time_and_text
+        time, text = self._time_and_text()
+        if self._state.adding or time != saved_time:
+            self.set_time_buckets()
+        if self._state.adding or text != saved_text:
+            self.set_rendered_html()
+        super(Message, self).save(*args, **kwargs)
+        self._saved_time_and_text = self._time_and_text()
+
     @property
     def embedded_html(self):
         #return utils.get_embedded_html(self.original_id)
-        return utils.render_html_tag(self.text)
+        if self.rendered_html is not None and self.rendered_html_version == utils.RENDER_HTML_VERSION:
+            return self.rendered_html
+        return utils.render_html_tag(self.text or "")
 
     @property
     def media_url(self):
@@ -436,5 +611,10 @@ class Message(models.Model):
         return self.__repr__()
 
 
-
-
+def select_message_details(messages):
+    """
+    Load the datasets, senders and media of some messages along with them,
+    since displaying a message (see :class:`.MessageSerializer`) reads them all.
+    Otherwise each message on a page would query them separately.
+    """
+    return messages.select_related('dataset', 'sender', 'sender__dataset').prefetch_related('media')
@@ -4,6 +4,7 @@ from unittest import skip
 from django.test import TestCase
 
 from msgvis.apps.corpus import models as corpus_models
+from msgvis.apps.corpus import utils as corpus_utils
 from msgvis.apps.dimensions import registry
 
 class DatasetModelTest(TestCase):
@@ -26,6 +27,78 @@ class MessageModelTest(TestCase):
         self.assertEquals(msgs.count(), 1)
         self.assertEquals(msgs.first().text, "Some text")
 
+    def test_time_buckets(self):
+        """Messages should store the start of their time bins of each size in epoch seconds."""
+        msg = corpus_models.Message.objects.create(dataset=self.dataset, text="Some text",
+                                                   time="2015-02-02T01:19:02Z")
+        msg = corpus_models.Message.objects.get(id=msg.id)
+        self.assertEquals(msg.timestamp, 1422839942)
+        self.assertEquals(msg.time_bucket_60, 1422839940)
+        self.assertEquals(msg.time_bucket_3600, 1422838800)
+        self.assertEquals(msg.time_bucket_86400, 1422835200)
+
+        msg = corpus_models.Message.objects.create(dataset=self.dataset, text="No time")
+        self.assertIsNone(msg.timestamp)
+        self.assertIsNone(msg.time_bucket_60)
+
+    def test_time_bucket_indexes(self):
+        """The hour, day and week bins should be indexed with the dataset, for grouping on the index."""
+        indexes = corpus_models.Message._meta.index_together
+        for field in ('time_bucket_3600', 'time_bucket_86400', 'time_bucket_604800'):
+            self.assertIn(('dataset', field), indexes)
+
+    def test_fill_time_buckets(self):
+        """Time bins should be filled in for messages stored without them."""
+        msg = corpus_models.Message.objects.create(dataset=self.dataset, text="Some text",
+                                                   time="2015-02-02T01:19:02Z")
+        expected = corpus_models.get_time_buckets(msg.time)
+        corpus_models.Message.objects.update(**dict((name, None) for name in expected))
+
+        self.assertEquals(corpus_models.fill_time_buckets(self.dataset), 1)
+        self.assertEquals(corpus_models.Message.objects.filter(id=msg.id).values(*expected.keys())[0], expected)
+
+
+    def test_rendered_html(self):
+        """Messages should store the html of their text."""
+        msg = corpus_models.Message.objects.create(dataset=self.dataset, text="#oso @someone http://t.co/x")
+        msg = corpus_models.Message.objects.get(id=msg.id)
+        self.assertEquals(msg.rendered_html, corpus_utils.render_html_tag(msg.text))
+        self.assertEquals(msg.rendered_html_version, corpus_utils.RENDER_HTML_VERSION)
+        self.assertEquals(msg.embedded_html, msg.rendered_html)
+
+    def test_save_unchanged(self):
+        """The time bins and html should only be found again when the time or text changes."""
+        msg = corpus_models.Message.objects.create(dataset=self.dataset, text="#oso",
+                                                   time="2015-02-02T01:19:02Z")
+        corpus_models.Message.objects.filter(id=msg.id).update(rendered_html="kept", time_bucket_60=1)
+
+        msg = corpus_models.Message.objects.get(id=msg.id)
+        msg.shared_count = 3
+        msg.save()
+        self.assertEquals(msg.rendered_html, "kept")
+        self.assertEquals(msg.time_bucket_60, 1)
+
+        msg.text = "#mudslide"
+        msg.save()
+        self.assertEquals(msg.rendered_html, corpus_utils.render_html_tag("#mudslide"))
+        self.assertEquals(msg.time_bucket_60, 1)
+
+        msg.time = datetime(2015, 2, 2, 1, 20, 2, tzinfo=msg.time.tzinfo)
+        msg.save()
+        self.assertEquals(msg.time_bucket_60, 1422840000)
+
+    def test_fill_rendered_html(self):
+        """Html should be rendered again for messages rendered by another version."""
+        msg = corpus_models.Message.objects.create(dataset=self.dataset, text="#oso")
+        other = corpus_models.Message.objects.create(dataset=self.dataset, text="#mudslide")
+        corpus_models.Message.objects.filter(id=msg.id).update(rendered_html="old", rendered_html_version=0)
+
+        self.assertEquals(corpus_models.Message.objects.get(id=msg.id).embedded_html,
+                          corpus_utils.render_html_tag("#oso"))
+        self.assertEquals(corpus_models.fill_rendered_html(self.dataset), 1)
+        self.assertEquals(corpus_models.Message.objects.get(id=msg.id).rendered_html,
+                          corpus_utils.render_html_tag("#oso"))
+        self.assertEquals(corpus_models.fill_rendered_html(self.dataset, force=True), 2)
 
 class GetExampleMessageTest(TestCase):
     def generate_some_messages(self, dataset):
@@ -126,3 +199,25 @@ class GetExampleMessageTest(TestCase):
         filters = {}
         msgs = self.dataset.get_example_messages(filters)
         self.assertEquals(msgs.count(), 2)
+
+
+class MessageDetailsTest(TestCase):
+    def setUp(self):
+        self.dataset = corpus_models.Dataset.objects.create(name="Test Corpus", description="My Dataset",
+                                                            has_prefetched_images=True)
+        for i in range(5):
+            sender = self.dataset.person_set.create(username="person%d" % i, original_id=i,
+                                                    profile_image_url="http://example.com/image%d.png" % i)
+            message = self.dataset.message_set.create(text="message %d" % i, sender=sender,
+                                                      contains_media=True)
+            message.media.create(type="photo", media_url="http://example.com/photo%d.jpg" % i)
+
+    def test_example_messages(self):
+        """Messages to display should be loaded with their senders, media and dataset"""
+        with self.assertNumQueries(2):
+            messages = list(corpus_models.select_message_details(self.dataset.get_example_messages()))
+            urls = sorted(message.media_url for message in messages)
+            images = sorted(message.sender.profile_image_processed_url for message in messages)
+
+        self.assertEquals(urls, ["photo%d.jpg" % i for i in range(5)])
+        self.assertEquals(images, ["profile_%d.png" % i for i in range(5)])
@@ -48,32 +48,19 @@ def render_link_html(matchobj):
     link = matchobj.group(0)
     return "<span class='link'>" + '<a href="' + link + '" target="_blank">' + link + "</a>" + "</span>"
 
-def render_html_tag(text):
-    pattern = r'(?<=\s)#\w+|^#\w+'
-    text = re.sub(pattern, render_hashtag_html, text)
-    pattern = r'(?<=\s)@\w+|^@\w+'
-    text = re.sub(pattern, render_mention_html, text)
-    http_pattern = r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+'
-    pattern = r'(?<=\s)' + http_pattern + '|^' + http_pattern
-    text = re.sub(pattern, render_link_html, text)
-    return text
-
-def quote_query(matchobj):
-    return "'" + matchobj.group(0) + "'"
-
-def quote(text):
-    pattern = r'(?<== )\d+\-\d+\-\d+ \d+:\d+:\d+|(?<== )[\da-zA-Z_#\-.]+(?=[ )])'
-    text = re.sub(pattern, quote_query, text)
-    return text
+# Bump this when render_html_tag changes, so stored message html is rendered again
+# (see :func:`msgvis.apps.corpus.models.fill_rendered_html`)
+RENDER_HTML_VERSION = 1
 
-def convert_boolean(query):
-    query = query.replace('\'True\'', "1")
-    query = query.replace('\'False\'', "0")
-    return query
+HASHTAG_PATTERN = re.compile(r'(?<=\s)#\w+|^#\w+')
+MENTION_PATTERN = re.compile(r'(?<=\s)@\w+|^@\w+')
+_HTTP_PATTERN = r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+'
+LINK_PATTERN = re.compile(r'(?<=\s)' + _HTTP_PATTERN + '|^' + _HTTP_PATTERN)
 
-def quote(text):
-    pattern = r'(?<== )\d+\-\d+\-\d+ \d+:\d+:\d+|(?<== )[\da-zA-Z_#\-.]+(?=[ )])'
-    text = re.sub(pattern, quote_query, text)
+def render_html_tag(text):
+    text = HASHTAG_PATTERN.sub(render_hashtag_html, text)
+    text = MENTION_PATTERN.sub(render_mention_html, text)
+    text = LINK_PATTERN.sub(render_link_html, text)
     return text
 
 def levels_or(field_name, domain):
@@ -95,4 +82,19 @@ def get_word_objs(queryset, text_field_name, related_field_name, words):
             or_objs = levels_or(related_field_name, map(lambda x: x.id, word_obj.related_words))
             word_objs.append(or_objs)
 
-    return word_objs
\ No newline at end of file
+    return word_objs
+
+
+def parse_keyword_clauses(keywords_text):
+    """
+    Split a keyword search like "soup food,NOT ladies" into its comma separated clauses.
+    Returns a list of ``(exclude, words)`` tuples, where exclude is True for clauses
+    starting with "NOT ".
+    """
+    clauses = []
+    for clause in keywords_text.split(','):
+        if clause.startswith("NOT "):
+            clauses.append((True, clause[4:].split(' ')))
+        else:
+            clauses.append((False, clause.split(' ')))
+    return clauses
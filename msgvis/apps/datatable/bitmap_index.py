@@ -0,0 +1,402 @@
+"""
+An index of the messages at each level of the categorical dimensions of a dataset.
+
+For each level of an indexed dimension, the index stores the ids of the
+messages at that level as a compressed :class:`.Bitmap`, including a level
+for the messages without a value. Only messages the data table counts
+(with a time in the dataset's time range) are indexed.
+
+Once the dimensions of a data table request, and of its filters and excludes,
+have all been indexed, the request is answered by intersecting bitmaps instead of
+joining the related tables. Unlike the :mod:`.cube`, any combination of filters
+and excludes on indexed dimensions can be answered, as long as the filters
+do not select levels of a many-to-many dimension in the table, or more than one
+level of any many-to-many dimension (which the join would count once per level).
+
+.. code-block:: python
+
+    from msgvis.apps.datatable import bitmap_index
+    bitmap_index.build(dataset, 'hashtags')
+    bitmap_index.build(dataset, 'language')
+    ...
+    bitmap_index.refresh(dataset)  # add messages imported since
+
+As with the cube, refreshing only adds new messages, an index is only used
+while it is up to date, and changes to messages that have already been
+indexed require a rebuild.
+"""
+from django.core.exceptions import ValidationError
+from django.db import transaction
+
+from msgvis.apps.base.bitmaps import Bitmap
+from msgvis.apps.dimensions import registry
+from msgvis.apps.datatable.models import LevelBitmap, BitmapIndexState, filter_time_range, _matched_levels
+from msgvis.apps.datatable.cube import (CubeQuery, Unsupported, BATCH_SIZE, encode_level, decode_level,
+                                        resolve_field, get_watermark, is_cube_dimension, is_time_dimension)
+
+# The most pairs of levels to intersect for a two-dimensional table
+MAX_LEVEL_PAIRS = 10000
+
+# Indexes loaded by this process, by dataset and dimension
+_loaded = {}
+
+
+def is_index_dimension(dimension):
+    """Return True if the dimension can be indexed."""
+    return is_cube_dimension(dimension) and not is_time_dimension(dimension)
+
+
+def _find_message_ids(dataset, dimension_key, after_id, upto_id):
+    """
+    Find the ids of the indexed messages with ids in (after_id, upto_id] at each level.
+    Returns a dict from encoded levels to lists of ids.
+    """
+    dimension = registry.get_dimension(dimension_key)
+    queryset = dataset.message_set.filter(id__gt=after_id, id__lte=upto_id)
+    queryset = filter_time_range(queryset, dataset)
+
+    expression = dimension.get_grouping_expression(queryset)
+    queryset, internal_key = dimension.select_grouping_expression(queryset, expression)
+
+    message_ids = {}
+    for level, message_id in queryset.values_list(internal_key, 'id').iterator():
+        message_ids.setdefault(encode_level(level), []).append(message_id)
+    return message_ids
+
+
+def _create_bitmaps(dataset, dimension_key, message_ids):
+    LevelBitmap.objects.bulk_create([
+        LevelBitmap(dataset=dataset, dimension=dimension_key, level=level,
+                    count=len(bitmap), bitmap=bitmap.serialize())
+        for level, bitmap in ((level, Bitmap(ids)) for level, ids in message_ids)
+    ])
+
+
+def _add_message_ids(dataset, dimension_key, message_ids):
+    """Add ids to the bitmaps of an index, creating bitmaps for new levels."""
+    pending = message_ids.items()
+    for start in xrange(0, len(pending), BATCH_SIZE):
+        batch = dict(pending[start:start + BATCH_SIZE])
+        rows = LevelBitmap.objects.filter(dataset=dataset, dimension=dimension_key, level__in=batch.keys())
+        for row in rows:
+            bitmap = Bitmap.deserialize(row.bitmap) | Bitmap(batch.pop(row.level))
+            LevelBitmap.objects.filter(pk=row.pk).update(count=len(bitmap), bitmap=bitmap.serialize())
+
+        _create_bitmaps(dataset, dimension_key, batch.iteritems())
+
+
+def build(dataset, dimension_key):
+    """Index all the messages in a dataset for a categorical dimension."""
+    if not is_index_dimension(registry.get_dimension(dimension_key)):
+        raise ValueError("The dimension %s cannot be indexed." % dimension_key)
+
+    with transaction.atomic():
+        LevelBitmap.objects.filter(dataset=dataset, dimension=dimension_key).delete()
+        state, created = BitmapIndexState.objects.get_or_create(dataset=dataset, dimension=dimension_key)
+
+        watermark = get_watermark(dataset)
+        _create_bitmaps(dataset, dimension_key,
+                        _find_message_ids(dataset, dimension_key, 0, watermark).iteritems())
+
+        state.last_message_id = watermark
+        state.start_time = dataset.start_time
+        state.end_time = dataset.end_time
+        state.save()
+
+    return state
+
+
+def refresh(dataset, rebuild=False):
+    """
+    Bring all the indexes built for a dataset up to date by adding the new messages.
+    Indexes are rebuilt from scratch if the time range of the dataset has changed,
+    or if rebuild is True.
+    """
+    states = list(BitmapIndexState.objects.filter(dataset=dataset))
+    watermark = get_watermark(dataset)
+
+    for state in states:
+        if rebuild or state.start_time != dataset.start_time or state.end_time != dataset.end_time:
+            build(dataset, state.dimension)
+            continue
+
+        if state.last_message_id >= watermark:
+            continue
+
+        with transaction.atomic():
+            message_ids = _find_message_ids(dataset, state.dimension, state.last_message_id, watermark)
+            _add_message_ids(dataset, state.dimension, message_ids)
+            state.last_message_id = watermark
+            state.save()
+
+    return states
+
+
+def drop(dataset, dimension_key):
+    """
+    Delete the index of a dimension, e.g. after its values have been recalculated.
+    Data tables will query the messages until it is built again.
+    """
+    with transaction.atomic():
+        LevelBitmap.objects.filter(dataset=dataset, dimension=dimension_key).delete()
+        BitmapIndexState.objects.filter(dataset=dataset, dimension=dimension_key).delete()
+
+
+def load(dataset, states):
+    """
+    Get the bitmaps of the indexes with the given states, as a dict from
+    dimension keys to dicts from encoded levels to bitmaps.
+    Indexes are kept in memory until they are updated.
+    """
+    indexes = {}
+    missing = {}
+    for state in states:
+        version, levels = _loaded.get((dataset.id, state.dimension), (None, None))
+        if version == (state.last_message_id, state.updated_at):
+            indexes[state.dimension] = levels
+        else:
+            missing[state.dimension] = state
+
+    if missing:
+        rows = LevelBitmap.objects.filter(dataset=dataset, dimension__in=missing.keys())
+        for key in missing:
+            indexes[key] = {}
+        for dimension_key, level, data in rows.values_list('dimension', 'level', 'bitmap').iterator():
+            indexes[dimension_key][level] = Bitmap.deserialize(data)
+        for key, state in missing.iteritems():
+            _loaded[(dataset.id, key)] = ((state.last_message_id, state.updated_at), indexes[key])
+
+    return indexes
+
+
+def preload(dataset):
+    """
+    Load all the indexes built for a dataset.
+    Run before gunicorn forks its workers so they share them (see :mod:`msgvis.preload`).
+    """
+    return load(dataset, BitmapIndexState.objects.filter(dataset=dataset))
+
+
+class LevelSelector(object):
+    """Resolves the levels of one dimension in filters and excludes to bitmaps."""
+
+    def __init__(self, dimension, levels):
+        self.dimension = dimension
+        self.field, self.multi_valued = resolve_field(dimension.field_name)
+        self.levels = levels
+
+    def bitmap(self, level):
+        """The messages at a level, as :meth:`.CategoricalDimension.filter` matches it."""
+        if level is None or unicode(level).strip() == "":
+            encoded = encode_level(None)
+        else:
+            try:
+                encoded = encode_level(self.field.get_prep_lookup('exact', level))
+            except (TypeError, ValueError, ValidationError):
+                raise Unsupported()
+        return self.levels.get(encoded, Bitmap())
+
+    def filter(self, bitmap, filter):
+        """Apply a filter as :meth:`.CategoricalDimension.filter` does."""
+        if any(value for key, value in filter.iteritems() if key not in ('dimension', 'value', 'levels')):
+            raise Unsupported()
+
+        if 'value' in filter:
+            value = filter['value']
+            if value == "false":
+                value = False
+            bitmap = bitmap & self.bitmap(value)
+
+        if filter.get('levels'):
+            bitmap = bitmap & Bitmap.union_all(self.bitmap(False if level == "false" else level)
+                                               for level in filter['levels'])
+        return bitmap
+
+    def exclude(self, bitmap, exclude):
+        """Apply an exclude filter as :meth:`.CategoricalDimension.exclude` does."""
+        if 'value' in exclude:
+            bitmap = bitmap - self.bitmap(exclude['value'])
+        for level in exclude.get('levels') or []:
+            bitmap = bitmap - self.bitmap(level)
+        return bitmap
+
+
+class BitmapQuery(CubeQuery):
+    """Answers a :meth:`.DataTable.generate` request by intersecting the bitmaps of the index."""
+
+    def __init__(self, datatable, dataset, selectors, filters, excludes):
+        self.datatable = datatable
+        self.dataset = dataset
+        self.dimensions = [d for d in (datatable.primary_dimension, datatable.secondary_dimension)
+                           if d is not None]
+
+        self.selectors = selectors
+        """A :class:`LevelSelector` for each indexed dimension, by key."""
+
+        self.filters = filters
+        self.excludes = excludes
+
+        self.filtered_keys = set(filter['dimension'].key for filter in filters)
+        """The keys of the dimensions that have a filter."""
+
+        # Every message is at one of the levels of any dimension, maybe the empty one
+        self.messages = Bitmap.union_all(selectors[self.dimensions[0].key].levels.itervalues())
+        """All the indexed messages."""
+
+    @classmethod
+    def create(cls, datatable, dataset, filters=None, exclude=None):
+        """
+        Returns a BitmapQuery if the request can be answered from the index, or None.
+        This requires categorical dimensions with up-to-date indexes, no
+        filters on many-to-many dimensions in the table, and at most one
+        level filtered on each many-to-many dimension.
+        """
+        dimensions = [d for d in (datatable.primary_dimension, datatable.secondary_dimension)
+                      if d is not None]
+        filters = filters or []
+        exclude = exclude or []
+
+        indexed = dict((d.key, d) for d in dimensions)
+        indexed.update((f['dimension'].key, f['dimension']) for f in filters + exclude)
+        if not all(is_index_dimension(d) for d in indexed.itervalues()):
+            return None
+
+        filtered_keys = set(f['dimension'].key for f in filters)
+        for dimension in dimensions:
+            if dimension.key in filtered_keys and resolve_field(dimension.field_name)[1]:
+                # Grouping would reuse the join of the filter, so only its levels would be counted
+                return None
+        for key, dimension in indexed.iteritems():
+            if resolve_field(dimension.field_name)[1]:
+                matched = sum(('value' in f) + len(f.get('levels') or []) for f in filters if f['dimension'].key == key)
+                if matched > 1:
+                    # The join has a row for each matching level, so messages would be counted more than once
+                    return None
+
+        states = list(BitmapIndexState.objects.filter(dataset=dataset, dimension__in=indexed.keys()))
+        if len(states) != len(indexed):
+            return None
+        watermark = get_watermark(dataset)
+        for state in states:
+            if state.last_message_id != watermark or \
+                    state.start_time != dataset.start_time or state.end_time != dataset.end_time:
+                return None
+
+        indexes = load(dataset, states)
+        selectors = dict((key, LevelSelector(dimension, indexes[key]))
+                         for key, dimension in indexed.iteritems())
+        return cls(datatable, dataset, selectors, filters, exclude)
+
+    def select(self, filters, excludes):
+        """The messages that pass the filters and excludes."""
+        bitmap = self.messages
+        for filter in filters:
+            bitmap = self.selectors[filter['dimension'].key].filter(bitmap, filter)
+        for exclude in excludes:
+            bitmap = self.selectors[exclude['dimension'].key].exclude(bitmap, exclude)
+        return bitmap
+
+    def domain(self, dimension):
+        """Return the levels of a dimension, sorted by frequency, and their labels."""
+        if hasattr(dimension, 'domain'):
+            domain = dimension.domain
+        else:
+            # Only the last filter and exclude on the dimension itself apply to the domain
+            filters = [f for f in self.filters if f['dimension'].key == dimension.key][-1:]
+            excludes = [f for f in self.excludes if f['dimension'].key == dimension.key][-1:]
+            messages = self.select(filters, excludes)
+
+            counts = []
+            for level, bitmap in self.selectors[dimension.key].levels.iteritems():
+                count = messages.intersection_count(bitmap)
+                if count > 0:
+                    counts.append((-count, decode_level(level)))
+            # Ties are broken by level, as the messages are sorted
+            domain = [level for count, level in sorted(counts)]
+
+        return domain, dimension.get_domain_labels(domain)
+
+    def _levels(self, dimension, domain=None):
+        """The encoded levels and bitmaps of a dimension, restricted to a domain if given."""
+        levels = self.selectors[dimension.key].levels
+        if domain is None:
+            return levels.items()
+        encoded = set(encode_level(level) for level in _matched_levels(domain))
+        return [(level, bitmap) for level, bitmap in levels.iteritems() if level in encoded]
+
+    def _count(self, messages, rows, key_levels):
+        """
+        Count the messages at each combination of levels, as rows of a table.
+        key_levels is a list of (dimension key, [(encoded level, bitmap)...]) pairs.
+        """
+        if len(key_levels) == 1:
+            key, levels = key_levels[0]
+            for level, bitmap in levels:
+                count = messages.intersection_count(bitmap)
+                if count > 0:
+                    rows.append({key: decode_level(level), 'value': count})
+            return rows
+
+        (primary_key, primary_levels), (secondary_key, secondary_levels) = key_levels
+        if len(primary_levels) * len(secondary_levels) > MAX_LEVEL_PAIRS:
+            raise Unsupported()
+        for primary_level, primary_bitmap in primary_levels:
+            selected = messages & primary_bitmap
+            if not selected:
+                continue
+            for secondary_level, secondary_bitmap in secondary_levels:
+                count = selected.intersection_count(secondary_bitmap)
+                if count > 0:
+                    rows.append({primary_key: decode_level(primary_level),
+                                 secondary_key: decode_level(secondary_level),
+                                 'value': count})
+        return rows
+
+    def table(self, restrictions):
+        """The counts for each level (pair of levels), restricted to some levels of each dimension."""
+        messages = self.select(self.filters, self.excludes)
+        return self._count(messages, [], [(d.key, self._levels(d, restrictions.get(d.key)))
+                                          for d in self.dimensions])
+
+    def table_with_others(self, domains, primary_flag, secondary_flag):
+        """
+        The counts for the top levels of each dimension, followed by the "Other" rows,
+        as :meth:`.DataTable.render_others` counts them. The "Other" levels are added to the domains.
+        """
+        primary = self.datatable.primary_dimension
+        secondary = self.datatable.secondary_dimension
+        messages = self.select(self.filters, self.excludes)
+
+        primary_levels = self._levels(primary, domains[primary.key] if primary_flag else None)
+        primary_other = u'Other ' + primary.name
+        primary_top = Bitmap.union_all(bitmap for level, bitmap in primary_levels)
+
+        if secondary is None:
+            table = self._count(messages, [], [(primary.key, primary_levels)])
+            domains[primary.key].append(primary_other)
+            table.append({primary.key: primary_other, 'value': len(messages - primary_top)})
+            return table
+
+        secondary_levels = self._levels(secondary, domains[secondary.key] if secondary_flag else None)
+        secondary_other = u'Other ' + secondary.name
+        secondary_top = Bitmap.union_all(bitmap for level, bitmap in secondary_levels)
+
+        table = self._count(messages, [], [(primary.key, primary_levels), (secondary.key, secondary_levels)])
+        if primary_flag:
+            domains[primary.key].append(primary_other)
+        if secondary_flag:
+            domains[secondary.key].append(secondary_other)
+
+        if primary_flag and secondary_flag:
+            table.append({primary.key: primary_other,
+                          secondary.key: secondary_other,
+                          'value': len(messages - primary_top - secondary_top)})
+        if secondary_flag:
+            for row in self._count((messages & primary_top) - secondary_top, [], [(primary.key, primary_levels)]):
+                row[secondary.key] = secondary_other
+                table.append(row)
+        if primary_flag:
+            for row in self._count((messages & secondary_top) - primary_top, [], [(secondary.key, secondary_levels)]):
+                row[primary.key] = primary_other
+                table.append(row)
+        return table
@@ -0,0 +1,156 @@
+"""
+A cache of data table results, in front of :meth:`.DataTable.generate`.
+
+Results are stored in the Django cache (see ``CACHES``) under a key made
+from a normalized form of the request and a version for the dataset.
+Anything that changes the messages of a dataset, their enhancements or
+its groups should call :func:`invalidate_dataset`, which gives the dataset
+a new version so that older results are never looked up again.
+The version is stored on the :class:`.Dataset`, so every process sees it
+change, even if each has its own cache.
+
+.. code-block:: python
+
+    from msgvis.apps.datatable.cache import table_cache
+    key = table_cache.make_key(dataset, dimensions, filters=filters)
+    found, result = table_cache.get(key)
+    if not found:
+        result = datatable.generate(dataset, filters)
+        table_cache.set(key, result)
+
+Set ``DATATABLE_CACHE_ENABLED = False`` to turn the cache off,
+and ``DATATABLE_CACHE_TIMEOUT`` to change how long results are kept (in seconds).
+"""
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.serializers.json import DjangoJSONEncoder
+
+from msgvis.apps.corpus.models import Dataset, new_table_version
+
+DEFAULT_TIMEOUT = 24 * 60 * 60
+
+
+def _normalize_filter(filter):
+    """A filter with the dimension replaced by its key and the levels in order."""
+    normalized = {}
+    for key, value in filter.iteritems():
+        if key == 'dimension':
+            value = getattr(value, 'key', value)
+        elif key == 'levels' and value is not None:
+            value = sorted(value)
+        normalized[key] = value
+    return normalized
+
+
+class TableCache(object):
+    """Stores data table results per dataset version, and counts hits and misses."""
+
+    prefix = 'datatable'
+
+    def __init__(self, cache_alias='default'):
+        self.cache_alias = cache_alias
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    @property
+    def enabled(self):
+        return getattr(settings, 'DATATABLE_CACHE_ENABLED', True)
+
+    @property
+    def timeout(self):
+        return getattr(settings, 'DATATABLE_CACHE_TIMEOUT', DEFAULT_TIMEOUT)
+
+    def get_version(self, dataset_id):
+        """The current version of a dataset's results, or None if there is no such dataset."""
+        return Dataset.objects.filter(id=dataset_id).values_list('table_version', flat=True).first()
+
+    def invalidate(self, dataset_id):
+        """Forget all the results for a dataset."""
+        Dataset.objects.filter(id=dataset_id).update(table_version=new_table_version())
+
+    def make_key(self, dataset, dimensions, filters=None, exclude=None, mode=None,
+                 page=None, page_size=100, search_key=None, groups=None):
+        """
+        Get the cache key for a request, or None if the request cannot be cached.
+        Dimensions and filters may use dimension objects or keys.
+        """
+        if not self.enabled:
+            return None
+
+        dataset_id = getattr(dataset, 'id', dataset)
+        request = {
+            'dimensions': [getattr(d, 'key', d) for d in dimensions],
+            'filters': [_normalize_filter(f) for f in filters or []],
+            'exclude': [_normalize_filter(f) for f in exclude or []],
+            'mode': mode or None,
+            'page': page,
+            # The page size only matters when paging
+            'page_size': page_size if page is not None else None,
+            'search_key': search_key,
+            'groups': groups or None,
+        }
+        try:
+            request = json.dumps(request, sort_keys=True, cls=DjangoJSONEncoder)
+            digest = hashlib.md5(request).hexdigest()
+            return '%s:%d:%s:%s' % (self.prefix, dataset_id, self.get_version(dataset_id), digest)
+        except (TypeError, ValueError):
+            return None
+
+    def _count(self, name):
+        key = '%s:stats:%s' % (self.prefix, name)
+        if not self.cache.add(key, 1, None):
+            try:
+                self.cache.incr(key)
+            except ValueError:
+                # It expired in between
+                self.cache.add(key, 1, None)
+
+    def get(self, key):
+        """Returns a (found, result) tuple."""
+        if key is None:
+            return False, None
+
+        value = self.cache.get(key)
+        if value is None:
+            self._count('misses')
+            return False, None
+
+        self._count('hits')
+        return True, value[0]
+
+    def set(self, key, result):
+        """Store a result. Tables are turned into lists first."""
+        if key is None:
+            return
+        if result is not None and result.get('table') is not None:
+            result['table'] = list(result['table'])
+        # Wrapped so that a None result can be told apart from a miss
+        self.cache.set(key, (result,), self.timeout)
+
+    def stats(self):
+        """The numbers of hits and misses, and the hit rate."""
+        names = ['hits', 'misses']
+        values = self.cache.get_many(['%s:stats:%s' % (self.prefix, name) for name in names])
+        hits, misses = [values.get('%s:stats:%s' % (self.prefix, name), 0) for name in names]
+        total = hits + misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': float(hits) / total if total else None,
+        }
+
+    def reset_stats(self):
+        self.cache.delete_many(['%s:stats:hits' % self.prefix, '%s:stats:misses' % self.prefix])
+
+
+table_cache = TableCache()
+
+
+def invalidate_dataset(dataset):
+    """Forget the cached data tables for a dataset (or dataset id), after its data has changed."""
+    table_cache.invalidate(getattr(dataset, 'id', dataset))
@@ -0,0 +1,631 @@
+"""
+A columnar snapshot of the messages in a dataset, for interactive data tables.
+
+The snapshot stores one NumPy array per message field, ordered by message id:
+the time, the ids of the type, sender, language and timezone, the sentiment,
+the reply and share counts and the boolean flags. Many-to-many relations
+(hashtags, urls, media, mentions and words) are stored as CSR arrays: the related
+ids of message ``i`` are ``<relation>_indices[<relation>_indptr[i]:<relation>_indptr[i + 1]]``.
+For each categorical dimension, a lookup array maps related ids to the
+positions of their levels in the snapshot's metadata.
+
+The arrays are saved as ``.npy`` files in a directory per dataset under
+``settings.COLUMNAR_SNAPSHOT_ROOT`` and memory-mapped when a data table
+first needs them, so they are only read from disk as they are used.
+
+.. code-block:: python
+
+    from msgvis.apps.datatable import columnar
+    columnar.build(dataset)
+    ...
+    columnar.refresh(dataset)  # rebuild if messages were imported since
+
+:class:`ColumnarQuery` answers :meth:`.DataTable.generate` requests on categorical
+dimensions from the snapshot. Filters become per-message weights and
+counts are taken with :func:`numpy.bincount`. A message is weighted by the number of
+join rows the SQL query would give it, so the counts are identical.
+Filters on time and on the message's quantitative fields are supported too.
+As with the :mod:`.cube`, a snapshot is only used while it includes every
+message in the dataset.
+"""
+import calendar
+import json
+import os
+import shutil
+from datetime import timedelta
+
+import numpy as np
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.utils import dateparse, timezone
+
+from msgvis.apps.corpus import models as corpus_models
+from msgvis.apps.dimensions import registry
+from msgvis.apps.datatable.models import _matched_levels
+from msgvis.apps.datatable.cube import (CubeQuery, Unsupported, encode_level, decode_level,
+                                        resolve_field, get_watermark, is_cube_dimension, is_time_dimension)
+
+# Message fields stored as columns, and their types
+FIELD_COLUMNS = [
+    ('type_id', np.int64),
+    ('sender_id', np.int64),
+    ('language_id', np.int64),
+    ('timezone_id', np.int64),
+    ('sentiment', np.int64),
+    ('replied_to_count', np.int64),
+    ('shared_count', np.int64),
+    ('contains_hashtag', np.bool_),
+    ('contains_url', np.bool_),
+    ('contains_media', np.bool_),
+    ('contains_mention', np.bool_),
+]
+
+# Stored for null values in integer columns, and for messages without a time
+NULL = np.iinfo(np.int64).min
+
+# The pairs of levels to count at most for a two-dimensional table
+MAX_LEVEL_PAIRS = 1000000
+
+# Snapshots loaded by this process, by dataset id
+_snapshots = {}
+
+
+def get_relations():
+    """The many-to-many relations stored as CSR arrays, as {name: (through model, message id field, related id field)}."""
+    from msgvis.apps.enhance.models import TweetWord
+
+    return {
+        'hashtags': (corpus_models.Message.hashtags.through, 'message_id', 'hashtag_id'),
+        'urls': (corpus_models.Message.urls.through, 'message_id', 'url_id'),
+        'media': (corpus_models.Message.media.through, 'message_id', 'media_id'),
+        'mentions': (corpus_models.Message.mentions.through, 'message_id', 'person_id'),
+        'tweet_words': (TweetWord.messages.through, 'message_id', 'tweetword_id'),
+    }
+
+
+def to_timestamp(value):
+    """Microseconds since the epoch for a datetime (or a string giving one)."""
+    if isinstance(value, basestring):
+        value = dateparse.parse_datetime(value)
+        if value is None:
+            raise Unsupported()
+    if timezone.is_naive(value):
+        value = timezone.make_aware(value, timezone.get_default_timezone())
+    return calendar.timegm(value.utctimetuple()) * 1000000 + value.microsecond
+
+
+def get_snapshot_dir(dataset):
+    root = getattr(settings, 'COLUMNAR_SNAPSHOT_ROOT')
+    return os.path.join(root, str(getattr(dataset, 'id', dataset)))
+
+
+def get_column_name(dimension):
+    """
+    The name of the column storing a dimension's values, and whether it holds related ids.
+    Raises :class:`Unsupported` for dimensions that are not stored.
+    """
+    parts = dimension.field_name.split('__')
+    if len(parts) == 1:
+        if parts[0] not in dict(FIELD_COLUMNS):
+            raise Unsupported()
+        return parts[0], False
+    if len(parts) == 2:
+        if parts[0] in get_relations():
+            return parts[0], True
+        if parts[0] + '_id' in dict(FIELD_COLUMNS):
+            return parts[0] + '_id', True
+    raise Unsupported()
+
+
+def is_snapshot_dimension(dimension):
+    """Return True if the levels of a dimension can be counted from the snapshot."""
+    if not is_cube_dimension(dimension) or is_time_dimension(dimension):
+        return False
+    try:
+        get_column_name(dimension)
+    except Unsupported:
+        return False
+    return True
+
+
+def _related_levels(dimension, related_ids):
+    """Returns the levels of a dimension and an array mapping related ids to their positions."""
+    target = dimension.field_name.split('__')[1]
+    model = resolve_field(dimension.field_name)[0].model
+
+    related_ids = np.unique(related_ids[related_ids != NULL])
+    lookup = np.empty(int(related_ids[-1]) + 1 if len(related_ids) else 0, dtype=np.int64)
+    lookup.fill(NULL)
+
+    levels = []
+    positions = {}
+    for start in xrange(0, len(related_ids), 1000):
+        chunk = related_ids[start:start + 1000].tolist()
+        for related_id, level in model.objects.filter(id__in=chunk).values_list('id', target):
+            encoded = encode_level(level)
+            if encoded not in positions:
+                positions[encoded] = len(levels)
+                levels.append(encoded)
+            lookup[related_id] = positions[encoded]
+    return levels, lookup
+
+
+def build(dataset):
+    """Save the columns of all the messages in a dataset."""
+    snapshot_dir = get_snapshot_dir(dataset)
+    building_dir = snapshot_dir + '.building'
+    if os.path.exists(building_dir):
+        shutil.rmtree(building_dir)
+    os.makedirs(building_dir)
+
+    watermark = get_watermark(dataset)
+    messages = dataset.message_set.filter(id__lte=watermark)
+
+    columns = {}
+    names = ['id', 'time'] + [name for name, dtype in FIELD_COLUMNS]
+    rows = list(messages.order_by('id').values_list(*names).iterator())
+    for i, name in enumerate(names):
+        if name == 'time':
+            values = [NULL if row[i] is None else to_timestamp(row[i]) for row in rows]
+            columns[name] = np.array(values, dtype=np.int64)
+        else:
+            dtype = dict(FIELD_COLUMNS).get(name, np.int64)
+            null = False if dtype == np.bool_ else NULL
+            columns[name] = np.array([null if row[i] is None else row[i] for row in rows], dtype=dtype)
+    del rows
+    ids = columns['id']
+
+    for relation, (through, message_field, related_field) in get_relations().iteritems():
+        pairs = through.objects.filter(**{message_field + '__in': messages.values('id')})
+        pairs = np.array(list(pairs.values_list(message_field, related_field).iterator()),
+                         dtype=np.int64).reshape(-1, 2)
+        pairs = pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+        rows = np.searchsorted(ids, pairs[:, 0])
+        columns[relation + '_indptr'] = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=len(ids)))))
+        columns[relation + '_indices'] = pairs[:, 1]
+
+    # The levels of each categorical dimension
+    levels = {}
+    for dimension in registry.get_dimensions():
+        if not is_snapshot_dimension(dimension):
+            continue
+        column, related = get_column_name(dimension)
+        if related:
+            related_ids = columns[column + '_indices' if column in get_relations() else column]
+            levels[dimension.key], columns[dimension.key + '_lookup'] = _related_levels(dimension, related_ids)
+        else:
+            values = columns[column]
+            if values.dtype == np.bool_:
+                levels[dimension.key] = [encode_level(False), encode_level(True)]
+            else:
+                levels[dimension.key] = [encode_level(int(value)) for value in np.unique(values[values != NULL])]
+
+    for name, values in columns.iteritems():
+        np.save(os.path.join(building_dir, name + '.npy'), values)
+    with open(os.path.join(building_dir, 'meta.json'), 'w') as meta_file:
+        json.dump({
+            'dataset': dataset.id,
+            'last_message_id': watermark,
+            'count': len(ids),
+            'levels': levels,
+        }, meta_file)
+
+    drop(dataset)
+    os.rename(building_dir, snapshot_dir)
+    return load(dataset, watermark)
+
+
+def refresh(dataset, rebuild=False):
+    """Rebuild the snapshot of a dataset, if there is one and it is missing messages (or if rebuild is True)."""
+    if not os.path.exists(os.path.join(get_snapshot_dir(dataset), 'meta.json')):
+        return None
+    snapshot = load(dataset)
+    if rebuild or snapshot.last_message_id != get_watermark(dataset):
+        return build(dataset)
+    return snapshot
+
+
+def drop(dataset):
+    """Delete the snapshot of a dataset, e.g. after the words of its messages have been recalculated."""
+    _snapshots.pop(getattr(dataset, 'id', dataset), None)
+    snapshot_dir = get_snapshot_dir(dataset)
+    if os.path.exists(snapshot_dir):
+        shutil.rmtree(snapshot_dir)
+
+
+def load(dataset, watermark=None):
+    """
+    Get the snapshot of a dataset, or None if it has not been built.
+    If a watermark is given, only a snapshot that includes messages up to it is returned.
+    """
+    snapshot = _snapshots.get(dataset.id)
+    if snapshot is None or (watermark is not None and snapshot.last_message_id != watermark):
+        meta_path = os.path.join(get_snapshot_dir(dataset), 'meta.json')
+        if not os.path.exists(meta_path):
+            return None
+        snapshot = Snapshot(get_snapshot_dir(dataset))
+        _snapshots[dataset.id] = snapshot
+
+    if watermark is not None and snapshot.last_message_id != watermark:
+        return None
+    return snapshot
+
+
+def preload(dataset):
+    """
+    Load the snapshot of a dataset, if there is one, and the levels of all its dimensions.
+    Run before gunicorn forks its workers so they share them (see :mod:`msgvis.preload`).
+    """
+    snapshot = load(dataset)
+    if snapshot is None:
+        return None
+    snapshot['time']
+    for key in snapshot.levels:
+        snapshot.level_column(registry.get_dimension(key))
+    return snapshot
+
+
+class LevelColumn(object):
+    """
+    The levels of a dimension for each message, as CSR arrays of level positions.
+    Messages without a value have one row at the empty level, like a left join,
+    so every message has at least one row.
+    """
+
+    def __init__(self, dimension, indptr, codes, levels):
+        self.dimension = dimension
+        self.field = resolve_field(dimension.field_name)[0]
+        self.indptr = indptr
+        self.codes = codes
+        self.encoded_levels = levels
+        self.positions = dict((level, i) for i, level in enumerate(levels))
+        self.null_code = self.positions[encode_level(None)]
+        self.lengths = np.diff(indptr)
+
+    def code_mask(self, levels):
+        """The positions of some levels, as :meth:`.CategoricalDimension.filter` matches them."""
+        mask = np.zeros(len(self.encoded_levels), dtype=np.bool_)
+        for level in levels:
+            if level is None or unicode(level).strip() == "":
+                mask[self.null_code] = True
+                continue
+            try:
+                encoded = encode_level(self.field.get_prep_lookup('exact', level))
+            except (TypeError, ValueError, ValidationError):
+                raise Unsupported()
+            if encoded in self.positions:
+                mask[self.positions[encoded]] = True
+        return mask
+
+    def matches(self, mask):
+        """The number of values of each message at the levels in the mask."""
+        if len(self.codes) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.add.reduceat(mask[self.codes].astype(np.int64), self.indptr[:-1])
+
+    def row_weights(self, weights):
+        return np.repeat(weights, self.lengths)
+
+    def counts(self, weights, mask=None):
+        """The total weight at each level (restricted to the levels in the mask), as a dict."""
+        row_weights = self.row_weights(weights)
+        totals = np.bincount(self.codes, weights=row_weights, minlength=len(self.encoded_levels))
+        codes = np.flatnonzero(totals)
+        if mask is not None:
+            codes = codes[mask[codes]]
+        return dict((code, int(totals[code])) for code in codes)
+
+
+class Snapshot(object):
+    """The columns of a dataset, loaded lazily from a snapshot directory."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as meta_file:
+            meta = json.load(meta_file)
+        self.last_message_id = meta['last_message_id']
+        self.count = meta['count']
+        self.levels = meta['levels']
+        self._arrays = {}
+        self._level_columns = {}
+
+    def __getitem__(self, name):
+        """A column, memory-mapped from its file the first time."""
+        if name not in self._arrays:
+            self._arrays[name] = np.load(os.path.join(self.path, name + '.npy'), mmap_mode='r')
+        return self._arrays[name]
+
+    def level_column(self, dimension):
+        """The :class:`LevelColumn` of a categorical dimension."""
+        if dimension.key not in self._level_columns:
+            self._level_columns[dimension.key] = self._make_level_column(dimension)
+        return self._level_columns[dimension.key]
+
+    def _make_level_column(self, dimension):
+        if dimension.key not in self.levels:
+            raise Unsupported()
+        column, related = get_column_name(dimension)
+        levels = list(self.levels[dimension.key])
+        null_level = encode_level(None)
+        if null_level not in levels:
+            levels.append(null_level)
+        null_code = levels.index(null_level)
+
+        if not related:
+            values = np.asarray(self[column])
+            if values.dtype == np.bool_:
+                codes = values.astype(np.int64)
+            else:
+                known = np.array([decode_level(level) for level in self.levels[dimension.key]], dtype=np.int64)
+                codes = np.searchsorted(known, values)
+                codes[values == NULL] = null_code
+            return LevelColumn(dimension, np.arange(len(codes) + 1), codes, levels)
+
+        lookup = np.asarray(self[dimension.key + '_lookup'])
+        if column not in get_relations():
+            ids = np.asarray(self[column])
+            codes = np.empty(len(ids), dtype=np.int64)
+            codes.fill(null_code)
+            known = ids != NULL
+            codes[known] = lookup[ids[known]]
+            codes[codes == NULL] = null_code
+            return LevelColumn(dimension, np.arange(len(codes) + 1), codes, levels)
+
+        # Add a row at the empty level for the messages without values
+        indptr = np.asarray(self[column + '_indptr'])
+        indices = np.asarray(self[column + '_indices'])
+        lengths = np.diff(indptr)
+        row_indptr = np.concatenate(([0], np.cumsum(np.maximum(lengths, 1))))
+        codes = np.empty(row_indptr[-1], dtype=np.int64)
+        codes.fill(null_code)
+        rows = np.repeat(row_indptr[:-1], lengths) + (np.arange(len(indices)) - np.repeat(indptr[:-1], lengths))
+        codes[rows] = lookup[indices]
+        codes[codes == NULL] = null_code
+        return LevelColumn(dimension, row_indptr, codes, levels)
+
+
+class ColumnarQuery(CubeQuery):
+    """Answers a :meth:`.DataTable.generate` request from the columns of a :class:`Snapshot`."""
+
+    def __init__(self, datatable, dataset, snapshot, filters, excludes):
+        self.datatable = datatable
+        self.dataset = dataset
+        self.snapshot = snapshot
+        self.dimensions = [d for d in (datatable.primary_dimension, datatable.secondary_dimension)
+                           if d is not None]
+        self.filters = filters
+        self.excludes = excludes
+
+        self.filtered_keys = set(filter['dimension'].key for filter in filters)
+        """The keys of the dimensions that have a filter."""
+
+        self.messages = self._time_range()
+        """A weight of 1 for each message the data table counts, as :func:`.filter_time_range` selects them."""
+
+    @classmethod
+    def create(cls, datatable, dataset, filters=None, exclude=None):
+        """
+        Returns a ColumnarQuery if the request can be answered from the snapshot, or None.
+        This requires categorical dimensions in the snapshot, a snapshot
+        including every message, and no filters on many-to-many dimensions in the table.
+        """
+        dimensions = [d for d in (datatable.primary_dimension, datatable.secondary_dimension)
+                      if d is not None]
+        filters = filters or []
+        exclude = exclude or []
+        if not all(is_snapshot_dimension(d) for d in dimensions):
+            return None
+
+        filtered_keys = set(f['dimension'].key for f in filters)
+        for dimension in dimensions:
+            if dimension.key in filtered_keys and resolve_field(dimension.field_name)[1]:
+                # Grouping would reuse the join of the filter, so only its levels would be counted
+                return None
+
+        for filter in filters + exclude:
+            dimension = filter['dimension']
+            if not is_snapshot_dimension(dimension) and not is_time_dimension(dimension) and \
+                    dimension.field_name not in ('replied_to_count', 'shared_count'):
+                return None
+
+        if load(dataset) is None:
+            # Nothing was built, so there is no need to look up the last message
+            return None
+        snapshot = load(dataset, get_watermark(dataset))
+        if snapshot is None:
+            return None
+        return cls(datatable, dataset, snapshot, filters, exclude)
+
+    def _time_range(self):
+        times = np.asarray(self.snapshot['time'])
+        selected = times != NULL
+        if self.dataset.start_time and self.dataset.end_time:
+            range = self.dataset.end_time - self.dataset.start_time
+            buffer = timedelta(seconds=range.total_seconds() * 0.1)
+            selected &= times >= to_timestamp(self.dataset.start_time - buffer)
+            selected &= times <= to_timestamp(self.dataset.end_time + buffer)
+        return selected.astype(np.int64)
+
+    def _filter(self, weights, filter):
+        """Apply a filter as the dimension's filter method does."""
+        dimension = filter['dimension']
+        if is_time_dimension(dimension):
+            if any(value for key, value in filter.iteritems() if key not in ('dimension', 'min_time', 'max_time')):
+                raise Unsupported()
+            times = np.asarray(self.snapshot['time'])
+            if filter.get('min_time'):
+                weights = weights * (times >= to_timestamp(filter['min_time']))
+            if filter.get('max_time'):
+                weights = weights * (times <= to_timestamp(filter['max_time']))
+            return weights
+
+        if not dimension.is_categorical():
+            if any(value for key, value in filter.iteritems() if key not in ('dimension', 'min', 'max')):
+                raise Unsupported()
+            values = np.asarray(self.snapshot[dimension.field_name])
+            if filter.get('min'):
+                weights = weights * (values >= filter['min'])
+            if filter.get('max'):
+                weights = weights * (values <= filter['max'])
+            return weights
+
+        if any(value for key, value in filter.iteritems() if key not in ('dimension', 'value', 'levels')):
+            raise Unsupported()
+        column = self.snapshot.level_column(dimension)
+
+        # Each filter joins the related table again, giving a row for each matching value
+        if 'value' in filter:
+            value = filter['value']
+            if value == "false":
+                value = False
+            weights = weights * column.matches(column.code_mask([value]))
+        if filter.get('levels'):
+            weights = weights * column.matches(column.code_mask([False if level == "false" else level
+                                                                 for level in filter['levels']]))
+        return weights
+
+    def _exclude(self, weights, exclude):
+        """Apply an exclude filter as the dimension's exclude method does."""
+        dimension = exclude['dimension']
+        if not dimension.is_categorical() or is_time_dimension(dimension):
+            raise Unsupported()
+        column = self.snapshot.level_column(dimension)
+
+        levels = list(exclude.get('levels') or [])
+        if 'value' in exclude:
+            levels.append(exclude['value'])
+        return weights * (column.matches(column.code_mask(levels)) == 0)
+
+    def select(self, filters, excludes):
+        """The weight of each message after the filters and excludes."""
+        weights = self.messages
+        for filter in filters:
+            weights = self._filter(weights, filter)
+        for exclude in excludes:
+            weights = self._exclude(weights, exclude)
+        return weights
+
+    def domain(self, dimension):
+        """Return the levels of a dimension, sorted by frequency, and their labels."""
+        if hasattr(dimension, 'domain'):
+            domain = list(dimension.domain)
+        else:
+            # Only the last filter and exclude on the dimension itself apply to the domain
+            filters = [f for f in self.filters if f['dimension'].key == dimension.key][-1:]
+            excludes = [f for f in self.excludes if f['dimension'].key == dimension.key][-1:]
+            column = self.snapshot.level_column(dimension)
+            counts = column.counts(self.select(filters, excludes))
+            # Ties are broken by level, as the messages are sorted
+            counts = sorted((-count, decode_level(column.encoded_levels[code]))
+                            for code, count in counts.iteritems())
+            domain = [level for count, level in counts]
+
+        return domain, dimension.get_domain_labels(domain)
+
+    def _mask(self, dimension, domain=None):
+        if domain is None:
+            return None
+        return self.snapshot.level_column(dimension).code_mask(_matched_levels(domain))
+
+    def _count(self, weights, masks):
+        """
+        Count the rows of the join at each level (pair of levels) of the dimensions,
+        restricted to the levels in the masks, as rows of a table.
+        """
+        columns = [self.snapshot.level_column(d) for d in self.dimensions]
+        if len(columns) == 1:
+            column = columns[0]
+            return [{column.dimension.key: decode_level(column.encoded_levels[code]), 'value': value}
+                    for code, value in column.counts(weights, masks[0]).iteritems()]
+
+        primary, secondary = columns
+        selected = np.flatnonzero(weights)
+        primary_lengths = primary.lengths[selected]
+        secondary_lengths = secondary.lengths[selected]
+        pair_counts = primary_lengths * secondary_lengths
+        total = int(pair_counts.sum())
+        if total > MAX_LEVEL_PAIRS:
+            raise Unsupported()
+
+        # The rows of the join of both dimensions, for each selected message
+        offsets = np.arange(total) - np.repeat(np.cumsum(pair_counts) - pair_counts, pair_counts)
+        repeated_secondary = np.repeat(secondary_lengths, pair_counts)
+        primary_codes = primary.codes[np.repeat(primary.indptr[selected], pair_counts) +
+                                      offsets // repeated_secondary]
+        secondary_codes = secondary.codes[np.repeat(secondary.indptr[selected], pair_counts) +
+                                          offsets % repeated_secondary]
+        pair_weights = np.repeat(weights[selected], pair_counts)
+
+        keep = np.ones(total, dtype=np.bool_)
+        for codes, mask in ((primary_codes, masks[0]), (secondary_codes, masks[1])):
+            if mask is not None:
+                keep &= mask[codes]
+        keys = primary_codes[keep] * len(secondary.encoded_levels) + secondary_codes[keep]
+        keys, inverse = np.unique(keys, return_inverse=True)
+        totals = np.bincount(inverse, weights=pair_weights[keep]) if len(keys) else []
+
+        table = []
+        for key, value in zip(keys, totals):
+            if value > 0:
+                primary_code, secondary_code = divmod(int(key), len(secondary.encoded_levels))
+                table.append({primary.dimension.key: decode_level(primary.encoded_levels[primary_code]),
+                              secondary.dimension.key: decode_level(secondary.encoded_levels[secondary_code]),
+                              'value': int(value)})
+        return table
+
+    def table(self, restrictions):
+        """The counts for each level (pair of levels), restricted to some levels of each dimension."""
+        return self._count(self.select(self.filters, self.excludes),
+                           [self._mask(d, restrictions.get(d.key)) for d in self.dimensions])
+
+    def table_with_others(self, domains, primary_flag, secondary_flag):
+        """
+        The counts for the top levels of each dimension, followed by the "Other" rows,
+        as :meth:`.DataTable.render_others` counts them. The "Other" levels are added to the domains.
+        """
+        primary = self.datatable.primary_dimension
+        secondary = self.datatable.secondary_dimension
+        weights = self.select(self.filters, self.excludes)
+
+        primary_mask = self._mask(primary, domains[primary.key] if primary_flag else None)
+        primary_other = u'Other ' + primary.name
+
+        if secondary is None:
+            table = self._count(weights, [primary_mask])
+            domains[primary.key].append(primary_other)
+            in_top = self.snapshot.level_column(primary).matches(primary_mask) > 0
+            table.append({primary.key: primary_other, 'value': int(weights[~in_top].sum())})
+            return table
+
+        secondary_mask = self._mask(secondary, domains[secondary.key] if secondary_flag else None)
+        secondary_other = u'Other ' + secondary.name
+
+        # Which messages have one of the top levels, as the excludes of the "Other" levels match them
+        primary_top = self.snapshot.level_column(primary).matches(
+            primary_mask if primary_mask is not None else self._mask(primary, domains[primary.key])) > 0
+        secondary_top = self.snapshot.level_column(secondary).matches(
+            secondary_mask if secondary_mask is not None else self._mask(secondary, domains[secondary.key])) > 0
+
+        table = self._count(weights, [primary_mask, secondary_mask])
+        if primary_flag:
+            domains[primary.key].append(primary_other)
+        if secondary_flag:
+            domains[secondary.key].append(secondary_other)
+
+        if primary_flag and secondary_flag:
+            table.append({primary.key: primary_other,
+                          secondary.key: secondary_other,
+                          'value': int(weights[~primary_top & ~secondary_top].sum())})
+        if secondary_flag:
+            column = self.snapshot.level_column(primary)
+            counts = column.counts(weights * primary_top * ~secondary_top, primary_mask)
+            table.extend({primary.key: decode_level(column.encoded_levels[code]),
+                          secondary.key: secondary_other, 'value': value}
+                         for code, value in counts.iteritems())
+        if primary_flag:
+            column = self.snapshot.level_column(secondary)
+            counts = column.counts(weights * ~primary_top * secondary_top, secondary_mask)
+            table.extend({primary.key: primary_other,
+                          secondary.key: decode_level(column.encoded_levels[code]), 'value': value}
+                         for code, value in counts.iteritems())
+        return table
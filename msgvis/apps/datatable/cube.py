@@ -0,0 +1,636 @@
+"""
+A materialized cube of message counts for categorical dimensions.
+
+For a dataset, the cube stores the number of messages at each level of
+a categorical dimension, and at each pair of levels of two categorical
+dimensions, as counted by :meth:`.DataTable.render`. Cubes may also pair
+a categorical dimension with time, counted in the time bins a data table
+would use for the whole dataset.
+
+Once built, data table requests that only filter on the levels of the
+dimensions in a cube are answered from the stored counts instead of grouping
+the messages again. A one-dimensional request with a filter on another
+dimension is answered by adding up the cells of their pair.
+
+.. code-block:: python
+
+    from msgvis.apps.datatable import cube
+    cube.build(dataset, 'language', 'sender')  # also builds 'language' and 'sender'
+    cube.build(dataset, 'hashtags', 'time')
+    ...
+    cube.refresh(dataset)  # count messages imported since
+
+Refreshing only counts new messages. Changes to messages that have already
+been counted (for example reply placeholders filled in by a later import)
+require a rebuild. A cube is only used while it is up to date, so stale
+counts are never returned: the data table falls back to querying the messages.
+"""
+import json
+
+from django.db import transaction
+from django.db.models import F, Count, Max, Min, Sum
+from django.db.models.fields.related import RelatedObject
+from django.utils import dateparse
+from datetime import datetime
+
+from msgvis.apps.corpus import models as corpus_models
+from msgvis.apps.dimensions import registry
+from msgvis.apps.dimensions.models import TimeDimension
+from msgvis.apps.datatable.models import (CubeCell, CubeState,
+                                          MAX_CATEGORICAL_LEVELS, filter_time_range)
+
+# How many cells to look up at a time, within SQLite's limit on query parameters.
+# Cells are created with the batch size the database allows.
+BATCH_SIZE = 500
+
+
+def is_time_dimension(dimension):
+    """Return True for the time dimension."""
+    return isinstance(dimension, TimeDimension)
+
+
+def is_cube_dimension(dimension):
+    """Return True if the dimension can be counted in the cube."""
+    return dimension is not None and dimension.key != 'groups' and \
+        (dimension.is_categorical() or is_time_dimension(dimension))
+
+
+def cube_key(primary_key, secondary_key=None):
+    """The (primary, secondary) dimension keys the cube for one or two dimensions is stored under."""
+    if not secondary_key:
+        return primary_key, ""
+    return tuple(sorted([primary_key, secondary_key]))
+
+
+def encode_level(level):
+    """Encode a level for storing in a cell."""
+    if isinstance(level, bool):
+        # Boolean fields are counted as 0 and 1
+        level = int(level)
+    elif isinstance(level, datetime):
+        # Time bins, on databases that return them as datetimes
+        level = {'datetime': level.isoformat()}
+    return json.dumps(level, ensure_ascii=False)
+
+
+def decode_level(level):
+    """Decode a level stored in a cell."""
+    level = json.loads(level)
+    if isinstance(level, dict):
+        return dateparse.parse_datetime(level['datetime'])
+    return level
+
+
+def resolve_field(field_name):
+    """
+    Follow a dimension's field name (e.g. ``hashtags__text``) from the message model.
+    Returns the field and whether a message may have more than one value.
+    """
+    opts = corpus_models.Message._meta
+    multi_valued = False
+    parts = field_name.split('__')
+    for i, part in enumerate(parts):
+        field, model, direct, m2m = opts.get_field_by_name(part)
+        if m2m or not direct:
+            multi_valued = True
+
+        if i == len(parts) - 1:
+            if isinstance(field, RelatedObject):
+                field = field.field
+            return field, multi_valued
+
+        if direct:
+            opts = field.rel.to._meta
+        else:
+            opts = field.model._meta
+
+
+def is_time_cube(primary_key, secondary_key):
+    """Return True if a cube counts messages in time bins."""
+    return 'time' in (primary_key, secondary_key)
+
+
+def get_watermark(dataset):
+    """The id of the last message in the dataset."""
+    return dataset.message_set.aggregate(last=Max('id'))['last'] or 0
+
+
+def get_time_bin_size(dataset):
+    """The size of the time bins a data table uses for all the messages in a dataset."""
+    from msgvis.apps.datatable import domain_cache
+    time = registry.get_dimension('time')
+    min_time, max_time = domain_cache.get_range(dataset, time)
+    if min_time is None:
+        return None
+    return time.get_bin_size(min_time, max_time)
+
+
+def count_messages(dataset, primary_key, secondary_key, after_id, upto_id, time_bin_size=None):
+    """
+    Count the messages with ids in (after_id, upto_id] at each level (or pair of levels),
+    grouping them the same way as :meth:`.DataTable.render`.
+    Returns a dict from encoded levels to a [count, min time, max time] list.
+    """
+    if is_time_cube(primary_key, secondary_key) and time_bin_size is None:
+        # There are no messages with a time
+        return {}
+
+    queryset = dataset.message_set.filter(id__gt=after_id, id__lte=upto_id)
+    queryset = filter_time_range(queryset, dataset)
+
+    internal_keys = []
+    converters = []
+    for key in (primary_key, secondary_key):
+        if not key:
+            continue
+        dimension = registry.get_dimension(key)
+        if is_time_dimension(dimension):
+            expression = dimension.get_grouping_expression(queryset, bin_size=time_bin_size)
+        else:
+            expression = dimension.get_grouping_expression(queryset)
+        queryset, internal_key = dimension.select_grouping_expression(queryset, expression)
+        internal_keys.append(internal_key)
+        converters.append(dimension.get_grouping_converter(expression) or (lambda value: value))
+
+    queryset = queryset.values(*internal_keys).annotate(value=Count('id'))
+    if time_bin_size is not None:
+        queryset = queryset.annotate(min_time=Min('time'), max_time=Max('time'))
+
+    counts = {}
+    for row in queryset:
+        key = tuple(encode_level(convert(row[k])) for k, convert in zip(internal_keys, converters))
+        if len(key) == 1:
+            key += ("",)
+        counts[key] = [row['value'], row.get('min_time'), row.get('max_time')]
+    return counts
+
+
+def _add_counts(dataset, primary_key, secondary_key, counts):
+    """Add counts to the cells of a cube, creating cells that do not exist yet."""
+    pending = counts.items()
+    for start in xrange(0, len(pending), BATCH_SIZE):
+        batch = dict(pending[start:start + BATCH_SIZE])
+        cells = CubeCell.objects.filter(dataset=dataset,
+                                        primary_dimension=primary_key,
+                                        secondary_dimension=secondary_key,
+                                        primary_level__in=set(key[0] for key in batch))
+        for cell in cells.only('id', 'primary_level', 'secondary_level', 'min_time', 'max_time'):
+            added = batch.pop((cell.primary_level, cell.secondary_level), None)
+            if added:
+                amount, min_time, max_time = added
+                update = dict(count=F('count') + amount)
+                if min_time is not None:
+                    update['min_time'] = min(min_time, cell.min_time or min_time)
+                    update['max_time'] = max(max_time, cell.max_time or max_time)
+                CubeCell.objects.filter(pk=cell.pk).update(**update)
+
+        _create_cells(dataset, primary_key, secondary_key, batch.iteritems())
+
+
+def _create_cells(dataset, primary_key, secondary_key, counts):
+    CubeCell.objects.bulk_create([
+        CubeCell(dataset=dataset,
+                 primary_dimension=primary_key, secondary_dimension=secondary_key,
+                 primary_level=primary_level, secondary_level=secondary_level,
+                 count=amount, min_time=min_time, max_time=max_time)
+        for (primary_level, secondary_level), (amount, min_time, max_time) in counts
+    ])
+
+
+def build(dataset, primary_key, secondary_key=None, each_dimension=True):
+    """
+    Count all the messages in a dataset for a categorical dimension, time, or a pair of them.
+    For a pair, each of the categorical dimensions is built as well, unless each_dimension is False.
+    """
+    for key in (primary_key, secondary_key):
+        if key is not None and not is_cube_dimension(registry.get_dimension(key)):
+            raise ValueError("The dimension %s cannot be counted in the cube." % key)
+
+    if secondary_key is not None and each_dimension:
+        for key in (primary_key, secondary_key):
+            if key != 'time':
+                _build_cube(dataset, key, "")
+
+    primary_key, secondary_key = cube_key(primary_key, secondary_key)
+    return _build_cube(dataset, primary_key, secondary_key)
+
+
+def _build_cube(dataset, primary_key, secondary_key, time_bin_size=None):
+    """Replace the cells of one cube by counting all the messages."""
+    if is_time_cube(primary_key, secondary_key) and time_bin_size is None:
+        time_bin_size = get_time_bin_size(dataset)
+
+    with transaction.atomic():
+        CubeCell.objects.filter(dataset=dataset,
+                                primary_dimension=primary_key,
+                                secondary_dimension=secondary_key).delete()
+        state, created = CubeState.objects.get_or_create(dataset=dataset,
+                                                         primary_dimension=primary_key,
+                                                         secondary_dimension=secondary_key)
+
+        watermark = get_watermark(dataset)
+        counts = count_messages(dataset, primary_key, secondary_key, 0, watermark, time_bin_size)
+        _create_cells(dataset, primary_key, secondary_key,
+                      sorted(counts.iteritems(), key=lambda item: -item[1][0]))
+
+        state.last_message_id = watermark
+        state.start_time = dataset.start_time
+        state.end_time = dataset.end_time
+        state.time_bin_size = time_bin_size
+        state.save()
+
+    return state
+
+
+def refresh(dataset, rebuild=False):
+    """
+    Bring all the cubes built for a dataset up to date by counting the new messages.
+    Cubes are rebuilt from scratch if the time range of the dataset has changed,
+    if the time bins have changed, or if rebuild is True.
+    """
+    states = list(CubeState.objects.filter(dataset=dataset))
+    watermark = get_watermark(dataset)
+    time_bin_size = None
+    if any(is_time_cube(state.primary_dimension, state.secondary_dimension) for state in states):
+        time_bin_size = get_time_bin_size(dataset)
+
+    for state in states:
+        rebuild_state = rebuild or state.start_time != dataset.start_time or state.end_time != dataset.end_time
+        if is_time_cube(state.primary_dimension, state.secondary_dimension) and \
+                state.time_bin_size != time_bin_size:
+            rebuild_state = True
+
+        if rebuild_state:
+            _build_cube(dataset, state.primary_dimension, state.secondary_dimension, time_bin_size)
+            continue
+
+        if state.last_message_id >= watermark:
+            continue
+
+        with transaction.atomic():
+            counts = count_messages(dataset, state.primary_dimension, state.secondary_dimension,
+                                     state.last_message_id, watermark, state.time_bin_size)
+            _add_counts(dataset, state.primary_dimension, state.secondary_dimension, counts)
+            state.last_message_id = watermark
+            state.save()
+
+    return states
+
+
+def drop(dataset, dimension_key):
+    """
+    Delete the cubes counting a dimension, e.g. after its values have been recalculated.
+    Data tables will query the messages until the cubes are built again.
+    """
+    with transaction.atomic():
+        for field_name in ('primary_dimension', 'secondary_dimension'):
+            CubeCell.objects.filter(dataset=dataset, **{field_name: dimension_key}).delete()
+            CubeState.objects.filter(dataset=dataset, **{field_name: dimension_key}).delete()
+
+
+class Unsupported(Exception):
+    """Raised when a request cannot be answered from the cube."""
+    pass
+
+
+class LevelConstraint(object):
+    """The levels a dimension is restricted to by filters and excludes, encoded as in the cells."""
+
+    def __init__(self, dimension):
+        if not is_cube_dimension(dimension) or is_time_dimension(dimension):
+            # Only levels of categorical dimensions can be selected
+            raise Unsupported()
+
+        self.dimension = dimension
+        self.field, self.multi_valued = resolve_field(dimension.field_name)
+        self.include = None
+        self.exclude = set()
+        self.filter_count = 0
+
+    def _prepare(self, level):
+        if level is None or unicode(level).strip() == "":
+            # Messages without a value are not counted separately
+            raise Unsupported()
+        try:
+            return encode_level(self.field.get_prep_lookup('exact', level))
+        except (TypeError, ValueError):
+            raise Unsupported()
+
+    def _restrict(self, levels):
+        levels = set(levels)
+        self.include = levels if self.include is None else self.include & levels
+
+    def add_filter(self, filter):
+        """Apply a filter as :meth:`.CategoricalDimension.filter` does."""
+        if any(value for key, value in filter.iteritems() if key not in ('dimension', 'value', 'levels')):
+            raise Unsupported()
+
+        self.filter_count += 1
+        if self.multi_valued and (self.filter_count > 1 or ('value' in filter and filter.get('levels'))):
+            # Two filters on the same related field may match different values
+            raise Unsupported()
+
+        if 'value' in filter:
+            value = filter['value']
+            if value == "false":
+                value = False
+            self._restrict([self._prepare(value)])
+
+        if filter.get('levels'):
+            self._restrict([self._prepare(False if level == "false" else level)
+                            for level in filter['levels']])
+
+    def add_exclude(self, exclude):
+        """Apply an exclude filter as :meth:`.CategoricalDimension.exclude` does."""
+        if self.multi_valued:
+            # Excluding a value removes messages from every level
+            raise Unsupported()
+
+        if 'value' in exclude:
+            self.exclude.add(self._prepare(exclude['value']))
+        for level in exclude.get('levels') or []:
+            self.exclude.add(self._prepare(level))
+
+    def can_be_summed(self):
+        """Return True if adding up the counts of the allowed levels counts each message once."""
+        if not self.multi_valued:
+            return True
+        return self.include is not None and len(self.include) == 1 and not self.exclude
+
+    def apply(self, queryset, lookup):
+        """Restrict cells to the allowed levels."""
+        if self.include is not None:
+            queryset = queryset.filter(**{lookup + '__in': self.include})
+        if self.exclude:
+            queryset = queryset.exclude(**{lookup + '__in': self.exclude})
+        return queryset
+
+
+class CubeQuery(object):
+    """Answers a :meth:`.DataTable.generate` request from the cube."""
+
+    def __init__(self, datatable, dataset, constraints, domain_constraints, filtered_keys=()):
+        self.datatable = datatable
+        self.dataset = dataset
+        self.dimensions = [d for d in (datatable.primary_dimension, datatable.secondary_dimension)
+                           if d is not None]
+
+        self.constraints = constraints
+        """All the filters and excludes on each dimension, for the table."""
+
+        self.domain_constraints = domain_constraints
+        """The last filter and exclude on each dimension in the table, for the domains."""
+
+        self.filtered_keys = set(filtered_keys)
+        """The keys of the dimensions that have a filter."""
+
+        keys = [d.key for d in self.dimensions]
+        keys.extend(key for key in constraints if key not in keys)
+        self.cube_key = cube_key(*keys)
+        """The cube the table is counted from."""
+
+        self.states = {}
+
+    @classmethod
+    def create(cls, datatable, dataset, filters=None, exclude=None):
+        """
+        Returns a CubeQuery if the request can be answered from the cube, or None.
+        This requires categorical or time dimensions with up-to-date cubes, and
+        filters on the levels of at most two dimensions that do not select empty values.
+        """
+        dimensions = [d for d in (datatable.primary_dimension, datatable.secondary_dimension)
+                      if d is not None]
+        if not all(is_cube_dimension(d) for d in dimensions):
+            return None
+        keys = set(d.key for d in dimensions)
+
+        try:
+            constraints = {}
+
+            def get_constraint(dimension):
+                if dimension.key not in constraints:
+                    if len(keys | set(constraints) | set([dimension.key])) > 2:
+                        # Cubes have at most two dimensions
+                        raise Unsupported()
+                    constraints[dimension.key] = LevelConstraint(dimension)
+                return constraints[dimension.key]
+
+            last_filters = {}
+            for filter in filters or []:
+                dimension = filter['dimension']
+                get_constraint(dimension).add_filter(filter)
+                last_filters[dimension.key] = filter
+
+            last_excludes = {}
+            for exclude_filter in exclude or []:
+                dimension = exclude_filter['dimension']
+                get_constraint(dimension).add_exclude(exclude_filter)
+                last_excludes[dimension.key] = exclude_filter
+
+            for key, constraint in constraints.iteritems():
+                if key not in keys and not constraint.can_be_summed():
+                    return None
+                if key in last_filters and constraint.multi_valued and \
+                        datatable.mode in ('omit_others', 'enable_others'):
+                    # Keeping the top levels would join the related table again
+                    return None
+
+            # The domains only take the last filter on their own dimension into account
+            domain_constraints = {}
+            for dimension in dimensions:
+                if is_time_dimension(dimension):
+                    continue
+                constraint = LevelConstraint(dimension)
+                if dimension.key in last_filters:
+                    constraint.add_filter(last_filters[dimension.key])
+                if dimension.key in last_excludes:
+                    constraint.add_exclude(last_excludes[dimension.key])
+                domain_constraints[dimension.key] = constraint
+        except Unsupported:
+            return None
+
+        query = cls(datatable, dataset, constraints, domain_constraints, last_filters.keys())
+        if not query.is_fresh():
+            return None
+        return query
+
+    def required_cubes(self):
+        """The cubes needed to answer the request."""
+        cubes = set([self.cube_key])
+        for dimension in self.dimensions:
+            if not hasattr(dimension, 'domain') and not is_time_dimension(dimension):
+                cubes.add(cube_key(dimension.key))
+        return cubes
+
+    def is_fresh(self):
+        """Return True if the cubes have been built and have counted every message."""
+        required = self.required_cubes()
+        states = CubeState.objects.filter(dataset=self.dataset,
+                                          primary_dimension__in=set(key[0] for key in required))
+        states = dict(((state.primary_dimension, state.secondary_dimension), state) for state in states)
+        if not all(key in states for key in required):
+            return False
+
+        watermark = get_watermark(self.dataset)
+        for key in required:
+            state = states[key]
+            if state.last_message_id != watermark or \
+                    state.start_time != self.dataset.start_time or state.end_time != self.dataset.end_time:
+                return False
+
+        self.states = states
+        return True
+
+    def _cells(self):
+        primary_key, secondary_key = self.cube_key
+        return CubeCell.objects.filter(dataset=self.dataset,
+                                       primary_dimension=primary_key,
+                                       secondary_dimension=secondary_key)
+
+    def _lookup(self, key):
+        return 'primary_level' if key == self.cube_key[0] else 'secondary_level'
+
+    def domain(self, dimension):
+        """Return the levels of a dimension, sorted by frequency, and their labels."""
+        if hasattr(dimension, 'domain'):
+            domain = dimension.domain
+        elif is_time_dimension(dimension):
+            # The time range of all the messages
+            time_range = self._cells().aggregate(min=Min('min_time'), max=Max('max_time'))
+            domain = dimension.get_domain_for_range(time_range['min'], time_range['max'])
+        else:
+            cells = CubeCell.objects.filter(dataset=self.dataset,
+                                            primary_dimension=dimension.key,
+                                            secondary_dimension="")
+            cells = self.domain_constraints[dimension.key].apply(cells, 'primary_level')
+            # Ties are broken by level, as the messages are sorted
+            counts = sorted((-count, decode_level(level))
+                            for count, level in cells.values_list('count', 'primary_level'))
+            domain = [level for count, level in counts]
+
+        return domain, dimension.get_domain_labels(domain)
+
+    def table(self, restrictions):
+        """The counts for each level (pair of levels), restricted to some levels of each dimension."""
+        cells = self._cells()
+        for key, constraint in self.constraints.iteritems():
+            cells = constraint.apply(cells, self._lookup(key))
+        for key, levels in restrictions.iteritems():
+            levels = set(encode_level(level) for level in levels)
+            cells = cells.filter(**{self._lookup(key) + '__in': levels})
+
+        for dimension in self.dimensions:
+            if is_time_dimension(dimension):
+                # The time bins depend on the time range of the selected messages
+                time_range = cells.aggregate(min=Min('min_time'), max=Max('max_time'))
+                if time_range['min'] is None:
+                    return []
+                bin_size = dimension.get_bin_size(time_range['min'], time_range['max'])
+                if bin_size != self.states[self.cube_key].time_bin_size:
+                    raise Unsupported()
+
+        keys = [d.key for d in self.dimensions]
+        lookups = [self._lookup(key) for key in keys]
+        if len(keys) == len([key for key in self.cube_key if key]):
+            rows = cells.order_by('id').values_list(*(lookups + ['count']))
+        else:
+            # Add up the levels of the filtered dimension
+            rows = cells.order_by().values(*lookups).annotate(total=Sum('count'))
+            rows = rows.values_list(*(lookups + ['total']))
+
+        table = []
+        for row in rows:
+            result = dict((key, decode_level(level)) for key, level in zip(keys, row))
+            result['value'] = row[-1]
+            table.append(result)
+        return table
+
+    def table_with_others(self, domains, primary_flag, secondary_flag):
+        """
+        The counts for the top levels of each dimension, followed by the "Other" rows,
+        as :meth:`.DataTable.render_others` counts them. The "Other" levels are added to the domains.
+        """
+        if not self.datatable.can_fold_others(primary_flag, secondary_flag):
+            raise Unsupported()
+        table, others = self.datatable.fold_others(self.table({}), domains, primary_flag, secondary_flag)
+        table.extend(others)
+        return table
+
+    def generate(self, page_size=100, page=None, search_key=None):
+        """
+        Return the same results as :meth:`.DataTable.generate`.
+        Raises :class:`Unsupported` if the time bins for the request were not counted,
+        or if the "Other" levels cannot be counted from the cube.
+        """
+        from msgvis.apps.datatable import domain_cache
+
+        datatable = self.datatable
+        primary = datatable.primary_dimension
+        secondary = datatable.secondary_dimension
+        keep_top = datatable.mode in ('omit_others', 'enable_others')
+
+        domains = {}
+        domain_labels = {}
+        max_page = None
+        restrictions = {}
+        primary_flag = False
+        secondary_flag = False
+
+        domain, labels = self.domain(primary)
+
+        # paging the first dimension, this is for the filter distribution
+        if primary.key not in self.filtered_keys and secondary is None and page is not None:
+            if is_time_dimension(primary):
+                raise Unsupported()
+
+            if search_key is not None:
+                domain, labels = domain_cache.select_levels(domain, labels, search=search_key)
+            start = (page - 1) * page_size
+            end = min(start + page_size, len(domain))
+            max_page = (len(domain) / page_size) + 1
+
+            # no level left
+            if len(domain) == 0 or start > len(domain):
+                return None
+
+            domain = domain[start:end]
+            if labels is not None:
+                labels = labels[start:end]
+            restrictions[primary.key] = domain
+        elif keep_top and primary.is_categorical() and len(domain) > MAX_CATEGORICAL_LEVELS:
+            primary_flag = True
+            domain = domain[:MAX_CATEGORICAL_LEVELS]
+            restrictions[primary.key] = domain
+            if labels is not None:
+                labels = labels[:MAX_CATEGORICAL_LEVELS]
+
+        domains[primary.key] = domain
+        if labels is not None:
+            domain_labels[primary.key] = labels
+
+        if secondary:
+            domain, labels = self.domain(secondary)
+            if keep_top and secondary.is_categorical() and len(domain) > MAX_CATEGORICAL_LEVELS:
+                secondary_flag = True
+                domain = domain[:MAX_CATEGORICAL_LEVELS]
+                restrictions[secondary.key] = domain
+                if labels is not None:
+                    labels = labels[:MAX_CATEGORICAL_LEVELS]
+
+            domains[secondary.key] = domain
+            if labels is not None:
+                domain_labels[secondary.key] = labels
+
+        if datatable.mode == 'enable_others' and (primary_flag or secondary_flag):
+            table = self.table_with_others(domains, primary_flag, secondary_flag)
+        else:
+            table = self.table(restrictions)
+
+        results = {
+            'table': table,
+            'domains': domains,
+            'domain_labels': domain_labels
+        }
+        if max_page is not None:
+            results['max_page'] = max_page
+        return results
@@ -0,0 +1,214 @@
+"""
+A persistent cache of the domains and ranges of dimensions in each dataset.
+
+Finding the domain of a dimension groups all the messages of a dataset, and
+the range of a quantitative dimension takes a MIN/MAX aggregate over them,
+on every data table request. Both only change when messages are imported
+or enhanced, so they are stored per dataset, dimension and number of bins
+the first time they are needed, and read back afterwards.
+:meth:`.DataTable.generate` reads the domains of dimensions without filters
+from the cache, and the ranges when the messages are not filtered.
+
+.. code-block:: python
+
+    from msgvis.apps.datatable import domain_cache
+    domain, labels = domain_cache.get_domain(dataset, dimension)
+    domain, labels = domain_cache.get_domain(dataset, dimension, limit=10, offset=20, search="oso")
+    min_val, max_val = domain_cache.get_range(dataset, dimension)
+    ...
+    domain_cache.invalidate(dataset, 'topics')  # after recalculating a dimension
+    domain_cache.warm(dataset)
+
+The levels of categorical dimensions are stored in order as :class:`.DomainLevel` rows,
+so that a page of the domain, or the levels matching a search, are read without
+loading the others.
+
+Domains and ranges are over the messages data tables count (see :func:`.filter_time_range`).
+Stored values are found again once messages are added to the dataset or its time
+range changes. Anything else that changes the values of a dimension must call
+:func:`invalidate`.
+"""
+import json
+from datetime import datetime
+
+from django.db import transaction, IntegrityError
+from django.utils import dateparse
+
+from msgvis.apps.dimensions import registry
+from msgvis.apps.datatable.models import DimensionDomain, DomainLevel, filter_time_range
+from msgvis.apps.datatable.cube import get_watermark
+
+
+class ValueEncoder(json.JSONEncoder):
+    """Encodes levels and values, with datetimes as ``{"datetime": iso}``."""
+
+    def default(self, obj):
+        if isinstance(obj, datetime):
+            return {'datetime': obj.isoformat()}
+        return super(ValueEncoder, self).default(obj)
+
+
+def _decode_object(obj):
+    if obj.keys() == ['datetime']:
+        return dateparse.parse_datetime(obj['datetime'])
+    return obj
+
+
+def encode(value):
+    """Encode a domain or value for storing."""
+    return json.dumps(value, cls=ValueEncoder, ensure_ascii=False)
+
+
+def decode(value):
+    """Decode a stored domain or value."""
+    return json.loads(value, object_hook=_decode_object)
+
+
+def select_levels(domain, labels, limit=None, offset=0, search=None):
+    """
+    Keep the levels of a domain containing the search string (ignoring case),
+    and at most limit levels after offset, as :meth:`.CategoricalDimension.get_domain` selects them.
+    Returns the selected levels and their labels.
+    """
+    if search is None and limit is None and not offset:
+        return domain, labels
+
+    indices = range(len(domain))
+    if search is not None:
+        search = search.lower()
+        indices = [i for i in indices
+                   if domain[i] is not None and unicode(domain[i]).lower().find(search) != -1]
+    indices = indices[offset:] if limit is None else indices[offset:offset + limit]
+
+    domain = [domain[i] for i in indices]
+    if labels is not None:
+        labels = [labels[i] for i in indices]
+    return domain, labels
+
+
+def is_cached_dimension(dimension):
+    """Return True if the domain of the dimension is found from the messages, and can be cached."""
+    return dimension.key != 'groups' and not hasattr(dimension, 'domain')
+
+
+def _find(dataset, dimension, bins):
+    """
+    Find the domain and range of a dimension over the messages of a dataset.
+    The domain of a categorical dimension is stored as levels, and None is returned.
+    """
+    queryset = filter_time_range(dataset.message_set.all(), dataset)
+    if dimension.is_categorical():
+        DomainLevel.objects.filter(dataset=dataset, dimension=dimension.key).delete()
+        DomainLevel.objects.bulk_create([
+            DomainLevel(dataset=dataset, dimension=dimension.key, rank=rank, level=encode(level),
+                        text=None if level is None else unicode(level))
+            for rank, level in enumerate(dimension.get_domain(queryset, bins=bins))
+        ])
+        return None, None, None
+
+    min_val, max_val = dimension.get_range(queryset)
+    return dimension.get_domain_for_range(min_val, max_val, bins), min_val, max_val
+
+
+def _is_fresh(entry, dataset, watermark):
+    return entry.last_message_id == watermark and \
+        entry.start_time == dataset.start_time and entry.end_time == dataset.end_time
+
+
+def _load(dataset, dimension, bins):
+    """The stored domain and range of a dimension, finding them again if needed."""
+    watermark = get_watermark(dataset)
+    entry = DimensionDomain.objects.filter(dataset=dataset, dimension=dimension.key, bins=bins).first()
+    if entry is not None and _is_fresh(entry, dataset, watermark):
+        return entry
+
+    if entry is None:
+        entry = DimensionDomain(dataset=dataset, dimension=dimension.key, bins=bins)
+
+    try:
+        with transaction.atomic():
+            domain, min_val, max_val = _find(dataset, dimension, bins)
+            entry.domain = encode(domain)
+            entry.min_value = encode(min_val)
+            entry.max_value = encode(max_val)
+            entry.last_message_id = watermark
+            entry.start_time = dataset.start_time
+            entry.end_time = dataset.end_time
+            entry.save()
+    except IntegrityError:
+        # Another process stored it first
+        pass
+    return entry
+
+
+def _levels(dataset, dimension, search=None):
+    levels = DomainLevel.objects.filter(dataset=dataset, dimension=dimension.key)
+    if search is not None:
+        levels = levels.filter(text__icontains=search)
+    return levels
+
+
+def get_domain(dataset, dimension, bins=None, limit=None, offset=0, search=None):
+    """
+    The levels of a dimension sorted by frequency, or the bins of a quantitative
+    dimension, over the messages of a dataset, and their labels.
+    Optionally, only the levels of a categorical dimension containing a search string
+    (ignoring case), and at most limit levels after offset, are read.
+    """
+    if not is_cached_dimension(dimension):
+        domain = dimension.get_domain(filter_time_range(dataset.message_set.all(), dataset), bins=bins)
+    elif not dimension.is_categorical():
+        domain = decode(_load(dataset, dimension, bins).domain)
+    else:
+        _load(dataset, dimension, None)
+        levels = _levels(dataset, dimension, search).order_by('rank')
+        if limit is not None:
+            levels = levels[offset:offset + limit]
+        elif offset:
+            levels = levels[offset:]
+        domain = [decode(level) for level in levels.values_list('level', flat=True)]
+        return domain, dimension.get_domain_labels(domain)
+
+    return select_levels(domain, dimension.get_domain_labels(domain), limit, offset, search)
+
+
+def get_domain_size(dataset, dimension, bins=None, search=None):
+    """The number of levels in the domain of a dimension, optionally only those containing a search string."""
+    if not is_cached_dimension(dimension) or not dimension.is_categorical():
+        return len(get_domain(dataset, dimension, bins, search=search)[0])
+
+    _load(dataset, dimension, None)
+    return _levels(dataset, dimension, search).count()
+
+
+def get_range(dataset, dimension):
+    """The min and max of a quantitative dimension over the messages of a dataset, or (None, None)."""
+    entry = _load(dataset, dimension, None)
+    return decode(entry.min_value), decode(entry.max_value)
+
+
+def invalidate(dataset, dimension_key=None):
+    """Forget the domains of a dimension, or of all dimensions, in a dataset."""
+    entries = DimensionDomain.objects.filter(dataset=dataset)
+    levels = DomainLevel.objects.filter(dataset=dataset)
+    if dimension_key is not None:
+        entries = entries.filter(dimension=dimension_key)
+        levels = levels.filter(dimension=dimension_key)
+    with transaction.atomic():
+        entries.delete()
+        levels.delete()
+
+
+def warm(dataset, dimension_keys=None):
+    """
+    Find and store the default domains of some dimensions, or of all that can be cached.
+    Returns the number of domains found.
+    """
+    if dimension_keys is None:
+        dimensions = [d for d in registry.get_dimensions() if is_cached_dimension(d)]
+    else:
+        dimensions = [registry.get_dimension(key) for key in dimension_keys]
+
+    for dimension in dimensions:
+        _load(dataset, dimension, None)
+    return len(dimensions)
@@ -0,0 +1,143 @@
+"""
+Compact layouts of data table results, for sending large tables.
+
+A generated table is a list of rows like ``{"hashtags": "#oso", "time": ..., "value": 3}``,
+repeating the dimension keys in every row. In the ``columns`` layout, the table
+has one array per dimension, giving the position of each row's level in the
+dimension's ``levels``, and one array of values:
+
+.. code-block:: python
+
+    {
+        "layout": "columns",
+        "levels": {"hashtags": ["#oso", "#mudslide"], "time": [t0, t1]},
+        "columns": {"hashtags": [0, 0, 1], "time": [0, 1, 0]},
+        "values": [3, 1, 2]
+    }
+
+In the ``matrix`` layout, for tables of one or two dimensions, the values are dense:
+one value for each level of the dimension, or one row for each level of the first
+dimension with a value for each level of the second. Missing cells are 0.
+
+.. code-block:: python
+
+    {
+        "layout": "matrix",
+        "levels": {"hashtags": ["#oso", "#mudslide"], "time": [t0, t1]},
+        "dimensions": ["hashtags", "time"],
+        "values": [[3, 1], [2, 0]]
+    }
+
+The levels of a dimension are its domain in the result, followed by any levels
+of the table that are not in it, so the positions of the domain are unchanged.
+
+.. code-block:: python
+
+    from msgvis.apps.datatable import layouts
+    result = datatable.generate(dataset)
+    compact = layouts.apply_layout(result, ['hashtags', 'time'], 'columns')
+"""
+
+# The default layout is the list of rows from :meth:`.DataTable.generate`
+LAYOUTS = ('rows', 'columns', 'matrix')
+
+
+def _table_keys(table, keys):
+    """The keys of the table's dimensions, in order, including groups if the rows have them."""
+    keys = list(keys)
+    if 'groups' not in keys and len(table) > 0 and 'groups' in table[0]:
+        keys.append('groups')
+    return keys
+
+
+class LevelIndex(object):
+    """The positions of the levels of a dimension, starting with its domain."""
+
+    def __init__(self, domain):
+        self.levels = list(domain or [])
+        self.positions = {}
+        for position, level in enumerate(self.levels):
+            self.positions.setdefault(level, position)
+
+    def __getitem__(self, level):
+        position = self.positions.get(level)
+        if position is None:
+            position = len(self.levels)
+            self.levels.append(level)
+            self.positions[level] = position
+        return position
+
+
+def to_columns(table, keys, domains):
+    """Lay out a list of rows as a position array per dimension and an array of values."""
+    table = list(table)
+    keys = _table_keys(table, keys)
+    indexes = dict((key, LevelIndex(domains.get(key))) for key in keys)
+    columns = dict((key, []) for key in keys)
+    values = []
+    for row in table:
+        for key in keys:
+            columns[key].append(indexes[key][row[key]])
+        values.append(row['value'])
+
+    return {
+        'layout': 'columns',
+        'levels': dict((key, index.levels) for key, index in indexes.iteritems()),
+        'columns': columns,
+        'values': values,
+    }
+
+
+def to_matrix(table, keys, domains):
+    """
+    Lay out a list of rows as a dense list (one dimension) or list of lists (two dimensions) of values.
+    Raises ValueError for tables with more dimensions.
+    """
+    table = list(table)
+    keys = _table_keys(table, keys)
+    if not 1 <= len(keys) <= 2:
+        raise ValueError("Only tables of one or two dimensions can be laid out as a matrix.")
+
+    indexes = [LevelIndex(domains.get(key)) for key in keys]
+    cells = {}
+    for row in table:
+        cell = tuple(index[row[key]] for key, index in zip(keys, indexes))
+        cells[cell] = cells.get(cell, 0) + row['value']
+
+    if len(keys) == 1:
+        values = [0] * len(indexes[0].levels)
+        for (i,), value in cells.iteritems():
+            values[i] = value
+    else:
+        values = [[0] * len(indexes[1].levels) for level in indexes[0].levels]
+        for (i, j), value in cells.iteritems():
+            values[i][j] = value
+
+    return {
+        'layout': 'matrix',
+        'levels': dict((key, index.levels) for key, index in zip(keys, indexes)),
+        'dimensions': keys,
+        'values': values,
+    }
+
+
+def apply_layout(result, keys, layout):
+    """
+    Get a copy of a :meth:`.DataTable.generate` result with its tables in a layout.
+    The keys are those of the requested dimensions, in order.
+    """
+    if result is None or layout is None or layout == 'rows':
+        return result
+    if layout not in LAYOUTS:
+        raise ValueError("Unknown layout %s" % layout)
+
+    lay_out = to_columns if layout == 'columns' else to_matrix
+    domains = result.get('domains', {})
+
+    result = dict(result)
+    if result.get('table') is not None:
+        result['table'] = lay_out(result['table'], keys, domains)
+    if result.get('tables') is not None:
+        result['tables'] = [dict(group, table=lay_out(group['table'], keys, domains))
+                            for group in result['tables']]
+    return result
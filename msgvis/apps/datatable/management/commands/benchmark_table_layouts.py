@@ -0,0 +1,72 @@
+from django.core.management.base import BaseCommand, make_option, CommandError
+from time import time
+
+
+class Command(BaseCommand):
+    help = "Compare the size and encoding time of a data table response in each layout."
+    args = "<dataset id> <dimension> [dimension]"
+    option_list = BaseCommand.option_list + (
+        make_option('--repeat',
+                    action='store',
+                    dest='repeat',
+                    type='int',
+                    default=5,
+                    help='How many times to encode each layout'),
+    )
+
+    def handle(self, dataset_id=None, *dimension_keys, **options):
+
+        if not dataset_id:
+            raise CommandError("Dataset id is required.")
+        try:
+            dataset_id = int(dataset_id)
+        except ValueError:
+            raise CommandError("Dataset id must be a number.")
+        if not 1 <= len(dimension_keys) <= 2:
+            raise CommandError("Give one or two dimensions.")
+
+        from rest_framework.renderers import JSONRenderer
+        from msgvis.apps.corpus.models import Dataset
+        from msgvis.apps.datatable.models import DataTable
+        from msgvis.apps.datatable import layouts
+        from msgvis.apps.api.serializers import DataTableSerializer
+        from msgvis.apps.api.renderers import iter_json
+
+        try:
+            dataset = Dataset.objects.get(id=dataset_id)
+        except Dataset.DoesNotExist:
+            raise CommandError("Dataset %d does not exist." % dataset_id)
+
+        request = DataTableSerializer(data={'dataset': dataset_id, 'dimensions': list(dimension_keys)})
+        if not request.is_valid():
+            raise CommandError("Invalid request: %s" % request.errors)
+        data = request.validated_data
+
+        start = time()
+        result = DataTable(*data['dimensions']).generate(dataset)
+        if result is None:
+            raise CommandError("There is no data table.")
+        result['table'] = list(result['table'])
+        print "Generated %d cells in %.2fs" % (len(result['table']), time() - start)
+
+        def encode_rows():
+            response_data = dict(data, result=result)
+            return JSONRenderer().render(DataTableSerializer(response_data).data)
+
+        def encode_layout(layout):
+            def encode():
+                response_data = DataTableSerializer(data).data
+                response_data['result'] = layouts.apply_layout(result, dimension_keys, layout)
+                return ''.join(iter_json(response_data))
+            return encode
+
+        encoders = [('rows', encode_rows), ('columns', encode_layout('columns')), ('matrix', encode_layout('matrix'))]
+
+        repeat = max(1, options.get('repeat'))
+        print "%-8s %12s %12s" % ("Layout", "Bytes", "Encode (ms)")
+        for layout, encode in encoders:
+            start = time()
+            for i in xrange(repeat):
+                body = encode()
+            elapsed = (time() - start) / repeat
+            print "%-8s %12d %12.1f" % (layout, len(body), elapsed * 1000)
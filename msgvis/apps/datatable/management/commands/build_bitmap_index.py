@@ -0,0 +1,60 @@
+from django.core.management.base import BaseCommand, make_option, CommandError
+from time import time
+
+
+class Command(BaseCommand):
+    help = "Index the messages at each level of categorical dimensions so data tables can be served by intersecting bitmaps."
+    args = "<dataset id> [dimension...]"
+    option_list = BaseCommand.option_list + (
+        make_option('--refresh',
+                    action='store_true',
+                    dest='refresh',
+                    default=False,
+                    help='Add new messages to the indexes already built for the dataset'),
+        make_option('--rebuild',
+                    action='store_true',
+                    dest='rebuild',
+                    default=False,
+                    help='Index all messages again in the indexes already built for the dataset'),
+    )
+
+    def handle(self, dataset_id, *dimensions, **options):
+
+        if not dataset_id:
+            raise CommandError("Dataset id is required.")
+        try:
+            dataset_id = int(dataset_id)
+        except ValueError:
+            raise CommandError("Dataset id must be a number.")
+
+        from msgvis.apps.corpus.models import Dataset
+        from msgvis.apps.dimensions import registry
+        from msgvis.apps.datatable import bitmap_index
+
+        try:
+            dataset = Dataset.objects.get(id=dataset_id)
+        except Dataset.DoesNotExist:
+            raise CommandError("Dataset %d does not exist." % dataset_id)
+
+        for key in dimensions:
+            try:
+                dimension = registry.get_dimension(key)
+            except KeyError:
+                raise CommandError("Unknown dimension %s" % key)
+            if not bitmap_index.is_index_dimension(dimension):
+                raise CommandError("The dimension %s cannot be indexed" % key)
+
+        if len(dimensions) == 0 and not (options.get('refresh') or options.get('rebuild')):
+            raise CommandError("Give at least one dimension, or --refresh or --rebuild.")
+
+        start = time()
+        if options.get('refresh') or options.get('rebuild'):
+            states = bitmap_index.refresh(dataset, rebuild=options.get('rebuild'))
+            print "Updated %d indexes" % len(states)
+
+        for key in dimensions:
+            print "Indexing %s..." % key
+            bitmap_index.build(dataset, key)
+            print "  %d levels" % dataset.level_bitmaps.filter(dimension=key).count()
+
+        print "Time: %.2fs" % (time() - start)
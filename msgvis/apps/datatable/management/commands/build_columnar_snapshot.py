@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand, make_option, CommandError
+from time import time
+
+
+class Command(BaseCommand):
+    help = "Save the columns of the messages in a dataset so data tables can be counted in memory."
+    args = "<dataset id>"
+    option_list = BaseCommand.option_list + (
+        make_option('--refresh',
+                    action='store_true',
+                    dest='refresh',
+                    default=False,
+                    help='Only rebuild the snapshot if there is one and messages were imported since'),
+        make_option('--drop',
+                    action='store_true',
+                    dest='drop',
+                    default=False,
+                    help='Delete the snapshot'),
+    )
+
+    def handle(self, dataset_id, **options):
+
+        if not dataset_id:
+            raise CommandError("Dataset id is required.")
+        try:
+            dataset_id = int(dataset_id)
+        except ValueError:
+            raise CommandError("Dataset id must be a number.")
+
+        from msgvis.apps.corpus.models import Dataset
+        from msgvis.apps.datatable import columnar
+
+        try:
+            dataset = Dataset.objects.get(id=dataset_id)
+        except Dataset.DoesNotExist:
+            raise CommandError("Dataset %d does not exist." % dataset_id)
+
+        start = time()
+        if options.get('drop'):
+            columnar.drop(dataset)
+            print "Deleted the snapshot"
+            return
+
+        if options.get('refresh'):
+            snapshot = columnar.refresh(dataset)
+            if snapshot is None:
+                print "There is no snapshot to refresh"
+                return
+        else:
+            snapshot = columnar.build(dataset)
+
+        print "%d messages in %s" % (snapshot.count, snapshot.path)
+        print "Time: %.2fs" % (time() - start)
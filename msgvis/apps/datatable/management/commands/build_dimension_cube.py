@@ -0,0 +1,67 @@
+from django.core.management.base import BaseCommand, make_option, CommandError
+from time import time
+
+
+class Command(BaseCommand):
+    help = "Count messages by categorical dimensions or time (or pairs of them) so data tables can be served from the counts."
+    args = "<dataset id> [dimension or dimension:dimension...]"
+    option_list = BaseCommand.option_list + (
+        make_option('--refresh',
+                    action='store_true',
+                    dest='refresh',
+                    default=False,
+                    help='Count new messages in the cubes already built for the dataset'),
+        make_option('--rebuild',
+                    action='store_true',
+                    dest='rebuild',
+                    default=False,
+                    help='Recount all messages in the cubes already built for the dataset'),
+    )
+
+    def handle(self, dataset_id, *dimensions, **options):
+
+        if not dataset_id:
+            raise CommandError("Dataset id is required.")
+        try:
+            dataset_id = int(dataset_id)
+        except ValueError:
+            raise CommandError("Dataset id must be a number.")
+
+        from msgvis.apps.corpus.models import Dataset
+        from msgvis.apps.dimensions import registry
+        from msgvis.apps.datatable import cube
+
+        try:
+            dataset = Dataset.objects.get(id=dataset_id)
+        except Dataset.DoesNotExist:
+            raise CommandError("Dataset %d does not exist." % dataset_id)
+
+        pairs = []
+        for spec in dimensions:
+            keys = spec.split(':')
+            if len(keys) > 2:
+                raise CommandError("Give one dimension or two separated by a colon, not %s" % spec)
+            for key in keys:
+                try:
+                    dimension = registry.get_dimension(key)
+                except KeyError:
+                    raise CommandError("Unknown dimension %s" % key)
+                if not cube.is_cube_dimension(dimension):
+                    raise CommandError("The dimension %s cannot be counted in a cube" % key)
+            pairs.append(keys)
+
+        if len(pairs) == 0 and not (options.get('refresh') or options.get('rebuild')):
+            raise CommandError("Give at least one dimension, or --refresh or --rebuild.")
+
+        start = time()
+        if options.get('refresh') or options.get('rebuild'):
+            states = cube.refresh(dataset, rebuild=options.get('rebuild'))
+            print "Updated %d cubes" % len(states)
+
+        for keys in pairs:
+            print "Counting %s..." % " x ".join(keys)
+            state = cube.build(dataset, *keys)
+            print "  %d cells" % dataset.cube_cells.filter(primary_dimension=state.primary_dimension,
+                                                          secondary_dimension=state.secondary_dimension).count()
+
+        print "Time: %.2fs" % (time() - start)
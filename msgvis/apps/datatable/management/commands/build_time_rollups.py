@@ -0,0 +1,64 @@
+from django.core.management.base import BaseCommand, make_option, CommandError
+from time import time
+
+
+class Command(BaseCommand):
+    help = "Count messages in time bins of every size, alone or by categorical dimensions, so time histograms can be served from the counts."
+    args = "<dataset id> [time or dimension...]"
+    option_list = BaseCommand.option_list + (
+        make_option('--refresh',
+                    action='store_true',
+                    dest='refresh',
+                    default=False,
+                    help='Count new messages in the rollups already built for the dataset'),
+        make_option('--rebuild',
+                    action='store_true',
+                    dest='rebuild',
+                    default=False,
+                    help='Recount all messages in the rollups already built for the dataset'),
+    )
+
+    def handle(self, dataset_id, *dimensions, **options):
+
+        if not dataset_id:
+            raise CommandError("Dataset id is required.")
+        try:
+            dataset_id = int(dataset_id)
+        except ValueError:
+            raise CommandError("Dataset id must be a number.")
+
+        from msgvis.apps.corpus.models import Dataset
+        from msgvis.apps.dimensions import registry
+        from msgvis.apps.datatable import rollup
+
+        try:
+            dataset = Dataset.objects.get(id=dataset_id)
+        except Dataset.DoesNotExist:
+            raise CommandError("Dataset %d does not exist." % dataset_id)
+
+        # 'time' rolls up time alone
+        dimensions = [None if key == 'time' else key for key in dimensions]
+        for key in dimensions:
+            if key is None:
+                continue
+            try:
+                dimension = registry.get_dimension(key)
+            except KeyError:
+                raise CommandError("Unknown dimension %s" % key)
+            if not rollup.is_rollup_dimension(dimension):
+                raise CommandError("Time cannot be rolled up by the dimension %s" % key)
+
+        if len(dimensions) == 0 and not (options.get('refresh') or options.get('rebuild')):
+            raise CommandError("Give time or at least one dimension, or --refresh or --rebuild.")
+
+        start = time()
+        if options.get('refresh') or options.get('rebuild'):
+            states = rollup.refresh(dataset, rebuild=options.get('rebuild'))
+            print "Updated %d rollups" % len(states)
+
+        for key in dimensions:
+            print "Rolling up time%s..." % (" x %s" % key if key else "")
+            rollup.build(dataset, key)
+            print "  %d rows" % dataset.time_rollups.filter(dimension=key or "").count()
+
+        print "Time: %.2fs" % (time() - start)
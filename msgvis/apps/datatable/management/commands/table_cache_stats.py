@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, make_option
+
+
+class Command(BaseCommand):
+    help = "Show how often data table results were found in the cache."
+    option_list = BaseCommand.option_list + (
+        make_option('--reset',
+                    action='store_true',
+                    dest='reset',
+                    default=False,
+                    help='Start counting again'),
+    )
+
+    def handle(self, *args, **options):
+        from msgvis.apps.datatable.cache import table_cache
+
+        stats = table_cache.stats()
+        hit_rate = "-" if stats['hit_rate'] is None else "%.1f%%" % (100 * stats['hit_rate'])
+        print "Hits: %d; Misses: %d; Hit rate: %s" % (stats['hits'], stats['misses'], hit_rate)
+
+        if options.get('reset'):
+            table_cache.reset_stats()
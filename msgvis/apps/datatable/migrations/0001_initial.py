@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import msgvis.apps.base.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('corpus', '0021_dataset_has_prefetched_images'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CubeCell',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('primary_dimension', models.CharField(max_length=64)),
+                ('secondary_dimension', models.CharField(default=b'', max_length=64, blank=True)),
+                ('primary_level', msgvis.apps.base.models.Utf8TextField()),
+                ('secondary_level', msgvis.apps.base.models.Utf8TextField(default=b'', blank=True)),
+                ('count', models.IntegerField(default=0)),
+                ('dataset', models.ForeignKey(related_name='cube_cells', to='corpus.Dataset')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='CubeState',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('primary_dimension', models.CharField(max_length=64)),
+                ('secondary_dimension', models.CharField(default=b'', max_length=64, blank=True)),
+                ('last_message_id', models.IntegerField(default=0)),
+                ('start_time', models.DateTimeField(default=None, null=True, blank=True)),
+                ('end_time', models.DateTimeField(default=None, null=True, blank=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('dataset', models.ForeignKey(related_name='cube_states', to='corpus.Dataset')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='cubestate',
+            unique_together=set([('dataset', 'primary_dimension', 'secondary_dimension')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='cubecell',
+            index_together=set([('dataset', 'primary_dimension', 'secondary_dimension')]),
+        ),
+    ]
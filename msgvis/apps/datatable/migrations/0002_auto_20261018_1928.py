@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datatable', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cubecell',
+            name='max_time',
+            field=models.DateTimeField(default=None, null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='cubecell',
+            name='min_time',
+            field=models.DateTimeField(default=None, null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='cubestate',
+            name='time_bin_size',
+            field=models.FloatField(default=None, null=True, blank=True),
+            preserve_default=True,
+        ),
+    ]
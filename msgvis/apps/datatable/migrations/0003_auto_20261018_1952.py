@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import msgvis.apps.base.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('corpus', '0021_dataset_has_prefetched_images'),
+        ('datatable', '0002_auto_20261018_1928'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BitmapIndexState',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('dimension', models.CharField(max_length=64)),
+                ('last_message_id', models.IntegerField(default=0)),
+                ('start_time', models.DateTimeField(default=None, null=True, blank=True)),
+                ('end_time', models.DateTimeField(default=None, null=True, blank=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('dataset', models.ForeignKey(related_name='bitmap_index_states', to='corpus.Dataset')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='LevelBitmap',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('dimension', models.CharField(max_length=64)),
+                ('level', msgvis.apps.base.models.Utf8TextField()),
+                ('count', models.IntegerField(default=0)),
+                ('bitmap', models.BinaryField()),
+                ('dataset', models.ForeignKey(related_name='level_bitmaps', to='corpus.Dataset')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='bitmapindexstate',
+            unique_together=set([('dataset', 'dimension')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='levelbitmap',
+            index_together=set([('dataset', 'dimension')]),
+        ),
+    ]
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import msgvis.apps.base.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('corpus', '0021_dataset_has_prefetched_images'),
+        ('datatable', '0003_auto_20261018_1952'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TimeRollup',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('dimension', models.CharField(default='', max_length=64, blank=True)),
+                ('bin_size', models.FloatField()),
+                ('time', models.CharField(max_length=64)),
+                ('level', msgvis.apps.base.models.Utf8TextField(default='', blank=True)),
+                ('count', models.IntegerField(default=0)),
+                ('min_time', models.DateTimeField(default=None, null=True, blank=True)),
+                ('max_time', models.DateTimeField(default=None, null=True, blank=True)),
+                ('dataset', models.ForeignKey(related_name='time_rollups', to='corpus.Dataset')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='TimeRollupState',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('dimension', models.CharField(default='', max_length=64, blank=True)),
+                ('last_message_id', models.IntegerField(default=0)),
+                ('start_time', models.DateTimeField(default=None, null=True, blank=True)),
+                ('end_time', models.DateTimeField(default=None, null=True, blank=True)),
+                ('min_time', models.DateTimeField(default=None, null=True, blank=True)),
+                ('max_time', models.DateTimeField(default=None, null=True, blank=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('dataset', models.ForeignKey(related_name='time_rollup_states', to='corpus.Dataset')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='timerollupstate',
+            unique_together=set([('dataset', 'dimension')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='timerollup',
+            index_together=set([('dataset', 'dimension', 'bin_size')]),
+        ),
+    ]
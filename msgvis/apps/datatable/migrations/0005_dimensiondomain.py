@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import msgvis.apps.base.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('corpus', '0021_dataset_has_prefetched_images'),
+        ('datatable', '0004_auto_20261018_2034'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DimensionDomain',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('dimension', models.CharField(max_length=64)),
+                ('bins', models.IntegerField(default=None, null=True, blank=True)),
+                ('domain', msgvis.apps.base.models.Utf8TextField()),
+                ('min_value', msgvis.apps.base.models.Utf8TextField(default='null')),
+                ('max_value', msgvis.apps.base.models.Utf8TextField(default='null')),
+                ('last_message_id', models.IntegerField(default=0)),
+                ('start_time', models.DateTimeField(default=None, null=True, blank=True)),
+                ('end_time', models.DateTimeField(default=None, null=True, blank=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('dataset', models.ForeignKey(related_name='dimension_domains', to='corpus.Dataset')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='dimensiondomain',
+            unique_together=set([('dataset', 'dimension', 'bins')]),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import msgvis.apps.base.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('corpus', '0021_dataset_has_prefetched_images'),
+        ('datatable', '0005_dimensiondomain'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DomainLevel',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('dimension', models.CharField(max_length=64)),
+                ('rank', models.IntegerField()),
+                ('level', msgvis.apps.base.models.Utf8TextField()),
+                ('text', msgvis.apps.base.models.Utf8TextField(default=None, null=True, blank=True)),
+                ('dataset', models.ForeignKey(related_name='domain_levels', to='corpus.Dataset')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterIndexTogether(
+            name='domainlevel',
+            index_together=set([('dataset', 'dimension', 'rank')]),
+        ),
+    ]
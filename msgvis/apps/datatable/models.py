@@ -2,16 +2,16 @@ from django.db import models
 from django.db.models import Q
 from datetime import timedelta
 import operator
+from collections import OrderedDict
 
 from msgvis.apps.base.models import MappedValuesQuerySet
+from msgvis.apps.base.bitmaps import Bitmap
+from msgvis.apps.base import models as base_models
 from msgvis.apps.corpus import models as corpus_models
 from msgvis.apps.groups import models as groups_models
 from msgvis.apps.dimensions import registry
 from msgvis.apps.corpus import utils
 
-import re
-from django.db import connection
-
 MAX_CATEGORICAL_LEVELS = 10
 
 def find_messages(queryset):
@@ -20,73 +20,25 @@ def find_messages(queryset):
         queryset = queryset.message_set.all()
     return queryset
 
-def get_field_name(text):
-    pattern = re.compile('(?<=__)\w+')
-    results = pattern.search(text)
-    if results:
-        return results.group()
-    return None
-
-def fetchall(sql):
-    sql = utils.convert_boolean(sql)
-    cursor = connection.cursor()
-    cursor.execute(sql)
-    desc = cursor.description
-    return [
-        row[0]
-        for row in cursor.fetchall()
-    ]
-
-def fetchall_table(sql):
-    sql = utils.convert_boolean(sql)
-    cursor = connection.cursor()
-    cursor.execute(sql)
-    desc = cursor.description
-    return [
-        dict(zip([col[0] for col in desc], row))
-        for row in cursor.fetchall()
-    ]
-
-def group_messages_by_dimension_with_raw_query(query, dimension, callback):
-    queryset = corpus_models.Message.objects.raw(query)
-    message_id = corpus_models.Message._meta.model_name + "_id" #message_id
-    fieldname = get_field_name(dimension.field_name)
-    key = dimension.key
-    related_mgr = getattr(corpus_models.Message, dimension.key)
-    if hasattr(related_mgr, "RelatedObjectDoesNotExist"):
-        related_table = related_mgr.field.rel.to._meta.db_table
-        related_id = related_mgr.field.rel.to._meta.model._meta.model_name + "_id"
-        if related_id == "person_id":
-            related_id = "sender_id"
-        elif related_id == "messagetype_id":
-            related_id = "type_id"
-        final_query = "SELECT B.%s AS `%s`, count(*) AS `value` FROM (%s) AS A, `%s` AS B WHERE A.%s=B.id GROUP BY B.%s ORDER BY `value` DESC" %(fieldname, key, query, related_table, related_id, fieldname)
-
-    else:
-        if hasattr(related_mgr, "field"):
-            through_table = related_mgr.through._meta.db_table  # e.g., corpus_message_hashtags
-            related_table = related_mgr.field.rel.to._meta.db_table # e.g., corpus_hashtag
-            related_id = related_mgr.field.rel.to._meta.model._meta.model_name + "_id"  # e.g., hashtag_id
-        elif hasattr(related_mgr, "related"):
-            through_table = related_mgr.related.field.rel.through._meta.db_table # e.g., enhance_messageword
-            related_table = related_mgr.related.model._meta.db_table # e.g., enhance_word
-            related_id = related_mgr.related.model._meta.model_name + "_id"  # e.g., word_id
-
-        final_query = "SELECT B.%s AS `%s`, count(*) AS `value` FROM (%s) AS A, `%s` AS B, `%s` AS C WHERE A.id=C.%s AND B.id=C.%s GROUP BY B.%s ORDER BY `value` DESC" %(fieldname, key, query, related_table, through_table, message_id, related_id, fieldname)
-    return callback(final_query)
-
-
-def group_messages_by_words_with_raw_query(query, callback):
-
-    pattern = re.compile(r'T\d+.`text`')
-    results = pattern.search(query)
-    if results:
-        table = results.group()
-        query = query.replace("`corpus_message`.`id`, `corpus_message`.`dataset_id`, `corpus_message`.`original_id`, `corpus_message`.`type_id`, `corpus_message`.`sender_id`, `corpus_message`.`time`, `corpus_message`.`language_id`, `corpus_message`.`sentiment`, `corpus_message`.`timezone_id`, `corpus_message`.`replied_to_count`, `corpus_message`.`shared_count`, `corpus_message`.`contains_hashtag`, `corpus_message`.`contains_url`, `corpus_message`.`contains_media`, `corpus_message`.`contains_mention`, `corpus_message`.`text`",
-                              "%s AS words, count(*) AS value" %(table))
-        query += "GROUP BY `words` ORDER BY `value` DESC"
-
-    return callback(query)
+def filter_time_range(queryset, dataset):
+    """Exclude messages without a time, or far outside the time range of the dataset."""
+    queryset = queryset.exclude(time__isnull=True)
+    if dataset.start_time and dataset.end_time:
+        range = dataset.end_time - dataset.start_time
+        buffer = timedelta(seconds=range.total_seconds() * 0.1)
+        queryset = queryset.filter(time__gte=dataset.start_time - buffer,
+                                   time__lte=dataset.end_time + buffer)
+    return queryset
+
+def _matched_levels(domain):
+    """The levels a filter on the domain matches, as :func:`utils.levels_or` matches them."""
+    levels = set()
+    for level in domain:
+        if level is None or unicode(level).strip() == "":
+            levels.add(None)
+        else:
+            levels.add(level)
+    return levels
 
 class DataTable(object):
     """
@@ -94,6 +46,18 @@ class DataTable(object):
     for a given pair of dimensions.
     """
 
+    use_cube = True
+    """Whether :meth:`generate` may answer from the :mod:`.cube` when it has been built."""
+
+    use_rollups = True
+    """Whether :meth:`generate` may answer time histograms from the :mod:`.rollup` tables when they have been built."""
+
+    use_bitmap_index = True
+    """Whether :meth:`generate` may answer from the :mod:`.bitmap_index` when it has been built."""
+
+    use_columnar = True
+    """Whether :meth:`generate` may answer from a :mod:`.columnar` snapshot when it has been built."""
+
     def __init__(self, primary_dimension, secondary_dimension=None):
         """
         Construct a DataTable for one or two dimensions.
@@ -126,34 +90,45 @@ class DataTable(object):
     def set_mode(self, mode):
         self.mode = mode
 
-    def render(self, queryset, desired_primary_bins=None, desired_secondary_bins=None):
+    def render(self, queryset, desired_primary_bins=None, desired_secondary_bins=None, ranges=None):
         """
         Given a set of messages (already filtered as necessary),
         calculate the data table.
 
-        Optionally, a number of primary and secondary bins may be given.
+        Optionally, a number of primary and secondary bins may be given,
+        and the (min, max) ranges of quantitative dimensions over the messages,
+        by dimension key, so they do not have to be found again.
 
         The result is a list of dictionaries. Each
         dictionary contains a key for each dimension
         and a value key for the count.
         """
 
+        def known_range(dimension):
+            if ranges is None or dimension.key not in ranges:
+                return {}
+            min_val, max_val = ranges[dimension.key]
+            return dict(min_val=min_val, max_val=max_val)
+
         if not self.secondary_dimension:
             # If there is only one dimension, we should be able to fall back
             # on that dimension's group_by() implementation.
             queryset = self.primary_dimension.group_by(queryset,
                                                        grouping_key=self.primary_dimension.key,
-                                                       bins=desired_primary_bins)
+                                                       bins=desired_primary_bins,
+                                                       **known_range(self.primary_dimension))
 
             return queryset.annotate(value=models.Count('id'))
 
         else:
             # Now it gets nasty...
             primary_group = self.primary_dimension.get_grouping_expression(queryset,
-                                                                           bins=desired_primary_bins)
+                                                                           bins=desired_primary_bins,
+                                                                           **known_range(self.primary_dimension))
 
             secondary_group = self.secondary_dimension.get_grouping_expression(queryset,
-                                                                               bins=desired_secondary_bins)
+                                                                               bins=desired_secondary_bins,
+                                                                               **known_range(self.secondary_dimension))
 
             if primary_group is None or secondary_group is None:
                 # There is no data to group
@@ -181,8 +156,17 @@ class DataTable(object):
             if internal_secondary_key != self.secondary_dimension.key:
                 mapping[internal_secondary_key] = self.secondary_dimension.key
 
-            if len(mapping) > 0:
-                return MappedValuesQuerySet.create_from(queryset, mapping)
+            # And convert some values into levels
+            converters = {}
+            for dimension, expression, internal_key in [
+                    (self.primary_dimension, primary_group, internal_primary_key),
+                    (self.secondary_dimension, secondary_group, internal_secondary_key)]:
+                converter = dimension.get_grouping_converter(expression)
+                if converter is not None:
+                    converters[internal_key] = converter
+
+            if len(mapping) > 0 or len(converters) > 0:
+                return MappedValuesQuerySet.create_from(queryset, mapping, converters)
             else:
                 return queryset
 
@@ -292,28 +276,195 @@ class DataTable(object):
                 return results
 
 
-    def domain(self, dimension, queryset, filter=None, exclude=None, desired_bins=None):
-        """Return the sorted levels in this dimension"""
+    def can_fold_others(self, primary_flag, secondary_flag):
+        """
+        Return True if :meth:`fold_others` gives the same results as :meth:`render_others`:
+        the dimensions must be categorical, and those with an "Other" level
+        must have one value per message.
+        """
+        from msgvis.apps.datatable.cube import resolve_field
+
+        for dimension, flag in ((self.primary_dimension, primary_flag),
+                                (self.secondary_dimension, secondary_flag)):
+            if dimension is None:
+                continue
+            if not dimension.is_categorical():
+                return False
+            if flag and resolve_field(dimension.field_name)[1]:
+                return False
+        return True
+
+    def fold_others(self, rows, domains, primary_flag, secondary_flag):
+        """
+        Given the complete table, without keeping only the top levels,
+        split it into the table for the top levels and the "Other" rows,
+        like :meth:`render` and :meth:`render_others` would count them.
+        This needs a single query instead of one for each kind of "Other" row.
+
+        Returns the table and the "Other" rows.
+        """
+        primary_key = self.primary_dimension.key
+        primary_other = u'Other ' + self.primary_dimension.name
+        primary_levels = _matched_levels(domains[primary_key])
+
+        if not self.secondary_dimension:
+            table = []
+            others = 0
+            for row in rows:
+                if row[primary_key] in primary_levels:
+                    table.append(row)
+                else:
+                    others += row['value']
+
+            domains[primary_key].append(primary_other)
+            return table, [{primary_key: primary_other, 'value': others}]
+
+        secondary_key = self.secondary_dimension.key
+        secondary_other = u'Other ' + self.secondary_dimension.name
+        secondary_levels = _matched_levels(domains[secondary_key])
+
+        table = []
+        others_others = 0
+        top_others = OrderedDict()
+        others_top = OrderedDict()
+        for row in rows:
+            primary_top = row[primary_key] in primary_levels
+            secondary_top = row[secondary_key] in secondary_levels
+            if primary_top and secondary_top:
+                table.append(row)
+            elif primary_top:
+                top_others[row[primary_key]] = top_others.get(row[primary_key], 0) + row['value']
+            elif secondary_top:
+                others_top[row[secondary_key]] = others_top.get(row[secondary_key], 0) + row['value']
+            else:
+                others_others += row['value']
+
+        others = []
+        if primary_flag:
+            domains[primary_key].append(primary_other)
+        if secondary_flag:
+            domains[secondary_key].append(secondary_other)
+
+        if primary_flag and secondary_flag:
+            others.append({primary_key: primary_other,
+                           secondary_key: secondary_other,
+                           'value': others_others})
+        if secondary_flag:
+            others.extend({primary_key: level, secondary_key: secondary_other, 'value': value}
+                          for level, value in top_others.iteritems())
+        if primary_flag:
+            others.extend({primary_key: primary_other, secondary_key: level, 'value': value}
+                          for level, value in others_top.iteritems())
+        return table, others
+
+    def domain(self, dimension, queryset, filter=None, exclude=None, desired_bins=None, dataset=None,
+               limit=None, offset=0, search_key=None):
+        """
+        Return the sorted levels in this dimension, and their labels.
+        Optionally, only the levels containing the search key (ignoring case),
+        and at most limit levels after offset, are returned. For categorical dimensions
+        drawn from the messages, only those levels are queried.
+
+        If the dataset is given, the queryset must hold all the messages the data table counts
+        in the dataset, and without a filter or exclude the domain is read from the :mod:`.domain_cache`.
+        """
+        from msgvis.apps.datatable import domain_cache
+
+        if dataset is not None and filter is None and exclude is None:
+            return domain_cache.get_domain(dataset, dimension, bins=desired_bins,
+                                           limit=limit, offset=offset, search=search_key)
+
         if filter is not None:
             queryset = dimension.filter(queryset, **filter)
 
         if exclude is not None:
             queryset = dimension.exclude(queryset, **exclude)
 
+        if dimension.is_categorical() and not hasattr(dimension, 'domain'):
+            domain = dimension.get_domain(queryset, limit=limit, offset=offset, search=search_key)
+            return domain, dimension.get_domain_labels(domain)
+
         domain = dimension.get_domain(queryset, bins=desired_bins)
         labels = dimension.get_domain_labels(domain)
 
-        return domain, labels
+        return domain_cache.select_levels(domain, labels, limit, offset, search_key)
+
+    def domain_size(self, dimension, queryset, exclude=None, dataset=None, search_key=None):
+        """
+        Return the number of levels :meth:`domain` returns without a limit,
+        for a dimension without a filter, counted in the query if possible.
+        """
+        from msgvis.apps.datatable import domain_cache
+
+        if dataset is not None and exclude is None:
+            return domain_cache.get_domain_size(dataset, dimension, search=search_key)
+
+        if exclude is not None:
+            queryset = dimension.exclude(queryset, **exclude)
+
+        if dimension.is_categorical() and not hasattr(dimension, 'domain'):
+            return dimension.get_domain_size(queryset, search=search_key)
+
+        return len(self.domain(dimension, queryset, search_key=search_key)[0])
 
-    def groups_domain(self, dimension, queryset_all, group_querysets, desired_bins=None):
-        """Return the sorted levels in the union of groups in this dimension"""
+    def known_ranges(self, dataset):
+        """
+        The cached (min, max) ranges of the quantitative dimensions over all the messages
+        the data table counts in the dataset, by dimension key, for :meth:`render`.
+        """
+        from msgvis.apps.datatable import domain_cache
+        return dict((dimension.key, domain_cache.get_range(dataset, dimension))
+                    for dimension in (self.primary_dimension, self.secondary_dimension)
+                    if dimension is not None and not dimension.is_categorical())
+
+    def level_bitmaps(self, dimension, queryset):
+        """
+        Get the ids of the messages (already filtered as necessary)
+        at each level of a categorical dimension, as a dictionary from levels to
+        :class:`.Bitmap` objects.
+        """
+        grouping_expression = dimension.get_grouping_expression(queryset)
+        if grouping_expression is None:
+            return {}
+        queryset, internal_key = dimension.select_grouping_expression(queryset, grouping_expression)
+
+        message_ids = {}
+        for level, message_id in queryset.values_list(internal_key, 'id').iterator():
+            message_ids.setdefault(level, []).append(message_id)
+        return dict((level, Bitmap(ids)) for level, ids in message_ids.iteritems())
+
+    def render_bitmap(self, bitmap, level_bitmaps, domain=None, others=False):
+        """
+        Given the ids of a set of messages and the bitmaps of the levels of the primary dimension,
+        calculate the data table. If a domain is given, only its levels are counted,
+        and with others, the messages at none of its levels are counted as well.
+        """
+        key = self.primary_dimension.key
+        levels = level_bitmaps.keys()
+        if domain is not None:
+            matched_levels = _matched_levels(domain)
+            levels = [level for level in levels if level in matched_levels]
+
+        table = []
+        for level in levels:
+            count = bitmap.intersection_count(level_bitmaps[level])
+            if count > 0:
+                table.append({key: level, 'value': count})
+
+        if others:
+            top_levels = Bitmap.union_all(level_bitmaps[level] for level in levels)
+            table.append({key: u'Other ' + self.primary_dimension.name,
+                          'value': len(bitmap - top_levels)})
+        return table
+
+    def groups_domain(self, dimension, queryset_all, level_bitmaps=None, desired_bins=None):
+        """
+        Return the sorted levels in the union of groups in this dimension.
+        For related categorical dimensions, the bitmaps of the levels in the union are required.
+        """
         if dimension.is_related_categorical():
-            query = ""
-            for idx, queryset in enumerate(group_querysets):
-                if idx > 0:
-                    query += " UNION "
-                query += "(%s)" %(utils.quote(str(queryset.query)))
-            domain = group_messages_by_dimension_with_raw_query(query, dimension, fetchall)
+            domain = [level for level in level_bitmaps if level is not None]
+            domain.sort(key=lambda level: len(level_bitmaps[level]), reverse=True)
 
         else:
             queryset = queryset_all
@@ -349,15 +500,54 @@ class DataTable(object):
         """
 
         if (groups is None):
+            if self.use_cube:
+                # Answer from the precomputed counts if possible
+                from msgvis.apps.datatable.cube import CubeQuery, Unsupported
+                cube_query = CubeQuery.create(self, dataset, filters, exclude)
+                if cube_query is not None:
+                    try:
+                        return cube_query.generate(page_size, page, search_key)
+                    except Unsupported:
+                        # The time bins were not counted
+                        pass
+
+            if self.use_rollups:
+                # Add up the counts of the time bins if possible
+                from msgvis.apps.datatable.rollup import RollupQuery, Unsupported
+                rollup_query = RollupQuery.create(self, dataset, filters, exclude)
+                if rollup_query is not None:
+                    try:
+                        return rollup_query.generate(page_size, page, search_key)
+                    except Unsupported:
+                        # The time bins are smaller than the rolled up ones
+                        pass
+
+            if self.use_bitmap_index:
+                # Intersect the bitmaps of the levels if possible
+                from msgvis.apps.datatable.bitmap_index import BitmapQuery, Unsupported
+                bitmap_query = BitmapQuery.create(self, dataset, filters, exclude)
+                if bitmap_query is not None:
+                    try:
+                        return bitmap_query.generate(page_size, page, search_key)
+                    except Unsupported:
+                        # Too many pairs of levels to intersect
+                        pass
+
+            if self.use_columnar:
+                # Count with the columns of the snapshot if possible
+                from msgvis.apps.datatable.columnar import ColumnarQuery, Unsupported
+                columnar_query = ColumnarQuery.create(self, dataset, filters, exclude)
+                if columnar_query is not None:
+                    try:
+                        return columnar_query.generate(page_size, page, search_key)
+                    except Unsupported:
+                        # A filter the columns cannot evaluate
+                        pass
+
             queryset = dataset.message_set.all()
 
             # Filter out null time
-            queryset = queryset.exclude(time__isnull=True)
-            if dataset.start_time and dataset.end_time:
-                range = dataset.end_time - dataset.start_time
-                buffer = timedelta(seconds=range.total_seconds() * 0.1)
-                queryset = queryset.filter(time__gte=dataset.start_time - buffer,
-                                           time__lte=dataset.end_time + buffer)
+            queryset = filter_time_range(queryset, dataset)
 
             unfiltered_queryset = queryset
 
@@ -395,31 +585,37 @@ class DataTable(object):
             primary_flag = False
             secondary_flag = False
 
-            # Include the domains for primary and (secondary) dimensions
-            domain, labels = self.domain(self.primary_dimension,
-                                         unfiltered_queryset,
-                                         primary_filter, primary_exclude)
+            # One more than the top levels, to know if there are others
+            keep_top = self.mode == 'enable_others' or self.mode == 'omit_others'
+            top_limit = MAX_CATEGORICAL_LEVELS + 1 if keep_top else None
 
             # paging the first dimension, this is for the filter distribution
             if primary_filter is None and self.secondary_dimension is None and page is not None:
 
-                if search_key is not None:
-                    domain, labels = self.filter_search_key(domain, labels, search_key)
+                # Only the levels on the page are queried
                 start = (page - 1) * page_size
-                end = min(start + page_size, len(domain))
-                max_page = (len(domain) / page_size) + 1
+                num_levels = self.domain_size(self.primary_dimension, unfiltered_queryset,
+                                              primary_exclude, dataset=dataset, search_key=search_key)
+                max_page = (num_levels / page_size) + 1
 
                 # no level left
-                if len(domain) == 0 or start > len(domain):
+                if num_levels == 0 or start > num_levels:
                     return None
 
-                domain = domain[start:end]
-                if labels is not None:
-                    labels = labels[start:end]
+                domain, labels = self.domain(self.primary_dimension,
+                                             unfiltered_queryset,
+                                             None, primary_exclude, dataset=dataset,
+                                             limit=page_size, offset=start, search_key=search_key)
 
                 queryset = queryset.filter(utils.levels_or(self.primary_dimension.field_name, domain))
             else:
-                if (self.mode == 'enable_others' or self.mode == 'omit_others') and \
+                # Include the domains for primary and (secondary) dimensions
+                domain, labels = self.domain(self.primary_dimension,
+                                             unfiltered_queryset,
+                                             primary_filter, primary_exclude, dataset=dataset,
+                                             limit=top_limit if self.primary_dimension.is_categorical() else None)
+
+                if keep_top and \
                     self.primary_dimension.is_categorical() and len(domain) > MAX_CATEGORICAL_LEVELS:
                     primary_flag = True
                     domain = domain[:MAX_CATEGORICAL_LEVELS]
@@ -437,9 +633,10 @@ class DataTable(object):
             if self.secondary_dimension:
                 domain, labels = self.domain(self.secondary_dimension,
                                              unfiltered_queryset,
-                                             secondary_filter, secondary_exclude)
+                                             secondary_filter, secondary_exclude, dataset=dataset,
+                                             limit=top_limit if self.secondary_dimension.is_categorical() else None)
 
-                if (self.mode == 'enable_others' or self.mode == 'omit_others') and \
+                if keep_top and \
                     self.secondary_dimension.is_categorical() and \
                         len(domain) > MAX_CATEGORICAL_LEVELS:
                     secondary_flag = True
@@ -457,15 +654,26 @@ class DataTable(object):
                 if labels is not None:
                     domain_labels[self.secondary_dimension.key] = labels
 
-            # Render a table
-            table = self.render(queryset)
-
-            if self.mode == "enable_others" and queryset_for_others is not None:
-                # adding others to the results
-                table_for_others = self.render_others(queryset_for_others, domains, primary_flag, secondary_flag)
-                table = list(table)
+            if self.mode == "enable_others" and queryset_for_others is not None and \
+                    self.can_fold_others(primary_flag, secondary_flag):
+                # Count the top levels and the others together
+                table, table_for_others = self.fold_others(self.render(queryset_for_others), domains,
+                                                           primary_flag, secondary_flag)
                 table.extend(table_for_others)
 
+            else:
+                # Render a table, with the ranges of all the messages if none were filtered out
+                ranges = None
+                if queryset is unfiltered_queryset:
+                    ranges = self.known_ranges(dataset)
+                table = self.render(queryset, ranges=ranges)
+
+                if self.mode == "enable_others" and queryset_for_others is not None:
+                    # adding others to the results
+                    table_for_others = self.render_others(queryset_for_others, domains, primary_flag, secondary_flag)
+                    table = list(table)
+                    table.extend(table_for_others)
+
             results = {
                 'table': table,
                 'domains': domains,
@@ -489,12 +697,7 @@ class DataTable(object):
             secondary_exclude = None
 
             queryset = dataset.message_set.all()
-            queryset = queryset.exclude(time__isnull=True)
-            if dataset.start_time and dataset.end_time:
-                range = dataset.end_time - dataset.start_time
-                buffer = timedelta(seconds=range.total_seconds() * 0.1)
-                queryset = queryset.filter(time__gte=dataset.start_time - buffer,
-                                           time__lte=dataset.end_time + buffer)
+            queryset = filter_time_range(queryset, dataset)
             if filters is not None:
                 for filter in filters:
                     dimension = filter['dimension']
@@ -517,14 +720,13 @@ class DataTable(object):
 
             queryset_all = queryset
 
-            #queryset = corpus_models.Message.objects.none()
+            group_objs = []
             group_querysets = []
             group_labels = []
-            #message_list = set()
-
 
             for group in groups:
                 group_obj = groups_models.Group.objects.get(id=group)
+                group_objs.append(group_obj)
                 if group_obj.order > 0:
                     group_labels.append("#%d %s"%(group_obj.order, group_obj.name))
                 else:
@@ -533,12 +735,7 @@ class DataTable(object):
 
 
                 # Filter out null time
-                queryset = queryset.exclude(time__isnull=True)
-                if dataset.start_time and dataset.end_time:
-                    range = dataset.end_time - dataset.start_time
-                    buffer = timedelta(seconds=range.total_seconds() * 0.1)
-                    queryset = queryset.filter(time__gte=dataset.start_time - buffer,
-                                               time__lte=dataset.end_time + buffer)
+                queryset = filter_time_range(queryset, dataset)
 
                 unfiltered_queryset = queryset
 
@@ -558,16 +755,19 @@ class DataTable(object):
 
                 group_querysets.append(queryset)
 
-#########################################################################################################################
-
-            # deal with union distribution
-            # This is due to union of queries in django does not work...
-            # super ugly. Refactoring is required.
-
+            # The messages in any of the groups at each level of the categorical dimensions
+            queryset_in_groups = queryset_all.filter(groups__id__in=groups)
+            primary_levels = None
+            if self.primary_dimension.is_related_categorical() or \
+                    (self.secondary_dimension is None and self.primary_dimension.is_categorical()):
+                primary_levels = self.level_bitmaps(self.primary_dimension, queryset_in_groups)
+            secondary_levels = None
+            if self.secondary_dimension and self.secondary_dimension.is_related_categorical():
+                secondary_levels = self.level_bitmaps(self.secondary_dimension, queryset_in_groups)
 
             # Include the domains for primary and (secondary) dimensions
             domain, labels = self.groups_domain(self.primary_dimension,
-                                         queryset_all, group_querysets)
+                                                queryset_all, primary_levels)
 
             # paging the first dimension, this is for the filter distribution
             if primary_filter is None and self.secondary_dimension is None and page is not None:
@@ -601,7 +801,7 @@ class DataTable(object):
 
             if self.secondary_dimension:
                 domain, labels = self.groups_domain(self.secondary_dimension,
-                                             queryset_all, group_querysets)
+                                                    queryset_all, secondary_levels)
 
                 if (self.mode == 'enable_others' or self.mode == 'omit_others') and \
                     self.secondary_dimension.is_categorical() and \
@@ -616,34 +816,43 @@ class DataTable(object):
                 domains[self.secondary_dimension.key] = domain
                 if labels is not None:
                     domain_labels[self.secondary_dimension.key] = labels
-#########################################################################################################################
 
             group_tables = []
-            for queryset in group_querysets:
-                queryset_for_others = queryset
-                if (self.mode == 'enable_others' or self.mode == 'omit_others') and \
-                    self.primary_dimension.is_categorical():
-                    queryset = queryset.filter(utils.levels_or(self.primary_dimension.field_name, domains[self.primary_dimension.key]))
-                if self.secondary_dimension:
+            if self.secondary_dimension is None and primary_levels is not None:
+                # Intersect the groups with the levels, after filtering
+                filtered = Bitmap.union_all(primary_levels.itervalues())
+                restrict = self.mode == 'enable_others' or self.mode == 'omit_others'
+                others = self.mode == 'enable_others' and primary_flag
+                for group_obj in group_objs:
+                    group_tables.append(self.render_bitmap(group_obj.get_bitmap() & filtered, primary_levels,
+                                                           domain=domains[self.primary_dimension.key] if restrict else None,
+                                                           others=others))
+                if others:
+                    domains[self.primary_dimension.key].append(u'Other ' + self.primary_dimension.name)
+
+            else:
+                for queryset in group_querysets:
+                    queryset_for_others = queryset
                     if (self.mode == 'enable_others' or self.mode == 'omit_others') and \
-                    self.secondary_dimension.is_categorical():
-                        if queryset_for_others is None:
-                            queryset_for_others = queryset
-                        queryset = queryset.filter(utils.levels_or(self.secondary_dimension.field_name, domains[self.secondary_dimension.key]))
-
-                # Render a table
-                if self.primary_dimension.key == "words":
-                    table = group_messages_by_words_with_raw_query(utils.quote(str(queryset.query)), fetchall_table)
-                else:
+                        self.primary_dimension.is_categorical():
+                        queryset = queryset.filter(utils.levels_or(self.primary_dimension.field_name, domains[self.primary_dimension.key]))
+                    if self.secondary_dimension:
+                        if (self.mode == 'enable_others' or self.mode == 'omit_others') and \
+                        self.secondary_dimension.is_categorical():
+                            if queryset_for_others is None:
+                                queryset_for_others = queryset
+                            queryset = queryset.filter(utils.levels_or(self.secondary_dimension.field_name, domains[self.secondary_dimension.key]))
+
+                    # Render a table
                     table = self.render(queryset)
 
-                if self.mode == "enable_others" and queryset_for_others is not None:
-                    # adding others to the results
-                    table_for_others = self.render_others(queryset_for_others, domains, primary_flag, secondary_flag)
-                    table = list(table)
-                    table.extend(table_for_others)
+                    if self.mode == "enable_others" and (primary_flag or secondary_flag):
+                        # adding others to the results
+                        table_for_others = self.render_others(queryset_for_others, domains, primary_flag, secondary_flag)
+                        table = list(table)
+                        table.extend(table_for_others)
 
-                group_tables.append(table)
+                    group_tables.append(table)
 
             if self.secondary_dimension is None:
                 final_table = []
@@ -680,3 +889,260 @@ class DataTable(object):
                 results['max_page'] = max_page
 
         return results
+
+
+class CubeCell(models.Model):
+    """
+    The number of messages at a level, or pair of levels, of one or two
+    categorical dimensions in a dataset. See :mod:`msgvis.apps.datatable.cube`.
+    """
+
+    class Meta:
+        index_together = [
+            ["dataset", "primary_dimension", "secondary_dimension"],
+        ]
+
+    dataset = models.ForeignKey(corpus_models.Dataset, related_name="cube_cells")
+
+    primary_dimension = models.CharField(max_length=64)
+    """The key of the first dimension."""
+
+    secondary_dimension = models.CharField(max_length=64, blank=True, default="")
+    """The key of the second dimension, or empty for a single dimension."""
+
+    primary_level = base_models.Utf8TextField()
+    """The json-encoded level of the first dimension."""
+
+    secondary_level = base_models.Utf8TextField(blank=True, default="")
+    """The json-encoded level of the second dimension, or empty for a single dimension."""
+
+    count = models.IntegerField(default=0)
+    """The number of messages, as counted by :meth:`DataTable.render`."""
+
+    min_time = models.DateTimeField(null=True, default=None, blank=True)
+    """The time of the first message, for cubes with a time dimension."""
+
+    max_time = models.DateTimeField(null=True, default=None, blank=True)
+    """The time of the last message, for cubes with a time dimension."""
+
+
+class CubeState(models.Model):
+    """Records which messages have been counted in the cube for one or two dimensions of a dataset."""
+
+    class Meta:
+        unique_together = ("dataset", "primary_dimension", "secondary_dimension")
+
+    dataset = models.ForeignKey(corpus_models.Dataset, related_name="cube_states")
+
+    primary_dimension = models.CharField(max_length=64)
+    """The key of the first dimension."""
+
+    secondary_dimension = models.CharField(max_length=64, blank=True, default="")
+    """The key of the second dimension, or empty for a single dimension."""
+
+    last_message_id = models.IntegerField(default=0)
+    """Messages with ids up to this one have been counted."""
+
+    start_time = models.DateTimeField(null=True, default=None, blank=True)
+    """The start time of the dataset when the messages were counted."""
+
+    end_time = models.DateTimeField(null=True, default=None, blank=True)
+    """The end time of the dataset when the messages were counted."""
+
+    time_bin_size = models.FloatField(null=True, default=None, blank=True)
+    """The size of the time bins in seconds, for cubes with a time dimension."""
+
+    updated_at = models.DateTimeField(auto_now=True)
+    """The :py:class:`datetime.datetime` when the cube was last updated."""
+
+    def __unicode__(self):
+        return "%s x %s in %s" % (self.primary_dimension, self.secondary_dimension or "-", self.dataset)
+
+
+class LevelBitmap(models.Model):
+    """
+    The ids of the messages at one level of a categorical dimension in a dataset,
+    as a serialized :class:`.Bitmap`. See :mod:`msgvis.apps.datatable.bitmap_index`.
+    """
+
+    class Meta:
+        index_together = [
+            ["dataset", "dimension"],
+        ]
+
+    dataset = models.ForeignKey(corpus_models.Dataset, related_name="level_bitmaps")
+
+    dimension = models.CharField(max_length=64)
+    """The key of the dimension."""
+
+    level = base_models.Utf8TextField()
+    """The json-encoded level, as in :class:`CubeCell`."""
+
+    count = models.IntegerField(default=0)
+    """The number of messages at the level."""
+
+    bitmap = models.BinaryField()
+    """The ids of the messages at the level."""
+
+
+class BitmapIndexState(models.Model):
+    """Records which messages have been added to the bitmap index for a dimension of a dataset."""
+
+    class Meta:
+        unique_together = ("dataset", "dimension")
+
+    dataset = models.ForeignKey(corpus_models.Dataset, related_name="bitmap_index_states")
+
+    dimension = models.CharField(max_length=64)
+    """The key of the dimension."""
+
+    last_message_id = models.IntegerField(default=0)
+    """Messages with ids up to this one have been added."""
+
+    start_time = models.DateTimeField(null=True, default=None, blank=True)
+    """The start time of the dataset when the messages were added."""
+
+    end_time = models.DateTimeField(null=True, default=None, blank=True)
+    """The end time of the dataset when the messages were added."""
+
+    updated_at = models.DateTimeField(auto_now=True)
+    """The :py:class:`datetime.datetime` when the index was last updated."""
+
+    def __unicode__(self):
+        return "%s in %s" % (self.dimension, self.dataset)
+
+
+class TimeRollup(models.Model):
+    """
+    The number of messages in a time bin of one size, optionally at a level
+    of a categorical dimension. See :mod:`msgvis.apps.datatable.rollup`.
+    """
+
+    class Meta:
+        index_together = [
+            ["dataset", "dimension", "bin_size"],
+        ]
+
+    dataset = models.ForeignKey(corpus_models.Dataset, related_name="time_rollups")
+
+    dimension = models.CharField(max_length=64, blank=True, default="")
+    """The key of the categorical dimension, or empty for time alone."""
+
+    bin_size = models.FloatField()
+    """The size of the time bin in seconds."""
+
+    time = models.CharField(max_length=64)
+    """The json-encoded time bin, as in :class:`CubeCell`."""
+
+    level = base_models.Utf8TextField(blank=True, default="")
+    """The json-encoded level of the categorical dimension, or empty for time alone."""
+
+    count = models.IntegerField(default=0)
+    """The number of messages, as counted by :meth:`DataTable.render`."""
+
+    min_time = models.DateTimeField(null=True, default=None, blank=True)
+    """The time of the first message."""
+
+    max_time = models.DateTimeField(null=True, default=None, blank=True)
+    """The time of the last message."""
+
+
+class TimeRollupState(models.Model):
+    """Records which messages have been counted in the time rollups for a dataset and a categorical dimension."""
+
+    class Meta:
+        unique_together = ("dataset", "dimension")
+
+    dataset = models.ForeignKey(corpus_models.Dataset, related_name="time_rollup_states")
+
+    dimension = models.CharField(max_length=64, blank=True, default="")
+    """The key of the categorical dimension, or empty for time alone."""
+
+    last_message_id = models.IntegerField(default=0)
+    """Messages with ids up to this one have been counted."""
+
+    start_time = models.DateTimeField(null=True, default=None, blank=True)
+    """The start time of the dataset when the messages were counted."""
+
+    end_time = models.DateTimeField(null=True, default=None, blank=True)
+    """The end time of the dataset when the messages were counted."""
+
+    min_time = models.DateTimeField(null=True, default=None, blank=True)
+    """The time of the first message counted."""
+
+    max_time = models.DateTimeField(null=True, default=None, blank=True)
+    """The time of the last message counted."""
+
+    updated_at = models.DateTimeField(auto_now=True)
+    """The :py:class:`datetime.datetime` when the rollups were last updated."""
+
+    def __unicode__(self):
+        return "time x %s in %s" % (self.dimension or "-", self.dataset)
+
+
+class DimensionDomain(models.Model):
+    """
+    The domain and range of a dimension over the messages data tables count in a dataset,
+    for a number of bins. See :mod:`msgvis.apps.datatable.domain_cache`.
+    """
+
+    class Meta:
+        unique_together = ("dataset", "dimension", "bins")
+
+    dataset = models.ForeignKey(corpus_models.Dataset, related_name="dimension_domains")
+
+    dimension = models.CharField(max_length=64)
+    """The key of the dimension."""
+
+    bins = models.IntegerField(null=True, default=None, blank=True)
+    """The desired number of bins, or None for the dimension's default."""
+
+    domain = base_models.Utf8TextField()
+    """The json-encoded bins of a quantitative dimension, or null when the levels are stored as :class:`DomainLevel` rows."""
+
+    min_value = base_models.Utf8TextField(default="null")
+    """The json-encoded minimum value of a quantitative dimension."""
+
+    max_value = base_models.Utf8TextField(default="null")
+    """The json-encoded maximum value of a quantitative dimension."""
+
+    last_message_id = models.IntegerField(default=0)
+    """The id of the last message in the dataset when the domain was found."""
+
+    start_time = models.DateTimeField(null=True, default=None, blank=True)
+    """The start time of the dataset when the domain was found."""
+
+    end_time = models.DateTimeField(null=True, default=None, blank=True)
+    """The end time of the dataset when the domain was found."""
+
+    updated_at = models.DateTimeField(auto_now=True)
+    """The :py:class:`datetime.datetime` when the domain was found."""
+
+    def __unicode__(self):
+        return "%s (%s bins) in %s" % (self.dimension, self.bins or "default", self.dataset)
+
+
+class DomainLevel(models.Model):
+    """
+    A level of a categorical dimension in a dataset, at its position in the domain,
+    so that domains can be paged and searched. See :mod:`msgvis.apps.datatable.domain_cache`.
+    """
+
+    class Meta:
+        index_together = [
+            ["dataset", "dimension", "rank"],
+        ]
+
+    dataset = models.ForeignKey(corpus_models.Dataset, related_name="domain_levels")
+
+    dimension = models.CharField(max_length=64)
+    """The key of the dimension."""
+
+    rank = models.IntegerField()
+    """The position of the level in the domain, from 0 for the most frequent."""
+
+    level = base_models.Utf8TextField()
+    """The json-encoded level."""
+
+    text = base_models.Utf8TextField(null=True, default=None, blank=True)
+    """The level as text for searching, or None for messages without a value."""
@@ -0,0 +1,260 @@
+"""
+Time histograms from rollups of message counts at every time bin size.
+
+:class:`.TimeDimension` groups messages by an expression on their time,
+which no index can help with, after finding the time range of the messages
+with another aggregate. For a dataset, the rollups store the number of
+messages in each time bin at every bin size a data table may choose
+(the steps of :attr:`.TimeDimension.d3_time_scaleSteps` from one minute up),
+optionally by the levels of one categorical dimension, along with the
+time range of the counted messages.
+
+A time histogram is then answered by adding up the rollup rows at the bin size
+:meth:`.TimeDimension.get_bin_size` picks for the selected messages, and the
+time domain comes from the stored time range instead of the messages.
+Unlike the time cubes of :mod:`.cube`, which only count the bins for the
+whole dataset, rollups still apply when filters narrow the time range.
+
+.. code-block:: python
+
+    from msgvis.apps.datatable import rollup
+    rollup.build(dataset)              # time alone
+    rollup.build(dataset, 'language')  # time by language
+    ...
+    rollup.refresh(dataset)  # count messages imported since
+
+Time bins do not depend on the other messages, so refreshing only counts the
+new messages. As with the cube, rollups are rebuilt when the time range
+of the dataset changes, and are only used while they are up to date.
+"""
+from django.db import transaction
+from django.db.models import F, Max, Min, Sum
+
+from msgvis.apps.dimensions import registry
+from msgvis.apps.dimensions.models import TimeDimension
+from msgvis.apps.datatable.models import TimeRollup, TimeRollupState
+from msgvis.apps.datatable.cube import (CubeQuery, Unsupported, BATCH_SIZE, encode_level, decode_level,
+                                        count_messages, get_watermark, is_cube_dimension, is_time_dimension)
+
+# The smallest time bins that are rolled up, in seconds.
+# Smaller bins are only chosen for short time ranges, which have few messages to group.
+MIN_BIN_SIZE = 60
+
+
+def get_bin_sizes():
+    """The time bin sizes that are rolled up, in seconds, from the smallest."""
+    return [step / 1000 for step in TimeDimension.d3_time_scaleSteps if step / 1000 >= MIN_BIN_SIZE]
+
+
+def is_rollup_dimension(dimension):
+    """Return True if time can be rolled up by the levels of the dimension."""
+    return is_cube_dimension(dimension) and not is_time_dimension(dimension)
+
+
+def _count_messages(dataset, dimension_key, after_id, upto_id):
+    """
+    Count the messages with ids in (after_id, upto_id] in the time bins of each size.
+    Returns a dict from (bin size, encoded time, encoded level) to a [count, min time, max time] list.
+    """
+    counts = {}
+    for bin_size in get_bin_sizes():
+        bins = count_messages(dataset, 'time', dimension_key, after_id, upto_id, bin_size)
+        for (time, level), added in bins.iteritems():
+            counts[(bin_size, time, level)] = added
+    return counts
+
+
+def _time_range(counts):
+    """The time range of the counted messages, or (None, None)."""
+    if not counts:
+        return None, None
+    return min(added[1] for added in counts.itervalues()), max(added[2] for added in counts.itervalues())
+
+
+def _create_rollups(dataset, dimension_key, counts):
+    TimeRollup.objects.bulk_create([
+        TimeRollup(dataset=dataset, dimension=dimension_key, bin_size=bin_size, time=time, level=level,
+                   count=amount, min_time=min_time, max_time=max_time)
+        for (bin_size, time, level), (amount, min_time, max_time) in counts
+    ])
+
+
+def _add_counts(dataset, dimension_key, counts):
+    """Add counts to the rollups of a dimension, creating rows for new time bins."""
+    pending = counts.items()
+    for start in xrange(0, len(pending), BATCH_SIZE):
+        batch = dict(pending[start:start + BATCH_SIZE])
+        for bin_size in set(key[0] for key in batch):
+            rows = TimeRollup.objects.filter(dataset=dataset, dimension=dimension_key, bin_size=bin_size,
+                                             time__in=set(key[1] for key in batch if key[0] == bin_size))
+            for row in rows.only('id', 'time', 'level', 'min_time', 'max_time'):
+                added = batch.pop((bin_size, row.time, row.level), None)
+                if added:
+                    amount, min_time, max_time = added
+                    TimeRollup.objects.filter(pk=row.pk).update(count=F('count') + amount,
+                                                                min_time=min(min_time, row.min_time),
+                                                                max_time=max(max_time, row.max_time))
+
+        _create_rollups(dataset, dimension_key, batch.iteritems())
+
+
+def build(dataset, dimension_key=None):
+    """Count all the messages in a dataset by time, or by time and a categorical dimension."""
+    dimension_key = dimension_key or ""
+    if dimension_key and not is_rollup_dimension(registry.get_dimension(dimension_key)):
+        raise ValueError("Time cannot be rolled up by the dimension %s." % dimension_key)
+
+    with transaction.atomic():
+        TimeRollup.objects.filter(dataset=dataset, dimension=dimension_key).delete()
+        state, created = TimeRollupState.objects.get_or_create(dataset=dataset, dimension=dimension_key)
+
+        watermark = get_watermark(dataset)
+        counts = _count_messages(dataset, dimension_key, 0, watermark)
+        _create_rollups(dataset, dimension_key, counts.iteritems())
+
+        state.last_message_id = watermark
+        state.start_time = dataset.start_time
+        state.end_time = dataset.end_time
+        state.min_time, state.max_time = _time_range(counts)
+        state.save()
+
+    return state
+
+
+def refresh(dataset, rebuild=False):
+    """
+    Bring all the rollups built for a dataset up to date by counting the new messages.
+    Rollups are rebuilt from scratch if the time range of the dataset has changed,
+    or if rebuild is True.
+    """
+    states = list(TimeRollupState.objects.filter(dataset=dataset))
+    watermark = get_watermark(dataset)
+
+    for state in states:
+        if rebuild or state.start_time != dataset.start_time or state.end_time != dataset.end_time:
+            build(dataset, state.dimension)
+            continue
+
+        if state.last_message_id >= watermark:
+            continue
+
+        with transaction.atomic():
+            counts = _count_messages(dataset, state.dimension, state.last_message_id, watermark)
+            _add_counts(dataset, state.dimension, counts)
+
+            min_time, max_time = _time_range(counts)
+            if min_time is not None:
+                state.min_time = min(min_time, state.min_time or min_time)
+                state.max_time = max(max_time, state.max_time or max_time)
+            state.last_message_id = watermark
+            state.save()
+
+    return states
+
+
+def drop(dataset, dimension_key):
+    """
+    Delete the rollups by a dimension, e.g. after its values have been recalculated.
+    Data tables will query the messages until they are built again.
+    """
+    with transaction.atomic():
+        TimeRollup.objects.filter(dataset=dataset, dimension=dimension_key).delete()
+        TimeRollupState.objects.filter(dataset=dataset, dimension=dimension_key).delete()
+
+
+class RollupQuery(CubeQuery):
+    """Answers a :meth:`.DataTable.generate` request with a time dimension from the rollups."""
+
+    def __init__(self, *args, **kwargs):
+        super(RollupQuery, self).__init__(*args, **kwargs)
+
+        keys = [key for key in self.cube_key if key and key != 'time']
+        self.rollup_key = keys[0] if keys else ""
+        """The categorical dimension the rollups are counted by, or empty."""
+
+        self.state = None
+
+    @classmethod
+    def create(cls, datatable, dataset, filters=None, exclude=None):
+        """
+        Returns a RollupQuery if the request can be answered from the rollups, or None.
+        This requires a time dimension, and at most one categorical dimension
+        in the table or in the filters, with up-to-date rollups.
+        Filters on time are not supported.
+        """
+        dimensions = [d for d in (datatable.primary_dimension, datatable.secondary_dimension)
+                      if d is not None]
+        if not any(is_time_dimension(d) for d in dimensions):
+            return None
+        return super(RollupQuery, cls).create(datatable, dataset, filters, exclude)
+
+    def is_fresh(self):
+        """Return True if the rollups have been built and have counted every message."""
+        state = TimeRollupState.objects.filter(dataset=self.dataset, dimension=self.rollup_key).first()
+        if state is None or state.last_message_id != get_watermark(self.dataset) or \
+                state.start_time != self.dataset.start_time or state.end_time != self.dataset.end_time:
+            return False
+
+        self.state = state
+        return True
+
+    def _rows(self, bin_size):
+        return TimeRollup.objects.filter(dataset=self.dataset, dimension=self.rollup_key, bin_size=bin_size)
+
+    def _lookup(self, key):
+        return 'time' if key == 'time' else 'level'
+
+    def domain(self, dimension):
+        """Return the levels of a dimension, sorted by frequency, or the time bins, and their labels."""
+        if hasattr(dimension, 'domain'):
+            domain = dimension.domain
+        elif is_time_dimension(dimension):
+            # The time range of all the messages
+            domain = dimension.get_domain_for_range(self.state.min_time, self.state.max_time)
+        else:
+            # Add up the largest time bins of each level
+            rows = self._rows(get_bin_sizes()[-1])
+            rows = self.domain_constraints[dimension.key].apply(rows, 'level')
+            rows = rows.order_by().values('level').annotate(total=Sum('count')).order_by('-total')
+            domain = [decode_level(level) for level, total in rows.values_list('level', 'total')]
+
+        return domain, dimension.get_domain_labels(domain)
+
+    def table(self, restrictions):
+        """
+        The counts for each time bin (and level), restricted to some levels of the categorical dimension.
+        Raises :class:`Unsupported` if the selected messages are too close together for the rolled up bins.
+        """
+        def select(rows):
+            for key, constraint in self.constraints.iteritems():
+                rows = constraint.apply(rows, self._lookup(key))
+            for key, levels in restrictions.iteritems():
+                levels = set(encode_level(level) for level in levels)
+                rows = rows.filter(**{self._lookup(key) + '__in': levels})
+            return rows
+
+        # The time bins depend on the time range of the selected messages
+        bin_sizes = get_bin_sizes()
+        time_range = select(self._rows(bin_sizes[0])).aggregate(min=Min('min_time'), max=Max('max_time'))
+        if time_range['min'] is None:
+            return []
+        bin_size = registry.get_dimension('time').get_bin_size(time_range['min'], time_range['max'])
+        if bin_size not in bin_sizes:
+            raise Unsupported()
+
+        rows = select(self._rows(bin_size))
+        keys = [d.key for d in self.dimensions]
+        lookups = [self._lookup(key) for key in keys]
+        if not self.rollup_key or self.rollup_key in keys:
+            rows = rows.order_by('id').values_list(*(lookups + ['count']))
+        else:
+            # Add up the levels of the filtered dimension
+            rows = rows.order_by().values(*lookups).annotate(total=Sum('count'))
+            rows = rows.values_list(*(lookups + ['total']))
+
+        table = []
+        for row in rows:
+            result = dict((key, decode_level(level)) for key, level in zip(keys, row))
+            result['value'] = row[-1]
+            table.append(result)
+        return table
@@ -1,10 +1,14 @@
 from django.test import TestCase
 from django.conf import settings
+from django.core.cache import cache as default_cache
+from django.test.utils import override_settings
 from django.utils import timezone as tz
 from django.utils import dateparse
 import mock
+from datetime import timedelta
 
-from msgvis.apps.datatable import models
+from msgvis.apps.datatable import models, cube, rollup, bitmap_index, columnar, domain_cache, layouts
+from msgvis.apps.datatable.cache import table_cache, invalidate_dataset
 from msgvis.apps.corpus import models as corpus_models
 from msgvis.apps.dimensions.models import CategoricalDimension
 from msgvis.apps.dimensions import registry
@@ -575,3 +579,830 @@ class GenerateDataTableTest(DistributionTestCaseMixins, TestCase):
         datatable = MockDataTable(primary_dimension='time')
         datatable.generate(dataset)
         self.assertEquals(len(render_calls), 1)
+
+
+class EnableOthersTest(DistributionTestCaseMixins, TestCase):
+    """Counting the "Other" levels together with the top levels"""
+
+    def setUp(self):
+        self.dataset = self.create_empty_dataset()
+        self.start = tz.now()
+
+        languages = [corpus_models.Language.objects.create(code="l%d" % i, name="Language %d" % i)
+                     for i in range(12)]
+        senders = [corpus_models.Person.objects.create(dataset=self.dataset, username="person%d" % i)
+                   for i in range(13)]
+
+        idx = 0
+        for lang_idx, language in enumerate(languages + [None]):
+            for i in range(lang_idx + 1):
+                message = corpus_models.Message.objects.create(
+                    dataset=self.dataset, language=language,
+                    sender=senders[(idx * 7) % 13],
+                    time=self.start + timedelta(minutes=idx),
+                )
+                message.hashtags.add(corpus_models.Hashtag.objects.create(text="#ht%d" % idx))
+                idx += 1
+
+        self.dataset.start_time = self.start
+        self.dataset.end_time = self.start + timedelta(minutes=idx)
+        self.dataset.save()
+
+    def generate(self, fold, primary, secondary=None, **kwargs):
+        datatable = models.DataTable(primary, secondary)
+        datatable.set_mode('enable_others')
+        datatable.use_cube = False
+        if not fold:
+            datatable.can_fold_others = lambda primary_flag, secondary_flag: False
+        return datatable.generate(self.dataset, **kwargs)
+
+    def assertSameResults(self, primary, secondary=None, **kwargs):
+        """Folding should give the same results as the separate queries for the "Other" levels"""
+        expected = self.generate(False, primary, secondary, **kwargs)
+        result = self.generate(True, primary, secondary, **kwargs)
+
+        def sort_table(table):
+            return sorted(sorted(row.items()) for row in table)
+
+        self.assertEquals(sort_table(result['table']), sort_table(expected['table']))
+        self.assertEquals(result['domains'], expected['domains'])
+        return result
+
+    def test_single_dimension(self):
+        """It should add up the other languages, next to the messages without one"""
+        result = self.assertSameResults('language')
+        self.assertIn(None, result['domains']['language'])
+        self.assertIn(u"Other Language", result['domains']['language'])
+        self.assertIn({'language': u"Other Language", 'value': 1 + 2 + 3}, result['table'])
+
+    def test_pair_of_dimensions(self):
+        """It should count the others of both dimensions"""
+        self.assertSameResults('language', 'sender')
+        self.assertSameResults('sender', 'language')
+        self.assertSameResults('language', 'sender', filters=[
+            dict(dimension=registry.get_dimension('language'),
+                 levels=["Language %d" % i for i in range(1, 12)]),
+        ])
+
+    def test_fewer_queries(self):
+        """It should need one query for the table instead of four"""
+        datatable = models.DataTable('language', 'sender')
+        datatable.set_mode('enable_others')
+        datatable.use_cube = False
+        self.assertTrue(datatable.can_fold_others(True, True))
+
+        # The domains are stored the first time
+        datatable.generate(self.dataset)
+
+        # The bitmap index states, the last message, the stored domain and
+        # levels of both dimensions, and the table
+        with self.assertNumQueries(1 + 2 * 3 + 1):
+            datatable.generate(self.dataset)
+
+    def test_many_to_many_dimensions(self):
+        """It should not fold the others of dimensions with several values per message"""
+        datatable = models.DataTable('hashtags', 'language')
+        self.assertFalse(datatable.can_fold_others(True, False))
+        self.assertTrue(datatable.can_fold_others(False, True))
+        self.assertFalse(models.DataTable('language', 'time').can_fold_others(True, False))
+
+        result = self.generate(True, 'hashtags')
+        self.assertIn({'hashtags': u"Other Hashtags", 'value': 91 - 10}, result['table'])
+
+
+class CubeTest(DistributionTestCaseMixins, TestCase):
+    """Answering data table requests from the materialized cube"""
+
+    def setUp(self):
+        # The last message has no time, so it is not counted
+        self.dataset, self.start = self.create_leveled_dataset(senders=True)
+
+    def generate(self, use_cube, primary, secondary=None, mode=None, **kwargs):
+        datatable = models.DataTable(primary, secondary)
+        if mode is not None:
+            datatable.set_mode(mode)
+        datatable.use_cube = use_cube
+        return datatable.generate(self.dataset, **kwargs)
+
+    def assertSameResults(self, primary, secondary=None, mode=None, **kwargs):
+        """The cube should give the same results as querying the messages"""
+        datatable = models.DataTable(primary, secondary)
+        if mode is not None:
+            datatable.set_mode(mode)
+        self.assertIsNotNone(cube.CubeQuery.create(datatable, self.dataset,
+                                                   kwargs.get('filters'), kwargs.get('exclude')))
+
+        expected = self.generate(False, primary, secondary, mode, **kwargs)
+
+        # Check the cube is up to date, get the domains that are not fixed, and get the table
+        # (after checking the time range of the selected messages)
+        dimensions = [d for d in (datatable.primary_dimension, datatable.secondary_dimension) if d is not None]
+        num_domains = len([d for d in dimensions if not hasattr(d, 'domain')])
+        num_time = len([d for d in dimensions if d.key == 'time'])
+        with self.assertNumQueries(3 + num_domains + num_time):
+            result = self.generate(True, primary, secondary, mode, **kwargs)
+
+        def sort_table(table):
+            return sorted(sorted(row.items()) for row in table)
+
+        self.assertEquals(sort_table(result['table']), sort_table(expected['table']))
+        self.assertEquals(result['domains'], dict((k, list(v)) for k, v in expected['domains'].iteritems()))
+        self.assertEquals(result['domain_labels'], expected['domain_labels'])
+        self.assertEquals(result.get('max_page'), expected.get('max_page'))
+        return result
+
+    def test_single_dimension(self):
+        """It should count the levels of one dimension"""
+        cube.build(self.dataset, 'language')
+        result = self.assertSameResults('language')
+        self.assertEquals(len(result['table']), 12)
+        self.assertEquals(result['domains']['language'][0], "Language 11")
+
+        self.assertSameResults('language', mode='omit_others')
+        result = self.assertSameResults('language', mode='enable_others')
+        self.assertIn({'language': "Other Language", 'value': 1 + 2}, result['table'])
+        self.assertSameResults('language', page=2, page_size=5)
+        self.assertSameResults('language', page=1, page_size=5, search_key="language 1")
+
+    def test_pair_of_dimensions(self):
+        """It should count pairs of levels, including many-to-many dimensions"""
+        cube.build(self.dataset, 'language', 'hashtags')
+        cube.build(self.dataset, 'sender', 'contains_url')
+
+        self.assertSameResults('language', 'hashtags')
+        self.assertSameResults('hashtags', 'language', mode='omit_others')
+        self.assertSameResults('hashtags', 'language', mode='enable_others')
+        self.assertSameResults('sender', 'contains_url')
+        self.assertSameResults('contains_url', 'sender')
+
+    def test_filters(self):
+        """It should apply filters and excludes on the dimensions in the table"""
+        cube.build(self.dataset, 'language', 'hashtags')
+        hashtags = registry.get_dimension('hashtags')
+        language = registry.get_dimension('language')
+
+        self.assertSameResults('language', 'hashtags', filters=[
+            dict(dimension=hashtags, levels=["#ht1", "#ht3"]),
+        ])
+        self.assertSameResults('language', 'hashtags', filters=[
+            dict(dimension=language, levels=["Language 3", "Language 5", "Language 7"]),
+            dict(dimension=language, value="Language 5"),
+        ], exclude=[
+            dict(dimension=language, levels=["Language 7"]),
+        ])
+        self.assertSameResults('language', filters=[
+            dict(dimension=language, levels=["Language 3", "Language 11"]),
+        ], page=1)
+
+        cube.build(self.dataset, 'contains_url')
+        self.assertSameResults('contains_url', filters=[
+            dict(dimension=registry.get_dimension('contains_url'), value="false"),
+        ])
+
+    def test_unsupported_requests(self):
+        """It should fall back on querying the messages"""
+        cube.build(self.dataset, 'language', 'hashtags')
+        hashtags = registry.get_dimension('hashtags')
+        language = registry.get_dimension('language')
+
+        unsupported = [
+            (models.DataTable('language', 'replies'), None, None),
+            (models.DataTable('language', 'sender'), None, None),
+            (models.DataTable('language'), [dict(dimension=registry.get_dimension('sender'), levels=["x"])], None),
+            (models.DataTable('language'), [dict(dimension=language, levels=[None])], None),
+            (models.DataTable('hashtags'), None, [dict(dimension=hashtags, levels=["#ht1"])]),
+            (models.DataTable('hashtags'), [dict(dimension=hashtags, levels=["#ht1"]),
+                                            dict(dimension=hashtags, levels=["#ht2"])], None),
+        ]
+        for datatable, filters, exclude in unsupported:
+            self.assertIsNone(cube.CubeQuery.create(datatable, self.dataset, filters, exclude))
+
+        datatable = models.DataTable('language', 'hashtags')
+        datatable.set_mode('enable_others')
+        self.assertIsNone(cube.CubeQuery.create(datatable, self.dataset, [
+            dict(dimension=hashtags, levels=["#ht1", "#ht2"]),
+        ]))
+
+    def test_refresh(self):
+        """It should only be used while up to date, and count new messages when refreshed"""
+        cube.build(self.dataset, 'language', 'hashtags')
+
+        language = corpus_models.Language.objects.get(code="l11")
+        message = corpus_models.Message.objects.create(dataset=self.dataset, language=language,
+                                                       time=self.start)
+        message.hashtags.add(corpus_models.Hashtag.objects.create(text="#new"))
+        self.assertIsNone(cube.CubeQuery.create(models.DataTable('language', 'hashtags'), self.dataset))
+
+        cube.refresh(self.dataset)
+        result = self.assertSameResults('language', 'hashtags')
+        self.assertIn({'language': "Language 11", 'hashtags': "#new", 'value': 1}, result['table'])
+
+        # Changing the dataset's time range changes which messages are counted
+        self.dataset.end_time += timedelta(minutes=1)
+        self.dataset.save()
+        self.assertIsNone(cube.CubeQuery.create(models.DataTable('language', 'hashtags'), self.dataset))
+        cube.refresh(self.dataset)
+        self.assertSameResults('language', 'hashtags')
+
+    def test_filter_on_other_dimension(self):
+        """It should add up the cells of a pair for a filter on another dimension"""
+        cube.build(self.dataset, 'language', 'contains_url')
+        cube.build(self.dataset, 'language', 'hashtags')
+        hashtags = registry.get_dimension('hashtags')
+        language = registry.get_dimension('language')
+
+        self.assertSameResults('language', filters=[
+            dict(dimension=registry.get_dimension('contains_url'), value=True),
+        ])
+        self.assertSameResults('language', filters=[
+            dict(dimension=hashtags, levels=["#ht2"]),
+        ], page=1, page_size=5)
+        self.assertSameResults('hashtags', filters=[
+            dict(dimension=language, levels=["Language 3", "Language 5"]),
+        ], exclude=[
+            dict(dimension=language, levels=["Language 5"]),
+        ])
+
+        # Messages with several of the hashtags would be counted more than once
+        self.assertIsNone(cube.CubeQuery.create(models.DataTable('language'), self.dataset, [
+            dict(dimension=hashtags, levels=["#ht1", "#ht2"]),
+        ]))
+
+    def test_time_bins(self):
+        """It should count categorical dimensions by time"""
+        cube.build(self.dataset, 'time')
+        cube.build(self.dataset, 'language', 'time')
+        cube.build(self.dataset, 'hashtags', 'time')
+        language = registry.get_dimension('language')
+
+        self.assertSameResults('time')
+        self.assertSameResults('language', 'time')
+        self.assertSameResults('time', 'hashtags', mode='omit_others')
+        self.assertSameResults('time', filters=[
+            dict(dimension=registry.get_dimension('hashtags'), levels=["#ht3"]),
+        ])
+        self.assertSameResults('time', 'language', filters=[
+            dict(dimension=language, levels=["Language 0", "Language 11"]),
+        ])
+
+        # The selected messages are too close together for the counted bins
+        filters = [dict(dimension=language, levels=["Language 11"])]
+        query = cube.CubeQuery.create(models.DataTable('language', 'time'), self.dataset, filters)
+        self.assertRaises(cube.Unsupported, query.generate)
+        result = self.generate(True, 'language', 'time', filters=filters)
+        self.assertEquals(len(result['table']), 12)
+
+
+class BitmapIndexTest(DistributionTestCaseMixins, TestCase):
+    """Answering data table requests by intersecting the bitmaps of the levels"""
+
+    def setUp(self):
+        # The last message has no time, so it is not indexed
+        self.dataset, self.start = self.create_leveled_dataset(empty_language=True)
+
+        for key in ('language', 'hashtags', 'contains_url'):
+            bitmap_index.build(self.dataset, key)
+
+    def generate(self, use_index, primary, secondary=None, mode=None, **kwargs):
+        datatable = models.DataTable(primary, secondary)
+        if mode is not None:
+            datatable.set_mode(mode)
+        datatable.use_cube = False
+        datatable.use_bitmap_index = use_index
+        return datatable.generate(self.dataset, **kwargs)
+
+    def assertSameResults(self, primary, secondary=None, mode=None, **kwargs):
+        """The index should give the same results as querying the messages"""
+        datatable = models.DataTable(primary, secondary)
+        if mode is not None:
+            datatable.set_mode(mode)
+        self.assertIsNotNone(bitmap_index.BitmapQuery.create(datatable, self.dataset,
+                                                             kwargs.get('filters'), kwargs.get('exclude')))
+
+        expected = self.generate(False, primary, secondary, mode, **kwargs)
+
+        # Check the indexes are up to date, and nothing else
+        with self.assertNumQueries(2):
+            result = self.generate(True, primary, secondary, mode, **kwargs)
+
+        def sort_table(table):
+            return sorted(sorted(row.items()) for row in table)
+
+        self.assertEquals(sort_table(result['table']), sort_table(expected['table']))
+        self.assertEquals(result['domains'], dict((k, list(v)) for k, v in expected['domains'].iteritems()))
+        self.assertEquals(result['domain_labels'], expected['domain_labels'])
+        self.assertEquals(result.get('max_page'), expected.get('max_page'))
+        return result
+
+    def test_single_dimension(self):
+        """It should count the levels of one dimension, including the empty level"""
+        result = self.assertSameResults('language')
+        self.assertEquals(len(result['table']), 13)
+        self.assertEquals(result['domains']['language'][0], None)
+
+        self.assertSameResults('hashtags')
+        self.assertSameResults('language', mode='omit_others')
+        self.assertSameResults('language', mode='enable_others')
+        self.assertSameResults('hashtags', mode='enable_others')
+        self.assertSameResults('language', page=2, page_size=5)
+
+    def test_pair_of_dimensions(self):
+        """It should count pairs of levels, including many-to-many dimensions"""
+        self.assertSameResults('language', 'hashtags')
+        self.assertSameResults('hashtags', 'contains_url')
+        self.assertSameResults('hashtags', 'language', mode='omit_others')
+        self.assertSameResults('hashtags', 'language', mode='enable_others')
+        self.assertSameResults('language', 'contains_url', mode='enable_others')
+
+    def test_filters(self):
+        """It should apply filters and excludes on any indexed dimension"""
+        hashtags = registry.get_dimension('hashtags')
+        language = registry.get_dimension('language')
+
+        self.assertSameResults('language', filters=[
+            dict(dimension=hashtags, levels=["#ht3"]),
+        ])
+        self.assertSameResults('language', 'contains_url', filters=[
+            dict(dimension=language, levels=["Language 3", "Language 5", None]),
+        ], exclude=[
+            dict(dimension=hashtags, levels=["#ht0"]),
+            dict(dimension=language, levels=["Language 5"]),
+        ], mode='enable_others')
+        self.assertSameResults('hashtags', filters=[
+            dict(dimension=registry.get_dimension('contains_url'), value="false"),
+        ], exclude=[
+            dict(dimension=hashtags, levels=["#ht1"]),
+        ])
+
+    def test_unsupported_requests(self):
+        """It should fall back on querying the messages"""
+        hashtags = registry.get_dimension('hashtags')
+        unsupported = [
+            (models.DataTable('language', 'time'), None),
+            (models.DataTable('language', 'sender'), None),
+            (models.DataTable('language'), [dict(dimension=registry.get_dimension('sender'), levels=["x"])]),
+            (models.DataTable('hashtags'), [dict(dimension=hashtags, levels=["#ht1"])]),
+            # Counted once for each matching level of a many-to-many filter
+            (models.DataTable('language'), [dict(dimension=hashtags, levels=["#ht1", "#ht3"])]),
+            (models.DataTable('language'), [dict(dimension=hashtags, levels=["#ht1"]),
+                                            dict(dimension=hashtags, value="#ht2")]),
+            (models.DataTable('language'), [dict(dimension=hashtags, levels=["#ht1"], value="#ht2")]),
+        ]
+        for datatable, filters in unsupported:
+            self.assertIsNone(bitmap_index.BitmapQuery.create(datatable, self.dataset, filters))
+
+    def test_refresh(self):
+        """It should only be used while up to date, and add new messages when refreshed"""
+        language = corpus_models.Language.objects.get(code="l11")
+        message = corpus_models.Message.objects.create(dataset=self.dataset, language=language,
+                                                       time=self.start)
+        message.hashtags.add(corpus_models.Hashtag.objects.create(text="#new"))
+        self.assertIsNone(bitmap_index.BitmapQuery.create(models.DataTable('language', 'hashtags'), self.dataset))
+
+        bitmap_index.refresh(self.dataset)
+        result = self.assertSameResults('language', 'hashtags')
+        self.assertIn({'language': "Language 11", 'hashtags': "#new", 'value': 1}, result['table'])
+
+        bitmap_index.drop(self.dataset, 'hashtags')
+        self.assertIsNone(bitmap_index.BitmapQuery.create(models.DataTable('language', 'hashtags'), self.dataset))
+
+
+class ColumnarSnapshotTest(DistributionTestCaseMixins, TestCase):
+    """Counting data tables with the columns of a snapshot"""
+
+    def setUp(self):
+        self.dataset, self.start = self.create_leveled_dataset(senders=True, empty_language=True)
+
+        columnar.build(self.dataset)
+
+    def tearDown(self):
+        columnar.drop(self.dataset)
+
+    def generate(self, use_columnar, primary, secondary=None, mode=None, **kwargs):
+        datatable = models.DataTable(primary, secondary)
+        if mode is not None:
+            datatable.set_mode(mode)
+        datatable.use_cube = False
+        datatable.use_bitmap_index = False
+        datatable.use_columnar = use_columnar
+        return datatable.generate(self.dataset, **kwargs)
+
+    def assertSameResults(self, primary, secondary=None, mode=None, **kwargs):
+        """The snapshot should give the same results as querying the messages"""
+        datatable = models.DataTable(primary, secondary)
+        if mode is not None:
+            datatable.set_mode(mode)
+        self.assertIsNotNone(columnar.ColumnarQuery.create(datatable, self.dataset,
+                                                           kwargs.get('filters'), kwargs.get('exclude')))
+
+        expected = self.generate(False, primary, secondary, mode, **kwargs)
+
+        # Check the snapshot is up to date, and nothing else
+        with self.assertNumQueries(1):
+            result = self.generate(True, primary, secondary, mode, **kwargs)
+
+        def sort_table(table):
+            return sorted(sorted(row.items()) for row in table)
+
+        self.assertEquals(sort_table(result['table']), sort_table(expected['table']))
+        self.assertEquals(result['domains'], dict((k, list(v)) for k, v in expected['domains'].iteritems()))
+        self.assertEquals(result['domain_labels'], expected['domain_labels'])
+        self.assertEquals(result.get('max_page'), expected.get('max_page'))
+        return result
+
+    def test_single_dimension(self):
+        """It should count the levels of one dimension, including the empty level"""
+        result = self.assertSameResults('language')
+        self.assertEquals(len(result['table']), 13)
+
+        self.assertSameResults('hashtags')
+        self.assertSameResults('sentiment')
+        self.assertSameResults('language', mode='enable_others')
+        self.assertSameResults('hashtags', mode='enable_others')
+        self.assertSameResults('language', page=2, page_size=5, search_key="language")
+
+    def test_pair_of_dimensions(self):
+        """It should count pairs of levels, including many-to-many dimensions"""
+        self.assertSameResults('language', 'hashtags')
+        self.assertSameResults('hashtags', 'sender')
+        self.assertSameResults('contains_url', 'language', mode='omit_others')
+        self.assertSameResults('hashtags', 'language', mode='enable_others')
+        self.assertSameResults('language', 'sender', mode='enable_others')
+
+    def test_filters(self):
+        """Filters on many-to-many dimensions should count a message once for each matching value"""
+        hashtags = registry.get_dimension('hashtags')
+        language = registry.get_dimension('language')
+
+        self.assertSameResults('language', filters=[
+            dict(dimension=hashtags, levels=["#ht3"]),
+        ])
+        self.assertSameResults('sender', 'contains_url', filters=[
+            dict(dimension=hashtags, levels=["#ht0", "#ht2"]),
+            dict(dimension=registry.get_dimension('replies'), min=2, max=5),
+            dict(dimension=registry.get_dimension('time'),
+                 min_time=self.start + timedelta(minutes=10)),
+        ], exclude=[
+            dict(dimension=language, levels=["Language 5", None]),
+        ])
+        self.assertSameResults('hashtags', 'language', filters=[
+            dict(dimension=registry.get_dimension('contains_url'), value="false"),
+            dict(dimension=language, levels=["Language 3", "Language 11"]),
+        ], exclude=[
+            dict(dimension=hashtags, levels=["#ht1"]),
+        ], mode='enable_others')
+
+    def test_unsupported_requests(self):
+        """It should fall back on querying the messages"""
+        hashtags = registry.get_dimension('hashtags')
+        unsupported = [
+            (models.DataTable('language', 'time'), None),
+            (models.DataTable('replies'), None),
+            (models.DataTable('topics'), None),
+            (models.DataTable('language'), [dict(dimension=registry.get_dimension('sender_follower_count'), min=1)]),
+            (models.DataTable('hashtags'), [dict(dimension=hashtags, levels=["#ht1"])]),
+        ]
+        for datatable, filters in unsupported:
+            self.assertIsNone(columnar.ColumnarQuery.create(datatable, self.dataset, filters))
+
+    def test_refresh(self):
+        """It should only be used while it includes every message"""
+        language = corpus_models.Language.objects.get(code="l11")
+        message = corpus_models.Message.objects.create(dataset=self.dataset, language=language,
+                                                       time=self.start)
+        message.hashtags.add(corpus_models.Hashtag.objects.create(text="#new"))
+        self.assertIsNone(columnar.ColumnarQuery.create(models.DataTable('language'), self.dataset))
+
+        columnar.refresh(self.dataset)
+        result = self.assertSameResults('language', 'hashtags')
+        self.assertIn({'language': "Language 11", 'hashtags': "#new", 'value': 1}, result['table'])
+
+    def test_preload(self):
+        """Preloading should keep the snapshot and its level columns in this process"""
+        from msgvis import preload
+
+        columnar.drop(self.dataset)
+        columnar.build(self.dataset)
+        preload.preload_datasets([self.dataset.id])
+
+        snapshot = columnar._snapshots[self.dataset.id]
+        self.assertIsNotNone(snapshot.level_column(registry.get_dimension('hashtags')))
+        self.assertIs(columnar.load(self.dataset), snapshot)
+        self.assertSameResults('hashtags', 'language')
+
+
+class RollupTest(DistributionTestCaseMixins, TestCase):
+    """Answering time histograms from the rollups of each time bin size"""
+
+    def setUp(self):
+        # Spread over enough time for bins of a minute or more
+        self.dataset, self.start = self.create_leveled_dataset(minutes_apart=13)
+
+    def generate(self, use_rollups, primary, secondary=None, mode=None, **kwargs):
+        datatable = models.DataTable(primary, secondary)
+        if mode is not None:
+            datatable.set_mode(mode)
+        datatable.use_cube = False
+        datatable.use_rollups = use_rollups
+        return datatable.generate(self.dataset, **kwargs)
+
+    def assertSameResults(self, primary, secondary=None, mode=None, **kwargs):
+        """The rollups should give the same results as querying the messages"""
+        datatable = models.DataTable(primary, secondary)
+        if mode is not None:
+            datatable.set_mode(mode)
+        self.assertIsNotNone(rollup.RollupQuery.create(datatable, self.dataset,
+                                                       kwargs.get('filters'), kwargs.get('exclude')))
+
+        expected = self.generate(False, primary, secondary, mode, **kwargs)
+
+        # Check the rollups are up to date, get the categorical domain,
+        # then the time range of the selected messages and the table
+        dimensions = [d for d in (datatable.primary_dimension, datatable.secondary_dimension) if d is not None]
+        num_domains = len([d for d in dimensions if d.key != 'time' and not hasattr(d, 'domain')])
+        with self.assertNumQueries(4 + num_domains):
+            result = self.generate(True, primary, secondary, mode, **kwargs)
+
+        def sort_table(table):
+            return sorted(sorted(row.items()) for row in table)
+
+        self.assertEquals(sort_table(result['table']), sort_table(expected['table']))
+        self.assertEquals(result['domains'], dict((k, list(v)) for k, v in expected['domains'].iteritems()))
+        self.assertEquals(result['domain_labels'], expected['domain_labels'])
+        return result
+
+    def test_time_bins(self):
+        """It should add up the bins of the size chosen for the selected messages"""
+        rollup.build(self.dataset)
+        rollup.build(self.dataset, 'language')
+        rollup.build(self.dataset, 'hashtags')
+        language = registry.get_dimension('language')
+
+        self.assertSameResults('time')
+        self.assertSameResults('language', 'time')
+        self.assertSameResults('time', 'hashtags', mode='omit_others')
+        self.assertSameResults('time', filters=[
+            dict(dimension=registry.get_dimension('hashtags'), levels=["#ht3"]),
+        ])
+
+        # Smaller bins than the whole dataset's
+        result = self.assertSameResults('time', 'language', filters=[
+            dict(dimension=language, levels=["Language 10", "Language 11"]),
+        ])
+        self.assertTrue(len(result['table']) > 0)
+        self.assertSameResults('time', exclude=[
+            dict(dimension=language, levels=["Language 11"]),
+        ])
+
+    def test_unsupported_requests(self):
+        """It should fall back on querying the messages"""
+        rollup.build(self.dataset)
+        rollup.build(self.dataset, 'language')
+        language = registry.get_dimension('language')
+
+        self.assertIsNone(rollup.RollupQuery.create(models.DataTable('language'), self.dataset))
+        self.assertIsNone(rollup.RollupQuery.create(models.DataTable('time', 'hashtags'), self.dataset))
+        self.assertIsNone(rollup.RollupQuery.create(models.DataTable('time'), self.dataset, [
+            dict(dimension=registry.get_dimension('time'), min_time=self.start + timedelta(hours=1)),
+        ]))
+
+        # The "Other" rows with time bins are only counted from the messages
+        datatable = models.DataTable('time', 'language')
+        datatable.set_mode('enable_others')
+        query = rollup.RollupQuery.create(datatable, self.dataset)
+        self.assertRaises(rollup.Unsupported, query.generate)
+
+        # A single message is binned by the second
+        filters = [dict(dimension=language, levels=["Language 0"])]
+        query = rollup.RollupQuery.create(models.DataTable('time'), self.dataset, filters)
+        self.assertRaises(rollup.Unsupported, query.generate)
+        result = self.generate(True, 'time', filters=filters)
+        self.assertEquals(list(result['table']), list(self.generate(False, 'time', filters=filters)['table']))
+
+    def test_refresh(self):
+        """It should only be used while it has counted every message"""
+        rollup.build(self.dataset, 'language')
+        language = corpus_models.Language.objects.get(code="l11")
+        corpus_models.Message.objects.create(dataset=self.dataset, language=language,
+                                             time=self.start + timedelta(minutes=5))
+        self.assertIsNone(rollup.RollupQuery.create(models.DataTable('time', 'language'), self.dataset))
+
+        rollup.refresh(self.dataset)
+        self.assertSameResults('time', 'language')
+
+        # Changing the dataset's time range changes which messages are counted
+        self.dataset.end_time += timedelta(minutes=1)
+        self.dataset.save()
+        self.assertIsNone(rollup.RollupQuery.create(models.DataTable('time', 'language'), self.dataset))
+        rollup.refresh(self.dataset)
+        self.assertSameResults('time', 'language')
+
+
+class DomainCacheTest(DistributionTestCaseMixins, TestCase):
+    """Storing the domains and ranges of dimensions per dataset"""
+
+    def setUp(self):
+        self.dataset = self.create_empty_dataset()
+        self.start = tz.now()
+        self.languages = [corpus_models.Language.objects.create(code="l%d" % i, name="Language %d" % i)
+                          for i in range(3)]
+        for idx in range(6):
+            corpus_models.Message.objects.create(dataset=self.dataset, language=self.languages[idx % 3 / 2],
+                                                 shared_count=idx * 10,
+                                                 time=self.start + timedelta(hours=idx))
+        self.dataset.start_time = self.start
+        self.dataset.end_time = self.start + timedelta(hours=5)
+        self.dataset.save()
+
+    def generate(self, primary, secondary=None, **kwargs):
+        datatable = models.DataTable(primary, secondary)
+        datatable.use_cube = False
+        datatable.use_rollups = False
+        datatable.use_bitmap_index = False
+        datatable.use_columnar = False
+        return datatable.generate(self.dataset, **kwargs)
+
+    def test_domains(self):
+        """It should give the domains and ranges found from the messages"""
+        messages = models.filter_time_range(self.dataset.message_set.all(), self.dataset)
+        for key in ('language', 'time', 'shares'):
+            dimension = registry.get_dimension(key)
+            domain, labels = domain_cache.get_domain(self.dataset, dimension)
+            self.assertEquals(domain, list(dimension.get_domain(messages)))
+
+        time = registry.get_dimension('time')
+        self.assertEquals(domain_cache.get_range(self.dataset, time), time.get_range(messages))
+        self.assertEquals(domain_cache.get_domain(self.dataset, time, bins=3)[0],
+                          time.get_domain(messages, bins=3))
+
+    def test_stored(self):
+        """It should only look up the stored domains and ranges"""
+        self.assertEquals(domain_cache.warm(self.dataset, ['language', 'shares']), 2)
+
+        # The last message id, the stored domain and its levels
+        with self.assertNumQueries(3):
+            domain, labels = domain_cache.get_domain(self.dataset, registry.get_dimension('language'))
+        self.assertEquals(domain, ["Language 0", "Language 1"])
+
+        with self.assertNumQueries(2):
+            self.assertEquals(domain_cache.get_range(self.dataset, registry.get_dimension('shares')), (0, 50))
+
+        # Without filters, neither the domain nor the range are aggregated again
+        expected = list(self.generate('shares')['table'])
+        with self.assertNumQueries(5):
+            self.assertEquals(list(self.generate('shares')['table']), expected)
+
+    def test_pages(self):
+        """It should read only the levels on a page, or matching a search"""
+        language = registry.get_dimension('language')
+        self.assertEquals(domain_cache.get_domain(self.dataset, language, limit=1, offset=1)[0], ["Language 1"])
+        self.assertEquals(domain_cache.get_domain(self.dataset, language, search="AGE 1")[0], ["Language 1"])
+        self.assertEquals(domain_cache.get_domain_size(self.dataset, language, search="language"), 2)
+
+        # Fixed domains are paged with their labels
+        sentiment = registry.get_dimension('sentiment')
+        domain, labels = domain_cache.get_domain(self.dataset, sentiment, limit=2, offset=1)
+        self.assertEquals(domain, list(sentiment.domain[1:3]))
+        self.assertEquals(labels, list(sentiment.domain_labels[1:3]))
+
+        # Paging the filter distribution
+        result = self.generate('language', page=2, page_size=1)
+        self.assertEquals(result['domains']['language'], ["Language 1"])
+        self.assertEquals(result['max_page'], 3)
+        self.assertEquals(list(result['table']), [{'language': "Language 1", 'value': 2}])
+        self.assertIsNone(self.generate('language', page=1, page_size=1, search_key="Language 5"))
+
+    def test_new_messages(self):
+        """It should find the domains again when messages are added or it is invalidated"""
+        language = registry.get_dimension('language')
+        domain_cache.get_domain(self.dataset, language)
+
+        for i in range(3):
+            corpus_models.Message.objects.create(dataset=self.dataset, language=self.languages[2],
+                                                 time=self.start)
+        self.assertEquals(domain_cache.get_domain(self.dataset, language)[0],
+                          ["Language 0", "Language 2", "Language 1"])
+
+        corpus_models.Message.objects.filter(language=self.languages[2]).update(language=self.languages[1])
+        domain_cache.invalidate(self.dataset, 'language')
+        self.assertEquals(domain_cache.get_domain(self.dataset, language)[0], ["Language 1", "Language 0"])
+
+
+@override_settings(DATATABLE_CACHE_ENABLED=True)
+class TableCacheTest(TestCase):
+    """Caching data table results"""
+
+    def setUp(self):
+        default_cache.clear()
+        self.dataset = corpus_models.Dataset.objects.create(name="Test cached dataset")
+        self.hashtags = registry.get_dimension('hashtags')
+
+    def test_normalized_keys(self):
+        """Requests that mean the same thing should share a key"""
+        key = table_cache.make_key(self.dataset, ['hashtags', 'time'],
+                                   filters=[dict(dimension=self.hashtags, levels=["#b", "#a"])])
+        self.assertEquals(key, table_cache.make_key(self.dataset.id, [self.hashtags, 'time'],
+                                                    filters=[dict(dimension='hashtags', levels=["#a", "#b"])],
+                                                    exclude=[], page_size=50))
+        self.assertNotEquals(key, table_cache.make_key(self.dataset, ['time', 'hashtags'],
+                                                       filters=[dict(dimension=self.hashtags, levels=["#a"])]))
+        self.assertNotEquals(table_cache.make_key(self.dataset, ['hashtags'], page=1, page_size=10),
+                             table_cache.make_key(self.dataset, ['hashtags'], page=1, page_size=20))
+
+        # Filters that cannot be written down are not cached
+        self.assertIsNone(table_cache.make_key(self.dataset, ['hashtags'], filters=[dict(dimension=object())]))
+        with self.settings(DATATABLE_CACHE_ENABLED=False):
+            self.assertIsNone(table_cache.make_key(self.dataset, ['hashtags']))
+
+    def test_hits_and_misses(self):
+        """It should return stored results and count hits"""
+        table_cache.reset_stats()
+        key = table_cache.make_key(self.dataset, ['hashtags'])
+        self.assertEquals(table_cache.get(key), (False, None))
+
+        result = {'table': iter([{'hashtags': "#a", 'value': 1}]), 'domains': {}, 'domain_labels': {}}
+        table_cache.set(key, result)
+        self.assertEquals(table_cache.get(key), (True, {
+            'table': [{'hashtags': "#a", 'value': 1}], 'domains': {}, 'domain_labels': {},
+        }))
+
+        # A page past the end has no results, which is also worth keeping
+        key = table_cache.make_key(self.dataset, ['hashtags'], page=5)
+        table_cache.set(key, None)
+        self.assertEquals(table_cache.get(key), (True, None))
+
+        self.assertEquals(table_cache.stats(), {'hits': 2, 'misses': 1, 'hit_rate': 2.0 / 3})
+
+    def test_invalidate_dataset(self):
+        """Results should not be used after the dataset changes"""
+        key = table_cache.make_key(self.dataset, ['hashtags'])
+        table_cache.set(key, {'table': []})
+        other_dataset = corpus_models.Dataset.objects.create(name="Another dataset")
+        other_key = table_cache.make_key(other_dataset, ['hashtags'])
+        table_cache.set(other_key, {'table': []})
+
+        invalidate_dataset(self.dataset)
+        new_key = table_cache.make_key(self.dataset, ['hashtags'])
+        self.assertNotEquals(key, new_key)
+        self.assertEquals(table_cache.get(new_key), (False, None))
+        self.assertEquals(table_cache.get(other_key), (True, {'table': []}))
+
+    def test_shared_version(self):
+        """The version should be kept with the dataset, so processes with their own caches agree on it"""
+        version = table_cache.get_version(self.dataset.id)
+        table_cache.cache.clear()
+        self.assertEquals(table_cache.get_version(self.dataset.id), version)
+
+        corpus_models.Dataset.objects.filter(id=self.dataset.id).update(table_version="changed elsewhere")
+        self.assertEquals(table_cache.get_version(self.dataset.id), "changed elsewhere")
+
+
+class LayoutsTest(TestCase):
+    def setUp(self):
+        self.result = {
+            'table': [
+                {'hashtags': "#oso", 'sender': "alice", 'value': 3},
+                {'hashtags': "#oso", 'sender': "bob", 'value': 1},
+                {'hashtags': None, 'sender': "alice", 'value': 2},
+            ],
+            'domains': {'hashtags': ["#oso", "#mudslide"], 'sender': ["alice", "bob"]},
+            'domain_labels': {},
+        }
+
+    def test_columns(self):
+        """Each row should become the positions of its levels, with levels outside the domain added"""
+        result = layouts.apply_layout(self.result, ['hashtags', 'sender'], 'columns')
+        self.assertEquals(result['table'], {
+            'layout': 'columns',
+            'levels': {'hashtags': ["#oso", "#mudslide", None], 'sender': ["alice", "bob"]},
+            'columns': {'hashtags': [0, 0, 2], 'sender': [0, 1, 0]},
+            'values': [3, 1, 2],
+        })
+        self.assertEquals(result['domains'], self.result['domains'])
+
+        # The result itself is unchanged
+        self.assertEquals(len(self.result['table']), 3)
+
+    def test_matrix(self):
+        """Every pair of levels should get a value"""
+        result = layouts.apply_layout(self.result, ['sender', 'hashtags'], 'matrix')
+        self.assertEquals(result['table']['dimensions'], ['sender', 'hashtags'])
+        self.assertEquals(result['table']['values'], [[3, 0, 2], [1, 0, 0]])
+
+        result = layouts.apply_layout({'table': [{'sender': "bob", 'value': 4}],
+                                       'domains': self.result['domains']}, ['sender'], 'matrix')
+        self.assertEquals(result['table']['values'], [0, 4])
+
+    def test_groups(self):
+        """The tables of groups should be laid out with the groups as a dimension"""
+        result = layouts.apply_layout({
+            'table': [{'sender': "alice", 'groups': 7, 'value': 2}],
+            'domains': {'sender': ["alice"], 'groups': [5, 7]},
+        }, ['sender'], 'columns')
+        self.assertEquals(result['table']['columns'], {'sender': [0], 'groups': [1]})
+
+        table = [{'sender': "alice", 'hashtags': "#oso", 'value': 1}]
+        result = layouts.apply_layout({'tables': [{'group_id': 5, 'group_name': "a group", 'table': table}],
+                                       'domains': self.result['domains']}, ['sender', 'hashtags'], 'matrix')
+        self.assertEquals(result['tables'][0]['group_id'], 5)
+        self.assertEquals(result['tables'][0]['table']['values'], [[1, 0], [0, 0]])
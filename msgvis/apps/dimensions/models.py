@@ -167,10 +167,20 @@ class CategoricalDimension(object):
         """
         return queryset, expression
 
-    def get_domain(self, queryset, **kwargs):
+    def get_grouping_converter(self, expression):
+        """
+        A function to convert the values of a grouping expression into levels,
+        or None if they are already levels.
+        """
+        return None
+
+    def get_domain(self, queryset, limit=None, offset=0, search=None, **kwargs):
         """
         Get the list of values of the dimension, either in natural order or
         sorted by frequency. The values will be drawn from the queryset.
+
+        Optionally, only the values containing a search string (ignoring case),
+        and at most limit values after offset, are drawn from the queryset.
         """
 
         if hasattr(self, 'domain'):
@@ -180,16 +190,44 @@ class CategoricalDimension(object):
         # Type checking
         queryset = find_messages(queryset)
 
+        queryset = self._search(queryset, search)
+
         # Use 'values' to group the queryset
+        grouping_expression = self.get_grouping_expression(queryset)
         queryset = self.group_by(queryset, grouping_key='value')
 
         # Count the messages in each group
         queryset = queryset.annotate(count=models.Count('id'))
 
-        queryset = queryset.order_by('-count')
+        # Ties are broken by value, so pages of levels never overlap
+        queryset = queryset.order_by('-count', grouping_expression)
+
+        if limit is not None:
+            queryset = queryset[offset:offset + limit]
+        elif offset:
+            queryset = queryset[offset:]
 
         return [row['value'] for row in queryset]
 
+    def get_domain_size(self, queryset, search=None):
+        """The number of values drawn from the queryset, optionally only those containing a search string."""
+
+        if hasattr(self, 'domain'):
+            return len(self.domain)
+
+        # Type checking
+        queryset = find_messages(queryset)
+
+        queryset = self._search(queryset, search)
+        queryset = self.group_by(queryset, grouping_key='value')
+        return queryset.annotate(count=models.Count('id')).count()
+
+    def _search(self, queryset, search):
+        """Keep the messages with a value containing the search string, ignoring case."""
+        if search is not None:
+            queryset = queryset.filter(Q((self.field_name + "__icontains", search)))
+        return queryset
+
 
     def get_domain_labels(self, domain):
         """Return a list of labels corresponding to the domain values"""
@@ -405,21 +443,29 @@ class QuantitativeDimension(CategoricalDimension):
             # Then use values to group by the grouping key.
             queryset = queryset.values(internal_key)
 
+            converter = self.get_grouping_converter(expression)
             return MappedValuesQuerySet.create_from(queryset, {
                 internal_key: grouping_key,
-            })
+            }, {internal_key: converter} if converter is not None else None)
 
-    def get_domain(self, queryset, bins=None, **kwargs):
+    def get_bin_size(self, min_val, max_val, bins=None):
+        """The bin size used to group values from min_val to max_val, as in :meth:`get_grouping_expression`."""
         if bins is None:
             bins = self.default_bins
+        return self._get_bin_size(min_val, max_val, bins)
 
+    def get_domain(self, queryset, bins=None, **kwargs):
         queryset = find_messages(queryset)
 
         min_val, max_val = self.get_range(queryset)
+        return self.get_domain_for_range(min_val, max_val, bins)
+
+    def get_domain_for_range(self, min_val, max_val, bins=None):
+        """Get the bins covering the values from min_val to max_val."""
         if min_val is None:
             return []
 
-        bin_size = self._get_bin_size(min_val, max_val, bins)
+        bin_size = self.get_bin_size(min_val, max_val, bins)
         min_bin = self._bin_value(min_val, bin_size)
         max_bin = self._bin_value(max_val, bin_size)
 
@@ -524,6 +570,7 @@ class TimeDimension(QuantitativeDimension):
         return queryset
 
     # Convert to unix timestamp. Divide by bin size. Floor. Multiply by bin size. Convert to datetime.
+    # Only used for bins smaller than the time buckets stored on messages (see :data:`.TIME_BUCKET_SIZES`).
     grouping_expressions = {
         'mysql': r"FROM_UNIXTIME({bin_size} * FLOOR(UNIX_TIMESTAMP(`{field_name}`) / {bin_size}))",
         'sqlite': r"DATETIME({bin_size} * CAST(STRFTIME('%%s', `{field_name}`) / {bin_size} AS INTEGER), 'unixepoch')"
@@ -605,6 +652,43 @@ class TimeDimension(QuantitativeDimension):
         else:
             return dt
 
+    def _get_bucket_field(self, bin_size):
+        if self.field_name != 'time':
+            return None
+        return corpus_models.get_time_bucket_field(bin_size)
+
+    def _render_grouping_expression(self, bin_size):
+        # Group on the stored time bins of the messages if there are some of this size
+        bucket_field = self._get_bucket_field(bin_size)
+        if bucket_field is not None:
+            return bucket_field
+        return super(TimeDimension, self)._render_grouping_expression(bin_size)
+
+    def _is_bucket_field(self, expression):
+        return self.field_name == 'time' and \
+            expression in [corpus_models.get_time_bucket_field(size) for size in corpus_models.TIME_BUCKET_SIZES]
+
+    def select_grouping_expression(self, queryset, expression):
+        if self._is_bucket_field(expression):
+            # A plain column
+            return queryset, expression
+        return super(TimeDimension, self).select_grouping_expression(queryset, expression)
+
+    def get_grouping_converter(self, expression):
+        """Time buckets are grouped as seconds since the epoch, and converted to datetimes."""
+        if self._is_bucket_field(expression):
+            return self._from_timestamp
+        return None
+
+    def _from_timestamp(self, timestamp):
+        if timestamp is None:
+            return None
+        dt = datetime.utcfromtimestamp(timestamp)
+        if settings.USE_TZ:
+            return dt.replace(tzinfo=timezone.utc)
+        else:
+            return dt
+
     def _iter_xrange(self, min, max, step):
         step = timedelta(seconds=step)
         max = max + step # bin values are the left side of each bin so we need an extra on the right
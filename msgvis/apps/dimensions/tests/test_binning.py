@@ -147,3 +147,14 @@ class TestTimeBinning(TestCase):
             desired_bins=50,
             expected_bin_size=5,
         )
+
+    def test_time_buckets(self):
+        """Time bins of a minute or more are grouped on the time buckets stored on messages"""
+        dimension = registry.get_dimension('time')
+        queryset = corpus_models.Message.objects.all()
+        self.assertEquals(dimension.get_grouping_expression(queryset, bin_size=3600.0), 'time_bucket_3600')
+        self.assertNotIn('time_bucket', dimension.get_grouping_expression(queryset, bin_size=30.0))
+
+        convert = dimension.get_grouping_converter('time_bucket_3600')
+        self.assertEquals(convert(1336089600), tz.datetime(2012, 5, 4, tzinfo=tz.utc))
+        self.assertIsNone(dimension.get_grouping_converter(dimension.field_name))
@@ -44,6 +44,43 @@ class CategoricalDomainTest(DistributionTestCaseMixins, TestCase):
         result = dimension.get_domain(dataset.message_set.all())
         self.assertEquals(result, language_names)
 
+    def test_domain_page(self):
+        """Only the levels on a page, or matching a search, are drawn from the messages"""
+
+        languages = self.create_test_languages(model=True)
+        language_names = [lang.name for lang in languages]
+        dimension = registry.get_dimension('language')
+
+        language_distribution = self.get_distribution([lang.id for lang in languages])
+        dataset = self.generate_messages_for_distribution(
+            field_name='language_id',
+            distribution=language_distribution,
+        )
+        messages = dataset.message_set.all()
+        by_frequency = list(reversed(language_names))
+
+        self.assertEquals(dimension.get_domain(messages, limit=2), by_frequency[:2])
+        self.assertEquals(dimension.get_domain(messages, limit=2, offset=1), by_frequency[1:3])
+        self.assertEquals(dimension.get_domain(messages, search="AN"), ["Spanish", "Japanese"])
+        self.assertEquals(dimension.get_domain_size(messages), 4)
+        self.assertEquals(dimension.get_domain_size(messages, search="an"), 2)
+
+    def test_domain_page_ties(self):
+        """Levels with the same count are sorted by value, so pages never overlap"""
+
+        languages = self.create_test_languages(model=True)
+        language_names = [lang.name for lang in languages]
+        dimension = registry.get_dimension('language')
+
+        dataset = self.generate_messages_for_distribution(
+            field_name='language_id',
+            distribution=dict((lang.id, 3) for lang in languages),
+        )
+        messages = dataset.message_set.all()
+
+        pages = [dimension.get_domain(messages, limit=1, offset=offset) for offset in range(len(languages))]
+        self.assertEquals(sum(pages, []), sorted(language_names))
+
     def test_categorical_domain(self):
         """
         Checks that the domain of a categorical model field,
@@ -0,0 +1,146 @@
+"""
+An in-memory index of the words in a dataset, for autocompleting keywords.
+
+Autocomplete used to match ``level__istartswith`` on the precalculated distribution
+of the words dimension (:class:`.PrecalcCategoricalDistribution`), which cannot use
+an index and sorts every match by count. The completion index keeps the words of
+a dataset in lower case, sorted, with their counts in a NumPy array, so the words
+starting with a prefix are a range found by binary search. For every prefix
+matching more than ``LARGE_RANGE`` words, the positions of the ``TOP_K`` most
+frequent ones are stored too, so no completion looks at more than ``LARGE_RANGE``
+counts, whatever the size of the vocabulary.
+
+.. code-block:: python
+
+    from msgvis.apps.enhance import completion
+    completion.complete(dataset, "mud")   # [u"mudslide", u"mud", ...]
+    completion.complete(dataset, "")      # the most frequent words
+
+Indexes are built in each process the first time they are needed, or before gunicorn
+forks its workers (see :mod:`msgvis.preload`). An index is built again once the
+dataset's data tables have been invalidated (see :func:`.invalidate_dataset`),
+which recalculating the distribution does.
+"""
+import bisect
+
+import numpy as np
+
+from msgvis.apps.enhance.models import PrecalcCategoricalDistribution
+from msgvis.apps.datatable.cache import table_cache
+
+# The dimension whose levels are completed
+DIMENSION_KEY = "words"
+
+# How many completions are stored for each large prefix
+TOP_K = 20
+
+# Prefixes matching more words than this have their completions stored
+LARGE_RANGE = 1000
+
+# Sorts after any character a word may continue with
+_MAX_CHAR = u'\uffff'
+
+# Indexes built by this process, by dataset id
+_indexes = {}
+
+
+def _top_positions(counts, lo, hi, limit):
+    """The positions in [lo, hi) with the largest counts, most frequent first."""
+    order = np.argsort(-counts[lo:hi], kind='mergesort')
+    return order[:limit] + lo
+
+
+class CompletionIndex(object):
+    """The words of a dataset sorted in lower case, with their counts and the top words of large prefixes."""
+
+    def __init__(self, levels, counts, version=None):
+        order = sorted(xrange(len(levels)), key=lambda i: levels[i].lower())
+        self.levels = [levels[i] for i in order]
+        self.keys = [level.lower() for level in self.levels]
+        self.counts = np.array([counts[i] for i in order], dtype=np.int64)
+        self.version = version
+
+        self.top = {}
+        """The positions of the most frequent words for each prefix matching more than LARGE_RANGE of them."""
+        self._store_top()
+
+    def _store_top(self):
+        ranges = [(u'', 0, len(self.keys))]
+        while ranges:
+            prefix, lo, hi = ranges.pop()
+            if hi - lo <= LARGE_RANGE:
+                continue
+            self.top[prefix] = _top_positions(self.counts, lo, hi, TOP_K)
+
+            # Split the range by the next character
+            length = len(prefix) + 1
+            i = lo
+            while i < hi:
+                if len(self.keys[i]) < length:
+                    # The prefix itself
+                    i += 1
+                    continue
+                child = self.keys[i][:length]
+                end = bisect.bisect_left(self.keys, child + _MAX_CHAR, i, hi)
+                ranges.append((child, i, end))
+                i = end
+
+    def prefix_range(self, prefix):
+        """The range of positions of the words starting with a (lower case) prefix."""
+        lo = bisect.bisect_left(self.keys, prefix)
+        hi = bisect.bisect_left(self.keys, prefix + _MAX_CHAR, lo)
+        return lo, hi
+
+    def complete(self, prefix, limit=TOP_K):
+        """The most frequent words starting with a prefix, ignoring case."""
+        prefix = prefix.lower()
+        positions = self.top.get(prefix) if limit <= TOP_K else None
+        if positions is None:
+            lo, hi = self.prefix_range(prefix)
+            positions = _top_positions(self.counts, lo, hi, limit)
+        return [self.levels[i] for i in positions[:limit]]
+
+    def __len__(self):
+        return len(self.levels)
+
+
+def build(dataset):
+    """Build the completion index of a dataset in this process."""
+    dataset_id = getattr(dataset, 'id', dataset)
+    version = table_cache.get_version(dataset_id)
+    rows = PrecalcCategoricalDistribution.objects.filter(dataset_id=dataset_id, dimension_key=DIMENSION_KEY)
+    levels, counts = [], []
+    for level, count in rows.exclude(level="").values_list('level', 'count').iterator():
+        levels.append(level)
+        counts.append(count)
+
+    index = CompletionIndex(levels, counts, version)
+    _indexes[dataset_id] = index
+    return index
+
+
+def load(dataset):
+    """Get the completion index of a dataset, building it if it is missing or out of date."""
+    dataset_id = getattr(dataset, 'id', dataset)
+    index = _indexes.get(dataset_id)
+    if index is None or index.version != table_cache.get_version(dataset_id):
+        index = build(dataset_id)
+    return index
+
+
+def preload(dataset):
+    """
+    Build the completion index of a dataset.
+    Run before gunicorn forks its workers so they share it (see :mod:`msgvis.preload`).
+    """
+    return load(dataset)
+
+
+def drop(dataset):
+    """Forget the completion index of a dataset in this process."""
+    _indexes.pop(getattr(dataset, 'id', dataset), None)
+
+
+def complete(dataset, prefix, limit=TOP_K):
+    """The most frequent words in a dataset starting with a prefix, ignoring case."""
+    return load(dataset).complete(prefix, limit)
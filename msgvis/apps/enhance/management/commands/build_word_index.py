@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+from time import time
+
+
+class Command(BaseCommand):
+    help = "Build or rebuild the word index used for keyword searches in a dataset."
+    args = "<dataset id>"
+
+    def handle(self, dataset_id, **options):
+
+        if not dataset_id:
+            raise CommandError("Dataset id is required.")
+        try:
+            dataset_id = int(dataset_id)
+        except ValueError:
+            raise CommandError("Dataset id must be a number.")
+
+        from msgvis.apps.corpus.models import Dataset
+        from msgvis.apps.enhance import word_index
+
+        try:
+            dataset = Dataset.objects.get(id=dataset_id)
+        except Dataset.DoesNotExist:
+            raise CommandError("Dataset %d does not exist." % dataset_id)
+
+        start = time()
+        num_lemmas = word_index.build(dataset)
+        print "Indexed %d lemmas" % num_lemmas
+        print "Time: %.2fs" % (time() - start)
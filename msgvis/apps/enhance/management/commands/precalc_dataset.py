@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand, make_option, CommandError
+
+
+class Command(BaseCommand):
+    help = "Build or rebuild all the precalculated distributions and dimension cubes for a dataset."
+    args = "<dataset id> [categorical_dimensions...]"
+    option_list = BaseCommand.option_list + (
+        make_option('--pairs',
+                    action='store_true',
+                    dest='pairs',
+                    default=False,
+                    help='Also count the pairs of low-cardinality dimensions'),
+        make_option('--pair',
+                    action='append',
+                    dest='pair_list',
+                    default=[],
+                    help='Also count a pair of dimensions, given as primary,secondary'),
+        make_option('--no-time',
+                    action='store_false',
+                    dest='by_time',
+                    default=True,
+                    help='Do not count dimensions by time'),
+    )
+
+    def handle(self, dataset_id, *dimensions, **options):
+
+        if not dataset_id:
+            raise CommandError("Dataset id is required.")
+        try:
+            dataset_id = int(dataset_id)
+        except ValueError:
+            raise CommandError("Dataset id must be a number.")
+
+        from msgvis.apps.dimensions import registry
+        from msgvis.apps.datatable import cube
+        from msgvis.apps.enhance.tasks import precalc_dataset
+
+        pairs = [tuple(pair.split(',')) for pair in options.get('pair_list')]
+        for pair in pairs:
+            if len(pair) != 2:
+                raise CommandError("Pairs must be given as primary,secondary")
+
+        for key in set(dimensions) | set(key for pair in pairs for key in pair):
+            try:
+                dimension = registry.get_dimension(key)
+            except KeyError:
+                raise CommandError("Unknown dimension %s" % key)
+            if not dimension.is_categorical() or not cube.is_cube_dimension(dimension):
+                raise CommandError("The dimension %s is not categorical" % key)
+
+        precalc_dataset(dataset_id=dataset_id,
+                        dimension_keys=list(dimensions) or None,
+                        pairs=options.get('pairs') or pairs,
+                        by_time=options.get('by_time'))
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import msgvis.apps.base.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('corpus', '0021_dataset_has_prefetched_images'),
+        ('enhance', '0015_auto_20150906_0752'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WordPostingList',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('text', msgvis.apps.base.models.Utf8CharField(default=b'', max_length=100, db_index=True, blank=True)),
+                ('message_count', models.IntegerField(default=0)),
+                ('message_ids', models.BinaryField()),
+                ('dataset', models.ForeignKey(related_name='word_postings', to='corpus.Dataset')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterIndexTogether(
+            name='wordpostinglist',
+            index_together=set([('dataset', 'text')]),
+        ),
+    ]
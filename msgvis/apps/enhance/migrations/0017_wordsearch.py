@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('corpus', '0025_index_fewer_time_buckets'),
+        ('enhance', '0016_auto_20261018_1938'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WordSearch',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('key', models.CharField(max_length=32)),
+                ('message_count', models.IntegerField(default=0)),
+                ('message_ids', models.BinaryField(default=None, null=True)),
+                ('dataset', models.ForeignKey(related_name='word_searches', to='corpus.Dataset')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='WordSearchResult',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('message_id', models.IntegerField()),
+                ('search', models.ForeignKey(related_name='results', to='enhance.WordSearch')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='wordsearchresult',
+            unique_together=set([('search', 'message_id')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='wordsearch',
+            unique_together=set([('dataset', 'key')]),
+        ),
+    ]
@@ -18,6 +18,11 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+# Gensim dictionaries built by this process, by dictionary id and size.
+# Dictionaries loaded before gunicorn forks its workers are shared by them.
+_gensim_dictionaries = {}
+
+
 class Dictionary(models.Model):
     name = models.CharField(max_length=100)
     dataset = models.ForeignKey(Dataset, related_name="dictionary", null=True, blank=True, default=None)
@@ -32,7 +37,15 @@ class Dictionary(models.Model):
     @property
     def gensim_dictionary(self):
         if not hasattr(self, '_gensim_dict'):
-            setattr(self, '_gensim_dict', self._make_gensim_dictionary())
+            key = (self.id, self.num_docs, self.num_pos, self.num_nnz)
+            if self.id is not None and key in _gensim_dictionaries:
+                gensim_dict, index2id = _gensim_dictionaries[key]
+                setattr(self, '_index2id', index2id)
+            else:
+                gensim_dict = self._make_gensim_dictionary()
+                if self.id is not None:
+                    _gensim_dictionaries[key] = (gensim_dict, self._index2id)
+            setattr(self, '_gensim_dict', gensim_dict)
         return getattr(self, '_gensim_dict')
 
     def get_word_id(self, bow_index):
@@ -405,8 +418,13 @@ class MessageTopic(models.Model):
         return examples.order_by('-probability')
 
 
+def get_text_sentiment(text):
+    """Get the sentiment label (-1, 0, 1) for a piece of text."""
+    return int(round(textblob.TextBlob(text).sentiment.polarity))
+
+
 def set_message_sentiment(message, save=True):
-    message.sentiment = int(round(textblob.TextBlob(message.text).sentiment.polarity))
+    message.sentiment = get_text_sentiment(message.text)
     if save:
         message.save()
 
@@ -435,6 +453,61 @@ class TweetWord(models.Model):
 
 
 
+class WordPostingList(models.Model):
+    """
+    The sorted ids of the messages in a dataset that contain any word with a lemma,
+    compressed. See :mod:`msgvis.apps.enhance.word_index`.
+    """
+    dataset = models.ForeignKey(Dataset, related_name="word_postings")
+    text = base_models.Utf8CharField(max_length=100, db_index=True, blank=True, default="")
+    """The lemma (:attr:`TweetWord.text`)"""
+
+    message_count = models.IntegerField(default=0)
+    message_ids = models.BinaryField()
+
+    class Meta:
+        index_together = [
+            ["dataset", "text"],
+        ]
+
+    def __unicode__(self):
+        return u"%s (%d messages)" % (self.text, self.message_count)
+
+
+class WordSearch(models.Model):
+    """
+    A keyword search evaluated on the word index of a version of a dataset.
+    A few matches are stored with it, compressed, and more as :class:`WordSearchResult` rows.
+    See :mod:`msgvis.apps.enhance.word_index`.
+    """
+    dataset = models.ForeignKey(Dataset, related_name="word_searches")
+    key = models.CharField(max_length=32)
+    """Identifies the search and the version of the dataset it was evaluated on"""
+
+    message_count = models.IntegerField(default=0)
+    message_ids = models.BinaryField(null=True, default=None)
+    """The matches, compressed, or None if they are stored as :class:`WordSearchResult` rows"""
+
+    class Meta:
+        unique_together = [
+            ["dataset", "key"],
+        ]
+
+
+class WordSearchResult(models.Model):
+    """
+    A message matching a :class:`WordSearch` with many matches, stored so that
+    the matches can be joined with the messages in SQL.
+    """
+    search = models.ForeignKey(WordSearch, related_name="results")
+    message_id = models.IntegerField()
+
+    class Meta:
+        unique_together = [
+            ["search", "message_id"],
+        ]
+
+
 class PrecalcCategoricalDistribution(models.Model):
     dataset = models.ForeignKey(Dataset, related_name="distributions", null=True, blank=True, default=None)
     dimension_key = models.CharField(db_index=True, max_length=64, blank=True, default="")
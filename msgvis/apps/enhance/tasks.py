@@ -4,6 +4,15 @@ from models import Dictionary, MessageWord, Word, MessageTopic, TweetWord, Preca
 from msgvis.apps.corpus.models import Dataset, Message
 from msgvis.apps.dimensions import registry
 from msgvis.apps.datatable import models as datatable_models
+from msgvis.apps.datatable import cube
+from msgvis.apps.datatable import rollup
+from msgvis.apps.datatable import bitmap_index
+from msgvis.apps.datatable import columnar
+from msgvis.apps.datatable import domain_cache
+from msgvis.apps.datatable.cache import invalidate_dataset
+from msgvis.apps.enhance import word_index
+from msgvis.apps.groups.models import invalidate_group_members, update_group_members
+from django.db import transaction
 import codecs
 import re
 from time import time
@@ -258,6 +267,13 @@ def standard_topic_pipeline(context, dataset_id, num_topics, **kwargs):
     context.apply_lda(dictionary, model, lda)
     context.evaluate_lda(dictionary, model, lda)
 
+    # The topics of the messages have changed
+    cube.drop(dataset_id, 'topics')
+    rollup.drop(dataset_id, 'topics')
+    domain_cache.invalidate(dataset_id, 'topics')
+    bitmap_index.drop(dataset_id, 'topics')
+    invalidate_dataset(dataset_id)
+
 
 def default_topic_context(name, dataset_id):
     dataset = Dataset.objects.get(pk=dataset_id)
@@ -322,6 +338,26 @@ def import_from_tweet_parser_results(dataset_id, filename):
         print "Processed %d messages" % count
         print "Time: %.2fs" % (time() - start)
 
+    # The words of the messages have changed
+    print "Building the word index"
+    start = time()
+    word_index.build(Dataset.objects.get(id=dataset_id))
+    print "Time: %.2fs" % (time() - start)
+
+    invalidate_group_members(dataset_id)
+    cube.drop(dataset_id, 'words')
+    rollup.drop(dataset_id, 'words')
+    domain_cache.invalidate(dataset_id, 'words')
+    bitmap_index.drop(dataset_id, 'words')
+    columnar.drop(dataset_id)
+    invalidate_dataset(dataset_id)
+
+    # Rather than on the next read of each group
+    print "Updating the members of the groups"
+    start = time()
+    update_group_members(dataset_id)
+    print "Time: %.2fs" % (time() - start)
+
 def precalc_categorical_dimension(dataset_id=1, dimension_key=None):
     datatable = datatable_models.DataTable(primary_dimension=dimension_key)
     dataset = Dataset.objects.get(id=dataset_id)
@@ -340,6 +376,55 @@ def precalc_categorical_dimension(dataset_id=1, dimension_key=None):
         bulk.append(obj)
 
     PrecalcCategoricalDistribution.objects.bulk_create(objs=bulk, batch_size=10000)
+    invalidate_dataset(dataset)
+
+
+# The categorical dimensions that are precalculated by default
+PRECALC_DIMENSIONS = ["hashtags", "words", "urls", "timezone", "contains_media", "sentiment", "type", "sender", "mentions"]
+
+# Dimensions with too many levels to pair with others or roll up by time
+UNPAIRED_DIMENSIONS = ["words", "sender", "hashtags", "mentions", "urls"]
+
+
+def precalc_dataset(dataset_id=1, dimension_keys=None, pairs=False, by_time=True):
+    """
+    Build or rebuild all the precalculated distributions for a dataset:
+    the distribution of each categorical dimension, dimension cubes
+    for each dimension, and time rollups for time alone and by each
+    dimension that is not in UNPAIRED_DIMENSIONS.
+
+    Pairs of dimensions are only counted on request: with pairs=True,
+    each pair of dimensions that are not in UNPAIRED_DIMENSIONS, or else
+    the given list of (primary key, secondary key) pairs.
+    """
+    dataset = Dataset.objects.get(id=dataset_id)
+    if dimension_keys is None:
+        dimension_keys = PRECALC_DIMENSIONS
+    paired_keys = [key for key in dimension_keys if key not in UNPAIRED_DIMENSIONS]
+
+    cubes = [(key, None) for key in dimension_keys]
+    if pairs is True:
+        cubes.extend((key, other) for i, key in enumerate(paired_keys) for other in paired_keys[i + 1:])
+    elif pairs:
+        cubes.extend(tuple(pair) for pair in pairs)
+    rollups = [None] + paired_keys if by_time else []
+
+    start = time()
+    for primary_key, secondary_key in cubes:
+        print "Counting %s..." % " x ".join(key for key in (primary_key, secondary_key) if key)
+        cube.build(dataset, primary_key, secondary_key, each_dimension=False)
+
+    for dimension_key in rollups:
+        print "Rolling up time%s..." % (" x %s" % dimension_key if dimension_key else "")
+        rollup.build(dataset, dimension_key)
+
+    # These are answered from the cubes
+    for dimension_key in dimension_keys:
+        print "Precalculating %s..." % dimension_key
+        with transaction.atomic(savepoint=False):
+            precalc_categorical_dimension(dataset_id=dataset_id, dimension_key=dimension_key)
+
+    print "Time: %.2fs" % (time() - start)
 
 
 def dump_tweets(dataset_id, save_path):
@@ -1,7 +1,14 @@
 from django.test import TestCase
+import mock
+from django.utils import timezone as tz
+from datetime import timedelta
 
-from msgvis.apps.enhance import models, tasks
+from msgvis.apps.enhance import models, tasks, word_index, completion
 from msgvis.apps.corpus import models as corpus_models
+from msgvis.apps.datatable.cube import CubeQuery
+from msgvis.apps.datatable.models import DataTable
+from msgvis.apps.datatable.cache import invalidate_dataset
+from msgvis.apps.dimensions import registry
 
 
 class MessageSentimentTest(TestCase):
@@ -138,3 +145,200 @@ class TopicsTest(TestCase):
             self.assertTrue(word in topic_a.name or word in topic_b.name)
             
 
+
+
+class PrecalcDatasetTest(TestCase):
+    def setUp(self):
+        self.dataset = corpus_models.Dataset.objects.create(name="Test Corpus", description="My Dataset")
+        now = tz.now()
+        hashtags = [corpus_models.Hashtag.objects.create(text="#ht%d" % i) for i in range(3)]
+        for i in range(10):
+            message = self.dataset.message_set.create(text="message %d" % i,
+                                                      time=now + timedelta(minutes=i),
+                                                      contains_media=i % 2 == 0)
+            message.hashtags.add(*hashtags[:i % 4])
+        self.dataset.start_time = now
+        self.dataset.end_time = now + timedelta(minutes=9)
+        self.dataset.save()
+
+    def test_precalc_dataset(self):
+        """It should build the distributions, cubes and time rollups, and answer filtered requests from them"""
+        tasks.precalc_dataset(dataset_id=self.dataset.id, dimension_keys=["hashtags", "contains_media"],
+                              pairs=[("contains_media", "hashtags")])
+
+        self.assertEquals(self.dataset.distributions.filter(dimension_key="hashtags").count(), 4)
+        cubes = set(self.dataset.cube_states.values_list('primary_dimension', 'secondary_dimension'))
+        self.assertEquals(cubes, set([
+            ("hashtags", ""), ("contains_media", ""), ("contains_media", "hashtags"),
+        ]))
+        rollups = set(self.dataset.time_rollup_states.values_list('dimension', flat=True))
+        self.assertEquals(rollups, set(["", "contains_media"]))
+
+        datatable = DataTable('hashtags', 'time')
+        filters = [dict(dimension=registry.get_dimension('contains_media'), value=True)]
+        self.assertIsNone(CubeQuery.create(datatable, self.dataset, filters))
+
+        datatable = DataTable('hashtags')
+        self.assertIsNotNone(CubeQuery.create(datatable, self.dataset, filters))
+        result = datatable.generate(self.dataset, filters)
+        self.assertEquals(sorted((row['hashtags'], row['value']) for row in result['table']),
+                          [(None, 3), (u"#ht0", 2), (u"#ht1", 2)])
+
+    def test_precalc_dataset_pairs(self):
+        """Pairs should only be counted on request, and never with high-cardinality dimensions"""
+        tasks.precalc_dataset(dataset_id=self.dataset.id, dimension_keys=["hashtags", "contains_media", "type"],
+                              by_time=False)
+        cubes = set(self.dataset.cube_states.values_list('primary_dimension', 'secondary_dimension'))
+        self.assertEquals(cubes, set([("hashtags", ""), ("contains_media", ""), ("type", "")]))
+
+        tasks.precalc_dataset(dataset_id=self.dataset.id, dimension_keys=["hashtags", "contains_media", "type"],
+                              pairs=True, by_time=False)
+        cubes = set(self.dataset.cube_states.values_list('primary_dimension', 'secondary_dimension'))
+        self.assertEquals(cubes, set([("hashtags", ""), ("contains_media", ""), ("type", ""),
+                                      ("contains_media", "type")]))
+
+
+class WordIndexTest(TestCase):
+    def setUp(self):
+        self.dataset = corpus_models.Dataset.objects.create(name="Test Corpus", description="My Dataset")
+        self.tweet = corpus_models.MessageType.objects.create(name="tweet")
+        retweet = corpus_models.MessageType.objects.create(name="retweet")
+
+        lemmas = {"soup": "soup", "soups": "soup", "food": "food",
+                  "ladies": "lady", "lady": "lady", "jobs": "job"}
+        words = dict((original, models.TweetWord.objects.create(dataset=self.dataset, original_text=original,
+                                                                 pos="N", text=text))
+                     for original, text in lemmas.iteritems())
+
+        self.messages = {}
+        for name, text, message_type in [("m1", "soup food", self.tweet),
+                                         ("m2", "soups lady", self.tweet),
+                                         ("m3", "food ladies", retweet),
+                                         ("m4", "soup food ladies", self.tweet),
+                                         ("m5", "jobs", self.tweet)]:
+            message = self.dataset.message_set.create(text=text, type=message_type)
+            message.tweet_words.add(*[words[word] for word in text.split(' ')])
+            self.messages[message.id] = name
+
+    def search(self, keywords, include_types=()):
+        results = self.dataset.get_advanced_search_results(keywords, list(include_types))
+        return sorted(self.messages[message.id] for message in results)
+
+    def assertSearchResults(self, keywords, expected, include_types=()):
+        self.assertEquals(self.search(keywords, include_types), expected)
+
+    def check_searches(self):
+        self.assertSearchResults("soup", ["m1", "m2", "m4"])
+        self.assertSearchResults("soups food", ["m1", "m4"])
+        self.assertSearchResults("soup,jobs", ["m1", "m2", "m4", "m5"])
+        self.assertSearchResults("soup,NOT lady", ["m1"])
+        self.assertSearchResults("soup,NOT food lady", ["m1", "m2"])
+        self.assertSearchResults("food unknown", ["m1", "m3", "m4"])
+        self.assertSearchResults("unknown", [])
+        self.assertSearchResults("food", ["m1", "m4"], include_types=[self.tweet])
+
+    def test_search_without_index(self):
+        """Searches should query the words of the messages if there is no index"""
+        self.assertIsNone(word_index.search(self.dataset, [(False, ["soup"])]))
+        self.check_searches()
+
+    def test_search_with_index(self):
+        """Searches should give the same results from the index"""
+        self.assertEquals(word_index.build(self.dataset), 4)
+        self.assertEquals(models.WordPostingList.objects.get(dataset=self.dataset, text="lady").message_count, 3)
+        self.check_searches()
+
+        # Looking up the lemma and posting list of one word, storing the search
+        # (in a savepoint) and looking for old searches to evict, then the messages
+        with self.assertNumQueries(3 + 2 + 4 + 1):
+            self.search("soups")
+
+        # The stored matches are listed in the query for the messages
+        with self.assertNumQueries(3 + 1):
+            self.search("soups")
+
+    def test_stored_results(self):
+        """The matches of a search should be stored for each version of the dataset"""
+        word_index.build(self.dataset)
+        searches = models.WordSearch.objects.filter(dataset=self.dataset)
+        results = models.WordSearchResult.objects.filter(search__dataset=self.dataset)
+
+        # A few matches are stored with the search, even none
+        self.assertSearchResults("soup", ["m1", "m2", "m4"])
+        self.assertSearchResults("soup", ["m1", "m2", "m4"])
+        self.assertSearchResults("unknown", [])
+        self.assertSearchResults("unknown", [])
+        self.assertEquals(sorted(searches.values_list('message_count', flat=True)), [0, 3])
+        self.assertEquals(results.count(), 0)
+
+        # More are stored as rows, once
+        with mock.patch.object(word_index, 'MAX_LISTED_RESULTS', 2):
+            self.assertSearchResults("food", ["m1", "m3", "m4"])
+            self.assertSearchResults("food", ["m1", "m3", "m4"])
+        self.assertEquals(results.count(), 3)
+
+        # A search stored by another request first is read back
+        search = searches.get(message_count=0)
+        self.assertEquals(word_index._store_search(self.dataset, search.key, word_index.EMPTY), search)
+
+        invalidate_dataset(self.dataset)
+        self.assertSearchResults("soup", ["m1", "m2", "m4"])
+        self.assertEquals(searches.count(), 4)
+
+        # The oldest searches are evicted
+        with mock.patch.object(word_index, 'MAX_STORED_SEARCHES', 2):
+            self.assertSearchResults("lady", ["m2", "m3", "m4"])
+        self.assertEquals(searches.count(), 2)
+        self.assertEquals(results.count(), 0)
+
+        word_index.build(self.dataset)
+        self.assertEquals(searches.count(), 0)
+
+    def test_encode_postings(self):
+        """Posting lists should be stored compressed and read back the same"""
+        ids = [3, 4, 10, 1000000, 2000000000]
+        self.assertEquals(word_index.decode_postings(word_index.encode_postings(ids)).tolist(), ids)
+        self.assertEquals(word_index.decode_postings(word_index.encode_postings([])).tolist(), [])
+
+
+class CompletionTest(TestCase):
+    def setUp(self):
+        self.dataset = corpus_models.Dataset.objects.create(name="Test Corpus", description="My Dataset")
+        for level, count in [("mudslide", 5), ("Mud", 8), ("muddy", 1), ("oso", 3), ("", 10)]:
+            models.PrecalcCategoricalDistribution.objects.create(dataset=self.dataset, dimension_key="words",
+                                                                 level=level, count=count)
+        models.PrecalcCategoricalDistribution.objects.create(dataset=self.dataset, dimension_key="hashtags",
+                                                             level="#mud", count=100)
+
+    def tearDown(self):
+        completion.drop(self.dataset)
+
+    def test_complete(self):
+        """It should give the most frequent words starting with a prefix, ignoring case"""
+        self.assertEquals(completion.complete(self.dataset, "mud"), [u"Mud", u"mudslide", u"muddy"])
+        self.assertEquals(completion.complete(self.dataset, "MUDS"), [u"mudslide"])
+        self.assertEquals(completion.complete(self.dataset, ""), [u"Mud", u"mudslide", u"oso", u"muddy"])
+        self.assertEquals(completion.complete(self.dataset, "mud", limit=1), [u"Mud"])
+        self.assertEquals(completion.complete(self.dataset, "x"), [])
+
+        # The index is kept in memory, and only the dataset's version is looked up
+        with self.assertNumQueries(1):
+            completion.complete(self.dataset, "o")
+
+    def test_large_prefixes(self):
+        """Prefixes matching many words should have their completions stored"""
+        levels = [u"w%04d" % i for i in range(completion.LARGE_RANGE + 10)]
+        index = completion.CompletionIndex(levels, range(len(levels)))
+        self.assertEquals(sorted(index.top.keys()), [u"", u"w"])
+        self.assertEquals(index.complete(u"W", limit=3), [u"w1009", u"w1008", u"w1007"])
+        self.assertEquals(index.complete(u"w00", limit=2), [u"w0099", u"w0098"])
+
+    def test_rebuild(self):
+        """The index should be built again after the dataset is invalidated"""
+        self.assertEquals(completion.complete(self.dataset, "oso"), [u"oso"])
+        models.PrecalcCategoricalDistribution.objects.create(dataset=self.dataset, dimension_key="words",
+                                                             level="osos", count=4)
+        self.assertEquals(completion.complete(self.dataset, "oso"), [u"oso"])
+
+        invalidate_dataset(self.dataset)
+        self.assertEquals(completion.complete(self.dataset, "oso"), [u"osos", u"oso"])
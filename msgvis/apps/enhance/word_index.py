@@ -0,0 +1,249 @@
+"""
+An inverted index of the words in a dataset, for keyword searches.
+
+For each lemma (:attr:`.TweetWord.text`) of a dataset, a :class:`.WordPostingList`
+stores the sorted ids of the messages containing any word with that lemma,
+delta-encoded and compressed. Keyword searches are then evaluated as
+intersections, unions and differences of these lists, instead of as joins
+on the message-word table.
+
+.. code-block:: python
+
+    word_index.build(dataset)
+    clauses = utils.parse_keyword_clauses("soup food,NOT ladies")
+    message_ids = word_index.search(dataset, clauses)
+
+The index must be rebuilt when the words of the messages change.
+
+A search may match millions of messages, too many to send back to the database
+in an ``IN (...)`` list. :func:`search_messages` stores each search once for each
+version of the dataset (see :func:`.invalidate_dataset`) as a :class:`.WordSearch`.
+A few matches are stored with it and listed, and more are stored in
+:class:`.WordSearchResult` rows, which a subquery joins with the messages:
+
+.. code-block:: python
+
+    messages = dataset.message_set.filter(id__in=word_index.search_messages(dataset, clauses))
+
+Storing the matches is a write, made by the first request for a search. Only the
+latest :data:`MAX_STORED_SEARCHES` searches of a dataset are kept.
+"""
+import hashlib
+import json
+import zlib
+
+import numpy as np
+from django.db import transaction, IntegrityError
+
+from msgvis.apps.enhance.models import TweetWord, WordPostingList, WordSearch, WordSearchResult
+from msgvis.apps.datatable.cache import table_cache
+
+# Message ids are stored as differences from the previous id
+DELTA_DTYPE = np.dtype('<u4')
+
+# How many words to collect the messages of at once
+BATCH_SIZE = 1000
+
+# How many search results to store at once
+RESULTS_BATCH_SIZE = 10000
+
+# Searches with at most this many matches store them compressed, and list them in the query
+MAX_LISTED_RESULTS = 1000
+
+# How many searches are stored for each dataset; older ones are evicted
+MAX_STORED_SEARCHES = 100
+
+EMPTY = np.array([], dtype=np.int64)
+
+
+def encode_postings(message_ids):
+    """Compress a sorted array of distinct message ids."""
+    message_ids = np.asarray(message_ids, dtype=np.int64)
+    deltas = np.diff(np.concatenate(([0], message_ids)))
+    return zlib.compress(deltas.astype(DELTA_DTYPE).tostring())
+
+
+def decode_postings(data):
+    """Get the sorted array of message ids back from :func:`encode_postings`."""
+    deltas = np.frombuffer(zlib.decompress(bytes(data)), dtype=DELTA_DTYPE)
+    return np.cumsum(deltas, dtype=np.int64)
+
+
+def is_built(dataset):
+    """Return True if the dataset has a word index."""
+    return WordPostingList.objects.filter(dataset=dataset).exists()
+
+
+def build(dataset, batch_size=BATCH_SIZE):
+    """(Re)build the word index of a dataset. Returns the number of lemmas."""
+
+    # The lemma of each word
+    lemmas = {}
+    for word_id, text in TweetWord.objects.filter(dataset=dataset).values_list('id', 'text'):
+        lemmas.setdefault(text, []).append(word_id)
+    texts = sorted(lemmas)
+
+    MessageTweetWord = TweetWord.messages.through
+    with transaction.atomic(savepoint=False):
+        WordPostingList.objects.filter(dataset=dataset).delete()
+        WordSearchResult.objects.filter(search__dataset=dataset).delete()
+        WordSearch.objects.filter(dataset=dataset).delete()
+
+        for batch_start in range(0, len(texts), batch_size):
+            batch = texts[batch_start:batch_start + batch_size]
+            lemma_of = dict((word_id, text) for text in batch for word_id in lemmas[text])
+
+            message_ids = dict((text, []) for text in batch)
+            links = MessageTweetWord.objects.filter(tweetword_id__in=lemma_of.keys())
+            for word_id, message_id in links.values_list('tweetword_id', 'message_id').iterator():
+                message_ids[lemma_of[word_id]].append(message_id)
+
+            postings = []
+            for text in batch:
+                ids = np.unique(np.array(message_ids[text], dtype=np.int64))
+                postings.append(WordPostingList(dataset=dataset, text=text,
+                                                message_count=len(ids),
+                                                message_ids=encode_postings(ids)))
+            WordPostingList.objects.bulk_create(postings)
+
+    return len(texts)
+
+
+def get_postings(dataset, word, cache=None):
+    """
+    Get the sorted ids of the messages with a word with the same lemma as the given word,
+    or None if the word does not occur in the dataset.
+    """
+    if cache is not None and word in cache:
+        return cache[word]
+
+    lemma = dataset.tweet_words.filter(original_text=word).values_list('text', flat=True)[:1]
+    if len(lemma) == 0:
+        postings = None
+    else:
+        # Lemmas that the database considers equal are merged
+        lists = [decode_postings(data) for data in
+                 WordPostingList.objects.filter(dataset=dataset, text=lemma[0])
+                 .values_list('message_ids', flat=True)]
+        if len(lists) == 0:
+            postings = EMPTY
+        elif len(lists) == 1:
+            postings = lists[0]
+        else:
+            postings = np.unique(np.concatenate(lists))
+
+    if cache is not None:
+        cache[word] = postings
+    return postings
+
+
+def _intersect(lists):
+    """The ids in all of the sorted lists, starting from the shortest one."""
+    lists = sorted(lists, key=len)
+    result = lists[0]
+    for ids in lists[1:]:
+        if len(result) == 0:
+            break
+        result = np.intersect1d(result, ids, assume_unique=True)
+    return result
+
+
+def _union(lists):
+    if len(lists) == 0:
+        return EMPTY
+    if len(lists) == 1:
+        return lists[0]
+    return np.unique(np.concatenate(lists))
+
+
+def search(dataset, clauses):
+    """
+    Evaluate keyword clauses (see :func:`.utils.parse_keyword_clauses`) on the word index.
+    Messages must contain all the words of an including clause, and not all the words of
+    any excluding clause. Words that do not occur in the dataset are ignored.
+
+    Returns a sorted array of message ids, or None if the dataset has no word index.
+    """
+    if not is_built(dataset):
+        return None
+    return _evaluate(dataset, clauses)
+
+
+def _evaluate(dataset, clauses):
+    cache = {}
+    included = []
+    excluded = []
+    for exclude, words in clauses:
+        lists = [get_postings(dataset, word, cache) for word in words]
+        lists = [ids for ids in lists if ids is not None]
+        if len(lists) == 0:
+            continue
+
+        if exclude:
+            excluded.append(_intersect(lists))
+        else:
+            included.append(_intersect(lists))
+
+    result = _union(included)
+    if len(result) > 0 and len(excluded) > 0:
+        result = np.setdiff1d(result, _union(excluded), assume_unique=True)
+    return result
+
+
+def _search_key(dataset, clauses):
+    """The key of the stored results of a search on the current version of a dataset."""
+    dataset_id = getattr(dataset, 'id', dataset)
+    clauses = sorted([bool(exclude), sorted(words)] for exclude, words in clauses)
+    search = json.dumps([table_cache.get_version(dataset_id), clauses])
+    return hashlib.md5(search).hexdigest()
+
+
+def _store_search(dataset, key, message_ids):
+    """Store the matches of a search, or get them if another request stored them first."""
+    listed = len(message_ids) <= MAX_LISTED_RESULTS
+    try:
+        with transaction.atomic():
+            search = WordSearch.objects.create(dataset=dataset, key=key, message_count=len(message_ids),
+                                               message_ids=encode_postings(message_ids) if listed else None)
+            if not listed:
+                for start in xrange(0, len(message_ids), RESULTS_BATCH_SIZE):
+                    WordSearchResult.objects.bulk_create([
+                        WordSearchResult(search=search, message_id=int(message_id))
+                        for message_id in message_ids[start:start + RESULTS_BATCH_SIZE]
+                    ])
+    except IntegrityError:
+        return WordSearch.objects.get(dataset=dataset, key=key)
+
+    _evict_searches(dataset)
+    return search
+
+
+def _evict_searches(dataset):
+    """Forget the oldest searches of a dataset, beyond the latest MAX_STORED_SEARCHES."""
+    searches = WordSearch.objects.filter(dataset=dataset).order_by('-id')
+    old = list(searches.values_list('id', flat=True)[MAX_STORED_SEARCHES:])
+    if old:
+        with transaction.atomic():
+            WordSearchResult.objects.filter(search_id__in=old).delete()
+            WordSearch.objects.filter(id__in=old).delete()
+
+
+def search_messages(dataset, clauses):
+    """
+    Like :func:`search`, but returns the ids of the matching messages for filtering messages
+    with ``id__in``: a list if there are few, or else a subquery. The matches are stored
+    the first time a search is made on a version of the dataset.
+
+    Returns None if the dataset has no word index.
+    """
+    if not is_built(dataset):
+        return None
+
+    key = _search_key(dataset, clauses)
+    search = WordSearch.objects.filter(dataset=dataset, key=key).first()
+    if search is None:
+        search = _store_search(dataset, key, _evaluate(dataset, clauses))
+
+    if search.message_ids is not None:
+        return decode_postings(search.message_ids).tolist()
+    return search.results.values('message_id')
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('groups', '0011_auto_20261018_1940'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='group',
+            name='members_bitmap',
+            field=models.BinaryField(default=None, null=True),
+            preserve_default=True,
+        ),
+    ]
@@ -1,10 +1,11 @@
-from django.db import models
+from django.db import models, transaction, connection
 from msgvis.apps.corpus import utils
 from msgvis.apps.corpus import models as corpus_models
 from msgvis.apps.enhance import models as enhance_models
 from django.contrib.auth.models import User
 import operator
 from django.utils import timezone
+from msgvis.apps.base.bitmaps import Bitmap
 
 class Group(models.Model):
     """
@@ -36,17 +37,68 @@ class Group(models.Model):
 
     deleted = models.BooleanField(default=False)
 
-    #messages = models.ManyToManyField(corpus_models.Message, null=True, blank=True, default=None, related_name='groups')
-    #"""The set of :class:`corpus_models.Message` that belong to this group."""
-
+    members = models.ManyToManyField(corpus_models.Message, blank=True, related_name='groups')
+    """The :class:`corpus_models.Message` matching the keywords, as of the last :meth:`update_members`."""
+
+    members_bitmap = models.BinaryField(null=True, default=None)
+    """The ids of the members, as a serialized :class:`.Bitmap`"""
+
+    member_count = models.IntegerField(default=0)
+    """The number of members"""
+
+    members_version = models.IntegerField(default=0)
+    """Incremented each time the members are updated"""
+
+    members_stale = models.BooleanField(default=True)
+    """True if the members need to be updated before they are used"""
+
+    def update_members(self):
+        """Run the keyword search and store the messages that match it."""
+        search_results = self.dataset.get_advanced_search_results(self.keywords, self.include_types.all())
+        search_sql, params = search_results.order_by().values('id').query.sql_with_params()
+
+        Membership = Group.members.through
+        qn = connection.ops.quote_name
+        # Copy the matches in the database rather than through Python
+        sql = "INSERT INTO %s (%s, %s) SELECT %%s, %s FROM (%s) AS matches" % (
+            qn(Membership._meta.db_table), qn('group_id'), qn('message_id'), qn('id'), search_sql)
+
+        with transaction.atomic():
+            Membership.objects.filter(group_id=self.id).delete()
+            connection.cursor().execute(sql, [self.id] + list(params))
+
+            members = Membership.objects.filter(group_id=self.id).values_list('message_id', flat=True)
+            bitmap = Bitmap(members.iterator())
+            self.member_count = len(bitmap)
+            self.members_bitmap = bitmap.serialize()
+            self.members_version += 1
+            self.members_stale = False
+            self.save(update_fields=['member_count', 'members_bitmap', 'members_version', 'members_stale'])
+
+    def ensure_members(self):
+        """
+        Update the members if they are stale. Reading the messages of a stale group
+        therefore writes its members, so :func:`update_group_members` should be run
+        when the messages or words of a dataset change.
+        """
+        if self.members_stale:
+            self.update_members()
+
+    def get_bitmap(self):
+        """The ids of the members as a :class:`.Bitmap`."""
+        if self.members_stale or self.members_bitmap is None:
+            self.update_members()
+        return Bitmap.deserialize(self.members_bitmap)
 
     @property
     def messages(self):
-        return self.dataset.get_advanced_search_results(self.keywords, self.include_types.all())
+        self.ensure_members()
+        return self.members.all()
 
     @property
     def message_count(self):
-        return self.messages.count()
+        self.ensure_members()
+        return self.member_count
 
 
     def __repr__(self):
@@ -55,6 +107,34 @@ class Group(models.Model):
     def __unicode__(self):
         return self.__repr__()
 
+def invalidate_group_members(dataset):
+    """Mark the members of the groups of a dataset (or dataset id) as stale, after its messages or words have changed."""
+    Group.objects.filter(dataset_id=getattr(dataset, 'id', dataset)).update(members_stale=True)
+
+
+def update_group_members(dataset):
+    """Update the stale members of the groups of a dataset (or dataset id). Returns the number of groups updated."""
+    groups = Group.objects.filter(dataset_id=getattr(dataset, 'id', dataset), members_stale=True)
+    count = 0
+    for group in groups:
+        group.update_members()
+        count += 1
+    return count
+
+
+def group_overlaps(groups):
+    """
+    Count the messages that each pair of groups have in common.
+    Returns a dictionary from pairs of group ids to counts.
+    """
+    bitmaps = [(group.id, group.get_bitmap()) for group in groups]
+    overlaps = {}
+    for i, (group_id, bitmap) in enumerate(bitmaps):
+        for other_id, other_bitmap in bitmaps[i + 1:]:
+            overlaps[(group_id, other_id)] = bitmap.intersection_count(other_bitmap)
+    return overlaps
+
+
 class ActionHistory(models.Model):
     """
     A model to record history
@@ -1,7 +1,8 @@
 from django.test import TestCase
 from msgvis.apps.corpus import models as corpus_models
-from msgvis.apps.groups.models import Group
+from msgvis.apps.groups.models import Group, invalidate_group_members, update_group_members, group_overlaps
 from msgvis.apps.enhance import models as enhance_models
+from msgvis.apps.enhance import word_index
 
 import json
 
@@ -141,3 +142,77 @@ class GroupTest(TestCase):
 
 
     
+
+
+class GroupMembersTest(TestCase):
+    def setUp(self):
+        self.dataset = corpus_models.Dataset.objects.create(name="Test Corpus", description="My Dataset")
+        self.words = dict((text, enhance_models.TweetWord.objects.create(dataset=self.dataset, original_text=text,
+                                                                         pos="N", text=text))
+                          for text in ["blah", "pink", "book"])
+        for text in ["blah pink", "blah book", "book"]:
+            self.add_message(text)
+
+    def add_message(self, text):
+        message = self.dataset.message_set.create(text=text, time="2015-02-02T01:19:02Z")
+        message.tweet_words.add(*[self.words[word] for word in text.split(' ')])
+        return message
+
+    def test_update_members(self):
+        """The messages matching the keywords should be stored when the group is updated"""
+        group = Group.objects.create(dataset=self.dataset, name="group", keywords="blah")
+        self.assertTrue(group.members_stale)
+
+        self.assertEquals(group.message_count, 2)
+        self.assertEquals(group.members_version, 1)
+        self.assertFalse(Group.objects.get(id=group.id).members_stale)
+
+        # Reading the members again does not search again
+        with self.assertNumQueries(1):
+            self.assertEquals(sorted(m.text for m in group.messages), ["blah book", "blah pink"])
+
+        group.keywords = "book,NOT blah"
+        group.update_members()
+        self.assertEquals([m.text for m in group.messages], ["book"])
+        self.assertEquals(group.members_version, 2)
+
+    def test_update_members_with_index(self):
+        """The members should be copied from the matches stored by the word index"""
+        word_index.build(self.dataset)
+        group = Group.objects.create(dataset=self.dataset, name="group", keywords="blah,NOT pink")
+        self.assertEquals([m.text for m in group.messages], ["blah book"])
+        self.assertEquals(group.message_count, 1)
+        self.assertEquals(group.get_bitmap().tolist(), [m.id for m in group.messages])
+
+    def test_invalidate_group_members(self):
+        """The members should be updated when they are used after the messages change"""
+        group = Group.objects.create(dataset=self.dataset, name="group", keywords="pink")
+        self.assertEquals(group.message_count, 1)
+
+        self.add_message("pink book")
+        self.assertEquals(Group.objects.get(id=group.id).message_count, 1)
+
+        invalidate_group_members(self.dataset)
+        self.assertEquals(Group.objects.get(id=group.id).message_count, 2)
+
+    def test_update_group_members(self):
+        """The stale members of a dataset should be updated ahead of being read"""
+        group = Group.objects.create(dataset=self.dataset, name="group", keywords="pink")
+        self.assertEquals(update_group_members(self.dataset), 1)
+        self.assertEquals(update_group_members(self.dataset), 0)
+
+        self.add_message("pink book")
+        invalidate_group_members(self.dataset)
+        self.assertEquals(update_group_members(self.dataset.id), 1)
+
+        group = Group.objects.get(id=group.id)
+        self.assertFalse(group.members_stale)
+        self.assertEquals(group.message_count, 2)
+
+    def test_group_overlaps(self):
+        """The bitmaps of the members should give the messages that groups share"""
+        blah = Group.objects.create(dataset=self.dataset, name="blah", keywords="blah")
+        book = Group.objects.create(dataset=self.dataset, name="book", keywords="book")
+        self.assertEquals(sorted(blah.get_bitmap()), sorted(m.id for m in blah.messages))
+
+        self.assertEquals(group_overlaps([blah, book]), {(blah.id, book.id): 1})
@@ -1,3 +1,4 @@
 from django.contrib import admin
 
-# Register your models here.
+from msgvis.apps.importer import models
+admin.site.register(models.ImportCheckpoint)
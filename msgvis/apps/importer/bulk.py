@@ -0,0 +1,603 @@
+"""
+Batch importing of tweets.
+
+The functions in :mod:`msgvis.apps.importer.models` import one tweet at a time and
+issue several queries for every message, person, hashtag, url and media item involved.
+:class:`BulkImporter` applies exactly the same rules to a whole chunk of tweets in memory
+and then writes the results with a handful of ``bulk_create`` and ``update`` queries.
+
+.. code-block:: python
+
+    importer = BulkImporter(dataset)
+    tweets = [parse_tweet_line(line) for line in lines]
+    importer.prepare(tweets)
+    for tweet in tweets:
+        if tweet is not None:
+            importer.import_tweet(tweet)
+    importer.flush()
+
+"""
+import json
+import traceback
+from collections import defaultdict, OrderedDict
+from datetime import datetime
+from email.utils import parsedate
+from urlparse import urlparse
+
+from django.utils.timezone import utc
+
+from msgvis.apps.corpus.models import Message, Person, Language, Timezone, MessageType, Hashtag, Url, Media, \
+    get_time_buckets, get_rendered_html
+from msgvis.apps.enhance.models import get_text_sentiment
+from msgvis.apps.importer.models import CountBuffer, LRUCache, ImportCaches
+
+# How many values to put in a single IN (...) clause
+QUERY_BATCH_SIZE = 500
+
+# Person fields that may be set from a user json object
+USER_FIELDS = (
+    ('screen_name', 'username'),
+    ('name', 'full_name'),
+    ('friends_count', 'friend_count'),
+    ('followers_count', 'follower_count'),
+    ('statuses_count', 'message_count'),
+    ('profile_image_url', 'profile_image_url'),
+)
+
+# Many-to-many fields of Message that the importer fills in
+LINK_FIELDS = ('hashtags', 'urls', 'media', 'mentions')
+
+
+def _batches(items, size=QUERY_BATCH_SIZE):
+    items = list(items)
+    for start in xrange(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _field_defaults(model):
+    """A dictionary of the default values for the concrete fields of a model, except the primary key."""
+    return dict((f.attname, f.get_default()) for f in model._meta.concrete_fields if not f.primary_key)
+
+
+def normalize_user(user_data):
+    """Extract the Person fields from a twitter user object."""
+    fields = {}
+    for json_key, field_name in USER_FIELDS:
+        if user_data.get(json_key):
+            fields[field_name] = user_data[json_key]
+
+    return {
+        'id': user_data['id'],
+        'fields': fields,
+        'lang': user_data.get('lang') or None,
+    }
+
+
+def normalize_tweet(tweet_data):
+    """
+    Convert a tweet json object into a compact dictionary containing
+    only what the importer needs. Dates, urls and sentiment are parsed here
+    so that this can be done without touching the database.
+
+    Returns None for objects that are not tweets.
+    """
+    if 'in_reply_to_status_id' not in tweet_data:
+        return None
+
+    tweet = {
+        'id': tweet_data['id'],
+        'text': tweet_data.get('text') or None,
+        'time': None,
+        'lang': tweet_data.get('lang') or None,
+        'user': None,
+        'time_zone': None,
+        'is_retweet': tweet_data.get('retweeted_status') is not None,
+        'retweeted_status': None,
+        'in_reply_to': None,
+        'hashtags': [],
+        'urls': [],
+        'media': [],
+        'mentions': [],
+        'sentiment': None,
+    }
+
+    if tweet_data.get('created_at'):
+        tweet['time'] = datetime(*(parsedate(tweet_data['created_at']))[:6], tzinfo=utc)
+
+    if tweet_data.get('user'):
+        tweet['user'] = normalize_user(tweet_data['user'])
+        tweet['time_zone'] = tweet_data['user'].get('time_zone') or None
+
+    if tweet['is_retweet']:
+        tweet['retweeted_status'] = normalize_tweet(tweet_data['retweeted_status'])
+    elif tweet_data.get('in_reply_to_status_id') is not None:
+        # The same placeholder that handle_reply_to() imports
+        tweet['in_reply_to'] = normalize_tweet({
+            'id': tweet_data['in_reply_to_status_id'],
+            'user': {
+                'id': tweet_data['in_reply_to_user_id'],
+                'screen_name': tweet_data['in_reply_to_screen_name'],
+            },
+            'in_reply_to_status_id': None
+        })
+
+    entities = tweet_data.get('entities')
+    if entities:
+        for hashtag in entities.get('hashtags') or []:
+            tweet['hashtags'].append((hashtag['text'],))
+        for url in entities.get('urls') or []:
+            domain = urlparse(url['expanded_url']).netloc
+            tweet['urls'].append((url['expanded_url'], domain, url['url']))
+        for media in entities.get('media') or []:
+            tweet['media'].append((media['type'], media['media_url']))
+        for mention in entities.get('user_mentions') or []:
+            tweet['mentions'].append(normalize_user(mention))
+
+    if tweet['text']:
+        tweet['sentiment'] = get_text_sentiment(tweet['text'])
+
+    return tweet
+
+
+def parse_tweet_line(json_str):
+    """
+    Parse a line of json into a normalized tweet.
+    Returns None if the line should not be imported.
+    """
+    tweet_data = json.loads(json_str)
+    if tweet_data.get('lang'):
+        lang = tweet_data.get('lang')
+        if lang != "en":
+            return None
+    return normalize_tweet(tweet_data)
+
+
+def parse_tweet_lines(lines):
+    """
+    Parse a list of json lines. This does not use the database,
+    so it may be run in a worker process.
+
+    Returns a list with an entry for each line: None for blank lines,
+    otherwise a ``(tweet, error)`` tuple. ``tweet`` is the normalized tweet,
+    or None if the line should not be imported, and ``error`` is the
+    formatted traceback if the line could not be parsed.
+    """
+    results = []
+    for json_str in lines:
+        if len(json_str) == 0:
+            results.append(None)
+            continue
+
+        try:
+            results.append((parse_tweet_line(json_str), None))
+        except:
+            results.append((None, traceback.format_exc()))
+
+    return results
+
+
+class LookupTable(object):
+    """
+    An in-memory map from the natural key of a reference model
+    (e.g. the text of a :class:`.Hashtag`) to its primary key.
+
+    Keys are tuples of values for ``key_fields``. Keys are requested
+    with :meth:`require` and become available after :meth:`resolve`,
+    which loads existing rows and creates the missing ones in bulk.
+    They stay available until :meth:`release`, after which only the
+    ``max_size`` most recently used keys are remembered.
+    """
+
+    def __init__(self, model, *key_fields, **kwargs):
+        self.model = model
+        self.key_fields = key_fields
+        self.cache = LRUCache(kwargs.get('max_size'))
+        self.ids = {}
+        self._pending = []
+        self._pending_set = set()
+
+    def require(self, key):
+        """Note that a key will be needed and return it."""
+        if key not in self.ids and key not in self._pending_set:
+            pk = self.cache.get(key)
+            if pk is not None:
+                self.ids[key] = pk
+            else:
+                self._pending.append(key)
+                self._pending_set.add(key)
+        return key
+
+    def resolve(self):
+        """Find or create a row for every required key."""
+        if not self._pending:
+            return
+
+        self._load(self._pending)
+
+        missing = [key for key in self._pending if key not in self.ids]
+        if missing:
+            self.model.objects.bulk_create([self.model(**dict(zip(self.key_fields, key)))
+                                            for key in missing])
+            self._load(missing)
+
+        self._pending = []
+        self._pending_set = set()
+
+    def _load(self, keys):
+        first_field = self.key_fields[0]
+        for batch in _batches(set(key[0] for key in keys)):
+            rows = self.model.objects \
+                .filter(**{first_field + '__in': batch}) \
+                .order_by('pk') \
+                .values_list('pk', *self.key_fields)
+            for row in rows:
+                key = tuple(row[1:])
+                if key not in self.ids:
+                    self.ids[key] = row[0]
+                    self.cache.put(key, row[0])
+
+    def release(self):
+        """Forget the keys that were required, except those still in the cache."""
+        self.ids = {}
+
+    def __getitem__(self, key):
+        return self.ids[key]
+
+
+class BulkImporter(object):
+    """
+    Imports chunks of normalized tweets (see :func:`normalize_tweet`) into a dataset.
+
+    Messages and people are held in memory as dictionaries of field values while
+    a chunk is processed. Reading a message or person hands out a copy and saving
+    stores the copy back, mirroring what the model instances do in
+    :func:`msgvis.apps.importer.models.get_or_create_a_tweet_from_json_obj`, so the
+    resulting database content is the same.
+
+    Reply, share and mention counts are collected separately, like the
+    :class:`.CountBuffer` used by the one-at-a-time functions. New rows are created
+    with their counts and existing rows get ``count = count + n`` updates, so the
+    counts stay correct when several importers write to the same dataset.
+    """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+        sizes = ImportCaches.sizes
+        self.languages = LookupTable(Language, 'code', max_size=sizes['language'])
+        self.timezones = LookupTable(Timezone, 'name', max_size=sizes['timezone'])
+        self.message_types = LookupTable(MessageType, 'name', max_size=sizes['messagetype'])
+        self.hashtags = LookupTable(Hashtag, 'text', max_size=sizes['hashtag'])
+        self.urls = LookupTable(Url, 'full_url', 'domain', 'short_url', max_size=sizes['url'])
+        self.media = LookupTable(Media, 'type', 'media_url', max_size=sizes['media'])
+        self._tables = OrderedDict([
+            ('language', self.languages),
+            ('timezone', self.timezones),
+            ('messagetype', self.message_types),
+            ('hashtag', self.hashtags),
+            ('url', self.urls),
+            ('media', self.media),
+        ])
+
+        self._link_tables = {
+            'hashtags': self.hashtags,
+            'urls': self.urls,
+            'media': self.media,
+        }
+
+        self._message_defaults = _field_defaults(Message)
+        self._message_defaults['dataset_id'] = dataset.id
+        self._person_defaults = _field_defaults(Person)
+        self._person_defaults['dataset_id'] = dataset.id
+
+        self._reset()
+
+    def _reset(self):
+        # The current state of every message and person, keyed by original id
+        self._messages = {}
+        self._people = {}
+
+        # The state of the rows that were already in the database
+        self._stored_messages = {}
+        self._stored_people = {}
+
+        # Original ids of the rows that will be created, in order
+        self._new_messages = []
+        self._new_people = []
+
+        # Many-to-many links, as (message original id, target key) pairs
+        self._links = dict((field_name, []) for field_name in LINK_FIELDS)
+        self._link_sets = dict((field_name, set()) for field_name in LINK_FIELDS)
+
+        # Increments to count fields, keyed by (model, original id, field name)
+        self._counts = defaultdict(int)
+
+    def prepare(self, tweets):
+        """
+        Load the existing messages and people that the given tweets may refer to.
+        This must be called before importing them.
+        """
+        message_ids = set()
+        person_ids = set()
+        for tweet in tweets:
+            if tweet is not None:
+                self._collect_ids(tweet, message_ids, person_ids)
+
+        sender_pks = set()
+        for batch in _batches(message_ids - set(self._messages)):
+            rows = Message.objects \
+                .filter(dataset=self.dataset, original_id__in=batch) \
+                .order_by('pk') \
+                .values()
+            for row in rows:
+                if row['original_id'] not in self._stored_messages:
+                    self._stored_messages[row['original_id']] = row
+                    if row['sender_id'] is not None:
+                        sender_pks.add(row['sender_id'])
+
+        for batch in _batches(person_ids - set(self._people)):
+            self._load_people(original_id__in=batch)
+
+        known_pks = set(row['id'] for row in self._stored_people.itervalues())
+        for batch in _batches(sender_pks - known_pks):
+            self._load_people(pk__in=batch)
+
+        # Messages refer to their senders by original id while in memory
+        sender_ids = dict((row['id'], row['original_id']) for row in self._stored_people.itervalues())
+        for original_id, row in self._stored_messages.iteritems():
+            if original_id not in self._messages:
+                message = dict(row)
+                message['sender'] = sender_ids.get(message.pop('sender_id'))
+                self._messages[original_id] = message
+
+        for original_id, row in self._stored_people.iteritems():
+            if original_id not in self._people:
+                self._people[original_id] = dict(row)
+
+    def _load_people(self, **filters):
+        rows = Person.objects \
+            .filter(dataset=self.dataset, **filters) \
+            .order_by('pk') \
+            .values()
+        for row in rows:
+            if row['original_id'] not in self._stored_people:
+                self._stored_people[row['original_id']] = row
+
+    def _collect_ids(self, tweet, message_ids, person_ids):
+        message_ids.add(tweet['id'])
+        if tweet['user']:
+            person_ids.add(tweet['user']['id'])
+        for mention in tweet['mentions']:
+            person_ids.add(mention['id'])
+        for related in (tweet['retweeted_status'], tweet['in_reply_to']):
+            if related is not None:
+                self._collect_ids(related, message_ids, person_ids)
+
+    def _get_message(self, original_id):
+        if original_id not in self._messages:
+            message = dict(self._message_defaults, original_id=original_id, sender=None)
+            self._messages[original_id] = message
+            self._new_messages.append(original_id)
+        return dict(self._messages[original_id])
+
+    def _save_message(self, message):
+        self._messages[message['original_id']] = message
+
+    def _get_person(self, original_id):
+        if original_id not in self._people:
+            person = dict(self._person_defaults, original_id=original_id)
+            self._people[original_id] = person
+            self._new_people.append(original_id)
+        return dict(self._people[original_id])
+
+    def _save_person(self, person):
+        self._people[person['original_id']] = person
+
+    def _link(self, field_name, message, key):
+        link = (message['original_id'], key)
+        if link not in self._link_sets[field_name]:
+            self._link_sets[field_name].add(link)
+            self._links[field_name].append(link)
+
+    def _import_user(self, user):
+        """See :func:`msgvis.apps.importer.models.create_an_user_from_json_obj`."""
+        person = self._get_person(user['id'])
+        person.update(user['fields'])
+        if user['lang']:
+            person['language'] = self.languages.require((user['lang'],))
+        self._save_person(person)
+        return person
+
+    def import_tweet(self, tweet):
+        """
+        Import a normalized tweet.
+        Returns a dictionary with the field values of the message.
+        """
+        return self._import_tweet(tweet)
+
+    def _import_tweet(self, tweet):
+        """See :func:`msgvis.apps.importer.models.get_or_create_a_tweet_from_json_obj`."""
+        message = self._get_message(tweet['id'])
+
+        if tweet['text']:
+            message['text'] = tweet['text']
+
+        if tweet['time']:
+            message['time'] = tweet['time']
+
+        # Rendered (and bucketed) even without text or a time, as Message.save does
+        message.update(get_rendered_html(message.get('text') or ''))
+        message.update(get_time_buckets(message.get('time')))
+
+        if tweet['lang']:
+            message['language'] = self.languages.require((tweet['lang'],))
+
+        if tweet['user']:
+            message['sender'] = self._import_user(tweet['user'])['original_id']
+
+            if tweet['time_zone']:
+                message['timezone'] = self.timezones.require((tweet['time_zone'],))
+
+        if tweet['is_retweet']:
+            message['type'] = self.message_types.require(('retweet',))
+            if tweet['retweeted_status'] is not None:
+                self._handle_related(tweet['retweeted_status'], 'shared_count')
+
+        elif tweet['in_reply_to'] is not None:
+            message['type'] = self.message_types.require(('reply',))
+            self._handle_related(tweet['in_reply_to'], 'replied_to_count')
+
+        else:
+            message['type'] = self.message_types.require(('tweet',))
+
+        self._handle_entities(message, tweet)
+
+        if tweet['sentiment'] is not None:
+            message['sentiment'] = tweet['sentiment']
+        else:
+            message['sentiment'] = get_text_sentiment(message['text'])
+
+        self._save_message(message)
+
+        return message
+
+    def _handle_related(self, related_tweet, count_field):
+        """See :func:`msgvis.apps.importer.models.handle_retweet` and ``handle_reply_to``."""
+        original = self._import_tweet(related_tweet)
+        if original['sender'] is None:
+            raise ValueError("Message %s has no sender" % original['original_id'])
+
+        self._counts[(Message, original['original_id'], count_field)] += 1
+        self._counts[(Person, original['sender'], count_field)] += 1
+
+    def _handle_entities(self, message, tweet):
+        """See :func:`msgvis.apps.importer.models.handle_entities`."""
+        for field_name, flag in (('hashtags', 'contains_hashtag'),
+                                 ('urls', 'contains_url'),
+                                 ('media', 'contains_media')):
+            if tweet[field_name]:
+                message[flag] = True
+                table = self._link_tables[field_name]
+                for key in tweet[field_name]:
+                    self._link(field_name, message, table.require(key))
+
+        if tweet['mentions']:
+            message['contains_mention'] = True
+            for mention in tweet['mentions']:
+                person = self._import_user(mention)
+                self._counts[(Person, person['original_id'], 'mentioned_count')] += 1
+                self._link('mentions', message, person['original_id'])
+
+    def flush(self):
+        """Write everything imported since :meth:`prepare` to the database."""
+
+        for table in self._tables.itervalues():
+            table.resolve()
+
+        counters = CountBuffer()
+        self._apply_counts(counters)
+
+        person_ids = self._flush_people()
+        message_ids = self._flush_messages(person_ids)
+        self._flush_links(message_ids, person_ids)
+        counters.flush()
+
+        for table in self._tables.itervalues():
+            table.release()
+        self._reset()
+
+    def cache_summary(self):
+        """Hits and misses of the lookup table caches, for progress messages."""
+        return ", ".join("%s %d/%d" % (name, table.cache.hits, table.cache.misses)
+                         for name, table in self._tables.iteritems())
+
+    def _apply_counts(self, counters):
+        """Add the counts to the new rows and pass those of the existing rows to ``counters``."""
+        tables = {
+            Message: (self._messages, self._stored_messages),
+            Person: (self._people, self._stored_people),
+        }
+        for (model, original_id, field_name), amount in self._counts.iteritems():
+            records, stored = tables[model]
+            if original_id in stored:
+                counters.add(model, stored[original_id]['id'], field_name, amount)
+            else:
+                records[original_id][field_name] += amount
+
+    def _resolve_foreign_keys(self, record, lookups):
+        for field_name, table in lookups:
+            if field_name in record:
+                key = record.pop(field_name)
+                record[field_name + '_id'] = table[key] if key is not None else None
+
+    def _flush_rows(self, model, records, stored, new_ids):
+        """Create the new rows and update the changed ones. Returns a map from original id to pk."""
+        model.objects.bulk_create([model(**records[original_id]) for original_id in new_ids])
+
+        ids = dict((original_id, row['id']) for original_id, row in stored.iteritems())
+        for batch in _batches(new_ids):
+            rows = model.objects \
+                .filter(dataset=self.dataset, original_id__in=batch) \
+                .order_by('pk') \
+                .values_list('original_id', 'pk')
+            for original_id, pk in rows:
+                ids.setdefault(original_id, pk)
+
+        for original_id, row in stored.iteritems():
+            record = records[original_id]
+            changes = dict((name, value) for name, value in record.iteritems()
+                           if row.get(name) != value)
+            if changes:
+                model.objects.filter(pk=row['id']).update(**changes)
+
+        return ids
+
+    def _flush_people(self):
+        for person in self._people.itervalues():
+            self._resolve_foreign_keys(person, [('language', self.languages)])
+
+        return self._flush_rows(Person, self._people, self._stored_people, self._new_people)
+
+    def _flush_messages(self, person_ids):
+        for message in self._messages.itervalues():
+            self._resolve_foreign_keys(message, [
+                ('language', self.languages),
+                ('timezone', self.timezones),
+                ('type', self.message_types),
+            ])
+            sender = message.pop('sender')
+            message['sender_id'] = person_ids[sender] if sender is not None else None
+
+        return self._flush_rows(Message, self._messages, self._stored_messages, self._new_messages)
+
+    def _flush_links(self, message_ids, person_ids):
+        stored_message_pks = [row['id'] for row in self._stored_messages.itervalues()]
+
+        for field_name in LINK_FIELDS:
+            if not self._links[field_name]:
+                continue
+
+            field = Message._meta.get_field(field_name)
+            through = field.rel.through
+            message_column = field.m2m_field_name() + '_id'
+            target_column = field.m2m_reverse_field_name() + '_id'
+
+            if field_name == 'mentions':
+                target_ids = person_ids
+            else:
+                target_ids = self._link_tables[field_name]
+
+            existing = set()
+            for batch in _batches(stored_message_pks):
+                existing.update(through.objects
+                                .filter(**{message_column + '__in': batch})
+                                .values_list(message_column, target_column))
+
+            rows = []
+            for original_id, key in self._links[field_name]:
+                link = (message_ids[original_id], target_ids[key])
+                if link not in existing:
+                    existing.add(link)
+                    rows.append(through(**{message_column: link[0], target_column: link[1]}))
+
+            through.objects.bulk_create(rows)
@@ -1,6 +1,7 @@
 from django.core.management.base import BaseCommand, CommandError
 
 from msgvis.apps.corpus.models import Dataset, Hashtag, Url, Media
+from msgvis.apps.datatable.cache import invalidate_dataset
 
 class Command(BaseCommand):
     """
@@ -27,7 +28,9 @@ class Command(BaseCommand):
         print "Deleting dataset %s with %d messages and %d people..." % (dataset.name,
                                                                          dataset.message_set.count(),
                                                                          dataset.person_set.count())
+        dataset_id = dataset.id
         dataset.delete()
+        invalidate_dataset(dataset_id)
 
         # Now delete all the unused crap
         media = Media.objects.filter(message=None)
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+from time import time
+
+
+class Command(BaseCommand):
+    help = "Set the epoch seconds and time bins of messages from their times, so time histograms can group on them."
+    args = "[dataset id]"
+
+    def handle(self, dataset_id=None, *args, **options):
+
+        from msgvis.apps.corpus.models import Dataset, fill_time_buckets
+
+        dataset = None
+        if dataset_id:
+            try:
+                dataset_id = int(dataset_id)
+            except ValueError:
+                raise CommandError("Dataset id must be a number.")
+            try:
+                dataset = Dataset.objects.get(id=dataset_id)
+            except Dataset.DoesNotExist:
+                raise CommandError("Dataset %d does not exist." % dataset_id)
+
+        start = time()
+        print "Filling in time bins..."
+        print "  %d messages" % fill_time_buckets(dataset)
+        print "Time: %.2fs" % (time() - start)
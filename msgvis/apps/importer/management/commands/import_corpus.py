@@ -1,11 +1,17 @@
 from django.core.management.base import BaseCommand, CommandError
-from msgvis.apps.importer.models import create_an_instance_from_json
+from msgvis.apps.importer.models import create_an_instance_from_json, CountBuffer, import_caches, ImportCheckpoint
+from msgvis.apps.importer.bulk import BulkImporter, parse_tweet_lines
+from msgvis.apps.importer import readers
+from msgvis.apps.datatable.cache import invalidate_dataset
 from optparse import make_option
 
 from msgvis.apps.corpus.models import Dataset
-from django.db import transaction
+from django.db import transaction, connection
 import traceback
 import sys
+import signal
+import multiprocessing
+from collections import deque, OrderedDict
 import path
 from time import time
 from django.conf import settings
@@ -18,6 +24,32 @@ class Command(BaseCommand):
 
         $ python manage.py import_corpus <file_path>
 
+    Files may be compressed with gzip, bzip2 or xz (``.gz``, ``.bz2``, ``.xz``)
+    or bundled in tar archives, which are decompressed as they are read.
+    Directories and glob patterns import every file they contain, in order.
+
+    With ``--bulk``, tweets are imported in chunks using
+    :class:`msgvis.apps.importer.bulk.BulkImporter`, which
+    produces the same data with far fewer queries.
+
+    With ``--workers N``, the json parsing, date and url parsing, and
+    sentiment analysis are done by N worker processes while
+    the main process writes the results to the database in batches.
+    This implies ``--bulk``.
+
+    Progress is saved after every committed group of lines, and
+    ``--resume`` continues an interrupted import from the last
+    committed line instead of the beginning of the file.
+
+    With ``--start-offset`` and ``--end-offset``, only the lines that
+    start within that byte range of the file are imported, so a large
+    file can be split between several importers:
+
+    .. code-block :: bash
+
+        $ python manage.py import_corpus tweets.json -d tweets --end-offset 20000000000 &
+        $ python manage.py import_corpus tweets.json -d tweets --start-offset 20000000000 &
+
     """
     args = '<corpus_filename> [...]'
     help = "Import a corpus into the database."
@@ -27,6 +59,46 @@ class Command(BaseCommand):
                     dest='dataset',
                     help='Set a target dataset to add to'
         ),
+        make_option('-b', '--bulk',
+                    action='store_true',
+                    dest='bulk',
+                    default=False,
+                    help='Import tweets in chunks with bulk inserts'
+        ),
+        make_option('--batch-size',
+                    action='store',
+                    dest='batch_size',
+                    type='int',
+                    default=None,
+                    help='Number of lines to import per transaction'
+        ),
+        make_option('-w', '--workers',
+                    action='store',
+                    dest='workers',
+                    type='int',
+                    default=1,
+                    help='Number of processes to use for parsing tweets (implies --bulk)'
+        ),
+        make_option('--resume',
+                    action='store_true',
+                    dest='resume',
+                    default=False,
+                    help='Continue from where the last import of the file stopped'
+        ),
+        make_option('--start-offset',
+                    action='store',
+                    dest='start_offset',
+                    type='int',
+                    default=0,
+                    help='Import the lines starting at or after this byte offset'
+        ),
+        make_option('--end-offset',
+                    action='store',
+                    dest='end_offset',
+                    type='int',
+                    default=None,
+                    help='Import the lines starting before this byte offset'
+        ),
     )
 
     def handle(self, *filenames, **options):
@@ -38,9 +110,26 @@ class Command(BaseCommand):
         if not dataset:
             dataset = filenames[0]
 
-        for f in filenames:
-            if not path.path(f).exists():
-                raise CommandError("Filename %s does not exist" % f)
+        try:
+            paths = readers.expand_paths(filenames)
+        except ValueError as e:
+            raise CommandError(str(e))
+        if not paths:
+            raise CommandError("No files found in %s" % ", ".join(filenames))
+        if not readers.xz_supported() and any(readers.detect_format(p)[1] == 'xz' for p in paths):
+            raise CommandError("Reading xz files requires the lzma module (pip install backports.lzma).")
+
+        workers = options.get('workers') or 1
+        if workers < 1:
+            raise CommandError("The number of workers must be at least 1.")
+
+        start_offset = options.get('start_offset') or 0
+        end_offset = options.get('end_offset')
+        if start_offset < 0 or (end_offset is not None and end_offset < start_offset):
+            raise CommandError("Invalid byte range %d to %d." % (start_offset, end_offset))
+        if (start_offset > 0 or end_offset is not None) and \
+                (len(paths) > 1 or readers.detect_format(paths[0])[0] == 'tar'):
+            raise CommandError("A byte range can only be given for a single file.")
 
         start = time()
         dataset_obj, created = Dataset.objects.get_or_create(name=dataset, description=dataset)
@@ -50,30 +139,73 @@ class Command(BaseCommand):
             print "Adding to existing dataset '%s' (%d)" % (dataset_obj.name, dataset_obj.id)
 
 
-        for i, corpus_filename in enumerate(filenames):
-            with open(corpus_filename, 'rb') as fp:
-                if len(filenames) > 1:
-                    print "Reading file %d of %d %s" % (i + 1, len(filenames), corpus_filename)
-                else:
-                    print "Reading file %s" % corpus_filename
+        throughput = Throughput()
+
+        for corpus_file in readers.iter_corpus_files(paths):
+            print "Reading file %s (%s)" % (corpus_file.name, corpus_file.format)
+
+            checkpoint = self._get_checkpoint(dataset_obj, corpus_file.name, start_offset, end_offset,
+                                              options.get('resume'))
 
-                importer = Importer(fp, dataset_obj)
+            importer = Importer(corpus_file.fp, dataset_obj,
+                                bulk=options.get('bulk'),
+                                commit_every=options.get('batch_size'),
+                                workers=workers,
+                                checkpoint=checkpoint)
+            if checkpoint.finished:
+                print "Already imported %d lines" % checkpoint.line
+            else:
+                file_start = time()
+                first_offset, first_line = importer.offset, importer.line
                 importer.run()
+                throughput.add(corpus_file.format, importer.offset - first_offset,
+                               importer.line - first_line, time() - file_start)
 
-                min_time, max_time = importer.get_time_range()
+            min_time, max_time = importer.get_time_range()
 
-                if min_time is not None and \
-                    (dataset_obj.start_time is None
-                     or dataset_obj.start_time > min_time):
-                    dataset_obj.start_time = min_time
+            if min_time is not None and \
+                (dataset_obj.start_time is None
+                 or dataset_obj.start_time > min_time):
+                dataset_obj.start_time = min_time
 
-                if max_time is not None and \
-                    (dataset_obj.end_time is None
-                     or dataset_obj.end_time < max_time):
-                    dataset_obj.end_time = max_time
+            if max_time is not None and \
+                (dataset_obj.end_time is None
+                 or dataset_obj.end_time < max_time):
+                dataset_obj.end_time = max_time
 
         dataset_obj.save()
 
+        throughput.report()
+
+        # Count the new messages in the dimension cubes, if any were built
+        from msgvis.apps.datatable import cube
+        states = cube.refresh(dataset_obj)
+        if states:
+            print "Updated %d dimension cubes" % len(states)
+
+        # Count the new messages in the time rollups, if any were built
+        from msgvis.apps.datatable import rollup
+        states = rollup.refresh(dataset_obj)
+        if states:
+            print "Updated %d time rollups" % len(states)
+
+        # Add the new messages to the bitmap indexes, if any were built
+        from msgvis.apps.datatable import bitmap_index
+        states = bitmap_index.refresh(dataset_obj)
+        if states:
+            print "Updated %d bitmap indexes" % len(states)
+
+        # Rebuild the columnar snapshot, if there is one
+        from msgvis.apps.datatable import columnar
+        if columnar.refresh(dataset_obj) is not None:
+            print "Updated the columnar snapshot"
+
+        # Find the domains of the dimensions for the new messages
+        from msgvis.apps.datatable import domain_cache
+        domain_cache.warm(dataset_obj)
+
+        invalidate_dataset(dataset_obj)
+
         print "Dataset '%s' (%d) contains %d messages spanning %s, from %s to %s" % (
             dataset_obj.name, dataset_obj.id, dataset_obj.message_set.count(),
             dataset_obj.end_time - dataset_obj.start_time,
@@ -82,14 +214,69 @@ class Command(BaseCommand):
         
         print "Time: %.2fs" % (time() - start)
 
+    def _get_checkpoint(self, dataset_obj, corpus_filename, start_offset, end_offset, resume):
+        checkpoint, created = ImportCheckpoint.objects.get_or_create(
+            dataset=dataset_obj,
+            path=path.path(corpus_filename).abspath(),
+            start_offset=start_offset,
+            defaults={'offset': start_offset, 'end_offset': end_offset})
+
+        if created:
+            return checkpoint
+
+        if not resume:
+            checkpoint.restart(end_offset)
+        elif checkpoint.end_offset != end_offset:
+            raise CommandError("The last import of %s ended at byte %s, not %s." % (
+                corpus_filename, checkpoint.end_offset, end_offset))
+        elif not checkpoint.finished:
+            print "Resuming after line %d (byte %d)" % (checkpoint.line, checkpoint.offset)
+
+        return checkpoint
+
+
+class Throughput(object):
+    """Totals of the bytes and lines read from each input format."""
+
+    def __init__(self):
+        self.formats = OrderedDict()
+
+    def add(self, format, bytes_read, lines, seconds):
+        totals = self.formats.setdefault(format, [0, 0, 0, 0.0])
+        totals[0] += 1
+        totals[1] += bytes_read
+        totals[2] += lines
+        totals[3] += seconds
+
+    def report(self):
+        for format, (files, bytes_read, lines, seconds) in self.formats.iteritems():
+            seconds = max(seconds, 1e-6)
+            print "%s: %d files, %.1f MB, %d lines in %.2fs (%.2f MB/s, %d lines/s)" % (
+                format, files, bytes_read / 1e6, lines, seconds, bytes_read / 1e6 / seconds, lines / seconds)
+
+
+def _ignore_interrupts():
+    """Let the main process handle Ctrl-C instead of the parsing workers."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
 
 class Importer(object):
     commit_every = 100
+    bulk_commit_every = 5000
     print_every = 1000
 
-    def __init__(self, fp, dataset):
+    def __init__(self, fp, dataset, bulk=False, commit_every=None, workers=1, checkpoint=None):
         self.fp = fp
         self.dataset = dataset
+        self.workers = workers
+        if workers > 1:
+            # Parsed tweets can only be written by the bulk importer
+            bulk = True
+        self.bulk_importer = BulkImporter(dataset) if bulk else None
+        if commit_every is not None:
+            self.commit_every = commit_every
+        elif bulk:
+            self.commit_every = self.bulk_commit_every
         self.line = 0
         self.imported = 0
         self.not_tweets = 0
@@ -97,56 +284,211 @@ class Importer(object):
         self.min_time = None
         self.max_time = None
 
-    def _import_group(self, lines):
+        # Byte offsets of the next line to read and the end of the range
+        self.offset = 0
+        self.end_offset = None
+
+        self.checkpoint = checkpoint
+        if checkpoint is not None:
+            self.line = checkpoint.line
+            self.imported = checkpoint.imported
+            self.not_tweets = checkpoint.not_tweets
+            self.errors = checkpoint.errors
+            self.min_time = checkpoint.min_time
+            self.max_time = checkpoint.max_time
+            self.offset = checkpoint.offset
+            self.end_offset = checkpoint.end_offset
+
+    def _message_imported(self, time):
+        self.imported += 1
+
+        if self.min_time is None or self.min_time > time:
+            self.min_time = time
+        if self.max_time is None or self.max_time < time:
+            self.max_time = time
+
+    def _import_error(self, line=None, formatted_traceback=None):
+        self.errors += 1
+        print >> sys.stderr, "Import error on line %d" % (line if line is not None else self.line)
+        if formatted_traceback is not None:
+            print >> sys.stderr, formatted_traceback
+        else:
+            traceback.print_exc()
+
+    def _save_checkpoint(self, line, offset):
+        """Record that everything before ``offset`` has been imported, in the current transaction."""
+        self.offset = offset
+        if self.checkpoint is None:
+            return
+
+        checkpoint = self.checkpoint
+        checkpoint.line = line
+        checkpoint.offset = offset
+        checkpoint.imported = self.imported
+        checkpoint.not_tweets = self.not_tweets
+        checkpoint.errors = self.errors
+        checkpoint.min_time = self.min_time
+        checkpoint.max_time = self.max_time
+        checkpoint.save()
+
+    def _import_group(self, lines, first_line, end_offset):
+        if self.bulk_importer is not None:
+            return self._import_parsed_group(parse_tweet_lines(lines), first_line, end_offset)
+
         with transaction.atomic(savepoint=False):
-            for json_str in lines:
+            # Reply, share and mention counts are written once per group
+            counters = CountBuffer()
+            for line, json_str in enumerate(lines, first_line):
 
                 if len(json_str) > 0:
                     try:
-                        message = create_an_instance_from_json(json_str, self.dataset)
+                        message = create_an_instance_from_json(json_str, self.dataset, counters)
                         if message:
-                            self.imported += 1
-
-                            if self.min_time is None or self.min_time > message.time:
-                                self.min_time = message.time
-                            if self.max_time is None or self.max_time < message.time:
-                                self.max_time = message.time
+                            self._message_imported(message.time)
                         else:
                             self.not_tweets += 1
                     except:
-                        self.errors += 1
-                        print >> sys.stderr, "Import error on line %d" % self.line
-                        traceback.print_exc()
+                        self._import_error(line)
+            counters.flush()
+            self._save_checkpoint(first_line + len(lines) - 1, end_offset)
 
         #if settings.DEBUG:
             # prevent memory leaks
         #    from django.db import connection
         #    connection.queries = []
 
+    def _import_parsed_group(self, parsed, first_line, end_offset):
+        """Write a group of lines parsed with :func:`.parse_tweet_lines`."""
+        tweets = []
+        for line, entry in enumerate(parsed, first_line):
+            if entry is None:
+                continue
+
+            tweet, error = entry
+            if error is not None:
+                self._import_error(line, error)
+            elif tweet:
+                tweets.append((line, tweet))
+            else:
+                self.not_tweets += 1
 
-    def run(self):
+        with transaction.atomic(savepoint=False):
+            self.bulk_importer.prepare([tweet for line, tweet in tweets])
+            for line, tweet in tweets:
+                try:
+                    message = self.bulk_importer.import_tweet(tweet)
+                    self._message_imported(message['time'])
+                except:
+                    self._import_error(line)
+            self.bulk_importer.flush()
+            self._save_checkpoint(first_line + len(parsed) - 1, end_offset)
+
+    def _seek(self):
+        """Move to the first line that has not been imported."""
+        if self.checkpoint is None:
+            return
+
+        if self.line == 0 and self.offset > 0:
+            # Skip the rest of the line that the range starts in, unless it starts exactly at the offset
+            self.fp.seek(self.offset - 1)
+            self.offset += max(len(self.fp.readline()) - 1, 0)
+        else:
+            self.fp.seek(self.offset)
+
+    def _read_groups(self):
+        """
+        Yield the line number of the first line, a list of lines, and the byte
+        offset after the last line, for each transaction group.
+        """
         transaction_group = []
+        line = self.line
+        first_line = line + 1
+        offset = self.offset
 
-        start = time()
+        # Lines are read one at a time since file iteration reads ahead, which breaks the offsets
+        while self.end_offset is None or offset < self.end_offset:
+            json_str = self.fp.readline()
+            if not json_str:
+                break
 
-        for json_str in self.fp:
-            self.line += 1
-            json_str = json_str.strip()
-            transaction_group.append(json_str)
+            line += 1
+            offset += len(json_str)
+            transaction_group.append(json_str.strip())
 
             if len(transaction_group) >= self.commit_every:
-                self._import_group(transaction_group)
+                yield first_line, transaction_group, offset
                 transaction_group = []
+                first_line = line + 1
+
+        yield first_line, transaction_group, offset
+
+    def _group_done(self, first_line, lines, start):
+        previous_line = self.line
+        self.line = first_line + len(lines) - 1
+        if self.line / self.print_every > previous_line / self.print_every:
+            print "%6.2fs | Reached line %d. Imported: %d; Non-tweets: %d; Errors: %d; Cache hits/misses: %s" % (
+            time() - start, self.line, self.imported, self.not_tweets, self.errors, self.cache_summary())
+
+    def cache_summary(self):
+        if self.bulk_importer is not None:
+            return self.bulk_importer.cache_summary()
+        return import_caches.summary()
+
+    def _run_serial(self, start):
+        for first_line, lines, end_offset in self._read_groups():
+            self._import_group(lines, first_line, end_offset)
+            self._group_done(first_line, lines, start)
+
+    def _run_parallel(self, start):
+        # The workers never use the database, and should not share our connection
+        if not connection.in_atomic_block:
+            connection.close()
+
+        pool = multiprocessing.Pool(self.workers, _ignore_interrupts)
+        # Groups that are being parsed, oldest first. Bounded so we don't read ahead of the database.
+        pending = deque()
+
+        def import_oldest():
+            first_line, lines, end_offset, result = pending.popleft()
+            self._import_parsed_group(result.get(), first_line, end_offset)
+            self._group_done(first_line, lines, start)
+
+        try:
+            for first_line, lines, end_offset in self._read_groups():
+                pending.append((first_line, lines, end_offset, pool.apply_async(parse_tweet_lines, (lines,))))
+                if len(pending) > 2 * self.workers:
+                    import_oldest()
+
+            while pending:
+                import_oldest()
+
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def run(self):
+        start = time()
+
+        self._seek()
 
-            if self.line > 0 and self.line % self.print_every == 0:
-                print "%6.2fs | Reached line %d. Imported: %d; Non-tweets: %d; Errors: %d" % (
-                time() - start, self.line, self.imported, self.not_tweets, self.errors)
+        import_caches.enable()
+        try:
+            if self.workers > 1:
+                self._run_parallel(start)
+            else:
+                self._run_serial(start)
 
-        if len(transaction_group) >= 0:
-            self._import_group(transaction_group)
+            print "%6.2fs | Finished %d lines. Imported: %d; Non-tweets: %d; Errors: %d; Cache hits/misses: %s" % (
+            time() - start, self.line, self.imported, self.not_tweets, self.errors, self.cache_summary())
+        finally:
+            import_caches.disable()
 
-        print "%6.2fs | Finished %d lines. Imported: %d; Non-tweets: %d; Errors: %d" % (
-        time() - start, self.line, self.imported, self.not_tweets, self.errors)
+        if self.checkpoint is not None:
+            self.checkpoint.finished = True
+            self.checkpoint.save()
 
     def get_time_range(self):
         return self.min_time, self.max_time
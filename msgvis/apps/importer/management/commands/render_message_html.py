@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, make_option, CommandError
+from time import time
+
+
+class Command(BaseCommand):
+    help = "Store the html of messages that have none or were rendered by an older version of the renderer."
+    args = "[dataset id]"
+    option_list = BaseCommand.option_list + (
+        make_option('--all',
+                    action='store_true',
+                    dest='all',
+                    default=False,
+                    help='Render the html of every message again'),
+    )
+
+    def handle(self, dataset_id=None, *args, **options):
+
+        from msgvis.apps.corpus.models import Dataset, fill_rendered_html
+
+        dataset = None
+        if dataset_id:
+            try:
+                dataset_id = int(dataset_id)
+            except ValueError:
+                raise CommandError("Dataset id must be a number.")
+            try:
+                dataset = Dataset.objects.get(id=dataset_id)
+            except Dataset.DoesNotExist:
+                raise CommandError("Dataset %d does not exist." % dataset_id)
+
+        start = time()
+        print "Rendering message html..."
+        print "  %d messages" % fill_rendered_html(dataset, force=options.get('all'))
+        print "Time: %.2fs" % (time() - start)
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('corpus', '0021_dataset_has_prefetched_images'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportCheckpoint',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('path', models.CharField(max_length=500)),
+                ('start_offset', models.BigIntegerField(default=0)),
+                ('end_offset', models.BigIntegerField(default=None, null=True, blank=True)),
+                ('offset', models.BigIntegerField(default=0)),
+                ('line', models.IntegerField(default=0)),
+                ('imported', models.IntegerField(default=0)),
+                ('not_tweets', models.IntegerField(default=0)),
+                ('errors', models.IntegerField(default=0)),
+                ('min_time', models.DateTimeField(default=None, null=True, blank=True)),
+                ('max_time', models.DateTimeField(default=None, null=True, blank=True)),
+                ('finished', models.BooleanField(default=False)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('dataset', models.ForeignKey(to='corpus.Dataset')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='importcheckpoint',
+            unique_together=set([('dataset', 'path', 'start_offset')]),
+        ),
+    ]
@@ -1,5 +1,7 @@
 import sys, six
+from collections import defaultdict, OrderedDict
 from django.db import IntegrityError
+from django.db.models import F
 from django.utils.timezone import utc
 from urlparse import urlparse
 
@@ -9,17 +11,255 @@ from email.utils import parsedate
 from msgvis.apps.questions.models import Article, Question
 from msgvis.apps.corpus.models import *
 from msgvis.apps.enhance.models import set_message_sentiment
+from django.db import models
+
+
+class ImportCheckpoint(models.Model):
+    """
+    The progress of importing a corpus file (or a byte range of one)
+    into a dataset. It is saved in the same transaction as each group
+    of imported lines, so an interrupted import can resume from
+    the last committed line.
+    """
+
+    class Meta:
+        unique_together = ('dataset', 'path', 'start_offset')
+
+    dataset = models.ForeignKey(Dataset)
+    """The dataset being imported into."""
+
+    path = models.CharField(max_length=500)
+    """The absolute path of the corpus file."""
+
+    start_offset = models.BigIntegerField(default=0)
+    """The byte offset where the range of the file being imported starts."""
+
+    end_offset = models.BigIntegerField(null=True, default=None, blank=True)
+    """The byte offset where the range ends, or null to read to the end of the file."""
+
+    offset = models.BigIntegerField(default=0)
+    """The byte offset of the first line that has not been imported."""
+
+    line = models.IntegerField(default=0)
+    """The number of lines imported, counting from the start of the range."""
+
+    imported = models.IntegerField(default=0)
+    """The number of messages imported."""
+
+    not_tweets = models.IntegerField(default=0)
+    """The number of lines that were not tweets."""
+
+    errors = models.IntegerField(default=0)
+    """The number of lines that could not be imported."""
+
+    min_time = models.DateTimeField(null=True, default=None, blank=True)
+    """The time of the earliest imported message."""
+
+    max_time = models.DateTimeField(null=True, default=None, blank=True)
+    """The time of the latest imported message."""
+
+    finished = models.BooleanField(default=False)
+    """Whether the whole range has been imported."""
+
+    updated_at = models.DateTimeField(auto_now=True)
+    """The :py:class:`datetime.datetime` when the checkpoint was last saved."""
+
+    def __unicode__(self):
+        return "%s [%d:%s] in %s" % (self.path, self.start_offset,
+                                     self.end_offset if self.end_offset is not None else '',
+                                     self.dataset)
+
+    def restart(self, end_offset=None):
+        """Forget the progress so the range is imported from the beginning."""
+        self.end_offset = end_offset
+        self.offset = self.start_offset
+        self.line = 0
+        self.imported = 0
+        self.not_tweets = 0
+        self.errors = 0
+        self.min_time = None
+        self.max_time = None
+        self.finished = False
+        self.save()
+
+
+class LRUCache(object):
+    """
+    A dictionary that keeps at most ``max_size`` items,
+    forgetting the least recently used ones first.
+    Counts the hits and misses of :meth:`get`.
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+
+    def get(self, key, default=None):
+        """Get the value for a key, marking it as recently used."""
+        if key in self._items:
+            self.hits += 1
+            value = self._items.pop(key)
+            self._items[key] = value
+            return value
+
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        """Store a value, forgetting the oldest items if the cache is full."""
+        self._items.pop(key, None)
+        self._items[key] = value
+        if self.max_size is not None:
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        self._items.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+
+class ImportCaches(object):
+    """
+    Caches of the languages, timezones, message types, hashtags,
+    urls, media and people looked up while importing, keyed
+    on their natural keys.
+
+    The caches are only used while enabled, since the rows they hold
+    disappear if the import is rolled back. The importer enables them
+    for the duration of an import:
+
+    .. code-block:: python
+
+        import_caches.enable()
+        try:
+            ...
+        finally:
+            import_caches.disable()
+
+    """
+
+    # Maximum number of rows to remember of each kind
+    sizes = OrderedDict([
+        ('language', 1000),
+        ('timezone', 1000),
+        ('messagetype', 100),
+        ('hashtag', 10000),
+        ('url', 10000),
+        ('media', 10000),
+        ('person', 50000),
+    ])
+
+    def __init__(self):
+        self.enabled = False
+        self.caches = OrderedDict((name, LRUCache(size)) for name, size in self.sizes.iteritems())
+
+    def enable(self):
+        self.clear()
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+        self.clear()
+
+    def clear(self):
+        for cache in self.caches.itervalues():
+            cache.clear()
+
+    def lookup(self, name, key, get_or_create):
+        """Return the cached row for a key, or call ``get_or_create()`` and remember the result."""
+        if not self.enabled:
+            return get_or_create()
+
+        cache = self.caches[name]
+        obj = cache.get(key)
+        if obj is None:
+            obj = get_or_create()
+            cache.put(key, obj)
+        return obj
+
+    def summary(self):
+        """Hits and misses of each cache, for progress messages."""
+        return ", ".join("%s %d/%d" % (name, cache.hits, cache.misses)
+                         for name, cache in self.caches.iteritems())
+
+
+import_caches = ImportCaches()
+
+
+class CountBuffer(object):
+    """
+    Collects increments to the reply, share and mention counts of
+    messages and people so that they can be written with a few
+    ``UPDATE ... SET count = count + n`` queries instead of
+    saving the row every time.
+
+    .. code-block:: python
+
+        counters = CountBuffer()
+        counters.add(Message, message.id, 'shared_count')
+        counters.add(Person, message.sender_id, 'shared_count')
+        counters.flush()
+
+    """
+
+    count_fields = {
+        Message: ('replied_to_count', 'shared_count'),
+        Person: ('replied_to_count', 'shared_count', 'mentioned_count'),
+    }
+
+    batch_size = 500
+
+    def __init__(self):
+        self.increments = defaultdict(int)
+
+    def add(self, model, pk, field_name, amount=1):
+        """Add to the count field of a row."""
+        self.increments[(model, field_name, pk)] += amount
+
+    @classmethod
+    def save(cls, obj):
+        """Save a message or person, leaving the count fields in the database alone."""
+        count_fields = cls.count_fields[obj.__class__]
+        obj.save(update_fields=[f.name for f in obj._meta.concrete_fields
+                                if not f.primary_key and f.name not in count_fields])
+
+    def flush(self):
+        """Write the collected increments to the database."""
+
+        # Rows that get the same increment can share an update
+        pks_by_increment = defaultdict(list)
+        for (model, field_name, pk), amount in self.increments.iteritems():
+            pks_by_increment[(model, field_name, amount)].append(pk)
+
+        for (model, field_name, amount), pks in pks_by_increment.iteritems():
+            for start in xrange(0, len(pks), self.batch_size):
+                model.objects \
+                    .filter(pk__in=pks[start:start + self.batch_size]) \
+                    .update(**{field_name: F(field_name) + amount})
+
+        self.increments = defaultdict(int)
 
 
 def create_an_user_from_json_obj(user_data, dataset_obj):
-    sender, created = Person.objects.get_or_create(dataset=dataset_obj,
-                                                   original_id=user_data['id'])
+    def get_or_create():
+        return Person.objects.get_or_create(dataset=dataset_obj, original_id=user_data['id'])[0]
+
+    sender = import_caches.lookup('person', (dataset_obj.id, user_data['id']), get_or_create)
     if user_data.get('screen_name'):
         sender.username = user_data['screen_name']
     if user_data.get('name'):
         sender.full_name = user_data['name']
     if user_data.get('lang'):
-        sender.language = Language.objects.get_or_create(code=user_data['lang'])[0]
+        sender.language = get_or_create_language(user_data['lang'])
     if user_data.get('friends_count'):
         sender.friend_count = user_data['friends_count']
     if user_data.get('followers_count'):
@@ -28,12 +268,14 @@ def create_an_user_from_json_obj(user_data, dataset_obj):
         sender.message_count = user_data['statuses_count']
     if user_data.get('profile_image_url'):
         sender.profile_image_url = user_data['profile_image_url']
-    sender.save()
+
+    # Cached people have stale counts, which are changed through a CountBuffer instead
+    CountBuffer.save(sender)
 
     return sender
 
 
-def create_an_instance_from_json(json_str, dataset_obj):
+def create_an_instance_from_json(json_str, dataset_obj, counters=None):
     """
     Given a dataset object, imports a tweet from json string into
     the dataset.
@@ -43,45 +285,58 @@ def create_an_instance_from_json(json_str, dataset_obj):
         lang = tweet_data.get('lang')
         if lang != "en":
             return False
-    return get_or_create_a_tweet_from_json_obj(tweet_data, dataset_obj)
+    return get_or_create_a_tweet_from_json_obj(tweet_data, dataset_obj, counters)
 
 
 def get_or_create_language(code):
-    lang, created = Language.objects.get_or_create(code=code)
-    return lang
+    def get_or_create():
+        lang, created = Language.objects.get_or_create(code=code)
+        return lang
+    return import_caches.lookup('language', code, get_or_create)
 
 
 def get_or_create_timezone(name):
-    zone, created = Timezone.objects.get_or_create(name=name)
-    return zone
+    def get_or_create():
+        zone, created = Timezone.objects.get_or_create(name=name)
+        return zone
+    return import_caches.lookup('timezone', name, get_or_create)
 
 
 def get_or_create_messagetype(name):
-    mtype, created = MessageType.objects.get_or_create(name=name)
-    return mtype
+    def get_or_create():
+        mtype, created = MessageType.objects.get_or_create(name=name)
+        return mtype
+    return import_caches.lookup('messagetype', name, get_or_create)
 
 
 def get_or_create_hashtag(hashtagblob):
-    ht, created = Hashtag.objects.get_or_create(text=hashtagblob['text'])
-    return ht
+    def get_or_create():
+        ht, created = Hashtag.objects.get_or_create(text=hashtagblob['text'])
+        return ht
+    return import_caches.lookup('hashtag', hashtagblob['text'], get_or_create)
 
 
 def get_or_create_url(urlblob):
     urlparse_results = urlparse(urlblob['expanded_url'])
     domain = urlparse_results.netloc
-    url, created = Url.objects.get_or_create(full_url=urlblob['expanded_url'],
-                                             domain=domain,
-                                             short_url=urlblob['url'])
-    return url
+
+    def get_or_create():
+        url, created = Url.objects.get_or_create(full_url=urlblob['expanded_url'],
+                                                 domain=domain,
+                                                 short_url=urlblob['url'])
+        return url
+    return import_caches.lookup('url', (urlblob['expanded_url'], domain, urlblob['url']), get_or_create)
 
 
 def get_or_create_media(mediablob):
-    media, created = Media.objects.get_or_create(type=mediablob['type'],
-                                                 media_url=mediablob['media_url'])
-    return media
+    def get_or_create():
+        media, created = Media.objects.get_or_create(type=mediablob['type'],
+                                                     media_url=mediablob['media_url'])
+        return media
+    return import_caches.lookup('media', (mediablob['type'], mediablob['media_url']), get_or_create)
 
 
-def handle_reply_to(status_id, user_id, screen_name, dataset_obj):
+def handle_reply_to(status_id, user_id, screen_name, dataset_obj, counters):
     # update original tweet shared_count
     tmp_tweet = {
         'id': status_id,
@@ -92,27 +347,21 @@ def handle_reply_to(status_id, user_id, screen_name, dataset_obj):
         'in_reply_to_status_id': None
     }
 
-    original_tweet = get_or_create_a_tweet_from_json_obj(tmp_tweet, dataset_obj)
+    original_tweet = get_or_create_a_tweet_from_json_obj(tmp_tweet, dataset_obj, counters)
     if original_tweet is not None:
-        original_tweet.replied_to_count += 1
-        original_tweet.save()
+        counters.add(Message, original_tweet.pk, 'replied_to_count')
+        counters.add(Person, original_tweet.sender.pk, 'replied_to_count')
 
-        original_tweet.sender.replied_to_count += 1
-        original_tweet.sender.save()
 
-
-def handle_retweet(retweeted_status, dataset_obj):
+def handle_retweet(retweeted_status, dataset_obj, counters):
     # update original tweet shared_count
-    original_tweet = get_or_create_a_tweet_from_json_obj(retweeted_status, dataset_obj)
+    original_tweet = get_or_create_a_tweet_from_json_obj(retweeted_status, dataset_obj, counters)
     if original_tweet is not None:
-        original_tweet.shared_count += 1
-        original_tweet.save()
-
-        original_tweet.sender.shared_count += 1
-        original_tweet.sender.save()
+        counters.add(Message, original_tweet.pk, 'shared_count')
+        counters.add(Person, original_tweet.sender.pk, 'shared_count')
 
 
-def handle_entities(tweet, entities, dataset_obj):
+def handle_entities(tweet, entities, dataset_obj, counters):
     # hashtags
     if entities.get('hashtags') and len(entities['hashtags']) > 0:
         tweet.contains_hashtag = True
@@ -136,19 +385,28 @@ def handle_entities(tweet, entities, dataset_obj):
         tweet.contains_mention = True
         for mention in entities['user_mentions']:
             mention_obj = create_an_user_from_json_obj(mention, dataset_obj)
-            mention_obj.mentioned_count += 1
-            mention_obj.save()
+            counters.add(Person, mention_obj.pk, 'mentioned_count')
             tweet.mentions.add(mention_obj)
 
 
-def get_or_create_a_tweet_from_json_obj(tweet_data, dataset_obj):
+def get_or_create_a_tweet_from_json_obj(tweet_data, dataset_obj, counters=None):
     """
     Given a dataset object, imports a tweet from json object into
     the dataset.
+
+    Increments to the reply, share and mention counts are added to ``counters``,
+    a :class:`CountBuffer`, to be written later. Without one, they are written
+    before returning.
     """
     if 'in_reply_to_status_id' not in tweet_data:
         return None
 
+    if counters is None:
+        counters = CountBuffer()
+        tweet = get_or_create_a_tweet_from_json_obj(tweet_data, dataset_obj, counters)
+        counters.flush()
+        return tweet
+
     # if tweet_data.get('lang') != 'en':
     #     return None
 
@@ -180,7 +438,7 @@ def get_or_create_a_tweet_from_json_obj(tweet_data, dataset_obj):
     if tweet_data.get('retweeted_status') is not None:
         tweet.type = get_or_create_messagetype("retweet")
 
-        handle_retweet(tweet_data['retweeted_status'], dataset_obj)
+        handle_retweet(tweet_data['retweeted_status'], dataset_obj, counters)
 
     elif tweet_data.get('in_reply_to_status_id') is not None:
         tweet.type = get_or_create_messagetype("reply")
@@ -188,18 +446,19 @@ def get_or_create_a_tweet_from_json_obj(tweet_data, dataset_obj):
         handle_reply_to(status_id=tweet_data['in_reply_to_status_id'],
                         user_id=tweet_data['in_reply_to_user_id'],
                         screen_name=tweet_data['in_reply_to_screen_name'],
-                        dataset_obj=dataset_obj)
+                        dataset_obj=dataset_obj,
+                        counters=counters)
 
     else:
         tweet.type = get_or_create_messagetype('tweet')
 
     if tweet_data.get('entities'):
-        handle_entities(tweet, tweet_data.get('entities'), dataset_obj)
+        handle_entities(tweet, tweet_data.get('entities'), dataset_obj, counters)
 
     # sentiment
     set_message_sentiment(tweet, save=False)
 
-    tweet.save()
+    counters.save(tweet)
 
     return tweet
 
@@ -0,0 +1,279 @@
+"""
+Streaming readers for corpus files.
+
+Corpus files contain one json tweet per line. They may be compressed with
+gzip, bzip2 or xz, or bundled in (possibly compressed) tar archives, and
+are decompressed while they are read, in large chunks.
+
+.. code-block:: python
+
+    for corpus_file in iter_corpus_files(expand_paths(['archive/*.json.gz'])):
+        for line in corpus_file.fp:
+            ...
+
+Reading xz files requires the ``lzma`` module (``pip install backports.lzma``).
+"""
+import bz2
+import glob
+import io
+import os
+import tarfile
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+# How many bytes to read and buffer at a time
+BUFFER_SIZE = 4 * 1024 * 1024
+
+# File name extensions of the compressed formats
+COMPRESSION_EXTENSIONS = (
+    ('.gz', 'gz'),
+    ('.gzip', 'gz'),
+    ('.bz2', 'bz2'),
+    ('.xz', 'xz'),
+    ('.lzma', 'xz'),
+)
+
+# File name extensions of compressed tar archives
+TAR_EXTENSIONS = (
+    ('.tgz', 'gz'),
+    ('.tbz2', 'bz2'),
+    ('.txz', 'xz'),
+)
+
+
+def xz_supported():
+    """Return True if xz files can be read"""
+    return lzma is not None
+
+
+class _PassThrough(object):
+    """A decompressor for data that is not compressed."""
+    unused_data = b''
+
+    def decompress(self, data):
+        return data
+
+
+def _decompressor_factory(compression):
+    if compression is None:
+        return _PassThrough
+    if compression == 'gz':
+        # Expect a gzip header
+        return lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if compression == 'bz2':
+        return bz2.BZ2Decompressor
+    if compression == 'xz':
+        if lzma is None:
+            raise ValueError("Reading xz files requires the lzma module.")
+        return lzma.LZMADecompressor
+    raise ValueError("Unknown compression %s" % compression)
+
+
+def detect_format(path):
+    """
+    Guess the format of a corpus file from its name.
+    Returns a ``(container, compression)`` tuple, where container is
+    ``'tar'`` or None and compression is ``'gz'``, ``'bz2'``, ``'xz'`` or None.
+    """
+    name = path.lower()
+
+    for extension, compression in TAR_EXTENSIONS:
+        if name.endswith(extension):
+            return 'tar', compression
+
+    compression = None
+    for extension, value in COMPRESSION_EXTENSIONS:
+        if name.endswith(extension):
+            compression = value
+            name = name[:-len(extension)]
+            break
+
+    if name.endswith('.tar'):
+        return 'tar', compression
+    return None, compression
+
+
+def format_name(container, compression):
+    """A short name for a format, e.g. ``'tar.gz'`` or ``'json'``."""
+    parts = [container or 'json']
+    if compression:
+        parts.append(compression)
+    return '.'.join(parts)
+
+
+def expand_paths(patterns):
+    """
+    Turn a list of file names, directories and glob patterns into
+    a sorted list of files. Hidden files in directories are skipped.
+    Raises ValueError if a pattern does not match anything.
+    """
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            found = []
+            for root, dirnames, filenames in os.walk(pattern):
+                dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+                found.extend(os.path.join(root, f) for f in filenames if not f.startswith('.'))
+            paths.extend(sorted(found))
+        elif os.path.exists(pattern):
+            paths.append(pattern)
+        else:
+            matches = sorted(glob.glob(pattern))
+            if not matches:
+                raise ValueError("Filename %s does not exist" % pattern)
+            paths.extend(expand_paths(matches))
+    return paths
+
+
+class DecompressingReader(io.RawIOBase):
+    """
+    A read-only file that decompresses another file as it is read.
+    Concatenated compressed streams (e.g. from pigz or pbzip2) are supported.
+    With no compression, it just adapts a file-like object (e.g. a file in a
+    tar archive) for use with :class:`io.BufferedReader`.
+
+    Seeking is only possible forwards, by decompressing and discarding data.
+    """
+
+    def __init__(self, fileobj, compression, chunk_size=BUFFER_SIZE):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self._make_decompressor = _decompressor_factory(compression)
+        self._decompressor = self._make_decompressor()
+        self._data = b''
+        self._data_start = 0
+        self._unused = b''
+        self._position = 0
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def _fill(self):
+        """Decompress the next chunk. Returns False at the end of the file."""
+        while self._data_start >= len(self._data):
+            compressed = self._unused or self.fileobj.read(self.chunk_size)
+            self._unused = b''
+            if not compressed:
+                return False
+
+            try:
+                self._data = self._decompressor.decompress(compressed)
+            except EOFError:
+                # The previous stream ended exactly at the end of a chunk
+                self._decompressor = self._make_decompressor()
+                self._data = self._decompressor.decompress(compressed)
+            self._data_start = 0
+
+            if self._decompressor.unused_data:
+                # Another stream follows
+                self._unused = self._decompressor.unused_data
+                self._decompressor = self._make_decompressor()
+        return True
+
+    def readinto(self, b):
+        if self._eof or not self._fill():
+            self._eof = True
+            return 0
+
+        size = min(len(b), len(self._data) - self._data_start)
+        b[:size] = self._data[self._data_start:self._data_start + size]
+        self._data_start += size
+        self._position += size
+        return size
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence != io.SEEK_SET:
+            raise IOError("Cannot seek from the end of a compressed file")
+        if offset < self._position:
+            raise IOError("Cannot seek backwards in a compressed file")
+
+        while self._position < offset and not self._eof:
+            if not self._fill():
+                self._eof = True
+                break
+            size = min(offset - self._position, len(self._data) - self._data_start)
+            self._data_start += size
+            self._position += size
+        return self._position
+
+    def close(self):
+        if not self.closed:
+            self.fileobj.close()
+        super(DecompressingReader, self).close()
+
+
+def open_stream(fileobj, compression=None):
+    """Wrap a binary file in a buffered reader that decompresses it if needed."""
+    if compression or not isinstance(fileobj, io.RawIOBase):
+        fileobj = DecompressingReader(fileobj, compression)
+    return io.BufferedReader(fileobj, BUFFER_SIZE)
+
+
+class CorpusFile(object):
+    """An open corpus file, or a file inside a tar archive."""
+
+    def __init__(self, name, format, fp, size=None):
+        self.name = name
+        """The absolute path of the file. Files in an archive are named as if the archive was a directory."""
+
+        self.format = format
+        """A short name of the format the file was read from."""
+
+        self.fp = fp
+        """A buffered binary file of json lines."""
+
+        self.size = size
+        """The size of the (compressed) file in bytes, if known."""
+
+
+def iter_corpus_files(paths):
+    """
+    Open each of the given files in turn, yielding a :class:`CorpusFile` for each file
+    and for each file inside a tar archive. Archives are read as a stream, so a file
+    must be finished with before asking for the next one.
+    """
+    for path in paths:
+        path = os.path.abspath(path)
+        container, compression = detect_format(path)
+
+        if container != 'tar':
+            fp = open_stream(io.open(path, 'rb', buffering=0), compression)
+            try:
+                yield CorpusFile(path, format_name(container, compression), fp, os.path.getsize(path))
+            finally:
+                fp.close()
+            continue
+
+        tar_fp = open_stream(io.open(path, 'rb', buffering=0), compression)
+        try:
+            with tarfile.open(fileobj=tar_fp, mode='r|') as tar:
+                for member in tar:
+                    if not member.isfile():
+                        continue
+
+                    member_compression = detect_format(member.name)[1]
+                    fp = open_stream(tar.extractfile(member), member_compression)
+                    try:
+                        yield CorpusFile(os.path.join(path, member.name),
+                                         format_name(container, compression or member_compression),
+                                         fp, member.size)
+                    finally:
+                        fp.close()
+        finally:
+            tar_fp.close()
@@ -1,9 +1,123 @@
 # -*- coding: utf-8 -*-
+import json
+import os
+import io
+import gzip
+import bz2
+import shutil
+import tarfile
+import tempfile
+from StringIO import StringIO
+import mock
 from django.test import TestCase
-from msgvis.apps.corpus.models import Dataset, Message
+from django.db import transaction
+from django.core.cache import cache
+from msgvis.apps.corpus.models import Dataset, Message, Person, Language, Timezone, MessageType, Hashtag, Url, Media
+from msgvis.apps.corpus.models import TIME_BUCKET_SIZES, get_time_bucket_field
 from msgvis.apps.questions.models import Article, Question
 
-from models import create_an_instance_from_json, load_research_questions_from_json, get_or_create_a_tweet_from_json_obj
+from models import ImportCheckpoint, create_an_instance_from_json, load_research_questions_from_json, get_or_create_a_tweet_from_json_obj, \
+    CountBuffer, LRUCache, import_caches, get_or_create_hashtag
+from bulk import BulkImporter, parse_tweet_line
+from management.commands.import_corpus import Importer
+import readers
+
+
+def make_user(id, screen_name, **extra):
+    user = {'id': id, 'screen_name': screen_name, 'name': screen_name.title()}
+    user.update(extra)
+    return user
+
+
+def make_tweet(id, user, text, created_at="Thu Feb 26 00:00:04 +0000 2015", **extra):
+    tweet = {
+        'id': id,
+        'user': user,
+        'text': text,
+        'lang': 'en',
+        'created_at': created_at,
+        'in_reply_to_status_id': None,
+        'in_reply_to_user_id': None,
+        'in_reply_to_screen_name': None,
+        'entities': {'hashtags': [], 'urls': [], 'user_mentions': []},
+    }
+    tweet.update(extra)
+    return tweet
+
+
+def sample_corpus():
+    """A few lines of tweets that exercise most of the importer."""
+    alice = make_user(1, 'alice', lang='en', time_zone='Pacific Time (US & Canada)', followers_count=10,
+                      profile_image_url='http://example.com/alice.png')
+    bob = make_user(2, 'bob', lang='fr', time_zone='Paris', friends_count=3)
+    carol = make_user(3, 'carol', statuses_count=7)
+
+    original = make_tweet(100, alice, "I love #soup from http://t.co/x so much!", entities={
+        'hashtags': [{'text': 'soup'}],
+        'urls': [{'url': 'http://t.co/x', 'expanded_url': 'http://soup.example.com/page'}],
+        'user_mentions': [{'id': 2, 'screen_name': 'bob', 'name': 'Bob B'}],
+    })
+    retweet = make_tweet(101, carol, "RT @alice: I love #soup", retweeted_status=original, entities={
+        'hashtags': [{'text': 'soup'}],
+        'user_mentions': [{'id': 1, 'screen_name': 'alice', 'name': 'Alice A'}],
+    })
+    reply = make_tweet(102, bob, "@alice terrible soup", in_reply_to_status_id=100,
+                       in_reply_to_user_id=1, in_reply_to_screen_name='alice', entities={
+                           'user_mentions': [{'id': 1, 'screen_name': 'alice', 'name': 'Alice A'}],
+                       })
+    unknown_reply = make_tweet(103, alice, "@dave what?", in_reply_to_status_id=999,
+                               in_reply_to_user_id=4, in_reply_to_screen_name='dave')
+    photo = make_tweet(104, carol, "Look at this #soup #Lunch", created_at="Fri Feb 27 10:00:00 +0000 2015",
+                       entities={
+                           'hashtags': [{'text': 'soup'}, {'text': 'Lunch'}],
+                           'media': [{'type': 'photo', 'media_url': 'http://pbs.example.com/a.jpg'}],
+                       })
+    french = make_tweet(105, bob, "J'adore la soupe", lang='fr')
+    not_a_tweet = {'delete': {'status': {'id': 100}}}
+
+    lines = [original, retweet, reply, unknown_reply, photo, french, not_a_tweet, reply]
+    return [json.dumps(line) for line in lines]
+
+
+def snapshot(dataset):
+    """Describe the imported content using natural keys only."""
+    def name_of(obj, field):
+        return getattr(obj, field) if obj is not None else None
+
+    messages = []
+    for msg in dataset.message_set.all():
+        messages.append((
+            msg.original_id, msg.text, msg.time, msg.sentiment,
+            name_of(msg.language, 'code'), name_of(msg.timezone, 'name'), name_of(msg.type, 'name'),
+            name_of(msg.sender, 'original_id'),
+            msg.replied_to_count, msg.shared_count,
+            msg.rendered_html, msg.rendered_html_version, msg.timestamp,
+            [getattr(msg, get_time_bucket_field(bin_size)) for bin_size in TIME_BUCKET_SIZES],
+            msg.contains_hashtag, msg.contains_url, msg.contains_media, msg.contains_mention,
+            sorted(h.text for h in msg.hashtags.all()),
+            sorted((u.full_url, u.domain, u.short_url) for u in msg.urls.all()),
+            sorted((m.type, m.media_url) for m in msg.media.all()),
+            sorted(p.original_id for p in msg.mentions.all()),
+        ))
+
+    people = []
+    for person in dataset.person_set.all():
+        people.append((
+            person.original_id, person.username, person.full_name, name_of(person.language, 'code'),
+            person.message_count, person.replied_to_count, person.shared_count, person.mentioned_count,
+            person.friend_count, person.follower_count, person.profile_image_url,
+        ))
+
+    references = (
+        sorted(Language.objects.values_list('code', flat=True)),
+        sorted(Timezone.objects.values_list('name', flat=True)),
+        sorted(MessageType.objects.values_list('name', flat=True)),
+        sorted(Hashtag.objects.values_list('text', flat=True)),
+        sorted(Url.objects.values_list('full_url', 'domain', 'short_url')),
+        sorted(Media.objects.values_list('type', 'media_url')),
+    )
+
+    return sorted(messages), sorted(people), references
 
 
 # Create your tests here.
@@ -65,4 +179,348 @@ class ImportTest(TestCase):
         self.assertEquals(len(question.dimensions.all()), 9)
 
         article = question.source
-        self.assertEquals(article.year, 2011)
\ No newline at end of file
+        self.assertEquals(article.year, 2011)
+
+
+class ImportComparisonMixin(object):
+    """Helpers for comparing the results of different import methods."""
+
+    def import_one_by_one(self, dataset, lines):
+        for line in lines:
+            create_an_instance_from_json(line, dataset)
+
+    def import_in_bulk(self, dataset, lines, chunk_size=100):
+        importer = BulkImporter(dataset)
+        for start in range(0, len(lines), chunk_size):
+            tweets = filter(None, [parse_tweet_line(line) for line in lines[start:start + chunk_size]])
+            importer.prepare(tweets)
+            for tweet in tweets:
+                importer.import_tweet(tweet)
+            importer.flush()
+
+    def import_and_rollback(self, import_fn, lines):
+        """Import the lines and return a snapshot of the database, then undo the import."""
+        cache.clear()
+        with transaction.atomic():
+            dataset = Dataset.objects.create(name="Test Corpus", description="My Dataset")
+            import_fn(dataset, lines)
+            result = snapshot(dataset)
+            transaction.set_rollback(True)
+        cache.clear()
+        return result
+
+
+class BulkImportTest(ImportComparisonMixin, TestCase):
+
+    def test_bulk_matches_one_by_one(self):
+        """Bulk importing produces the same data as importing one tweet at a time."""
+        lines = sample_corpus()
+        expected = self.import_and_rollback(self.import_one_by_one, lines)
+        actual = self.import_and_rollback(self.import_in_bulk, lines)
+
+        self.assertEquals(len(expected[0]), 6)
+        self.assertEquals(actual, expected)
+
+    def test_bulk_matches_one_by_one_across_chunks(self):
+        """Tweets in later chunks update the messages and people from earlier chunks."""
+        lines = sample_corpus()
+        expected = self.import_and_rollback(self.import_one_by_one, lines)
+        actual = self.import_and_rollback(lambda dataset, lines: self.import_in_bulk(dataset, lines, chunk_size=2),
+                                          lines)
+
+        self.assertEquals(actual, expected)
+
+    def test_bulk_adds_to_existing_data(self):
+        """Bulk importing on top of existing messages matches the one-by-one importer."""
+        lines = sample_corpus()
+
+        def import_twice(import_fn):
+            def fn(dataset, lines):
+                self.import_one_by_one(dataset, lines[:3])
+                import_fn(dataset, lines)
+            return fn
+
+        expected = self.import_and_rollback(import_twice(self.import_one_by_one), lines)
+        actual = self.import_and_rollback(import_twice(self.import_in_bulk), lines)
+
+        self.assertEquals(actual, expected)
+
+
+class CountBufferTest(ImportComparisonMixin, TestCase):
+
+    def viral_corpus(self, retweets=30):
+        alice = make_user(1, 'alice')
+        original = make_tweet(100, alice, "Soup is good")
+        lines = [json.dumps(original)]
+        for i in range(retweets):
+            fan = make_user(10 + i, 'fan%d' % i)
+            lines.append(json.dumps(make_tweet(1000 + i, fan, "RT @alice: Soup is good", retweeted_status=original)))
+        return lines
+
+    def test_counts_are_summed(self):
+        """Retweets of the same tweet are counted in one update per row."""
+        dataset = Dataset.objects.create(name="Test Corpus", description="My Dataset")
+        counters = CountBuffer()
+        for line in self.viral_corpus():
+            create_an_instance_from_json(line, dataset, counters)
+
+        # The original message and its sender
+        self.assertEquals(len(counters.increments), 2)
+        with self.assertNumQueries(2):
+            counters.flush()
+
+        self.assertEquals(dataset.message_set.get(original_id=100).shared_count, 30)
+        self.assertEquals(dataset.person_set.get(original_id=1).shared_count, 30)
+        self.assertEquals(len(counters.increments), 0)
+
+    def test_save_keeps_stored_counts(self):
+        """Saving a row does not overwrite counts written by someone else."""
+        dataset = Dataset.objects.create(name="Test Corpus", description="My Dataset")
+        message = Message.objects.create(dataset=dataset, original_id=100)
+
+        Message.objects.filter(pk=message.pk).update(shared_count=5)
+        message.text = "Soup is good"
+        CountBuffer().save(message)
+
+        message = Message.objects.get(pk=message.pk)
+        self.assertEquals(message.shared_count, 5)
+        self.assertEquals(message.text, "Soup is good")
+
+    def test_bulk_matches_one_by_one_for_viral_tweet(self):
+        """Bulk importing counts retweets of existing messages correctly."""
+        lines = self.viral_corpus()
+
+        def import_split(import_fn):
+            def fn(dataset, lines):
+                self.import_one_by_one(dataset, lines[:5])
+                import_fn(dataset, lines[5:])
+            return fn
+
+        expected = self.import_and_rollback(import_split(self.import_one_by_one), lines)
+        actual = self.import_and_rollback(import_split(self.import_in_bulk), lines)
+
+        self.assertEquals(actual, expected)
+        self.assertEquals(expected[0][0][9], 30)
+
+
+class LRUCacheTest(TestCase):
+
+    def test_least_recently_used_is_forgotten(self):
+        cache = LRUCache(max_size=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEquals(cache.get('a'), 1)
+        cache.put('c', 3)
+
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertEquals(len(cache), 2)
+        self.assertEquals(cache.get('b'), None)
+        self.assertEquals((cache.hits, cache.misses), (1, 1))
+
+    def test_import_caches_only_when_enabled(self):
+        first = get_or_create_hashtag({'text': 'soup'})
+        with self.assertNumQueries(1):
+            second = get_or_create_hashtag({'text': 'soup'})
+        self.assertEquals(first, second)
+
+        import_caches.enable()
+        try:
+            get_or_create_hashtag({'text': 'soup'})
+            with self.assertNumQueries(0):
+                get_or_create_hashtag({'text': 'soup'})
+        finally:
+            import_caches.disable()
+
+
+class ImporterTest(ImportComparisonMixin, TestCase):
+
+    def corpus_file(self, lines):
+        return "\n".join(lines + ["", "{not json"])
+
+    def run_importer(self, dataset, lines, **kwargs):
+        fp = StringIO(self.corpus_file(lines))
+        importer = Importer(fp, dataset, **kwargs)
+        with mock.patch('sys.stdout', new_callable=StringIO) as stdout, mock.patch('sys.stderr'):
+            importer.run()
+        importer.output = stdout.getvalue()
+        return importer
+
+    def test_resume_after_interruption(self):
+        """An interrupted import continues from the last committed group."""
+        lines = sample_corpus()
+        expected = self.import_and_rollback(self.import_one_by_one, lines)
+
+        checkpoints = []
+
+        def import_interrupted(dataset, lines):
+            checkpoint = ImportCheckpoint.objects.create(dataset=dataset, path='/tmp/corpus.json')
+            with mock.patch.object(Importer, '_group_done', side_effect=[None, KeyboardInterrupt]):
+                self.assertRaises(KeyboardInterrupt, self.run_importer, dataset, lines,
+                                  commit_every=2, checkpoint=checkpoint)
+
+            checkpoint = ImportCheckpoint.objects.get(pk=checkpoint.pk)
+            checkpoints.append((checkpoint.line, checkpoint.offset, checkpoint.finished))
+            self.run_importer(dataset, lines, commit_every=2, checkpoint=checkpoint)
+            checkpoints.append(ImportCheckpoint.objects.get(pk=checkpoint.pk))
+
+        actual = self.import_and_rollback(import_interrupted, lines)
+        self.assertEquals(actual, expected)
+
+        self.assertEquals(checkpoints[0], (4, len("\n".join(lines[:4])) + 1, False))
+        checkpoint = checkpoints[1]
+        self.assertEquals(checkpoint.line, len(lines) + 2)
+        self.assertEquals(checkpoint.offset, len(self.corpus_file(lines)))
+        self.assertEquals((checkpoint.imported, checkpoint.not_tweets, checkpoint.errors), (6, 2, 1))
+        self.assertTrue(checkpoint.finished)
+
+    def test_byte_ranges(self):
+        """Importing a file in two byte ranges imports every line once."""
+        lines = sample_corpus()
+        expected = self.import_and_rollback(self.import_one_by_one, lines)
+
+        # Split in the middle of a line, and exactly at the start of a line
+        for split in (len(self.corpus_file(lines)) / 2, len("\n".join(lines[:3])) + 1):
+            importers = []
+
+            def import_ranges(dataset, lines):
+                for start, end in ((0, split), (split, None)):
+                    checkpoint = ImportCheckpoint.objects.create(dataset=dataset, path='/tmp/corpus.json',
+                                                                 start_offset=start, offset=start, end_offset=end)
+                    importers.append(self.run_importer(dataset, lines, bulk=True, checkpoint=checkpoint))
+
+            actual = self.import_and_rollback(import_ranges, lines)
+            self.assertEquals(actual, expected)
+            self.assertEquals(sum(importer.line for importer in importers), len(lines) + 2)
+
+    def test_lookup_caches(self):
+        """The serial importer caches lookups without changing the results."""
+        lines = sample_corpus()
+        expected = self.import_and_rollback(self.import_one_by_one, lines)
+
+        importers = []
+
+        def import_serial(dataset, lines):
+            importers.append(self.run_importer(dataset, lines))
+
+        actual = self.import_and_rollback(import_serial, lines)
+        self.assertEquals(actual, expected)
+
+        # One miss for each message type and person
+        self.assertIn("messagetype 7/3", importers[0].output)
+        self.assertIn("person 11/4", importers[0].output)
+        self.assertFalse(import_caches.enabled)
+
+    def test_progress(self):
+        """The importer prints its progress every print_every lines."""
+        lines = sample_corpus()
+        importers = []
+
+        def import_serial(dataset, lines):
+            with mock.patch.object(Importer, 'print_every', 2):
+                importers.append(self.run_importer(dataset, lines, commit_every=2))
+
+        self.import_and_rollback(import_serial, lines)
+        self.assertIn("Reached line 2.", importers[0].output)
+        self.assertIn("Reached line 4.", importers[0].output)
+
+    def test_parallel_parsing(self):
+        """Parsing in worker processes gives the same results as the serial importer."""
+        lines = sample_corpus()
+        expected = self.import_and_rollback(self.import_one_by_one, lines)
+
+        importers = []
+
+        def import_parallel(dataset, lines):
+            importers.append(self.run_importer(dataset, lines, workers=2, commit_every=3))
+
+        actual = self.import_and_rollback(import_parallel, lines)
+        self.assertEquals(actual, expected)
+
+        importer = importers[0]
+        self.assertEquals(importer.line, len(lines) + 2)
+        self.assertEquals(importer.imported, 6)
+        self.assertEquals(importer.not_tweets, 2)
+        self.assertEquals(importer.errors, 1)
+
+
+class ReadersTest(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.content = "\n".join(sample_corpus()) + "\n"
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, content=None):
+        filename = os.path.join(self.dir, name)
+        content = self.content if content is None else content
+        if name.endswith('.gz'):
+            fp = gzip.open(filename, 'wb')
+        elif name.endswith('.bz2'):
+            fp = bz2.BZ2File(filename, 'wb')
+        else:
+            fp = open(filename, 'wb')
+        with fp:
+            fp.write(content)
+        return filename
+
+    def read_all(self, paths):
+        return [(os.path.relpath(f.name, self.dir), f.format, f.fp.read())
+                for f in readers.iter_corpus_files(paths)]
+
+    def test_compressed_files(self):
+        """Compressed files are read the same as plain files."""
+        paths = [self.write('a.json'), self.write('b.json.gz'), self.write('c.json.bz2')]
+        self.assertEquals(self.read_all(paths), [
+            ('a.json', 'json', self.content),
+            ('b.json.gz', 'json.gz', self.content),
+            ('c.json.bz2', 'json.bz2', self.content),
+        ])
+
+    def test_tar_archives(self):
+        """Files inside tar archives are read in order, and may be compressed themselves."""
+        members = [self.write('hour1.json'), self.write('hour2.json.gz')]
+        archive = os.path.join(self.dir, 'day.tar.gz')
+        with tarfile.open(archive, 'w:gz') as tar:
+            for member in members:
+                tar.add(member, arcname=os.path.basename(member))
+
+        self.assertEquals(self.read_all([archive]), [
+            ('day.tar.gz/hour1.json', 'tar.gz', self.content),
+            ('day.tar.gz/hour2.json.gz', 'tar.gz', self.content),
+        ])
+
+    def test_concatenated_streams_and_seeking(self):
+        """Concatenated gzip files are read as one, and can be skipped forwards."""
+        first = self.write('first.json.gz')
+        with open(first, 'rb') as fp:
+            compressed = fp.read()
+        path = os.path.join(self.dir, 'double.json.gz')
+        with open(path, 'wb') as fp:
+            fp.write(compressed * 2)
+
+        fp = readers.open_stream(io.open(path, 'rb', buffering=0), 'gz')
+        fp.seek(len(self.content) + 10)
+        self.assertEquals(fp.read(), self.content[10:])
+        self.assertRaises(IOError, fp.seek, 0)
+
+    def test_expand_paths(self):
+        """Directories and globs are expanded in order, skipping hidden files."""
+        self.write('b.json')
+        self.write('a.json.gz')
+        self.write('.hidden.json')
+        self.write('notes.txt')
+
+        self.assertEquals([os.path.basename(p) for p in readers.expand_paths([self.dir])],
+                          ['a.json.gz', 'b.json', 'notes.txt'])
+        self.assertEquals([os.path.basename(p) for p in readers.expand_paths([os.path.join(self.dir, '*.json*')])],
+                          ['a.json.gz', 'b.json'])
+        self.assertRaises(ValueError, readers.expand_paths, [os.path.join(self.dir, 'missing*.json')])
+
+    def test_detect_format(self):
+        self.assertEquals(readers.detect_format('tweets.json'), (None, None))
+        self.assertEquals(readers.detect_format('tweets.JSON.XZ'), (None, 'xz'))
+        self.assertEquals(readers.detect_format('tweets.tar.bz2'), ('tar', 'bz2'))
+        self.assertEquals(readers.detect_format('tweets.tgz'), ('tar', 'gz'))
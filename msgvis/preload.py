@@ -0,0 +1,95 @@
+"""
+Load read-only dataset structures once, before gunicorn forks its workers.
+
+Each gunicorn worker is a separate process, so anything cached in memory
+(columnar snapshots, bitmap indexes, completion indexes, gensim dictionaries) would be built
+again by every worker, and again after every restart. With ``preload_app``,
+gunicorn imports the application in the master process, and the
+``when_ready`` hook in ``gunicorn.conf.py`` calls :func:`preload_datasets`
+there. The workers forked afterwards share the loaded pages copy-on-write.
+NumPy arrays and memory-mapped snapshot files keep their data out of
+the reference-counted objects, so those pages stay shared.
+
+.. code-block:: python
+
+    from msgvis import preload
+    preload.preload_datasets()          # every dataset
+    preload.preload_datasets([1, 3])    # some datasets
+    print preload.memory_usage()        # this process's shared and private memory
+"""
+import logging
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+
+def preload_dataset(dataset):
+    """Load the snapshot, bitmap indexes, completion index and dictionary of a dataset into this process."""
+    from msgvis.apps.datatable import bitmap_index, columnar
+    from msgvis.apps.enhance import completion
+
+    columnar.preload(dataset)
+    bitmap_index.preload(dataset)
+    completion.preload(dataset)
+
+    dictionary = dataset.get_dictionary()
+    if dictionary is not None:
+        dictionary.gensim_dictionary
+
+
+def preload_datasets(dataset_ids=None):
+    """
+    Load the structures of some datasets (by default ``settings.PRELOAD_DATASETS``,
+    or all of them if that is None) into this process.
+    The database connections are closed afterwards, so forked processes do not share them.
+    """
+    from msgvis.apps.corpus.models import Dataset
+
+    if dataset_ids is None:
+        dataset_ids = getattr(settings, 'PRELOAD_DATASETS', None)
+
+    datasets = Dataset.objects.all()
+    if dataset_ids is not None:
+        datasets = datasets.filter(id__in=dataset_ids)
+
+    try:
+        for dataset in datasets:
+            logger.info("Preloading dataset %d" % dataset.id)
+            preload_dataset(dataset)
+    finally:
+        for connection in connections.all():
+            connection.close()
+
+
+def memory_usage():
+    """
+    The memory of this process in bytes, as a dict with ``rss``, ``shared`` and ``private`` keys,
+    read from ``/proc/self/smaps``. Returns None where that is not available.
+    Private memory is the overhead of a worker: the pages it does not share with the others.
+    """
+    usage = {'rss': 0, 'shared': 0, 'private': 0}
+    fields = {
+        'Rss:': 'rss',
+        'Shared_Clean:': 'shared',
+        'Shared_Dirty:': 'shared',
+        'Private_Clean:': 'private',
+        'Private_Dirty:': 'private',
+    }
+    try:
+        with open('/proc/self/smaps') as smaps:
+            for line in smaps:
+                parts = line.split()
+                if parts and parts[0] in fields:
+                    usage[fields[parts[0]]] += int(parts[1]) * 1024
+    except IOError:
+        return None
+    return usage
+
+
+def format_memory_usage(usage):
+    if usage is None:
+        return "memory usage unavailable"
+    return "rss %.1f MB, shared %.1f MB, private %.1f MB" % (
+        usage['rss'] / 1048576.0, usage['shared'] / 1048576.0, usage['private'] / 1048576.0)
@@ -434,3 +434,23 @@ TWITTER_ACCESS_TOKEN_SECRET = get_env_setting('TWITTER_ACCESS_TOKEN_SECRET', '')
 QUANTITATIVE_DIMENSION_BINS = 50
 ######### END DIMENSION SETTINGS
 
+
+######### DATA TABLE CACHE SETTINGS
+# Data table results are cached per dataset version, see msgvis.apps.datatable.cache
+DATATABLE_CACHE_ENABLED = True
+DATATABLE_CACHE_TIMEOUT = 24 * 60 * 60
+######### END DATA TABLE CACHE SETTINGS
+
+
+######### COLUMNAR SNAPSHOT SETTINGS
+# Where the columns of datasets are saved, see msgvis.apps.datatable.columnar
+COLUMNAR_SNAPSHOT_ROOT = get_env_setting('COLUMNAR_SNAPSHOT_ROOT', PROJECT_ROOT / 'snapshots')
+######### END COLUMNAR SNAPSHOT SETTINGS
+
+
+######### PRELOAD SETTINGS
+# Datasets loaded before gunicorn forks its workers, as comma separated ids (all by default).
+# See msgvis.preload
+PRELOAD_DATASETS = [int(dataset_id) for dataset_id in get_env_setting('PRELOAD_DATASETS', '').split(',')
+                    if dataset_id.strip()] or None
+######### END PRELOAD SETTINGS
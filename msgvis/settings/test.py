@@ -15,3 +15,8 @@ DATABASES = {
 PASSWORD_HASHERS = (
     'django.contrib.auth.hashers.MD5PasswordHasher',
 )
+
+########## COLUMNAR SNAPSHOTS
+# Snapshots are written to disk, outside the test database, so keep them out of the project
+import tempfile
+COLUMNAR_SNAPSHOT_ROOT = path(tempfile.mkdtemp())